@@ -0,0 +1,74 @@
+"""Add latitude/longitude to ctos
+
+Revision ID: a3f1c9d2e7b4
+Revises: cb2214986b53
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3f1c9d2e7b4'
+down_revision: Union[str, Sequence[str], None] = 'cb2214986b53'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _parse_gps(gps_str):
+    try:
+        parts = (gps_str or "").split(",")
+        if len(parts) == 2:
+            return float(parts[0].strip()), float(parts[1].strip())
+    except (ValueError, TypeError):
+        pass
+    return None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    if 'ctos' not in sa.inspect(bind).get_table_names():
+        # Tabela ainda não criada (create_all a criará já com as colunas)
+        return
+
+    op.add_column('ctos', sa.Column('latitude', sa.Float(), nullable=True))
+    op.add_column('ctos', sa.Column('longitude', sa.Float(), nullable=True))
+    op.create_index('ix_ctos_empresa_lat_lng', 'ctos', ['empresa_id', 'latitude', 'longitude'], unique=False)
+
+    # Backfill a partir do texto "lat,lng"
+    ctos = sa.table(
+        'ctos',
+        sa.column('id', sa.Integer),
+        sa.column('coordenadas_gps', sa.String),
+        sa.column('latitude', sa.Float),
+        sa.column('longitude', sa.Float),
+    )
+    rows = bind.execute(
+        sa.select(ctos.c.id, ctos.c.coordenadas_gps).where(ctos.c.coordenadas_gps.isnot(None))
+    ).fetchall()
+    updates = []
+    for cto_id, gps in rows:
+        coords = _parse_gps(gps)
+        if coords:
+            updates.append({"b_id": cto_id, "b_lat": coords[0], "b_lng": coords[1]})
+    if updates:
+        bind.execute(
+            ctos.update().where(ctos.c.id == sa.bindparam("b_id")).values(
+                latitude=sa.bindparam("b_lat"), longitude=sa.bindparam("b_lng")
+            ),
+            updates,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    if 'ctos' not in sa.inspect(bind).get_table_names():
+        return
+    op.drop_index('ix_ctos_empresa_lat_lng', table_name='ctos')
+    op.drop_column('ctos', 'longitude')
+    op.drop_column('ctos', 'latitude')
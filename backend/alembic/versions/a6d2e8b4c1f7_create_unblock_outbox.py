@@ -0,0 +1,53 @@
+"""Create unblock_outbox table (durable post-payment unblock queue)
+
+Revision ID: a6d2e8b4c1f7
+Revises: f1c7d3a9b2e6
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a6d2e8b4c1f7'
+down_revision: Union[str, Sequence[str], None] = 'f1c7d3a9b2e6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'unblock_outbox' in inspector.get_table_names():
+        return
+    op.create_table(
+        'unblock_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('contrato_id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False, server_default='pending'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+        sa.Column('locked_at', sa.DateTime(), nullable=True),
+        sa.Column('claim_token', sa.String(length=36), nullable=True),
+        sa.Column('last_error', sa.String(length=500), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('processed_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['contrato_id'], ['servicos_contratados.id']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(op.f('ix_unblock_outbox_id'), 'unblock_outbox', ['id'], unique=False)
+    op.create_index(op.f('ix_unblock_outbox_contrato_id'), 'unblock_outbox', ['contrato_id'], unique=False)
+    op.create_index(op.f('ix_unblock_outbox_claim_token'), 'unblock_outbox', ['claim_token'], unique=False)
+    op.create_index('ix_unblock_outbox_status_next_attempt', 'unblock_outbox', ['status', 'next_attempt_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'unblock_outbox' in inspector.get_table_names():
+        op.drop_table('unblock_outbox')
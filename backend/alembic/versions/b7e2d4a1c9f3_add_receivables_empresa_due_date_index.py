@@ -0,0 +1,40 @@
+"""Add (empresa_id, due_date) index to receivables
+
+Revision ID: b7e2d4a1c9f3
+Revises: a3f1c9d2e7b4
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e2d4a1c9f3'
+down_revision: Union[str, Sequence[str], None] = 'a3f1c9d2e7b4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _has_index(bind, name):
+    return any(ix['name'] == name for ix in sa.inspect(bind).get_indexes('receivables'))
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    if 'receivables' not in sa.inspect(bind).get_table_names():
+        return
+    if not _has_index(bind, 'ix_receivables_empresa_due_date'):
+        op.create_index('ix_receivables_empresa_due_date', 'receivables', ['empresa_id', 'due_date'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    if 'receivables' not in sa.inspect(bind).get_table_names():
+        return
+    if _has_index(bind, 'ix_receivables_empresa_due_date'):
+        op.drop_index('ix_receivables_empresa_due_date', table_name='receivables')
@@ -0,0 +1,40 @@
+"""Add (empresa_id, status, paid_at) index to receivables
+
+Revision ID: c4a9e1f7d2b8
+Revises: b7e2d4a1c9f3
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4a9e1f7d2b8'
+down_revision: Union[str, Sequence[str], None] = 'b7e2d4a1c9f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _has_index(bind, name):
+    return any(ix['name'] == name for ix in sa.inspect(bind).get_indexes('receivables'))
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    if 'receivables' not in sa.inspect(bind).get_table_names():
+        return
+    if not _has_index(bind, 'ix_receivables_empresa_status_paid_at'):
+        op.create_index('ix_receivables_empresa_status_paid_at', 'receivables', ['empresa_id', 'status', 'paid_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    if 'receivables' not in sa.inspect(bind).get_table_names():
+        return
+    if _has_index(bind, 'ix_receivables_empresa_status_paid_at'):
+        op.drop_index('ix_receivables_empresa_status_paid_at', table_name='receivables')
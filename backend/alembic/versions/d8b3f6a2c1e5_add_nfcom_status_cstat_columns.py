@@ -0,0 +1,67 @@
+"""Add status/cstat columns and composite indexes to nfcom
+
+Revision ID: d8b3f6a2c1e5
+Revises: c4a9e1f7d2b8
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd8b3f6a2c1e5'
+down_revision: Union[str, Sequence[str], None] = 'c4a9e1f7d2b8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+_INDEXES = {
+    'ix_nfcom_empresa_status_data_emissao': ['empresa_id', 'status', 'data_emissao'],
+    'ix_nfcom_empresa_serie_numero': ['empresa_id', 'serie', 'numero_nf'],
+}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'nfcom' not in inspector.get_table_names():
+        return
+    columns = {c['name'] for c in inspector.get_columns('nfcom')}
+    if 'status' not in columns:
+        op.add_column('nfcom', sa.Column('status', sa.String(length=20), nullable=False, server_default='pendente'))
+    if 'cstat' not in columns:
+        op.add_column('nfcom', sa.Column('cstat', sa.String(length=3), nullable=True))
+
+    # Backfill com a regra usada antes na leitura das notas:
+    # protocolo -> emitida; retorno de evento cStat=134/135/136 -> cancelada
+    op.execute("UPDATE nfcom SET status = 'emitida', cstat = '100' WHERE protocolo_autorizacao IS NOT NULL")
+    for code in ('134', '136', '135'):
+        op.execute(
+            f"UPDATE nfcom SET status = 'cancelada', cstat = '{code}' "
+            f"WHERE informacoes_adicionais LIKE '%cStat={code}%'"
+        )
+
+    existing = {ix['name'] for ix in inspector.get_indexes('nfcom')}
+    for name, cols in _INDEXES.items():
+        if name not in existing:
+            op.create_index(name, 'nfcom', cols, unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'nfcom' not in inspector.get_table_names():
+        return
+    existing = {ix['name'] for ix in inspector.get_indexes('nfcom')}
+    for name in _INDEXES:
+        if name in existing:
+            op.drop_index(name, table_name='nfcom')
+    columns = {c['name'] for c in inspector.get_columns('nfcom')}
+    if 'cstat' in columns:
+        op.drop_column('nfcom', 'cstat')
+    if 'status' in columns:
+        op.drop_column('nfcom', 'status')
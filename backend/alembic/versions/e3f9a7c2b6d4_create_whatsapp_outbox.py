@@ -0,0 +1,57 @@
+"""Create whatsapp_outbox table (durable WhatsApp outbound queue)
+
+Revision ID: e3f9a7c2b6d4
+Revises: d8b3f6a2c1e5
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3f9a7c2b6d4'
+down_revision: Union[str, Sequence[str], None] = 'd8b3f6a2c1e5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'whatsapp_outbox' in inspector.get_table_names():
+        return
+    op.create_table(
+        'whatsapp_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('empresa_id', sa.Integer(), nullable=True),
+        sa.Column('instance', sa.String(length=100), nullable=False),
+        sa.Column('to_phone', sa.String(length=30), nullable=False),
+        sa.Column('message', sa.Text(), nullable=True),
+        sa.Column('is_media', sa.Boolean(), nullable=False),
+        sa.Column('file_name', sa.String(length=255), nullable=True),
+        sa.Column('file_data', sa.Text(length=16777215), nullable=True),
+        sa.Column('status', sa.String(length=20), nullable=False, server_default='pending'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+        sa.Column('locked_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.String(length=500), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['empresa_id'], ['empresas.id']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(op.f('ix_whatsapp_outbox_id'), 'whatsapp_outbox', ['id'], unique=False)
+    op.create_index(op.f('ix_whatsapp_outbox_empresa_id'), 'whatsapp_outbox', ['empresa_id'], unique=False)
+    op.create_index('ix_whatsapp_outbox_status_next_attempt', 'whatsapp_outbox', ['status', 'next_attempt_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'whatsapp_outbox' in inspector.get_table_names():
+        op.drop_table('whatsapp_outbox')
@@ -0,0 +1,46 @@
+"""Add keyset and full-text indexes to tickets
+
+Revision ID: f1c7d3a9b2e6
+Revises: e3f9a7c2b6d4
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1c7d3a9b2e6'
+down_revision: Union[str, Sequence[str], None] = 'e3f9a7c2b6d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'tickets' not in inspector.get_table_names():
+        return
+    existing = {ix['name'] for ix in inspector.get_indexes('tickets')}
+    if 'ix_tickets_empresa_created_id' not in existing:
+        op.create_index('ix_tickets_empresa_created_id', 'tickets', ['empresa_id', 'created_at', 'id'], unique=False)
+    if 'ix_tickets_titulo_descricao_ft' not in existing and bind.dialect.name == 'mysql':
+        op.create_index(
+            'ix_tickets_titulo_descricao_ft', 'tickets', ['titulo', 'descricao'],
+            unique=False, mysql_prefix='FULLTEXT',
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'tickets' not in inspector.get_table_names():
+        return
+    existing = {ix['name'] for ix in inspector.get_indexes('tickets')}
+    for name in ('ix_tickets_titulo_descricao_ft', 'ix_tickets_empresa_created_id'):
+        if name in existing:
+            op.drop_index(name, table_name='tickets')
@@ -6,8 +6,8 @@ from sqlalchemy.orm import Session
 
 from app.core.database import get_db
 from app.routes.auth import get_current_active_user, get_current_user_optional
-from app.models.access_control import role_permission_association, user_role_association, Permission, Role
 from app.models.models import Usuario
+from app.services import access_cache
 
 
 def permission_checker(permission_name: str) -> Callable:
@@ -17,6 +17,7 @@ def permission_checker(permission_name: str) -> Callable:
     - Superusers sempre têm todas as permissões.
     - Procurar roles atribuídas ao usuário (user_role_association) que contenham a permissão.
     - As atribuições podem ser globais (empresa_id NULL) ou associadas à empresa ativa do usuário.
+    - Licença, admin e permissões vêm do access_cache (sem consultas enquanto válidos).
     """
     def _checker(
         db: Session = Depends(get_db),
@@ -47,29 +48,12 @@ def permission_checker(permission_name: str) -> Callable:
             return True
 
         # Admin da Empresa bypass: se o usuário for admin da empresa ativa, libera tudo
-        if empresa_id:
-            from app.models.models import UsuarioEmpresa
-            is_admin_assoc = db.query(UsuarioEmpresa).filter(
-                UsuarioEmpresa.usuario_id == current_user.id,
-                UsuarioEmpresa.empresa_id == empresa_id,
-                UsuarioEmpresa.is_admin == True
-            ).first()
-            if is_admin_assoc:
-                return True
-
-        # Monta query: existe role para este usuário com a permissão desejada?
-        q = db.query(Role).join(user_role_association, Role.id == user_role_association.c.role_id)
-        q = q.join(role_permission_association, Role.id == role_permission_association.c.role_id)
-        q = q.join(Permission, Permission.id == role_permission_association.c.permission_id)
-        q = q.filter(user_role_association.c.user_id == current_user.id)
-        q = q.filter(Permission.name == permission_name)
-
-        # Permite roles globais (empresa_id IS NULL) ou com empresa específica
-        if empresa_id is not None:
-            q = q.filter((user_role_association.c.empresa_id == None) | (user_role_association.c.empresa_id == empresa_id))
+        membership = access_cache.get_membership(db, current_user.id, empresa_id)
+        if empresa_id and membership.is_admin:
+            return True
 
-        has = db.query(q.exists()).scalar()
-        if not has:
+        # Roles globais (empresa_id NULL) ou da empresa ativa com a permissão desejada
+        if permission_name not in membership.permissions:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Permissão negada")
         return True
 
@@ -5,6 +5,7 @@ from app.models.models import Empresa, UsuarioEmpresa, Cliente, NFCom
 from app.models.access_control import Role
 from app.schemas.empresa import EmpresaCreate, EmpresaUpdate, UsuarioEmpresaCreate
 from app.core.security import encrypt_sensitive_data, decrypt_sensitive_data
+from app.services import nfcom_cache
 
 
 def _decrypt_sensitive_fields(empresa: Empresa) -> SimpleNamespace:
@@ -172,6 +173,8 @@ def update_empresa(db: Session, db_obj: Empresa, obj_in: EmpresaUpdate):
     db.add(db_obj)
     db.commit()
     db.refresh(db_obj)
+    if update_data.get('certificado_path') or update_data.get('certificado_senha'):
+        nfcom_cache.invalidate_certificate(db_obj.id)
     return db_obj
 
 def get_empresas_by_usuario(db: Session, usuario_id: int, skip: int = 0, limit: int = 100):
@@ -1,6 +1,7 @@
 import base64
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func, and_, or_, String, text
+from sqlalchemy import func, and_, or_, case, String, text
+from sqlalchemy.exc import IntegrityError
 from typing import Optional
 from fastapi import HTTPException, status
 import xml.etree.ElementTree as ET
@@ -22,6 +23,9 @@ from app.models import models
 from types import SimpleNamespace
 from app.schemas import nfcom as nfcom_schema
 from app.crud import crud_servico, crud_empresa
+from app.services.nfcom_transmission import SefazSession, NFCOM_SEFAZ_MAX_IN_FLIGHT
+from app.services import nfcom_cache, nfcom_artifacts
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 
 # ==============================================================================
@@ -44,6 +48,14 @@ from app.crud import crud_servico, crud_empresa
 # DEPRECATED: Use settings.NFCOM_AMBIENTE ao invés desta constante
 # AMBIENTE_PRODUCAO = False  # Removido - use .env
 
+# Dump do template de assinatura, do envelope SOAP e da resposta da SEFAZ a
+# cada nota (diagnóstico de rejeições)
+NFCOM_SIGN_DEBUG = os.environ.get("NFCOM_SIGN_DEBUG", "").lower() in ("1", "true", "yes")
+
+# Emissão em massa: notas por commit e tamanho das listas IN do pré-carregamento
+NFCOM_BULK_CHUNK_SIZE = int(os.environ.get("NFCOM_BULK_CHUNK_SIZE", "100"))
+NFCOM_BULK_IN_CHUNK = 1000
+
 def get_qrcode_url_base(uf_code: str, ambiente: Optional[str] = None) -> str:
     """
     Retorna a URL base do QR Code para a UF especificada.
@@ -128,20 +140,7 @@ def get_nfcom(db: Session, nfcom_id: int, empresa_id: int = None):
     nfcom = q.first()
     if nfcom and nfcom.xml_gerado:
         nfcom.xml_url = f"/empresas/{nfcom.empresa_id}/nfcom/{nfcom.id}/xml"
-    # Define status dinamicamente: marca como 'cancelada' se houver retorno de evento com cStat=134/135/136
-    try:
-        nfcom_status = None
-        if nfcom:
-            info = (nfcom.informacoes_adicionais or '')
-            # cStat 135=evento vinculado, 136=vinculação prejudicada, 134=NFCom em situação diferente
-            if any(code in info for code in ['cStat=135', 'cStat=136', 'cStat=134']):
-                nfcom_status = 'cancelada'
-            else:
-                nfcom_status = 'emitida' if nfcom.protocolo_autorizacao else 'pendente'
-            # Atribui atributo dinâmico para consumo no frontend
-            setattr(nfcom, 'status', nfcom_status)
-    except Exception:
-        pass
+    # status ('pendente'/'emitida'/'cancelada') é coluna, gravada no retorno da autorização e do cancelamento
     return nfcom
 
 def get_nfcoms_by_empresa(
@@ -206,19 +205,13 @@ def get_nfcoms_by_empresa(
             pass  # Ignora filtro inválido
     
     if status:
+        # Coluna status indexada com (empresa_id, status, data_emissao)
         if status == 'authorized':
-            base_query = base_query.filter(models.NFCom.protocolo_autorizacao.isnot(None))
+            base_query = base_query.filter(models.NFCom.status.in_(('emitida', 'cancelada')))
         elif status == 'pending':
-            base_query = base_query.filter(models.NFCom.protocolo_autorizacao.is_(None))
+            base_query = base_query.filter(models.NFCom.status == 'pendente')
         elif status == 'cancelled' or status == 'canceled':
-            # Filtra notas cuja informacoes_adicionais indica evento de cancelamento (cStat 134/135/136)
-            base_query = base_query.filter(
-                or_(
-                    models.NFCom.informacoes_adicionais.ilike('%cStat=134%'),
-                    models.NFCom.informacoes_adicionais.ilike('%cStat=135%'),
-                    models.NFCom.informacoes_adicionais.ilike('%cStat=136%')
-                )
-            )
+            base_query = base_query.filter(models.NFCom.status == 'cancelada')
     
     # Verificar e corrigir valores se necessário
     if min_value is not None and max_value is not None:
@@ -231,22 +224,20 @@ def get_nfcoms_by_empresa(
     if max_value is not None:
         base_query = base_query.filter(models.NFCom.valor_total <= max_value)
     
-    # 1. Total de registros (após filtros)
-    total = base_query.count()
-    
-    # 2. Soma do valor total (após filtros)
-    total_geral_valor = base_query.with_entities(func.sum(models.NFCom.valor_total)).scalar() or 0.0
-    
-    # 3. Contagens por status (após filtros)
-    total_autorizadas = base_query.filter(models.NFCom.protocolo_autorizacao.isnot(None)).count()
-    total_pendentes = base_query.filter(models.NFCom.protocolo_autorizacao.is_(None)).count()
-    total_canceladas = base_query.filter(
-        or_(
-            models.NFCom.informacoes_adicionais.like('%cStat=134%'),
-            models.NFCom.informacoes_adicionais.like('%cStat=135%'),
-            models.NFCom.informacoes_adicionais.like('%cStat=136%')
-        )
-    ).count()
+    # 1-3. Total de registros, soma do valor e contagens por status (após filtros), numa consulta
+    def _count_if(cond):
+        return func.coalesce(func.sum(case((cond, 1), else_=0)), 0)
+
+    totals = base_query.with_entities(
+        func.count(models.NFCom.id),
+        func.sum(models.NFCom.valor_total),
+        _count_if(models.NFCom.status.in_(('emitida', 'cancelada'))),
+        _count_if(models.NFCom.status == 'pendente'),
+        _count_if(models.NFCom.status == 'cancelada'),
+    ).one()
+    total = totals[0]
+    total_geral_valor = totals[1] or 0.0
+    total_autorizadas, total_pendentes, total_canceladas = (int(v) for v in totals[2:])
     
     # 4. Registros paginados
     nfcoms = base_query.order_by(models.NFCom.numero_nf.desc()).offset(skip).limit(limit).options(
@@ -259,16 +250,6 @@ def get_nfcoms_by_empresa(
     for nfcom in nfcoms:
         if nfcom.xml_gerado:
             nfcom.xml_url = f"/empresas/{nfcom.empresa_id}/nfcom/{nfcom.id}/xml"
-        # Atribui status dinâmico: 'cancelada' quando retorno de evento contém cStat=134/135/136
-        try:
-            info = (nfcom.informacoes_adicionais or '')
-            # cStat 135=evento vinculado, 136=vinculação prejudicada, 134=NFCom em situação diferente
-            if any(code in info for code in ['cStat=135', 'cStat=136', 'cStat=134']):
-                setattr(nfcom, 'status', 'cancelada')
-            else:
-                setattr(nfcom, 'status', 'emitida' if nfcom.protocolo_autorizacao else 'pendente')
-        except Exception:
-            pass
 
     return {
         "total": total, 
@@ -279,13 +260,72 @@ def get_nfcoms_by_empresa(
         "total_canceladas": total_canceladas
     }
 
-def get_next_numero_nf(db: Session, empresa_id: int, serie: int = 1) -> int:
-    """Calcula o próximo número sequencial para a NFCom."""
+def _max_numero_nf(db: Session, empresa_id: int, serie: int) -> int:
     last_nf = db.query(func.max(models.NFCom.numero_nf)).filter(
         models.NFCom.empresa_id == empresa_id,
         models.NFCom.serie == serie
     ).scalar()
-    return (last_nf or 0) + 1
+    return last_nf or 0
+
+
+def get_next_numero_nf(db: Session, empresa_id: int, serie: int = 1) -> int:
+    """Próximo número sequencial da NFCom (apenas consulta; para emitir use reserve_numeros_nf)."""
+    ultimo = db.query(models.NFComNumeracao.ultimo_numero).filter(
+        models.NFComNumeracao.empresa_id == empresa_id,
+        models.NFComNumeracao.serie == serie
+    ).scalar()
+    if ultimo is None:
+        ultimo = _max_numero_nf(db, empresa_id, serie)
+    return ultimo + 1
+
+
+def reserve_numeros_nf(db: Session, empresa_id: int, serie: int = 1, quantidade: int = 1) -> int:
+    """Reserva `quantidade` números consecutivos e retorna o primeiro.
+
+    A linha de nfcom_numeracao da empresa/série fica travada até o commit
+    (ou rollback, que devolve a faixa) da transação corrente. Na primeira
+    reserva a sequência é semeada com MAX(numero_nf) das notas existentes.
+    """
+    if quantidade < 1:
+        raise ValueError("quantidade deve ser >= 1")
+
+    def _locked_row():
+        return db.query(models.NFComNumeracao).filter(
+            models.NFComNumeracao.empresa_id == empresa_id,
+            models.NFComNumeracao.serie == serie
+        ).with_for_update().first()
+
+    row = _locked_row()
+    if row is None:
+        seed = _max_numero_nf(db, empresa_id, serie)
+        try:
+            with db.begin_nested():
+                db.add(models.NFComNumeracao(empresa_id=empresa_id, serie=serie, ultimo_numero=seed))
+        except IntegrityError:
+            # Outra transação criou a linha ao mesmo tempo
+            pass
+        row = _locked_row()
+
+    primeiro = row.ultimo_numero + 1
+    row.ultimo_numero += quantidade
+    db.flush()
+    return primeiro
+
+
+def release_numeros_nf(db: Session, empresa_id: int, serie: int, reservado_ate: int, usado_ate: int) -> bool:
+    """Devolve o final não usado de uma faixa reservada.
+
+    Só tem efeito se ninguém reservou números depois da faixa; caso
+    contrário os números ficam sem uso (lacuna a inutilizar na SEFAZ).
+    """
+    if usado_ate >= reservado_ate:
+        return True
+    updated = db.query(models.NFComNumeracao).filter(
+        models.NFComNumeracao.empresa_id == empresa_id,
+        models.NFComNumeracao.serie == serie,
+        models.NFComNumeracao.ultimo_numero == reservado_ate
+    ).update({models.NFComNumeracao.ultimo_numero: usado_ate}, synchronize_session=False)
+    return bool(updated)
 
 def _calculate_dv(key: str) -> str:
     """Calcula o Dígito Verificador (DV) para uma chave de 43 dígitos (Módulo 11)."""
@@ -926,6 +966,95 @@ def _make_nfcom_snapshot(nfcom, empresa_snapshot, client_snapshot=None):
     snap.valor_total = getattr(nfcom, 'valor_total', 0) or 0
     return snap
 
+def _certificado_senha_plain(empresa) -> Optional[str]:
+    """Senha do certificado em texto plano (aceita valor criptografado ou legado em texto plano)."""
+    senha = getattr(empresa, 'certificado_senha', None)
+    if not senha:
+        return ""
+    if isinstance(senha, str) and not senha.startswith('gAAAAA'):
+        # Senha em texto plano (compatibilidade com dados antigos)
+        return senha
+    # Senha criptografada (padrão)
+    try:
+        return decrypt_sensitive_data(senha)
+    except Exception as e:
+        print(f"DEBUG: ERRO ao descriptografar senha: {e}")
+        return None
+
+
+def _load_signing_material(empresa) -> nfcom_cache.SigningMaterial:
+    """Localiza e abre o PFX/P12 da empresa e extrai chave e certificados."""
+    # Resolve caminho absoluto do certificado (aceita caminho absoluto ou relativo ao CERTIFICATES_DIR)
+    cert_path_raw = empresa.certificado_path or ""
+    cert_path_norm = cert_path_raw.replace("/secure/", "").replace("\\secure\\", "")
+    cert_path_norm = cert_path_norm.lstrip('/\\')
+    if Path(cert_path_raw).is_absolute():
+        absolute_cert_path = Path(cert_path_raw)
+    else:
+        absolute_cert_path = Path(settings.CERTIFICATES_DIR) / cert_path_norm
+
+    # Verifica existência e acessibilidade; fornecer mensagens claras ao cliente
+    if not absolute_cert_path.exists():
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Arquivo de certificado não encontrado: {absolute_cert_path}")
+
+    # Se for diretório, tenta encontrar automaticamente um .pfx/.p12 dentro dele
+    try:
+        if absolute_cert_path.is_dir():
+            pfx_candidates = list(absolute_cert_path.glob('*.pfx')) + list(absolute_cert_path.glob('*.p12'))
+            if pfx_candidates:
+                absolute_cert_path = pfx_candidates[0]
+            else:
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=(
+                    f"Caminho de certificado é um diretório mas não contém arquivos .pfx/.p12: {absolute_cert_path}. "
+                    "Defina `empresa.certificado_path` apontando para o arquivo .pfx/.p12 ou coloque o arquivo no diretório especificado."))
+    except PermissionError:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Permissão negada ao acessar o diretório do certificado: {absolute_cert_path}")
+
+    # Verifica permissão de leitura
+    if not os.access(str(absolute_cert_path), os.R_OK):
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=(
+            f"Permissão negada ao acessar o certificado: {absolute_cert_path}. Verifique as permissões do arquivo e o usuário do processo."))
+
+    # Abre o arquivo PFX/P12 com tratamento de PermissionError para mensagens claras
+    try:
+        with open(absolute_cert_path, "rb") as f:
+            pfx_data = f.read()
+    except PermissionError:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=(
+            f"Permissão negada ao abrir o certificado: {absolute_cert_path}. Verifique se o processo tem permissão de leitura."))
+
+    certificado_senha = _certificado_senha_plain(empresa)
+    senha_bytes = certificado_senha.encode('utf-8') if certificado_senha else None
+    try:
+        private_key, certificate, additional_certificates = pkcs12.load_key_and_certificates(pfx_data, senha_bytes)
+    except Exception as e1:
+        print(f"DEBUG: FALHA ao carregar com senha: {e1}")
+        try:
+            private_key, certificate, additional_certificates = pkcs12.load_key_and_certificates(pfx_data, None)
+            print(f"DEBUG: Certificado carregado SEM SENHA (certificado sem proteção)")
+        except Exception as e2:
+            print(f"DEBUG: FALHA ao carregar sem senha: {e2}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Erro ao assinar NFCom: {str(e1)}"
+            )
+
+    if not private_key or not certificate:
+        raise HTTPException(status_code=500, detail="Erro ao converter PFX para PEM: PFX inválido: não foi possível extrair chave privada e/ou certificado.")
+
+    return nfcom_cache.SigningMaterial(absolute_cert_path, private_key, certificate, additional_certificates)
+
+
+def _get_signing_material(empresa) -> nfcom_cache.SigningMaterial:
+    """Material de assinatura da empresa, lido do disco apenas quando o certificado muda."""
+    return nfcom_cache.get_signing_material(
+        getattr(empresa, 'id', None),
+        getattr(empresa, 'certificado_path', None),
+        getattr(empresa, 'certificado_senha', None),
+        lambda: _load_signing_material(empresa),
+    )
+
+
 def sign_nfcom_xml(xml_string: str, empresa, chave_acesso: str = None, tipo_emissao=None) -> str:
     """
     Assina o XML da NFCom com assinatura enveloped usando cryptography.
@@ -942,83 +1071,9 @@ def sign_nfcom_xml(xml_string: str, empresa, chave_acesso: str = None, tipo_emis
         import traceback
         import re
 
-        # Resolve caminho absoluto do certificado (aceita caminho absoluto ou relativo ao CERTIFICATES_DIR)
-        cert_path_raw = empresa.certificado_path or ""
-        cert_path_norm = cert_path_raw.replace("/secure/", "").replace("\\secure\\", "")
-        cert_path_norm = cert_path_norm.lstrip('/\\')
-        if Path(cert_path_raw).is_absolute():
-            absolute_cert_path = Path(cert_path_raw)
-        else:
-            absolute_cert_path = Path(settings.CERTIFICATES_DIR) / cert_path_norm
-
-        # Verifica existência e acessibilidade; fornecer mensagens claras ao cliente
-        if not absolute_cert_path.exists():
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Arquivo de certificado não encontrado: {absolute_cert_path}")
-
-        # Se for diretório, tenta encontrar automaticamente um .pfx/.p12 dentro dele
-        try:
-            if absolute_cert_path.is_dir():
-                pfx_candidates = list(absolute_cert_path.glob('*.pfx')) + list(absolute_cert_path.glob('*.p12'))
-                if pfx_candidates:
-                    absolute_cert_path = pfx_candidates[0]
-                else:
-                    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=(
-                        f"Caminho de certificado é um diretório mas não contém arquivos .pfx/.p12: {absolute_cert_path}. "
-                        "Defina `empresa.certificado_path` apontando para o arquivo .pfx/.p12 ou coloque o arquivo no diretório especificado."))
-        except PermissionError:
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Permissão negada ao acessar o diretório do certificado: {absolute_cert_path}")
-
-        # Verifica permissão de leitura
-        if not os.access(str(absolute_cert_path), os.R_OK):
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=(
-                f"Permissão negada ao acessar o certificado: {absolute_cert_path}. Verifique as permissões do arquivo e o usuário do processo."))
-
-        # Abre o arquivo PFX/P12 com tratamento de PermissionError para mensagens claras
-        try:
-            with open(absolute_cert_path, "rb") as f:
-                pfx_data = f.read()
-        except PermissionError:
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=(
-                f"Permissão negada ao abrir o certificado: {absolute_cert_path}. Verifique se o processo tem permissão de leitura."))
-
-        # Descriptografa a senha se necessário
-        certificado_senha = ""
-        if hasattr(empresa, 'certificado_senha') and empresa.certificado_senha:
-            print(f"DEBUG: certificado_senha raw = {empresa.certificado_senha[:20]}..." if len(empresa.certificado_senha) > 20 else f"DEBUG: certificado_senha raw = {empresa.certificado_senha}")
-            print(f"DEBUG: certificado_senha começa com 'gAAAAA'? {empresa.certificado_senha.startswith('gAAAAA') if isinstance(empresa.certificado_senha, str) else 'N/A'}")
-            
-            if isinstance(empresa.certificado_senha, str) and len(empresa.certificado_senha) > 0 and not empresa.certificado_senha.startswith('gAAAAA'):
-                # Senha em texto plano (compatibilidade com dados antigos)
-                certificado_senha = empresa.certificado_senha
-                print(f"DEBUG: Usando senha em TEXTO PLANO")
-            else:
-                # Senha criptografada (padrão)
-                try:
-                    certificado_senha = decrypt_sensitive_data(empresa.certificado_senha)
-                    print(f"DEBUG: Senha DESCRIPTOGRAFADA com sucesso")
-                except Exception as e:
-                    print(f"DEBUG: ERRO ao descriptografar senha: {e}")
-                    certificado_senha = None
-        else:
-            print(f"DEBUG: Empresa SEM certificado_senha definido")
-
-        senha_bytes = certificado_senha.encode('utf-8') if certificado_senha else None
-        print(f"DEBUG: senha_bytes = {'<bytes>' if senha_bytes else 'None'}, len={len(senha_bytes) if senha_bytes else 0}")
-        
-        try:
-            private_key, certificate, additional_certificates = pkcs12.load_key_and_certificates(pfx_data, senha_bytes)
-            print(f"DEBUG: Certificado carregado COM SUCESSO usando senha fornecida")
-        except Exception as e1:
-            print(f"DEBUG: FALHA ao carregar com senha: {e1}")
-            try:
-                private_key, certificate, additional_certificates = pkcs12.load_key_and_certificates(pfx_data, None)
-                print(f"DEBUG: Certificado carregado SEM SENHA (certificado sem proteção)")
-            except Exception as e2:
-                print(f"DEBUG: FALHA ao carregar sem senha: {e2}")
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"Erro ao assinar NFCom: {str(e1)}"
-                )
+        # Chave/certificado em cache por empresa + certificado (caminho, mtime) + senha
+        material = _get_signing_material(empresa)
+        certificate = material.certificate
 
         # Prepara árvore XML
         ns = "http://www.portalfiscal.inf.br/nfcom"
@@ -1082,11 +1137,12 @@ def sign_nfcom_xml(xml_string: str, empresa, chave_acesso: str = None, tipo_emis
             pass
         qrCodNFCom.text = qr_code_base_url + params
         # Log adicional para garantir correção futura: mostra tpAmb usado no QR
-        try:
-            print(f"DEBUG: URL QR Code gerada: {qrCodNFCom.text} (tpAmb={tpAmb}, empresa_ambiente={empresa_ambiente}, settings.NFCOM_AMBIENTE={settings.NFCOM_AMBIENTE})")
-        except Exception:
-            # Não falhar por logging
-            pass
+        if NFCOM_SIGN_DEBUG:
+            try:
+                print(f"DEBUG: URL QR Code gerada: {qrCodNFCom.text} (tpAmb={tpAmb}, empresa_ambiente={empresa_ambiente}, settings.NFCOM_AMBIENTE={settings.NFCOM_AMBIENTE})")
+            except Exception:
+                # Não falhar por logging
+                pass
 
         # Assinatura enveloped: referência ao Id do infNFCom
         inf_id = root_inf.get('Id')
@@ -1146,38 +1202,13 @@ def sign_nfcom_xml(xml_string: str, empresa, chave_acesso: str = None, tipo_emis
 
         pem_path = None
         try:
-            try:
-                pem_path = _convert_pfx_to_pem(pfx_data, certificado_senha)
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"Erro ao converter PFX para PEM: {e}")
-
-            # Extrai o certificado em base64 do PEM gerado para garantir que X509Certificate seja preenchido
-            cert_b64_from_pem = None
-            try:
-                if pem_path and os.path.exists(pem_path):
-                    with open(pem_path, 'r', encoding='utf-8') as pf:
-                        pem_text = pf.read()
-                    m = re.search(r"-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----", pem_text, re.S)
-                    if m:
-                        cert_b64_from_pem = ''.join(m.group(1).split())
-            except Exception as e:
-                print('DEBUG: falha ao extrair certificado do PEM logo após conversao:', e)
+            # Certificado em base64 para preencher X509Certificate caso o xmlsec não o faça
+            cert_b64_from_pem = material.cert_b64
 
             ctx = xmlsec.SignatureContext()
             try:
-                print(f"DEBUG: loading key from PEM path: {pem_path}")
-                key = xmlsec.Key.from_file(pem_path, xmlsec.KeyFormat.PEM, None)
-                ctx.key = key
-                
-                # CRÍTICO: Carregar o certificado no key para que xmlsec preencha X509Certificate automaticamente
-                try:
-                    # Carrega o certificado x509 no key object
-                    key.load_cert_from_file(pem_path, xmlsec.KeyFormat.CERT_PEM)
-                    print('DEBUG: Certificado carregado no key object com sucesso')
-                except Exception as cert_err:
-                    print(f'DEBUG: Falha ao carregar certificado no key: {cert_err}')
-                    # Não é fatal - vamos preencher manualmente depois
-                    
+                # Chave com o certificado carregado, reaproveitada entre notas
+                ctx.key = material.xmlsec_key()
             except Exception as e:
                 tb = traceback.format_exc()
                 print('DEBUG: falha ao carregar chave PEM:', e, tb)
@@ -1186,26 +1217,28 @@ def sign_nfcom_xml(xml_string: str, empresa, chave_acesso: str = None, tipo_emis
             # Assina
             try:
                 # DEBUG: dump the signature template before signing to help diagnose failures
-                try:
-                    print('DEBUG: Signature template before sign:\n', etree.tostring(sign_node, encoding='unicode', pretty_print=True))
-                except Exception:
-                    pass
+                if NFCOM_SIGN_DEBUG:
+                    try:
+                        print('DEBUG: Signature template before sign:\n', etree.tostring(sign_node, encoding='unicode', pretty_print=True))
+                    except Exception:
+                        pass
 
                 # EXTRA DEBUG: mostrar nsmap do Signature e dos ancestrais para entender onde o xmlns padrao aparece
-                try:
-                    parent = sign_node.getparent()
-                    def ancestors(elem):
-                        cur = elem
-                        outs = []
-                        while cur is not None:
-                            outs.append(cur)
-                            cur = cur.getparent()
-                        return outs
-
-                    print('DEBUG: sign_node.nsmap=', getattr(sign_node, 'nsmap', None))
-                    print('DEBUG: sign_node está isolado (parent é temp)?', parent.tag == 'temp' if parent is not None else 'No parent')
-                except Exception as e:
-                    print('DEBUG: erro ao coletar nsmap/debugs adicionais:', e)
+                if NFCOM_SIGN_DEBUG:
+                    try:
+                        parent = sign_node.getparent()
+                        def ancestors(elem):
+                            cur = elem
+                            outs = []
+                            while cur is not None:
+                                outs.append(cur)
+                                cur = cur.getparent()
+                            return outs
+
+                        print('DEBUG: sign_node.nsmap=', getattr(sign_node, 'nsmap', None))
+                        print('DEBUG: sign_node está isolado (parent é temp)?', parent.tag == 'temp' if parent is not None else 'No parent')
+                    except Exception as e:
+                        print('DEBUG: erro ao coletar nsmap/debugs adicionais:', e)
 
                 # ESTRATÉGIA NOVA: assinar ANTES de inserir no nfcom_root
                 # Primeiro, insere temporariamente no nfcom_root para que xmlsec possa resolver a URI
@@ -1503,9 +1536,8 @@ def sign_nfcom_xml(xml_string: str, empresa, chave_acesso: str = None, tipo_emis
 def validate_xml_with_xsd(xml_string: str, xsd_path: str):
     """Valida uma string XML contra um arquivo de schema XSD."""
     try:
-        # Parse o schema XSD
-        xsd_doc = etree.parse(xsd_path)
-        xsd_schema = etree.XMLSchema(xsd_doc)
+        # Schema compilado em cache (recompilado apenas se o arquivo mudar)
+        xsd_schema = nfcom_cache.get_xml_schema(xsd_path)
 
         # Parse o XML que queremos validar
         xml_doc = etree.fromstring(xml_string.encode('utf-8'))
@@ -1593,7 +1625,8 @@ def create_nfcom(db: Session, nfcom_in: nfcom_schema.NFComCreate, empresa_id: in
 
     # 2. Define o número e a série da nota
     serie = 1 # Série fixa por enquanto
-    numero_nf = get_next_numero_nf(db, empresa_id=empresa_id, serie=serie)
+    # Reserva dentro da transação da criação: um rollback devolve o número
+    numero_nf = reserve_numeros_nf(db, empresa_id=empresa_id, serie=serie)
 
     # Pré-cria o objeto para ter acesso aos dados para gerar a chave
     # (sem adicionar ao DB ainda)
@@ -1707,6 +1740,7 @@ def update_nfcom(db: Session, nfcom_id: int, nfcom_in: nfcom_schema.NFComUpdate)
     db_nfcom = db.query(models.NFCom).filter(models.NFCom.id == nfcom_id).first()
     if not db_nfcom:
         raise HTTPException(status_code=404, detail="NFCom não encontrada")
+    chave_anterior = db_nfcom.chave_acesso
     
     # 2. Atualiza os dados da NFCom (exceto itens)
     # Excluir collections (itens, faturas) para evitar atribuir listas/dicts diretamente às relações ORM
@@ -1764,6 +1798,8 @@ def update_nfcom(db: Session, nfcom_id: int, nfcom_in: nfcom_schema.NFComUpdate)
     # 5. Commit e refresh
     db.commit()
     db.refresh(db_nfcom)
+    # XML/DANFE armazenados não correspondem mais à nota editada
+    nfcom_artifacts.invalidate(chave_anterior)
     return db_nfcom
 
 def delete_nfcom(db: Session, nfcom_id: int, empresa_id: int) -> bool:
@@ -1779,9 +1815,8 @@ def delete_nfcom(db: Session, nfcom_id: int, empresa_id: int) -> bool:
         raise HTTPException(status_code=404, detail="NFCom não encontrada nesta empresa")
     
     # 2. Verifica se a NFCom está autorizada
-    # Também bloquear exclusão se a nota foi cancelada (informacoes_adicionais com cStat de evento)
-    info = (db_nfcom.informacoes_adicionais or '')
-    if any(code in info for code in ['cStat=135', 'cStat=136', 'cStat=134']):
+    # Também bloquear exclusão se a nota foi cancelada
+    if db_nfcom.status == 'cancelada':
         raise HTTPException(
             status_code=400,
             detail=f"Não é possível excluir NFCom #{db_nfcom.numero_nf} - nota cancelada"
@@ -1803,534 +1838,756 @@ def delete_nfcom(db: Session, nfcom_id: int, empresa_id: int) -> bool:
     
     return True
 
-def bulk_emit_nfcom_from_contracts(db: Session, contract_ids: list, empresa_id: int, execute: bool = False, transmit: bool = False) -> dict:
-    """
-    Emissão em massa (modo dry-run).
+def _to_float_safe(v):
+    """Converte valores do contrato para float (aceita strings como '1.800,00')."""
+    try:
+        from decimal import Decimal
+        if v is None:
+            return 0.0
+        if isinstance(v, (int, float)):
+            return float(v)
+        if isinstance(v, Decimal):
+            return float(v)
+        if isinstance(v, str):
+            s = v.strip()
+            # Caso comuns PT-BR: '1.800,00' -> '1800.00'
+            if s.count(',') == 1 and s.count('.') >= 1:
+                s = s.replace('.', '').replace(',', '.')
+            else:
+                s = s.replace(',', '.')
+            s = s.replace(' ', '')
+            return float(s)
+        return 0.0
+    except Exception:
+        return 0.0
 
-    Esta função valida cada contrato informado e retorna um relatório com os
-    contratos que passaram nas validações (lista `successes`) e os que falharam
-    (lista `failures` com mensagem). NÃO cria nem transmite NFComs — é um modo
-    seguro para o frontend validar antes de executar a operação real.
+
+def _contract_validation_error(contrato) -> Optional[str]:
+    """Valida os itens mínimos para emitir NFCom a partir de um contrato.
+
+    Retorna a mensagem de erro ou None se o contrato pode ser emitido.
     """
-    from app.crud import crud_servico_contratado
+    # Valida itens mínimos necessários para emitir NFCom a partir de um contrato
+    # - cliente_id
+    # - servico_id
+    # - valor_unitario > 0
+    if not getattr(contrato, 'cliente_id', None):
+        return "Contrato sem cliente associado"
+    if not getattr(contrato, 'servico_id', None):
+        return "Contrato sem serviço associado"
+    contrato_vu = _to_float_safe(getattr(contrato, 'valor_unitario', None))
+    if contrato_vu in (None, 0, 0.0):
+        return "Contrato com valor_unitario inválido"
+
+    # Se o tipo de faturamento exigir contrato (NORMAL/CENTRALIZADO), verificar datas
+    tp_fat = getattr(contrato, 'tp_fat', None) or getattr(contrato, 'tipo_faturamento', None) or None
+    # Normalizamos para string se for Enum-like
+    try:
+        tp_fat_val = str(tp_fat.value) if hasattr(tp_fat, 'value') else str(tp_fat)
+    except Exception:
+        tp_fat_val = str(tp_fat)
 
-    successes = []
-    failures = []
-    skipped = []
+    if tp_fat_val and tp_fat_val.upper() in ('0', 'NORMAL', '1', 'CENTRALIZADO'):
+        if not getattr(contrato, 'numero_contrato', None) or not getattr(contrato, 'd_contrato_ini', None):
+            return "Contrato sem número ou data inicial (obrigatório para tipo de faturamento)"
+    return None
 
-    if not contract_ids:
-        return {"successes": successes, "failures": failures, "skipped": skipped}
 
-    for cid in contract_ids:
-        try:
-            contrato = crud_servico_contratado.get_servico_contratado(db, contrato_id=cid, empresa_id=empresa_id)
-            if not contrato:
-                failures.append({"contract_id": cid, "error": "Contrato não encontrado ou não pertence à empresa"})
-                continue
+def _chunked(values, size: int):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
 
-            # Valida itens mínimos necessários para emitir NFCom a partir de um contrato
-            # - cliente_id
-            # - servico_id
-            # - valor_unitario > 0
-            if not getattr(contrato, 'cliente_id', None):
-                failures.append({"contract_id": cid, "error": "Contrato sem cliente associado"})
-                continue
-            if not getattr(contrato, 'servico_id', None):
-                failures.append({"contract_id": cid, "error": "Contrato sem serviço associado"})
-                continue
-            # Normaliza/valida valor_unitario do contrato (aceita strings como '1.800,00')
-            def _to_float_safe(v):
-                try:
-                    from decimal import Decimal
-                    if v is None:
-                        return 0.0
-                    if isinstance(v, (int, float)):
-                        return float(v)
-                    if isinstance(v, Decimal):
-                        return float(v)
-                    if isinstance(v, str):
-                        s = v.strip()
-                        # Caso comuns PT-BR: '1.800,00' -> '1800.00'
-                        if s.count(',') == 1 and s.count('.') >= 1:
-                            s = s.replace('.', '').replace(',', '.')
-                        else:
-                            s = s.replace(',', '.')
-                        s = s.replace(' ', '')
-                        return float(s)
-                    return 0.0
-                except Exception:
-                    return 0.0
 
-            contrato_vu = _to_float_safe(getattr(contrato, 'valor_unitario', None))
-            if contrato_vu in (None, 0, 0.0):
-                failures.append({"contract_id": cid, "error": "Contrato com valor_unitario inválido"})
+class _BulkEmitContext:
+    """Linhas necessárias para emitir as NFComs de um conjunto de contratos.
+
+    Contratos, empresa, clientes (com endereços), serviços, NFComs já emitidas
+    no mês e recebíveis são carregados com algumas consultas IN, em vez de
+    várias consultas por contrato.
+    """
+
+    def __init__(self, db: Session, empresa_id: int, contract_ids: list, execute: bool):
+        import datetime as _dt
+
+        self.db = db
+        self.empresa_id = empresa_id
+        today = _dt.date.today()
+        # Janela usada para evitar duplicados no mesmo mês e ano
+        self.start_dt = _dt.datetime(today.year, today.month, 1, 0, 0, 0)
+        if today.month == 12:
+            self.end_dt = _dt.datetime(today.year + 1, 1, 1, 0, 0, 0)
+        else:
+            self.end_dt = _dt.datetime(today.year, today.month + 1, 1, 0, 0, 0)
+
+        self.contratos = {}
+        for chunk in _chunked(set(contract_ids), NFCOM_BULK_IN_CHUNK):
+            for contrato in db.query(models.ServicoContratado).filter(
+                models.ServicoContratado.id.in_(chunk),
+                models.ServicoContratado.empresa_id == empresa_id
+            ).all():
+                self.contratos[contrato.id] = contrato
+
+        self.empresa = None
+        self.clientes = {}
+        self.servicos = {}
+        self.receivables = {}
+        # numero_contrato / (cliente_id, servico_id) -> NFCom do mês (id, numero_nf, serie, valor_total)
+        self.nf_por_contrato = {}
+        self.nf_por_cliente_servico = {}
+        if execute and self.contratos:
+            self._load()
+
+    def _load(self):
+        from app.models.models import Receivable
+
+        db = self.db
+        contratos = list(self.contratos.values())
+        cliente_ids = {c.cliente_id for c in contratos if c.cliente_id}
+        servico_ids = {c.servico_id for c in contratos if c.servico_id}
+        numeros = {c.numero_contrato for c in contratos if getattr(c, 'numero_contrato', None)}
+
+        self.empresa = crud_empresa.get_empresa_raw(db, empresa_id=self.empresa_id)
+
+        for chunk in _chunked(cliente_ids, NFCOM_BULK_IN_CHUNK):
+            for cliente in db.query(models.Cliente).options(
+                joinedload(models.Cliente.empresa_associations).joinedload(models.EmpresaCliente.enderecos)
+            ).filter(models.Cliente.id.in_(chunk)).all():
+                self.clientes[cliente.id] = cliente
+
+        for chunk in _chunked(servico_ids, NFCOM_BULK_IN_CHUNK):
+            for serv in db.query(models.Servico).filter(models.Servico.id.in_(chunk)).all():
+                self.servicos[serv.id] = serv
+
+        # NFComs já emitidas no mês: por número do contrato (mais específico) e,
+        # para contratos sem número, por cliente + serviço do item. Ordenadas por
+        # id para que a mais recente prevaleça, como na busca individual.
+        nf_cols = (models.NFCom.id, models.NFCom.numero_nf, models.NFCom.serie, models.NFCom.valor_total)
+        no_mes = (
+            models.NFCom.empresa_id == self.empresa_id,
+            models.NFCom.data_emissao >= self.start_dt,
+            models.NFCom.data_emissao < self.end_dt,
+        )
+        for chunk in _chunked(numeros, NFCOM_BULK_IN_CHUNK):
+            for row in db.query(*nf_cols, models.NFCom.numero_contrato).filter(
+                *no_mes, models.NFCom.numero_contrato.in_(chunk)
+            ).order_by(models.NFCom.id).all():
+                self.nf_por_contrato[row.numero_contrato] = row
+        if servico_ids:
+            for chunk in _chunked(cliente_ids, NFCOM_BULK_IN_CHUNK):
+                for row in db.query(*nf_cols, models.NFCom.cliente_id, models.NFComItem.servico_id).join(models.NFComItem).filter(
+                    *no_mes,
+                    models.NFCom.cliente_id.in_(chunk),
+                    models.NFComItem.servico_id.in_(servico_ids)
+                ).order_by(models.NFCom.id).all():
+                    self.nf_por_cliente_servico[(row.cliente_id, row.servico_id)] = row
+
+        # Recebível de cada contrato: o mais recente emitido no mês ou, na falta
+        # dele, o mais recente do contrato
+        ids = list(self.contratos)
+        for chunk in _chunked(ids, NFCOM_BULK_IN_CHUNK):
+            for recv in db.query(Receivable).filter(
+                Receivable.servico_contratado_id.in_(chunk),
+                Receivable.issue_date >= self.start_dt
+            ).order_by(Receivable.id).all():
+                self.receivables[recv.servico_contratado_id] = recv
+        faltando = [i for i in ids if i not in self.receivables]
+        for chunk in _chunked(faltando, NFCOM_BULK_IN_CHUNK):
+            ultimos = [row[0] for row in db.query(func.max(Receivable.id)).filter(
+                Receivable.servico_contratado_id.in_(chunk)
+            ).group_by(Receivable.servico_contratado_id).all()]
+            if ultimos:
+                for recv in db.query(Receivable).filter(Receivable.id.in_(ultimos)).all():
+                    self.receivables[recv.servico_contratado_id] = recv
+
+    def existing_nf(self, contrato):
+        # Evita emissão duplicada: priorizamos verificação pelo número do contrato
+        # quando disponível; caso contrário, caímos para verificação por
+        # cliente+serviço+mês. Isso evita gerar múltiplas NFComs quando o
+        # mesmo cliente tiver vários contratos distintos no mesmo mês.
+        numero_contrato = getattr(contrato, 'numero_contrato', None)
+        if numero_contrato:
+            return self.nf_por_contrato.get(numero_contrato)
+        return self.nf_por_cliente_servico.get((contrato.cliente_id, contrato.servico_id))
+
+    def register(self, contrato, db_nf) -> list:
+        """Registra uma nota emitida no lote para as verificações de duplicidade.
+
+        Retorna o que é preciso para desfazer o registro (forget).
+        """
+        row = SimpleNamespace(id=db_nf.id, numero_nf=db_nf.numero_nf, serie=db_nf.serie, valor_total=db_nf.valor_total)
+        undo = []
+        keys = [(self.nf_por_cliente_servico, (contrato.cliente_id, contrato.servico_id))]
+        if db_nf.numero_contrato:
+            keys.append((self.nf_por_contrato, db_nf.numero_contrato))
+        for target, key in keys:
+            undo.append((target, key, target.get(key)))
+            target[key] = row
+        return undo
+
+    @staticmethod
+    def forget(undo: list) -> None:
+        for target, key, previous in reversed(undo):
+            if previous is None:
+                target.pop(key, None)
+            else:
+                target[key] = previous
+
+    def count_emittable(self, contract_ids: list) -> int:
+        """Quantos contratos do lote geram NFCom.
+
+        Aplica as mesmas regras do laço de emissão (contrato válido e sem nota
+        no mês, inclusive de outro contrato do próprio lote), para que a faixa
+        reservada não inclua números de contratos que serão pulados.
+        """
+        total = 0
+        undo = []
+        for cid in contract_ids:
+            contrato = self.contratos.get(cid)
+            if not contrato or _contract_validation_error(contrato) or self.existing_nf(contrato):
                 continue
+            total += 1
+            previsto = SimpleNamespace(id=None, numero_nf=None, serie=None, valor_total=None,
+                                       numero_contrato=getattr(contrato, 'numero_contrato', None))
+            undo.extend(self.register(contrato, previsto))
+        self.forget(undo)
+        return total
+
+
+def _add_contract_nfcom(db: Session, ctx: _BulkEmitContext, contrato, numero_nf: int, serie: int):
+    """Cria (sem commit) a NFCom de um contrato, com itens e fatura."""
+    cid = contrato.id
+    empresa_id = ctx.empresa_id
+    contrato_vu = _to_float_safe(getattr(contrato, 'valor_unitario', None))
+
+    # Dados da empresa para preencher cMunFG
+    empresa_row = ctx.empresa
+    if not empresa_row:
+        raise Exception("Empresa não encontrada")
 
-            # Se o tipo de faturamento exigir contrato (NORMAL/CENTRALIZADO), verificar datas
-            tp_fat = getattr(contrato, 'tp_fat', None) or getattr(contrato, 'tipo_faturamento', None) or None
-            # Normalizamos para string se for Enum-like
-            try:
-                tp_fat_val = str(tp_fat.value) if hasattr(tp_fat, 'value') else str(tp_fat)
-            except Exception:
-                tp_fat_val = str(tp_fat)
+    # Calcula valor total do contrato (normalizando possíveis strings formadas em PT-BR).
+    # Preferimos sempre o total derivado de quantidade * valor_unitario quando houver discrepância
+    raw_valor_total = getattr(contrato, 'valor_total', None)
+    parsed_raw_total = None
+    if raw_valor_total not in (None, ''):
+        parsed_raw_total = _to_float_safe(raw_valor_total)
 
-            if tp_fat_val and tp_fat_val.upper() in ('0', 'NORMAL', '1', 'CENTRALIZADO'):
-                if not getattr(contrato, 'numero_contrato', None) or not getattr(contrato, 'd_contrato_ini', None):
-                    failures.append({"contract_id": cid, "error": "Contrato sem número ou data inicial (obrigatório para tipo de faturamento)"})
-                    continue
+    qty = (getattr(contrato, 'quantidade', 1) or 1)
+    computed_total = qty * contrato_vu
 
-            # Caso passe em todas as validações, se execute==True cria a NFCom no banco
-            if execute:
-                try:
-                    # Carrega dados da empresa para preencher cMunFG
-                    empresa_row = crud_empresa.get_empresa_raw(db, empresa_id=empresa_id)
-                    if not empresa_row:
-                        raise Exception("Empresa não encontrada")
-
-                    # Determina próximo número e série
-                    serie = 1
-                    numero_nf = get_next_numero_nf(db, empresa_id=empresa_id, serie=serie)
-
-                    # Calcula valor total do contrato (normalizando possíveis strings formadas em PT-BR).
-                    # Preferimos sempre o total derivado de quantidade * valor_unitario quando houver discrepância
-                    raw_valor_total = getattr(contrato, 'valor_total', None)
-                    parsed_raw_total = None
-                    if raw_valor_total not in (None, ''):
-                        parsed_raw_total = _to_float_safe(raw_valor_total)
-
-                    qty = (getattr(contrato, 'quantidade', 1) or 1)
-                    computed_total = qty * contrato_vu
-
-                    # Se raw_total ausente ou diferente do computado (diferença > 1 centavo), usar o computado
-                    if parsed_raw_total is None or abs(parsed_raw_total - computed_total) > 0.01:
-                        valor_total = round(computed_total, 2)
-                    else:
-                        valor_total = round(parsed_raw_total, 2)
+    # Se raw_total ausente ou diferente do computado (diferença > 1 centavo), usar o computado
+    if parsed_raw_total is None or abs(parsed_raw_total - computed_total) > 0.01:
+        valor_total = round(computed_total, 2)
+    else:
+        valor_total = round(parsed_raw_total, 2)
 
-                    # Busca endereço do cliente associado à empresa (se existir)
-                    cliente = None
-                    try:
-                        cliente = db.query(models.Cliente).options(
-                            joinedload(models.Cliente.empresa_associations).joinedload(models.EmpresaCliente.enderecos)
-                        ).filter(models.Cliente.id == contrato.cliente_id).first()
-                    except Exception:
-                        cliente = None
+    # Endereço do cliente associado à empresa (se existir)
+    cliente = ctx.clientes.get(contrato.cliente_id)
 
-                    dest_kwargs = {}
-                    try:
-                        if cliente:
-                            # procura associação específica para a empresa
-                            assoc = None
-                            for ea in getattr(cliente, 'empresa_associations', []) or []:
-                                try:
-                                    if getattr(ea, 'empresa_id', None) == empresa_id:
-                                        assoc = ea
-                                        break
-                                except Exception:
-                                    continue
-
-                            if assoc and getattr(assoc, 'enderecos', None):
-                                # prefere endereço principal
-                                end = None
-                                for e in assoc.enderecos:
-                                    if getattr(e, 'is_principal', False):
-                                        end = e
-                                        break
-                                if end is None:
-                                    end = assoc.enderecos[0]
-
-                                dest_kwargs.update({
-                                    'dest_endereco': getattr(end, 'endereco', '') or '',
-                                    'dest_numero': getattr(end, 'numero', '') or '',
-                                    'dest_bairro': getattr(end, 'bairro', '') or '',
-                                    'dest_municipio': getattr(end, 'municipio', '') or '',
-                                    'dest_uf': getattr(end, 'uf', '') or '',
-                                    'dest_cep': getattr(end, 'cep', '') or '',
-                                    'dest_codigo_ibge': getattr(end, 'codigo_ibge', '') or ''
-                                })
-                    except Exception:
-                        dest_kwargs = {}
+    dest_kwargs = {}
+    try:
+        if cliente:
+            # procura associação específica para a empresa
+            assoc = None
+            for ea in getattr(cliente, 'empresa_associations', []) or []:
+                try:
+                    if getattr(ea, 'empresa_id', None) == empresa_id:
+                        assoc = ea
+                        break
+                except Exception:
+                    continue
 
-                    # Evita emissão duplicada: priorizamos verificação pelo número do contrato
-                    # quando disponível; caso contrário, caímos para verificação por
-                    # cliente+serviço+mês. Isso evita gerar múltiplas NFComs quando o
-                    # mesmo cliente tiver vários contratos distintos no mesmo mês.
-                    try:
-                        import datetime as _dt
-                        today = _dt.date.today()
-                        # Modificado para evitar duplicados no mesmo mês e ano
-                        start_dt = _dt.datetime(today.year, today.month, 1, 0, 0, 0)
-                        if today.month == 12:
-                            end_dt = _dt.datetime(today.year + 1, 1, 1, 0, 0, 0)
-                        else:
-                            end_dt = _dt.datetime(today.year, today.month + 1, 1, 0, 0, 0)
-
-                        numero_contrato = getattr(contrato, 'numero_contrato', None)
-                        if numero_contrato:
-                            # Primeiro, tentar encontrar por número do contrato (mais específico)
-                            existing_nf = db.query(models.NFCom).filter(
-                                models.NFCom.empresa_id == empresa_id,
-                                models.NFCom.numero_contrato == numero_contrato,
-                                models.NFCom.data_emissao >= start_dt,
-                                models.NFCom.data_emissao < end_dt
-                            ).order_by(models.NFCom.id.desc()).first()
-                        else:
-                            # Fallback: procurar NFCom existente juntando com NFComItem para comparar servico_id
-                            existing_nf = db.query(models.NFCom).join(models.NFComItem).filter(
-                                models.NFCom.empresa_id == empresa_id,
-                                models.NFCom.cliente_id == getattr(contrato, 'cliente_id', None),
-                                models.NFComItem.servico_id == getattr(contrato, 'servico_id', None),
-                                models.NFCom.data_emissao >= start_dt,
-                                models.NFCom.data_emissao < end_dt
-                            ).order_by(models.NFCom.id.desc()).first()
-                    except Exception:
-                        existing_nf = None
-
-                    if existing_nf:
-                        # Não emitir novamente automaticamente; registrar como pulado
-                        skipped.append({
-                            "contract_id": cid,
-                            "cliente_id": getattr(contrato, 'cliente_id', None),
-                            "servico_id": getattr(contrato, 'servico_id', None),
-                            "nfcom_id": getattr(existing_nf, 'id', None),
-                            "numero_nf": getattr(existing_nf, 'numero_nf', None),
-                            "serie": getattr(existing_nf, 'serie', None),
-                            "valor_total": getattr(existing_nf, 'valor_total', None),
-                            "reason": "already_emitted_same_client_service_month"
-                        })
-                        # pula para o próximo contrato
-                        continue
-
-                    # Cria o objeto NFCom mínimo
-                    db_nf = models.NFCom(
-                        empresa_id=empresa_id,
-                        cliente_id=contrato.cliente_id,
-                        numero_nf=numero_nf,
-                        serie=serie,
-                        cMunFG=str(empresa_row.codigo_ibge)[:7] if getattr(empresa_row, 'codigo_ibge', None) else '',
-                        data_emissao=date.today(),
-                        valor_total=valor_total,
-                        numero_contrato=getattr(contrato, 'numero_contrato', None),
-                        d_contrato_ini=getattr(contrato, 'd_contrato_ini', None),
-                        d_contrato_fim=getattr(contrato, 'd_contrato_fim', None),
-                        **dest_kwargs
-                    )
-                    db.add(db_nf)
-                    db.flush()
+            if assoc and getattr(assoc, 'enderecos', None):
+                # prefere endereço principal
+                end = None
+                for e in assoc.enderecos:
+                    if getattr(e, 'is_principal', False):
+                        end = e
+                        break
+                if end is None:
+                    end = assoc.enderecos[0]
+
+                dest_kwargs.update({
+                    'dest_endereco': getattr(end, 'endereco', '') or '',
+                    'dest_numero': getattr(end, 'numero', '') or '',
+                    'dest_bairro': getattr(end, 'bairro', '') or '',
+                    'dest_municipio': getattr(end, 'municipio', '') or '',
+                    'dest_uf': getattr(end, 'uf', '') or '',
+                    'dest_cep': getattr(end, 'cep', '') or '',
+                    'dest_codigo_ibge': getattr(end, 'codigo_ibge', '') or ''
+                })
+    except Exception:
+        dest_kwargs = {}
+
+    # Cria o objeto NFCom mínimo
+    db_nf = models.NFCom(
+        empresa_id=empresa_id,
+        cliente_id=contrato.cliente_id,
+        numero_nf=numero_nf,
+        serie=serie,
+        cMunFG=str(empresa_row.codigo_ibge)[:7] if getattr(empresa_row, 'codigo_ibge', None) else '',
+        data_emissao=date.today(),
+        valor_total=valor_total,
+        numero_contrato=getattr(contrato, 'numero_contrato', None),
+        d_contrato_ini=getattr(contrato, 'd_contrato_ini', None),
+        d_contrato_fim=getattr(contrato, 'd_contrato_fim', None),
+        **dest_kwargs
+    )
+    db.add(db_nf)
+    db.flush()
 
-                    # Verifica se há taxa de instalação pendente para incluir na NFCom
-                    taxa_instalacao = getattr(contrato, 'taxa_instalacao', 0) or 0
-                    taxa_paga = getattr(contrato, 'taxa_instalacao_paga', False) or False
+    # Verifica se há taxa de instalação pendente para incluir na NFCom
+    taxa_instalacao = getattr(contrato, 'taxa_instalacao', 0) or 0
+    taxa_paga = getattr(contrato, 'taxa_instalacao_paga', False) or False
 
-                    # Calcula valor total incluindo taxa de instalação se aplicável
-                    valor_total_plano = valor_total
-                    valor_total_com_taxa = valor_total
+    # Calcula valor total incluindo taxa de instalação se aplicável
+    valor_total_plano = valor_total
+    valor_total_com_taxa = valor_total
 
-                    if taxa_instalacao > 0 and not taxa_paga:
-                        valor_total_com_taxa = valor_total + taxa_instalacao
-                        # Atualiza o valor total da NFCom para incluir a taxa
-                        valor_total = valor_total_com_taxa
-                        db_nf.valor_total = valor_total
+    if taxa_instalacao > 0 and not taxa_paga:
+        valor_total_com_taxa = valor_total + taxa_instalacao
+        # Atualiza o valor total da NFCom para incluir a taxa
+        valor_total = valor_total_com_taxa
+        db_nf.valor_total = valor_total
 
-                    # Cria itens da NFCom (plano + taxa de instalação se aplicável)
-                    itens_criados = []
+    # Cria itens da NFCom (plano + taxa de instalação se aplicável)
+    itens_criados = []
 
-                    # Item 1: Plano de assinatura (sempre presente)
-                    serv = None
-                    try:
-                        serv = db.query(models.Servico).filter(models.Servico.id == contrato.servico_id).first()
-                    except Exception:
-                        serv = None
+    # Item 1: Plano de assinatura (sempre presente)
+    serv = ctx.servicos.get(contrato.servico_id)
 
-                    # Determina valor unitário final (prioriza valor do contrato, senão valor do serviço)
-                    serv_vu = None
-                    try:
-                        serv_vu = float(getattr(serv, 'valor_unitario', 0) or 0)
-                    except Exception:
-                        serv_vu = 0.0
-
-                    final_vu = contrato_vu if contrato_vu and contrato_vu > 0 else serv_vu
-
-                    item_plano = models.NFComItem(
-                        nfcom_id=db_nf.id,
-                        servico_id=getattr(contrato, 'servico_id', None),
-                        cClass=getattr(serv, 'cClass', '') if serv is not None else '',
-                        codigo_servico=getattr(serv, 'codigo', '') if serv is not None else '',
-                        descricao_servico=getattr(serv, 'descricao', '') if serv is not None else '',
-                        quantidade=getattr(contrato, 'quantidade', 1) or 1,
-                        unidade_medida=getattr(serv, 'unidade_medida', '4') if serv is not None else '4',
-                        valor_unitario=final_vu,
-                        # Preencher campos fiscais padrão do serviço/contrato
-                        valor_desconto=(getattr(contrato, 'valor_desconto', None) if getattr(contrato, 'valor_desconto', None) is not None else getattr(serv, 'valor_desconto_default', 0)) or 0,
-                        valor_outros=(getattr(contrato, 'valor_outros', None) if getattr(contrato, 'valor_outros', None) is not None else getattr(serv, 'valor_outros_default', 0)) or 0,
-                        cfop=(getattr(contrato, 'servico_cfop', None) or (getattr(serv, 'cfop', None) if serv is not None else '') ) or '',
-                        ncm=(getattr(contrato, 'servico_ncm', None) or (getattr(serv, 'ncm', None) if serv is not None else '')) or '',
-                        base_calculo_icms=(getattr(contrato, 'servico_base_calculo_icms_default', None) if getattr(contrato, 'servico_base_calculo_icms_default', None) is not None else getattr(serv, 'base_calculo_icms_default', None)) or 0,
-                        aliquota_icms=(getattr(contrato, 'servico_aliquota_icms_default', None) if getattr(contrato, 'servico_aliquota_icms_default', None) is not None else getattr(serv, 'aliquota_icms_default', None)) or 0,
-                        base_calculo_pis=(getattr(contrato, 'servico_base_calculo_pis_default', None) if getattr(contrato, 'servico_base_calculo_pis_default', None) is not None else getattr(serv, 'base_calculo_pis_default', None)) or 0,
-                        aliquota_pis=(getattr(contrato, 'servico_aliquota_pis_default', None) if getattr(contrato, 'servico_aliquota_pis_default', None) is not None else getattr(serv, 'aliquota_pis_default', None)) or 0,
-                        base_calculo_cofins=(getattr(contrato, 'servico_base_calculo_cofins_default', None) if getattr(contrato, 'servico_base_calculo_cofins_default', None) is not None else getattr(serv, 'base_calculo_cofins_default', None)) or 0,
-                        aliquota_cofins=(getattr(contrato, 'servico_aliquota_cofins_default', None) if getattr(contrato, 'servico_aliquota_cofins_default', None) is not None else getattr(serv, 'aliquota_cofins_default', None)) or 0,
-                        valor_total=valor_total_plano
-                    )
-                    db.add(item_plano)
-                    itens_criados.append(item_plano)
-
-                    # Item 2: Taxa de instalação (se aplicável)
-                    if taxa_instalacao > 0 and not taxa_paga:
-                        # Cria um serviço específico para taxa de instalação ou usa um genérico
-                        # Aqui assumimos que existe um serviço padrão para "Taxa de Instalação"
-                        # ou podemos criar um item genérico
-                        item_taxa = models.NFComItem(
-                            nfcom_id=db_nf.id,
-                            servico_id=None,  # Taxa não está ligada a um serviço específico
-                            cClass='010101',  # Código genérico para serviços - pode ser configurado
-                            codigo_servico='TAXA_INSTALACAO',
-                            descricao_servico='Taxa de Instalação de Serviço de Telecomunicações',
-                            quantidade=1,
-                            unidade_medida='UN',
-                            valor_unitario=taxa_instalacao,
-                            valor_desconto=0,
-                            valor_outros=0,
-                            # Campos fiscais específicos para taxa de instalação
-                            # Estes podem ser diferentes do plano de assinatura
-                            cfop='5307',  # CFOP específico para serviços de instalação
-                            ncm='',  # Taxa de instalação geralmente não tem NCM
-                            base_calculo_icms=taxa_instalacao,  # Base de cálculo = valor da taxa
-                            aliquota_icms=18.0,  # Alíquota padrão - pode ser configurada
-                            base_calculo_pis=taxa_instalacao,
-                            aliquota_pis=0.65,  # PIS para serviços
-                            base_calculo_cofins=taxa_instalacao,
-                            aliquota_cofins=3.0,  # COFINS para serviços
-                            valor_total=taxa_instalacao
-                        )
-                        db.add(item_taxa)
-                        itens_criados.append(item_taxa)
-
-                        # Marca a taxa como paga no contrato
-                        contrato.taxa_instalacao_paga = True
-                        db.add(contrato)
-
-
-                    # Cria fatura se houver vencimento/valor
-                    try:
-                        import datetime as _dt
-                        import calendar as _cal
+    # Determina valor unitário final (prioriza valor do contrato, senão valor do serviço)
+    serv_vu = None
+    try:
+        serv_vu = float(getattr(serv, 'valor_unitario', 0) or 0)
+    except Exception:
+        serv_vu = 0.0
+
+    final_vu = contrato_vu if contrato_vu and contrato_vu > 0 else serv_vu
+
+    item_plano = models.NFComItem(
+        nfcom_id=db_nf.id,
+        servico_id=getattr(contrato, 'servico_id', None),
+        cClass=getattr(serv, 'cClass', '') if serv is not None else '',
+        codigo_servico=getattr(serv, 'codigo', '') if serv is not None else '',
+        descricao_servico=getattr(serv, 'descricao', '') if serv is not None else '',
+        quantidade=getattr(contrato, 'quantidade', 1) or 1,
+        unidade_medida=getattr(serv, 'unidade_medida', '4') if serv is not None else '4',
+        valor_unitario=final_vu,
+        # Preencher campos fiscais padrão do serviço/contrato
+        valor_desconto=(getattr(contrato, 'valor_desconto', None) if getattr(contrato, 'valor_desconto', None) is not None else getattr(serv, 'valor_desconto_default', 0)) or 0,
+        valor_outros=(getattr(contrato, 'valor_outros', None) if getattr(contrato, 'valor_outros', None) is not None else getattr(serv, 'valor_outros_default', 0)) or 0,
+        cfop=(getattr(contrato, 'servico_cfop', None) or (getattr(serv, 'cfop', None) if serv is not None else '') ) or '',
+        ncm=(getattr(contrato, 'servico_ncm', None) or (getattr(serv, 'ncm', None) if serv is not None else '')) or '',
+        base_calculo_icms=(getattr(contrato, 'servico_base_calculo_icms_default', None) if getattr(contrato, 'servico_base_calculo_icms_default', None) is not None else getattr(serv, 'base_calculo_icms_default', None)) or 0,
+        aliquota_icms=(getattr(contrato, 'servico_aliquota_icms_default', None) if getattr(contrato, 'servico_aliquota_icms_default', None) is not None else getattr(serv, 'aliquota_icms_default', None)) or 0,
+        base_calculo_pis=(getattr(contrato, 'servico_base_calculo_pis_default', None) if getattr(contrato, 'servico_base_calculo_pis_default', None) is not None else getattr(serv, 'base_calculo_pis_default', None)) or 0,
+        aliquota_pis=(getattr(contrato, 'servico_aliquota_pis_default', None) if getattr(contrato, 'servico_aliquota_pis_default', None) is not None else getattr(serv, 'aliquota_pis_default', None)) or 0,
+        base_calculo_cofins=(getattr(contrato, 'servico_base_calculo_cofins_default', None) if getattr(contrato, 'servico_base_calculo_cofins_default', None) is not None else getattr(serv, 'base_calculo_cofins_default', None)) or 0,
+        aliquota_cofins=(getattr(contrato, 'servico_aliquota_cofins_default', None) if getattr(contrato, 'servico_aliquota_cofins_default', None) is not None else getattr(serv, 'aliquota_cofins_default', None)) or 0,
+        valor_total=valor_total_plano
+    )
+    db.add(item_plano)
+    itens_criados.append(item_plano)
+
+    # Item 2: Taxa de instalação (se aplicável)
+    if taxa_instalacao > 0 and not taxa_paga:
+        # Cria um serviço específico para taxa de instalação ou usa um genérico
+        # Aqui assumimos que existe um serviço padrão para "Taxa de Instalação"
+        # ou podemos criar um item genérico
+        item_taxa = models.NFComItem(
+            nfcom_id=db_nf.id,
+            servico_id=None,  # Taxa não está ligada a um serviço específico
+            cClass='010101',  # Código genérico para serviços - pode ser configurado
+            codigo_servico='TAXA_INSTALACAO',
+            descricao_servico='Taxa de Instalação de Serviço de Telecomunicações',
+            quantidade=1,
+            unidade_medida='UN',
+            valor_unitario=taxa_instalacao,
+            valor_desconto=0,
+            valor_outros=0,
+            # Campos fiscais específicos para taxa de instalação
+            # Estes podem ser diferentes do plano de assinatura
+            cfop='5307',  # CFOP específico para serviços de instalação
+            ncm='',  # Taxa de instalação geralmente não tem NCM
+            base_calculo_icms=taxa_instalacao,  # Base de cálculo = valor da taxa
+            aliquota_icms=18.0,  # Alíquota padrão - pode ser configurada
+            base_calculo_pis=taxa_instalacao,
+            aliquota_pis=0.65,  # PIS para serviços
+            base_calculo_cofins=taxa_instalacao,
+            aliquota_cofins=3.0,  # COFINS para serviços
+            valor_total=taxa_instalacao
+        )
+        db.add(item_taxa)
+        itens_criados.append(item_taxa)
 
-                        # 1. Tenta buscar primeiro o Receivable real deste contrato gerado no mês atual
-                        # para obtermos o vencimento e o número da fatura reais e garantirmos sincronia total.
-                        real_receivable = None
-                        try:
-                            from app.models.models import Receivable
-                            today = _dt.date.today()
-                            start_month = _dt.datetime(today.year, today.month, 1, 0, 0, 0)
-                            real_receivable = db.query(Receivable).filter(
-                                Receivable.servico_contratado_id == contrato.id,
-                                Receivable.issue_date >= start_month
-                            ).order_by(Receivable.id.desc()).first()
-
-                            if not real_receivable:
-                                # Fallback: pegar o mais recente do contrato
-                                real_receivable = db.query(Receivable).filter(
-                                    Receivable.servico_contratado_id == contrato.id
-                                ).order_by(Receivable.id.desc()).first()
-                        except Exception:
-                            real_receivable = None
+        # Marca a taxa como paga no contrato
+        contrato.taxa_instalacao_paga = True
+        db.add(contrato)
 
-                        dv = None
-                        if real_receivable and real_receivable.due_date:
-                            dv = real_receivable.due_date
-
-                        if dv is None:
-                            # Fallback: cálculo tradicional caso não haja Receivable cadastrado
-                            def _build_by_day(day_num: int, base_date: _dt.date) -> _dt.date:
-                                year = base_date.year
-                                month = base_date.month
-                                last_day = _cal.monthrange(year, month)[1]
-                                use_day = min(int(day_num), last_day)
-                                candidate = _dt.date(year, month, use_day)
-                                if candidate <= base_date:
-                                    # avançar para próximo mês
-                                    if month == 12:
-                                        year += 1
-                                        month = 1
-                                    else:
-                                        month += 1
-                                    last_day = _cal.monthrange(year, month)[1]
-                                    use_day = min(int(day_num), last_day)
-                                    candidate = _dt.date(year, month, use_day)
-                                return candidate
-
-                            today = _dt.date.today()
-
-                            day_from_venc = None
-                            # Prioriza dia_vencimento (novo campo)
-                            if getattr(contrato, 'dia_vencimento', None) is not None:
-                                try:
-                                    day_from_venc = int(getattr(contrato, 'dia_vencimento'))
-                                except Exception:
-                                    day_from_venc = None
-                            else:
-                                # Fallback para legacy `vencimento` date (extrai dia se possível)
-                                venc = getattr(contrato, 'vencimento', None)
-                                if venc is not None:
-                                    try:
-                                        # Se for string ISO, extrai dia
-                                        if isinstance(venc, str):
-                                            # aceita 'YYYY-MM-DD' ou 'YYYY-MM-DDTHH:MM:SS...'
-                                            import re as _re
-                                            m = _re.match(r"^(\d{4})-(\d{2})-(\d{2})", venc)
-                                            if m:
-                                                day_from_venc = int(m.group(3))
-                                        elif isinstance(venc, (_dt.datetime, _dt.date)):
-                                            day_from_venc = int(venc.day)
-                                        elif isinstance(venc, (int, float)):
-                                            # epoch millis/seconds? tentar converter
-                                            try:
-                                                candidate_dt = _dt.datetime.fromtimestamp(float(venc))
-                                                day_from_venc = int(candidate_dt.day)
-                                            except Exception:
-                                                day_from_venc = None
-                                    except Exception:
-                                        day_from_venc = None
-
-                            if day_from_venc:
-                                # Construir vencimento usando apenas o dia informado
-                                venc = _build_by_day(day_from_venc, today)
-                            else:
-                                # Se não houver `vencimento` explícito utilizável, derivamos a partir do `dia_emissao`
-                                dia = getattr(contrato, 'dia_emissao', None)
-                                if dia:
-                                    venc = _build_by_day(int(dia), today)
 
-                            # Como fallback, usa datas de contrato (fim/ini) se ainda sem vencimento
-                            if venc is None:
-                                venc = getattr(contrato, 'd_contrato_fim', None) or getattr(contrato, 'd_contrato_ini', None)
+    # Cria fatura se houver vencimento/valor
+    try:
+        import datetime as _dt
+        import calendar as _cal
+        # 1. Usa o Receivable real deste contrato (do mês atual ou, na falta, o mais recente)
+        # para obtermos o vencimento e o número da fatura reais e garantirmos sincronia total.
+        real_receivable = ctx.receivables.get(contrato.id)
+
+        dv = None
+        if real_receivable and real_receivable.due_date:
+            dv = real_receivable.due_date
+
+        if dv is None:
+            # Fallback: cálculo tradicional caso não haja Receivable cadastrado
+            def _build_by_day(day_num: int, base_date: _dt.date) -> _dt.date:
+                year = base_date.year
+                month = base_date.month
+                last_day = _cal.monthrange(year, month)[1]
+                use_day = min(int(day_num), last_day)
+                candidate = _dt.date(year, month, use_day)
+                if candidate <= base_date:
+                    # avançar para próximo mês
+                    if month == 12:
+                        year += 1
+                        month = 1
+                    else:
+                        month += 1
+                    last_day = _cal.monthrange(year, month)[1]
+                    use_day = min(int(day_num), last_day)
+                    candidate = _dt.date(year, month, use_day)
+                return candidate
 
-                            if venc:
-                                # Normaliza para datetime quando possível (suporta date, datetime e strings ISO)
-                                try:
-                                    if isinstance(venc, _dt.datetime):
-                                        dv = venc
-                                    elif isinstance(venc, _dt.date):
-                                        dv = _dt.datetime.combine(venc, _dt.datetime.min.time())
-                                    elif isinstance(venc, str):
-                                        # tenta parse ISO primeiro, depois dateutil como fallback
-                                        try:
-                                            dv = _dt.datetime.fromisoformat(venc)
-                                        except Exception:
-                                            try:
-                                                from dateutil import parser as _p
-                                                dv = _p.parse(venc)
-                                            except Exception:
-                                                dv = None
-                                    else:
-                                        dv = None
-                                except Exception:
-                                    dv = None
-
-                        if dv is not None:
-                            numero_fatura_real = None
-                            if real_receivable:
-                                numero_fatura_real = real_receivable.nosso_numero or str(real_receivable.id)
-
-                            numero_fatura = numero_fatura_real or str(getattr(contrato, 'numero_contrato', f'CT{cid}'))
-
-                            nf_fat = models.NFComFatura(
-                                nfcom_id=db_nf.id,
-                                numero_fatura=numero_fatura,
-                                data_vencimento=dv,
-                                valor_fatura=valor_total or 0
-                            )
-                            db.add(nf_fat)
-                            db.flush()
-
-                            # Se o Receivable real foi encontrado, associar o ID da fatura da NFCom a ele
-                            if real_receivable:
-                                try:
-                                    real_receivable.nfcom_fatura_id = nf_fat.id
-                                    db.add(real_receivable)
-                                    db.flush()
-                                except Exception:
-                                    pass
+            today = _dt.date.today()
 
-                            # Debug opcional para rastrear criação automática de faturas
+            day_from_venc = None
+            # Prioriza dia_vencimento (novo campo)
+            if getattr(contrato, 'dia_vencimento', None) is not None:
+                try:
+                    day_from_venc = int(getattr(contrato, 'dia_vencimento'))
+                except Exception:
+                    day_from_venc = None
+            else:
+                # Fallback para legacy `vencimento` date (extrai dia se possível)
+                venc = getattr(contrato, 'vencimento', None)
+                if venc is not None:
+                    try:
+                        # Se for string ISO, extrai dia
+                        if isinstance(venc, str):
+                            # aceita 'YYYY-MM-DD' ou 'YYYY-MM-DDTHH:MM:SS...'
+                            import re as _re
+                            m = _re.match(r"^(\d{4})-(\d{2})-(\d{2})", venc)
+                            if m:
+                                day_from_venc = int(m.group(3))
+                        elif isinstance(venc, (_dt.datetime, _dt.date)):
+                            day_from_venc = int(venc.day)
+                        elif isinstance(venc, (int, float)):
+                            # epoch millis/seconds? tentar converter
                             try:
-                                print(f"DEBUG: Fatura criada automaticamente para contrato {cid} com número real {numero_fatura} e vencimento {dv}")
+                                candidate_dt = _dt.datetime.fromtimestamp(float(venc))
+                                day_from_venc = int(candidate_dt.day)
                             except Exception:
-                                pass
+                                day_from_venc = None
                     except Exception:
-                        # não bloquear criação por falha na fatura
-                        pass
+                        day_from_venc = None
 
-                    # Commit por contrato para persistir e evitar bloqueios
-                    db.commit()
-                    db.refresh(db_nf)
+            if day_from_venc:
+                # Construir vencimento usando apenas o dia informado
+                venc = _build_by_day(day_from_venc, today)
+            else:
+                # Se não houver `vencimento` explícito utilizável, derivamos a partir do `dia_emissao`
+                dia = getattr(contrato, 'dia_emissao', None)
+                if dia:
+                    venc = _build_by_day(int(dia), today)
+
+            # Como fallback, usa datas de contrato (fim/ini) se ainda sem vencimento
+            if venc is None:
+                venc = getattr(contrato, 'd_contrato_fim', None) or getattr(contrato, 'd_contrato_ini', None)
 
-                    # Se solicitado, transmite a NFCom imediatamente
-                    transmit_result = None
-                    transmitted = False
-                    if transmit:
+            if venc:
+                # Normaliza para datetime quando possível (suporta date, datetime e strings ISO)
+                try:
+                    if isinstance(venc, _dt.datetime):
+                        dv = venc
+                    elif isinstance(venc, _dt.date):
+                        dv = _dt.datetime.combine(venc, _dt.datetime.min.time())
+                    elif isinstance(venc, str):
+                        # tenta parse ISO primeiro, depois dateutil como fallback
                         try:
-                            transmit_result = transmit_nfcom(db, nfcom_id=db_nf.id, empresa_id=empresa_id)
-                            # Considera transmitida se cStat == '100'
-                            if isinstance(transmit_result, dict) and str(transmit_result.get('cStat', '')).strip() == '100':
-                                transmitted = True
-                        except HTTPException as he:
-                            # Transmissão falhou — registrar como falha
+                            dv = _dt.datetime.fromisoformat(venc)
+                        except Exception:
                             try:
-                                db.rollback()
+                                from dateutil import parser as _p
+                                dv = _p.parse(venc)
                             except Exception:
-                                pass
-                            failures.append({
-                                "contract_id": cid,
-                                "nfcom_id": getattr(db_nf, 'id', None),
-                                "error": f"Transmissão falhou: {he.detail}"
-                            })
-                            # continuar para o próximo contrato
-                            continue
-                        except Exception as te:
-                            try:
-                                db.rollback()
-                            except Exception:
-                                pass
-                            failures.append({"contract_id": cid, "nfcom_id": getattr(db_nf, 'id', None), "error": f"Erro na transmissão: {te}"})
-                            continue
+                                dv = None
+                    else:
+                        dv = None
+                except Exception:
+                    dv = None
+
+        if dv is not None:
+            numero_fatura_real = None
+            if real_receivable:
+                numero_fatura_real = real_receivable.nosso_numero or str(real_receivable.id)
+
+            numero_fatura = numero_fatura_real or str(getattr(contrato, 'numero_contrato', f'CT{cid}'))
+
+            nf_fat = models.NFComFatura(
+                nfcom_id=db_nf.id,
+                numero_fatura=numero_fatura,
+                data_vencimento=dv,
+                valor_fatura=valor_total or 0
+            )
+            db.add(nf_fat)
+            db.flush()
+
+            # Se o Receivable real foi encontrado, associar o ID da fatura da NFCom a ele
+            if real_receivable:
+                try:
+                    real_receivable.nfcom_fatura_id = nf_fat.id
+                    db.add(real_receivable)
+                    db.flush()
+                except Exception:
+                    pass
+
+            # Debug opcional para rastrear criação automática de faturas
+            try:
+                print(f"DEBUG: Fatura criada automaticamente para contrato {cid} com número real {numero_fatura} e vencimento {dv}")
+            except Exception:
+                pass
+    except Exception:
+        # não bloquear criação por falha na fatura
+        pass
+
+    return db_nf
+
 
-                    successes.append({
+def iter_bulk_emit_nfcom(
+    db: Session,
+    contract_ids: list,
+    empresa_id: int,
+    execute: bool = False,
+    transmit: bool = False,
+    chunk_size: Optional[int] = None,
+):
+    """Emissão em massa em lote, como gerador de eventos de progresso.
+
+    Produz pares (tipo, item) na ordem em que os resultados ficam prontos:
+    - 'success' / 'failure' / 'skipped': itens do relatório de
+      bulk_emit_nfcom_from_contracts. Em modo execute, 'success' só é
+      produzido depois do commit do bloco em que a nota foi criada;
+    - 'transmitted' (com `transmit`): resultado do envio de uma nota emitida
+      ({contract_id, nfcom_id, transmitted, transmit_result}). Erros de envio
+      chegam como 'failure' com o nfcom_id da nota.
+
+    Os dados de todos os contratos são pré-carregados (_BulkEmitContext).
+    Cada contrato é gravado em um savepoint e o commit é feito a cada
+    `chunk_size` notas (NFCOM_BULK_CHUNK_SIZE); se o commit de um bloco
+    falhar, as notas do bloco viram falhas e seus números voltam para a
+    faixa reservada. As notas emitidas são transmitidas ao final por
+    transmit_nfcoms, que gera/assina os XMLs e envia em paralelo.
+    """
+    if not contract_ids:
+        return
+
+    ctx = _BulkEmitContext(db, empresa_id, contract_ids, execute)
+    chunk_size = max(1, chunk_size or NFCOM_BULK_CHUNK_SIZE)
+    serie = 1
+    emitidas = []  # (contract_id, nfcom_id) já gravadas
+    pendentes = []  # (item de sucesso, undo do registro) do bloco atual
+
+    if execute:
+        # Reserva de uma vez a faixa dos contratos que serão emitidos e libera a
+        # trava logo em seguida; o número só avança quando o bloco com a NFCom
+        # do contrato é gravado
+        quantidade = ctx.count_emittable(contract_ids)
+        if quantidade:
+            primeiro_numero = reserve_numeros_nf(db, empresa_id=empresa_id, serie=serie, quantidade=quantidade)
+            db.commit()
+        else:
+            primeiro_numero = 1
+        reservado_ate = primeiro_numero + quantidade - 1
+        proximo_numero = primeiro_numero
+
+    def _commit_chunk():
+        nonlocal proximo_numero
+        eventos = []
+        try:
+            db.commit()
+        except Exception as e:
+            try:
+                db.rollback()
+            except Exception:
+                pass
+            for item, undo in pendentes:
+                ctx.forget(undo)
+                eventos.append(("failure", {"contract_id": item["contract_id"], "error": f"Erro ao criar NFCom: {e}"}))
+        else:
+            proximo_numero += len(pendentes)
+            for item, _undo in pendentes:
+                emitidas.append((item["contract_id"], item["nfcom_id"]))
+                eventos.append(("success", item))
+        pendentes.clear()
+        return eventos
+
+    # Os objetos pré-carregados continuam válidos entre os commits dos blocos;
+    # sem isso cada commit expiraria contratos, clientes e recebíveis já lidos
+    expire_on_commit = db.expire_on_commit
+    db.expire_on_commit = False
+    try:
+        for cid in contract_ids:
+            try:
+                contrato = ctx.contratos.get(cid)
+                if not contrato:
+                    yield "failure", {"contract_id": cid, "error": "Contrato não encontrado ou não pertence à empresa"}
+                    continue
+
+                erro = _contract_validation_error(contrato)
+                if erro:
+                    yield "failure", {"contract_id": cid, "error": erro}
+                    continue
+
+                if not execute:
+                    yield "success", {
                         "contract_id": cid,
-                        "nfcom_id": db_nf.id,
-                        "numero_nf": db_nf.numero_nf,
-                        "serie": db_nf.serie,
-                        "valor_total": db_nf.valor_total,
-                        "transmitted": transmitted,
-                        "transmit_result": transmit_result
-                    })
+                        "cliente_id": contrato.cliente_id,
+                        "servico_id": contrato.servico_id,
+                        "numero_contrato": getattr(contrato, 'numero_contrato', None),
+                        "d_contrato_ini": getattr(contrato, 'd_contrato_ini', None),
+                        "d_contrato_fim": getattr(contrato, 'd_contrato_fim', None),
+                        "valor_unitario": getattr(contrato, 'valor_unitario', None),
+                        "valor_total": getattr(contrato, 'valor_total', None)
+                    }
+                    continue
+
+                existing_nf = ctx.existing_nf(contrato)
+                if existing_nf:
+                    # Não emitir novamente automaticamente; registrar como pulado
+                    yield "skipped", {
+                        "contract_id": cid,
+                        "cliente_id": getattr(contrato, 'cliente_id', None),
+                        "servico_id": getattr(contrato, 'servico_id', None),
+                        "nfcom_id": getattr(existing_nf, 'id', None),
+                        "numero_nf": getattr(existing_nf, 'numero_nf', None),
+                        "serie": getattr(existing_nf, 'serie', None),
+                        "valor_total": getattr(existing_nf, 'valor_total', None),
+                        "reason": "already_emitted_same_client_service_month"
+                    }
+                    continue
+
+                # Próximo número da faixa reservada (notas do bloco ainda sem commit incluídas)
+                numero_nf = proximo_numero + len(pendentes)
+                try:
+                    with db.begin_nested():
+                        db_nf = _add_contract_nfcom(db, ctx, contrato, numero_nf, serie)
                 except Exception as e:
-                    try:
-                        db.rollback()
-                    except Exception:
-                        pass
-                    failures.append({"contract_id": cid, "error": f"Erro ao criar NFCom: {e}"})
-            else:
-                successes.append({
+                    yield "failure", {"contract_id": cid, "error": f"Erro ao criar NFCom: {e}"}
+                    continue
+
+                item = {
                     "contract_id": cid,
-                    "cliente_id": contrato.cliente_id,
-                    "servico_id": contrato.servico_id,
-                    "numero_contrato": getattr(contrato, 'numero_contrato', None),
-                    "d_contrato_ini": getattr(contrato, 'd_contrato_ini', None),
-                    "d_contrato_fim": getattr(contrato, 'd_contrato_fim', None),
-                    "valor_unitario": getattr(contrato, 'valor_unitario', None),
-                    "valor_total": getattr(contrato, 'valor_total', None)
-                })
+                    "nfcom_id": db_nf.id,
+                    "numero_nf": db_nf.numero_nf,
+                    "serie": db_nf.serie,
+                    "valor_total": db_nf.valor_total,
+                    "transmitted": False,
+                    "transmit_result": None
+                }
+                pendentes.append((item, ctx.register(contrato, db_nf)))
+                if len(pendentes) >= chunk_size:
+                    yield from _commit_chunk()
+
+            except HTTPException:
+                # Repropaga erros HTTP já formatados
+                raise
+            except Exception as e:
+                yield "failure", {"contract_id": cid, "error": f"Erro ao processar contrato: {e}"}
+
+        if pendentes:
+            yield from _commit_chunk()
+
+    finally:
+        db.expire_on_commit = expire_on_commit
+        if execute:
+            # Descarta um bloco interrompido e devolve os números que sobraram
+            # (contratos pulados ou com falha)
+            try:
+                db.rollback()
+                release_numeros_nf(db, empresa_id, serie, reservado_ate, proximo_numero - 1)
+                db.commit()
+            except Exception:
+                db.rollback()
+
+    if not (execute and transmit and emitidas):
+        return
+
+    contrato_por_nf = {nfcom_id: cid for cid, nfcom_id in emitidas}
+    for ok, item in transmit_nfcoms(db, empresa_id, [nfcom_id for _cid, nfcom_id in emitidas]):
+        nfcom_id = item.get("nfcom_id")
+        cid = contrato_por_nf.get(nfcom_id)
+        if ok or item.get("error") == "transmit_failed":
+            # Rejeição da SEFAZ: a nota continua emitida, apenas não autorizada
+            yield "transmitted", {
+                "contract_id": cid,
+                "nfcom_id": nfcom_id,
+                "transmitted": ok,
+                "transmit_result": item.get("resultado", item)
+            }
+        else:
+            yield "failure", {
+                "contract_id": cid,
+                "nfcom_id": nfcom_id,
+                "error": f"Transmissão falhou: {item.get('message') or item.get('error')}"
+            }
 
-        except HTTPException:
-            # Repropaga erros HTTP já formatados
-            raise
-        except Exception as e:
-            failures.append({"contract_id": cid, "error": f"Erro ao processar contrato: {e}"})
 
-    return {"successes": successes, "failures": failures, "skipped": skipped}
+class BulkEmitReport:
+    """Acumula os eventos de iter_bulk_emit_nfcom no relatório successes/failures/skipped."""
+
+    def __init__(self):
+        self.successes = []
+        self.failures = []
+        self.skipped = []
+        # nfcom_id -> item em successes (para registrar o resultado da transmissão)
+        self._emitidas = {}
+
+    def add(self, tipo: str, item: dict) -> None:
+        if tipo == "success":
+            self.successes.append(item)
+            if item.get("nfcom_id") is not None:
+                self._emitidas[item["nfcom_id"]] = item
+        elif tipo == "skipped":
+            self.skipped.append(item)
+        elif tipo == "transmitted":
+            self._emitidas[item["nfcom_id"]].update(transmitted=item["transmitted"], transmit_result=item["transmit_result"])
+        else:
+            # Nota emitida cuja transmissão falhou sai de successes
+            emitida = self._emitidas.pop(item.get("nfcom_id"), None)
+            if emitida is not None:
+                self.successes.remove(emitida)
+            self.failures.append(item)
+
+    def as_dict(self) -> dict:
+        return {"successes": self.successes, "failures": self.failures, "skipped": self.skipped}
+
+
+def bulk_emit_nfcom_from_contracts(db: Session, contract_ids: list, empresa_id: int, execute: bool = False, transmit: bool = False) -> dict:
+    """
+    Emissão em massa a partir de contratos.
+
+    Sem `execute` (dry-run) apenas valida cada contrato e retorna um relatório
+    com os contratos que passaram nas validações (lista `successes`) e os que
+    falharam (lista `failures` com mensagem), sem criar nem transmitir NFComs —
+    é um modo seguro para o frontend validar antes de executar a operação real.
+    Com `execute` cria as NFComs (e com `transmit` as transmite); `skipped`
+    lista os contratos que já têm nota no mês. Ver iter_bulk_emit_nfcom.
+    """
+    report = BulkEmitReport()
+    for tipo, item in iter_bulk_emit_nfcom(db, contract_ids, empresa_id, execute=execute, transmit=transmit):
+        report.add(tipo, item)
+    return report.as_dict()
+
 
 def get_sefaz_url_by_uf(uf: str, ambiente: str, service: str = "recepcao") -> str:
     """Retorna a URL do webservice da SEFAZ com base na UF, ambiente e serviço solicitado.
@@ -2777,12 +3034,19 @@ def transmit_evento_cancelamento(db: Session, nfcom_id: int, empresa_id: int, nP
                 note = f"Evento cancelamento enviado em {datetime.now(timezone.utc).isoformat()}: cStat={cStat} xMotivo={xMotivo} nProt={nProt_event}\nRespostaSEFAZ:\n{response.text}"
                 try:
                     db_nfcom.informacoes_adicionais = (db_nfcom.informacoes_adicionais or '') + "\n" + note
+                    if cStat:
+                        # Evento homologado cancela a nota; rejeição só registra o código
+                        db_nfcom.cstat = str(cStat).strip()
+                        if db_nfcom.cstat in models.NFCOM_CANCEL_CSTATS:
+                            db_nfcom.status = 'cancelada'
                     db.commit()
                 except Exception:
                     try:
                         db.rollback()
                     except Exception:
                         pass
+                # Evento de cancelamento: descarta XML/DANFE armazenados da nota
+                nfcom_artifacts.invalidate(db_nfcom.chave_acesso)
 
                 # cStat 218 = NFCom já está cancelada no SEFAZ
                 if str(cStat).strip() == '218':
@@ -2790,8 +3054,10 @@ def transmit_evento_cancelamento(db: Session, nfcom_id: int, empresa_id: int, nP
                     try:
                         # Extrai informações do cancelamento da mensagem de erro
                         note_218 = f"NFCom já cancelada no SEFAZ: cStat=218 {xMotivo}"
-                        if 'cStat=135' not in (db_nfcom.informacoes_adicionais or ''):
-                            db_nfcom.informacoes_adicionais = (db_nfcom.informacoes_adicionais or '').rstrip() + f"\n{note_218}\ncStat=135\n"
+                        if db_nfcom.status != 'cancelada':
+                            db_nfcom.informacoes_adicionais = (db_nfcom.informacoes_adicionais or '').rstrip() + f"\n{note_218}\n"
+                            db_nfcom.status = 'cancelada'
+                            db_nfcom.cstat = '218'
                             db.commit()
                             print(f"INFO: NFCom {db_nfcom.id} marcada como cancelada via cStat=218")
                     except Exception as e:
@@ -2804,7 +3070,7 @@ def transmit_evento_cancelamento(db: Session, nfcom_id: int, empresa_id: int, nP
                 # If SEFAZ returned duplication (cStat 631), we should query SEFAZ for the NFCom
                 # status/events to determine whether there is a prior cancelamento event already
                 # registered. If a prior cancel is found (cStat 135/136/134 inside procEventoNFCom),
-                # record it in informacoes_adicionais so that get_nfcom() marks NFCom as 'cancelada'.
+                # record it in informacoes_adicionais and set the NFCom status to 'cancelada'.
                 if str(cStat).strip() == '631' and xMotivo and 'Duplicidade de evento' in xMotivo:
                     print(f"INFO: Detectado cStat=631 (duplicidade) para NFCom {db_nfcom.id}. Consultando SEFAZ...")
                     consulta_sucesso = False
@@ -2820,8 +3086,10 @@ def transmit_evento_cancelamento(db: Session, nfcom_id: int, empresa_id: int, nP
                         try:
                             # cStat 631 indica que o evento JÁ EXISTE no SEFAZ, então marcamos como cancelada
                             note = f"Evento cancelamento detectado via cStat=631 (duplicidade): xMotivo={xMotivo}"
-                            if note not in (db_nfcom.informacoes_adicionais or ''):
-                                db_nfcom.informacoes_adicionais = (db_nfcom.informacoes_adicionais or '').rstrip() + f"\n{note}\ncStat=135\n"
+                            if db_nfcom.status != 'cancelada':
+                                db_nfcom.informacoes_adicionais = (db_nfcom.informacoes_adicionais or '').rstrip() + f"\n{note}\n"
+                                db_nfcom.status = 'cancelada'
+                                db_nfcom.cstat = '631'
                                 db.commit()
                                 print(f"INFO: NFCom {db_nfcom.id} marcada como cancelada via cStat=631")
                         except Exception as e:
@@ -2922,9 +3190,9 @@ def consultar_status_servico_sefaz(db: Session, empresa_id: int, ambiente: str):
 def _check_and_mark_cancelado_from_consulta(db: Session, db_nfcom, empresa_row):
     """Consulta a situação da NFCom (consSitNFCom) e procura por eventos de cancelamento homologados.
 
-    Se encontrar um evento 110111 com cStat em (135,136,134), atualiza
-    `db_nfcom.informacoes_adicionais` com os detalhes do evento para que o
-    método `get_nfcom()` marque a nota como cancelada.
+    Se encontrar um evento 110111 com cStat em (135,136,134), registra os
+    detalhes do evento em `db_nfcom.informacoes_adicionais` e marca a nota
+    como 'cancelada'.
     """
     try:
         tpAmb = '1' if getattr(empresa_row, 'ambiente_nfcom', None) == 'producao' else ('2' if getattr(empresa_row, 'ambiente_nfcom', None) == 'homologacao' else ('1' if settings.NFCOM_AMBIENTE == 'producao' else '2'))
@@ -2993,11 +3261,14 @@ def _check_and_mark_cancelado_from_consulta(db: Session, db_nfcom, empresa_row):
             if code in ('135', '136', '134'):
                 xMotivo_elem = proc.find('.//nfcom:xMotivo', ns)
                 nProt_elem = proc.find('.//nfcom:nProt', ns)
-                # Anexa observação para que get_nfcom() reconheça cancelamento
+                # Anexa observação do evento para auditoria
                 note = f"Evento cancelamento detectado via consulta: cStat={code} xMotivo={(xMotivo_elem.text if xMotivo_elem is not None else '')} nProt={(nProt_elem.text if nProt_elem is not None else '')}"
                 try:
                     db_nfcom.informacoes_adicionais = (db_nfcom.informacoes_adicionais or '') + "\n" + note
+                    db_nfcom.status = 'cancelada'
+                    db_nfcom.cstat = code
                     db.commit()
+                    nfcom_artifacts.invalidate(db_nfcom.chave_acesso)
                     print(f"INFO: Atualizado informacoes_adicionais para NFCom {db_nfcom.id} com evento de cancelamento: cStat={code}")
                 except Exception:
                     try:
@@ -3011,10 +3282,48 @@ def _check_and_mark_cancelado_from_consulta(db: Session, db_nfcom, empresa_row):
         print(f"ERRO na consulta de eventos (consSitNFCom): {e}")
         return False
 
-def transmit_nfcom(db: Session, nfcom_id: int, empresa_id: int) -> dict:
+def _open_sefaz_session(empresa_raw, pool_size: int = NFCOM_SEFAZ_MAX_IN_FLIGHT) -> SefazSession:
+    """Carrega o certificado A1 da empresa em uma SefazSession.
+
+    Usa o mesmo material em cache da assinatura; o PEM temporário é
+    removido assim que o SSLContext da sessão é carregado.
     """
-    Transmite uma NFCom para o webservice da SEFAZ.
-    SEMPRE gera e assina o XML na hora da transmissão para garantir formato correto.
+    if not empresa_raw or not empresa_raw.certificado_path or not empresa_raw.certificado_senha:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Certificado digital da empresa não configurado.")
+
+    material = _get_signing_material(empresa_raw)
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.pem', prefix='cert_')
+    try:
+        tmp.write(material.full_pem)
+        tmp.close()
+        return SefazSession(tmp.name, pool_size=pool_size)
+    finally:
+        # Garante que o arquivo PEM temporário seja excluído
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+
+
+def _empresa_snapshot(empresa):
+    """Cópia simples dos campos do emitente usados em generate_nfcom_xml.
+
+    Permite gerar o XML fora da thread da Session sem disparar lazy loads.
+    """
+    if empresa is None:
+        return None
+    campos = (
+        'id', 'cnpj', 'razao_social', 'inscricao_estadual', 'regime_tributario',
+        'endereco', 'numero', 'bairro', 'municipio', 'uf', 'cep', 'codigo_ibge',
+        'ambiente_nfcom',
+    )
+    return SimpleNamespace(**{campo: getattr(empresa, campo, None) for campo in campos})
+
+
+def _transmission_job(db: Session, nfcom_id: int, empresa_id: int):
+    """Etapa da preparação que usa a Session: busca a nota, gera a chave de acesso
+    e tira um snapshot para geração do XML.
+
+    Retorna (db_nfcom, empresa_raw, job). `job` só contém objetos simples e
+    pode ser processado por _build_transmission_envelope em outra thread.
     """
     # 1. Busca a NFCom e a Empresa
     db_nfcom = get_nfcom(db, nfcom_id=nfcom_id, empresa_id=empresa_id)
@@ -3071,9 +3380,60 @@ def transmit_nfcom(db: Session, nfcom_id: int, empresa_id: int) -> dict:
         except Exception:
             pass
 
+        snapshot = _make_nfcom_snapshot(db_nfcom, _empresa_snapshot(db_nfcom.empresa))
+    except Exception as e:
+        print(f"ERRO ao gerar XML para transmissão: {e}")
+        raise HTTPException(status_code=500, detail=f"Erro ao gerar XML para transmissão: {e}")
+
+    # 3. Define a URL do Webservice da SEFAZ (permite preferência por empresa)
+    empresa_ambiente = getattr(empresa_raw, 'ambiente_nfcom', None)
+    if empresa_ambiente in ('producao', 'homologacao'):
+        ambiente = empresa_ambiente
+    else:
+        # Usar configuração global se não especificado por empresa
+        ambiente = settings.NFCOM_AMBIENTE
+    sefaz_url = get_sefaz_url_by_uf(db_nfcom.empresa.uf, ambiente)
+    print(f"DEBUG: Ambiente={ambiente}, WebService URL={sefaz_url}")
+
+    job = SimpleNamespace(
+        nfcom_id=db_nfcom.id,
+        chave_acesso=db_nfcom.chave_acesso,
+        tipo_emissao=getattr(db_nfcom, 'tipo_emissao', None),
+        ambiente_nfcom=empresa_ambiente,
+        snapshot=snapshot,
+        empresa_para_assinatura=empresa_para_assinatura,
+        sefaz_url=sefaz_url,
+    )
+    return db_nfcom, empresa_raw, job
+
+
+def _debug_dump(prefix: str, content, suffix: str = '.xml'):
+    """Salva `content` em um arquivo temporário quando NFCOM_SIGN_DEBUG está ativo.
+
+    Retorna o caminho do arquivo ou None.
+    """
+    if not NFCOM_SIGN_DEBUG:
+        return None
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    try:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, prefix=prefix, dir=tempfile.gettempdir()) as tmp:
+            tmp.write(content or b'')
+            return tmp.name
+    except Exception:
+        print("WARN: não foi possível salvar arquivo de diagnóstico:\n", traceback.format_exc())
+        return None
+
+
+def _build_transmission_envelope(job):
+    """Gera, assina e empacota o XML de um `job` de _transmission_job.
+
+    Não acessa o banco; é seguro executar em um pool de threads.
+    Retorna (xml_assinado, soap_body, soap_file_path).
+    """
+    try:
         # Gera XML não assinado
-        snapshot = _make_nfcom_snapshot(db_nfcom, db_nfcom.empresa)
-        xml_nao_assinado = generate_nfcom_xml(snapshot)
+        xml_nao_assinado = generate_nfcom_xml(job.snapshot)
         # Valida localmente o XML gerado contra o XSD disponibilizado no repositório.
         # Isso evita enviar XML rejeitado por problemas de posicionamento/ordem de elementos
         # e fornece diagnóstico imediato para correção.
@@ -3088,14 +3448,13 @@ def transmit_nfcom(db: Session, nfcom_id: int, empresa_id: int) -> dict:
                     # incluir temporariamente o <infNFComSupl> com o QR aqui também.
 
                     # Determina URL do QR Code pela UF da chave usando função helper
-                    uf_code = db_nfcom.chave_acesso[:2] if db_nfcom.chave_acesso else "41"
+                    uf_code = job.chave_acesso[:2] if job.chave_acesso else "41"
                     # Preferir o ambiente definido na empresa_raw quando disponível
-                    empresa_ambiente = getattr(empresa_raw, 'ambiente_nfcom', None)
+                    empresa_ambiente = job.ambiente_nfcom
                     qr_code_base_url = get_qrcode_url_base(uf_code, ambiente=empresa_ambiente)
 
                     # XSD exige parâmetro tpAmb=[1-2]: pattern obrigatório conforme nfcomTiposBasico_v1.00.xsd linha 1992
                     # Permitir escolha por empresa (ambiente_nfcom). Caso não exista, usar configuração global
-                    empresa_ambiente = getattr(empresa_raw, 'ambiente_nfcom', None)
                     if empresa_ambiente in ('producao', 'producao'):
                         tpAmb = "1"
                     elif empresa_ambiente in ('homologacao', 'homologação', 'homolog'):
@@ -3104,10 +3463,10 @@ def transmit_nfcom(db: Session, nfcom_id: int, empresa_id: int) -> dict:
                         # Usar configuração global se não especificado por empresa
                         tpAmb = "1" if settings.NFCOM_AMBIENTE == "producao" else "2"
 
-                    params = f"?chNFCom={db_nfcom.chave_acesso}&tpAmb={tpAmb}"
+                    params = f"?chNFCom={job.chave_acesso}&tpAmb={tpAmb}"
                     try:
-                        if getattr(db_nfcom, 'tipo_emissao', None) == models.TipoEmissao.CONTINGENCIA:
-                            to_sign = db_nfcom.chave_acesso + settings.SECRET_KEY
+                        if job.tipo_emissao == models.TipoEmissao.CONTINGENCIA:
+                            to_sign = job.chave_acesso + settings.SECRET_KEY
                             signature = hashlib.sha1(to_sign.encode('utf-8')).hexdigest()
                             params += f"&sign={signature}"
                     except Exception:
@@ -3115,18 +3474,14 @@ def transmit_nfcom(db: Session, nfcom_id: int, empresa_id: int) -> dict:
                     # Nota: não podemos validar <infNFCom> isoladamente contra o XSD porque
                     # o XSD só define <NFCom> como raiz global (que exige <Signature>).
                     # A validação completa será feita pelo SEFAZ após assinatura e envio.
-                    # Salvamos o XML não assinado para diagnóstico em caso de rejeição:
-                    temp_unsigned = tempfile.NamedTemporaryFile(
-                        mode='w', encoding='utf-8', suffix='.xml',
-                        prefix=f'unsigned_nfcom_{db_nfcom.id}_', delete=False
-                    )
-                    temp_unsigned.write(xml_nao_assinado)
-                    temp_unsigned.close()
-                    print(f"DEBUG: XML não assinado salvo em: {temp_unsigned.name}")
+                    # Com NFCOM_SIGN_DEBUG salvamos o XML não assinado para diagnóstico em caso de rejeição:
+                    unsigned_path = _debug_dump(f'unsigned_nfcom_{job.nfcom_id}_', xml_nao_assinado)
+                    if unsigned_path:
+                        print(f"DEBUG: XML não assinado salvo em: {unsigned_path}")
                 except HTTPException as ve:
                     # Salva o XML que falhou na validação em arquivo temporário para inspeção
                     try:
-                        tmpf = tempfile.NamedTemporaryFile(delete=False, suffix='.xml', prefix=f'invalid_nfcom_{db_nfcom.id}_', dir=tempfile.gettempdir())
+                        tmpf = tempfile.NamedTemporaryFile(delete=False, suffix='.xml', prefix=f'invalid_nfcom_{job.nfcom_id}_', dir=tempfile.gettempdir())
                         try:
                             tmpf.write(xml_nao_assinado.encode('utf-8'))
                             tmpf.flush()
@@ -3148,20 +3503,7 @@ def transmit_nfcom(db: Session, nfcom_id: int, empresa_id: int) -> dict:
             print("WARN: Falha ao tentar validar XML localmente contra XSD:", traceback.format_exc())
         
         # Assina o XML (já inclui minificação interna)
-        xml_assinado = sign_nfcom_xml(xml_nao_assinado, empresa_para_assinatura, db_nfcom.chave_acesso, getattr(db_nfcom, 'tipo_emissao', None))
-        
-        # Salva o XML assinado no banco IMEDIATAMENTE para garantir que o
-        # conteúdo enviado à SEFAZ esteja sempre persistido, mesmo que a
-        # SEFAZ retorne erro/rejeição. Isso facilita auditoria e reenvio.
-        try:
-            db_nfcom.xml_gerado = xml_assinado
-            db.commit()
-            db.refresh(db_nfcom)
-        except Exception:
-            try:
-                db.rollback()
-            except Exception:
-                pass
+        xml_assinado = sign_nfcom_xml(xml_nao_assinado, job.empresa_para_assinatura, job.chave_acesso, job.tipo_emissao)
 
         print(f"DEBUG: XML gerado e assinado com {len(xml_assinado)} caracteres")
         
@@ -3169,16 +3511,6 @@ def transmit_nfcom(db: Session, nfcom_id: int, empresa_id: int) -> dict:
         print(f"ERRO ao gerar XML para transmissão: {e}")
         raise HTTPException(status_code=500, detail=f"Erro ao gerar XML para transmissão: {e}")
 
-    # 3. Define a URL do Webservice da SEFAZ (permite preferência por empresa)
-    empresa_ambiente = getattr(empresa_raw, 'ambiente_nfcom', None)
-    if empresa_ambiente in ('producao', 'homologacao'):
-        ambiente = empresa_ambiente
-    else:
-        # Usar configuração global se não especificado por empresa
-        ambiente = settings.NFCOM_AMBIENTE
-    sefaz_url = get_sefaz_url_by_uf(db_nfcom.empresa.uf, ambiente)
-    print(f"DEBUG: Ambiente={ambiente}, WebService URL={sefaz_url}")
-
     # 4. Compacta o XML com GZIP e codifica em Base64, como esperado pela SEFAZ.
     xml_bytes = xml_assinado.encode('utf-8')
     gzip_buffer = io.BytesIO()
@@ -3190,198 +3522,340 @@ def transmit_nfcom(db: Session, nfcom_id: int, empresa_id: int) -> dict:
     # "A área referente ao SOAP Header não deverá ser informada."
     soap_body = f"""<soap12:Envelope xmlns:soap12=\"http://www.w3.org/2003/05/soap-envelope\" xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\" xmlns:xsd=\"http://www.w3.org/2001/XMLSchema\"><soap12:Body><nfcomDadosMsg xmlns=\"http://www.portalfiscal.inf.br/nfcom/wsdl/NFComRecepcao\">{dados_comprimidos_base64}</nfcomDadosMsg></soap12:Body></soap12:Envelope>"""
 
-    # Log do XML sendo enviado para debug
-    print("=== XML sendo enviado para SEFAZ ===")
-    print(soap_body)
-    print("=== Fim do XML ===")
-
-    # Salva o envelope SOAP em um arquivo temporário para debug externo (curl/openssl)
-    soap_file_path = None
-    try:
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.xml', prefix=f'soap_nfcom_{db_nfcom.id}_', dir=tempfile.gettempdir())
-        try:
-            tmp.write(soap_body.encode('utf-8'))
-            tmp.flush()
-            soap_file_path = tmp.name
-        finally:
-            tmp.close()
+    # Com NFCOM_SIGN_DEBUG, loga o envelope e o salva em arquivo temporário
+    # para debug externo (curl/openssl)
+    if NFCOM_SIGN_DEBUG:
+        print("=== XML sendo enviado para SEFAZ ===")
+        print(soap_body)
+        print("=== Fim do XML ===")
+    soap_file_path = _debug_dump(f'soap_nfcom_{job.nfcom_id}_', soap_body)
+    if soap_file_path:
         print(f"DEBUG: SOAP salvo em: {soap_file_path}")
-    except Exception:
-        print("WARN: não foi possível salvar o SOAP em arquivo temporário:\n", traceback.format_exc())
-        soap_file_path = None
 
-    # 4. Define os cabeçalhos da requisição
-    # Alguns endpoints rejeitam o parâmetro charset; usar Content-Type sem charset pode evitar rejeição 599
-    headers = {'Content-Type': 'application/soap+xml'}
-    
-    # 5. Prepara o certificado digital para a requisição
-    empresa_raw = crud_empresa.get_empresa_raw(db, empresa_id=empresa_id)
-    if not empresa_raw or not empresa_raw.certificado_path or not empresa_raw.certificado_senha:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Certificado digital da empresa não configurado.")
+    return xml_assinado, soap_body, soap_file_path
 
-    cert_password = decrypt_sensitive_data(empresa_raw.certificado_senha)
-    relative_cert_path = empresa_raw.certificado_path.replace("/secure/", "", 1)
-    absolute_cert_path = Path(settings.CERTIFICATES_DIR) / relative_cert_path
 
-    if not absolute_cert_path.exists():
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Arquivo de certificado não encontrado: {absolute_cert_path}")
-
-    pem_file_path = None
-    response = None
+def _store_xml_gerado(db: Session, db_nfcom, xml_assinado: str) -> None:
+    # Salva o XML assinado no banco antes de processar o retorno para garantir
+    # que o conteúdo enviado à SEFAZ esteja sempre persistido, mesmo que a
+    # SEFAZ retorne erro/rejeição. Isso facilita auditoria e reenvio.
     try:
-        with open(absolute_cert_path, "rb") as f:
-            pfx_data = f.read()
-        
-        pem_file_path = _convert_pfx_to_pem(pfx_data, cert_password)
+        db_nfcom.xml_gerado = xml_assinado
+        db.commit()
+        db.refresh(db_nfcom)
+    except Exception:
+        try:
+            db.rollback()
+        except Exception:
+            pass
 
-        # 6. Envia a requisição SOAP para o SEFAZ
-        response = requests.post(
-            url=sefaz_url,
-            data=soap_body.encode('utf-8'),
-            headers=headers,
-            cert=pem_file_path,
-            verify=False,  # Homologação pode não ter certificado válido
-            timeout=30
-        )
 
-        # 7. Processa a resposta da SEFAZ
-        # Processa a resposta da SEFAZ e sempre retorna o conteúdo para facilitar debug
-        if response is not None:
-            # Se a resposta estiver vazia, evita parsear e retorna detalhes para debug
-            content_len = len(response.content or b'')
-            print(f"DEBUG: resposta SEFAZ status={response.status_code} headers={response.headers} content_len={content_len}")
-            if content_len == 0:
-                # Salva resposta vazia (se houver) para debug
-                resp_tmp = None
-                try:
-                    tmp_resp = tempfile.NamedTemporaryFile(delete=False, suffix='.resp', prefix=f'sefaz_resp_{db_nfcom.id}_', dir=tempfile.gettempdir())
-                    tmp_resp.write(response.content or b'')
-                    tmp_resp.flush()
-                    resp_tmp = tmp_resp.name
-                    tmp_resp.close()
-                except Exception:
-                    resp_tmp = None
+def _prepare_transmission(db: Session, nfcom_id: int, empresa_id: int):
+    """Gera, assina e empacota a NFCom para envio.
 
-                return {"status_code": response.status_code, "error": "Resposta vazia da SEFAZ", "headers": dict(response.headers), "content_len": content_len, "content": response.text, "xml_enviado": soap_body, "soap_file": soap_file_path, "soap_response_file": resp_tmp}
+    Retorna (db_nfcom, empresa_raw, xml_assinado, soap_body, soap_file_path, sefaz_url).
+    """
+    db_nfcom, empresa_raw, job = _transmission_job(db, nfcom_id, empresa_id)
+    xml_assinado, soap_body, soap_file_path = _build_transmission_envelope(job)
+    _store_xml_gerado(db, db_nfcom, xml_assinado)
+    return db_nfcom, empresa_raw, xml_assinado, soap_body, soap_file_path, job.sefaz_url
+
+
+def _process_sefaz_response(db: Session, db_nfcom, response, xml_assinado: str, soap_body: str, soap_file_path) -> dict:
+    """Interpreta o retorno da SEFAZ e grava protocolo/XML do processo quando autorizada."""
+    # 7. Processa a resposta da SEFAZ
+    # Processa a resposta da SEFAZ e sempre retorna o conteúdo para facilitar debug
+    if response is not None:
+        # Se a resposta estiver vazia, evita parsear e retorna detalhes para debug
+        content_len = len(response.content or b'')
+        print(f"DEBUG: resposta SEFAZ status={response.status_code} headers={response.headers} content_len={content_len}")
+        if content_len == 0:
+            # Salva resposta vazia (se houver) para debug
+            resp_tmp = _debug_dump(f'sefaz_resp_{db_nfcom.id}_', response.content, suffix='.resp')
+
+            return {"status_code": response.status_code, "error": "Resposta vazia da SEFAZ", "headers": dict(response.headers), "content_len": content_len, "content": response.text, "xml_enviado": soap_body, "soap_file": soap_file_path, "soap_response_file": resp_tmp}
 
-            try:
-                # Salva o conteúdo bruto da resposta em arquivo para análise offline
-                resp_file_path = None
-                try:
-                    tmp_resp = tempfile.NamedTemporaryFile(delete=False, suffix='.xml', prefix=f'sefaz_resp_{db_nfcom.id}_', dir=tempfile.gettempdir())
-                    tmp_resp.write(response.content or b'')
-                    tmp_resp.flush()
-                    resp_file_path = tmp_resp.name
-                    tmp_resp.close()
-                except Exception:
-                    resp_file_path = None
+        try:
+            # Salva o conteúdo bruto da resposta em arquivo para análise offline
+            resp_file_path = _debug_dump(f'sefaz_resp_{db_nfcom.id}_', response.content)
 
-                # Tenta descompactar se o header indicar gzip
-                try:
-                    encoding = response.headers.get('Content-Encoding', '')
-                    if 'gzip' in encoding.lower():
-                        try:
-                            import gzip as _gzip
-                            decompressed = _gzip.decompress(response.content)
-                            # sobrescreve o arquivo salvo com a versão descomprimida para facilitar leitura
-                            if resp_file_path:
-                                with open(resp_file_path, 'wb') as f:
-                                    f.write(decompressed)
-                            parse_content = decompressed
-                        except Exception:
-                            parse_content = response.content
-                    else:
+            # Tenta descompactar se o header indicar gzip
+            try:
+                encoding = response.headers.get('Content-Encoding', '')
+                if 'gzip' in encoding.lower():
+                    try:
+                        import gzip as _gzip
+                        decompressed = _gzip.decompress(response.content)
+                        # sobrescreve o arquivo salvo com a versão descomprimida para facilitar leitura
+                        if resp_file_path:
+                            with open(resp_file_path, 'wb') as f:
+                                f.write(decompressed)
+                        parse_content = decompressed
+                    except Exception:
                         parse_content = response.content
-                except Exception:
+                else:
                     parse_content = response.content
+            except Exception:
+                parse_content = response.content
 
-                root = ET.fromstring(parse_content)
-                ns_soap = {'soap': 'http://www.w3.org/2003/05/soap-envelope'}
-                ns_nfcom = {'nfcom': 'http://www.portalfiscal.inf.br/nfcom'}
-                ns_wsdl = {'wsdl': 'http://www.portalfiscal.inf.br/nfcom/wsdl/NFComRecepcao'}
-                
-                body = root.find('soap:Body', ns_soap)
+            root = ET.fromstring(parse_content)
+            ns_soap = {'soap': 'http://www.w3.org/2003/05/soap-envelope'}
+            ns_nfcom = {'nfcom': 'http://www.portalfiscal.inf.br/nfcom'}
+            ns_wsdl = {'wsdl': 'http://www.portalfiscal.inf.br/nfcom/wsdl/NFComRecepcao'}
+            
+            body = root.find('soap:Body', ns_soap)
+            
+            # Tenta encontrar retNFCom (resposta com cStat) ou protNFCom (autorização)
+            result_node = None
+            if body is not None:
+                # Primeiro tenta retNFCom (rejeições, erros)
+                result_node = body.find('.//nfcom:retNFCom', ns_nfcom)
+                if result_node is None:
+                    # Se não encontrou, tenta protNFCom (autorização)
+                    result_node = body.find('.//nfcom:protNFCom', ns_nfcom)
+
+            if result_node is not None:
+                # Busca cStat e xMotivo no namespace nfcom
+                cStat_elem = result_node.find('.//nfcom:cStat', ns_nfcom)
+                xMotivo_elem = result_node.find('.//nfcom:xMotivo', ns_nfcom)
+                nProt_elem = result_node.find('.//nfcom:nProt', ns_nfcom)
                 
-                # Tenta encontrar retNFCom (resposta com cStat) ou protNFCom (autorização)
-                result_node = None
-                if body is not None:
-                    # Primeiro tenta retNFCom (rejeições, erros)
-                    result_node = body.find('.//nfcom:retNFCom', ns_nfcom)
-                    if result_node is None:
-                        # Se não encontrou, tenta protNFCom (autorização)
-                        result_node = body.find('.//nfcom:protNFCom', ns_nfcom)
-
-                if result_node is not None:
-                    # Busca cStat e xMotivo no namespace nfcom
-                    cStat_elem = result_node.find('.//nfcom:cStat', ns_nfcom)
-                    xMotivo_elem = result_node.find('.//nfcom:xMotivo', ns_nfcom)
-                    nProt_elem = result_node.find('.//nfcom:nProt', ns_nfcom)
-                    
-                    cStat = cStat_elem.text if cStat_elem is not None else "N/A"
-                    xMotivo = xMotivo_elem.text if xMotivo_elem is not None else "N/A"
-                    nProt = nProt_elem.text if nProt_elem is not None else None
-
-                    print(f"=== RESPOSTA SEFAZ ===")
-                    print(f"cStat: {cStat}")
-                    print(f"xMotivo: {xMotivo}")
-                    print(f"nProt: {nProt}")
-                    print(f"===================")
-
-                    if cStat == "100":
-                        # Autorizada! Extrai apenas o protNFCom da resposta, não o retNFCom inteiro
-                        if result_node.tag.endswith('retNFCom'):
-                            prot_node = result_node.find('.//nfcom:protNFCom', ns_nfcom)
-                            if prot_node is not None:
-                                prot_xml = ET.tostring(prot_node, encoding='unicode', method='xml')
-                            else:
-                                prot_xml = ET.tostring(result_node, encoding='unicode', method='xml')
+                cStat = cStat_elem.text if cStat_elem is not None else "N/A"
+                xMotivo = xMotivo_elem.text if xMotivo_elem is not None else "N/A"
+                nProt = nProt_elem.text if nProt_elem is not None else None
+
+                print(f"=== RESPOSTA SEFAZ ===")
+                print(f"cStat: {cStat}")
+                print(f"xMotivo: {xMotivo}")
+                print(f"nProt: {nProt}")
+                print(f"===================")
+
+                if cStat == "100":
+                    # Autorizada! Extrai apenas o protNFCom da resposta, não o retNFCom inteiro
+                    if result_node.tag.endswith('retNFCom'):
+                        prot_node = result_node.find('.//nfcom:protNFCom', ns_nfcom)
+                        if prot_node is not None:
+                            prot_xml = ET.tostring(prot_node, encoding='unicode', method='xml')
                         else:
                             prot_xml = ET.tostring(result_node, encoding='unicode', method='xml')
-                        
-                        # Remove a declaração XML do xml_assinado se existir
-                        xml_sem_declaracao = xml_assinado
-                        if xml_sem_declaracao.startswith('<?xml'):
-                            # Encontra o fim da declaração XML
-                            end_pos = xml_sem_declaracao.find('?>')
-                            if end_pos != -1:
-                                xml_sem_declaracao = xml_sem_declaracao[end_pos + 2:].lstrip()
-                        
-                        # Cria o XML nfcomProc envolvente
-                        proc_xml = f'''<?xml version="1.0" encoding="UTF-8"?>
+                    else:
+                        prot_xml = ET.tostring(result_node, encoding='unicode', method='xml')
+                    
+                    # Remove a declaração XML do xml_assinado se existir
+                    xml_sem_declaracao = xml_assinado
+                    if xml_sem_declaracao.startswith('<?xml'):
+                        # Encontra o fim da declaração XML
+                        end_pos = xml_sem_declaracao.find('?>')
+                        if end_pos != -1:
+                            xml_sem_declaracao = xml_sem_declaracao[end_pos + 2:].lstrip()
+                    
+                    # Cria o XML nfcomProc envolvente
+                    proc_xml = f'''<?xml version="1.0" encoding="UTF-8"?>
 <nfcomProc versao="1.00" xmlns="http://www.portalfiscal.inf.br/nfcom">
 {xml_sem_declaracao}
 {prot_xml}
 </nfcomProc>'''
-                        
-                        # Salva protocolo e XML do processo autorizado no banco
-                        db_nfcom.protocolo_autorizacao = nProt
-                        db_nfcom.xml_gerado = proc_xml
-                        db.commit()
-                        print("✅ NFCom AUTORIZADA! Protocolo e XML do processo salvos no banco.")
+                    
+                    # Salva protocolo e XML do processo autorizado no banco
+                    db_nfcom.protocolo_autorizacao = nProt
+                    db_nfcom.xml_gerado = proc_xml
+                    db_nfcom.status = 'emitida'
+                    db_nfcom.cstat = cStat
+                    db.commit()
+                    print("✅ NFCom AUTORIZADA! Protocolo e XML do processo salvos no banco.")
+                    # Guarda o XML autorizado no armazenamento de artefatos (downloads/ZIP/email)
+                    nfcom_artifacts.xml_path(db_nfcom)
+                elif cStat_elem is not None and cStat and db_nfcom.status == 'pendente' and not db_nfcom.protocolo_autorizacao:
+                    # Rejeição da SEFAZ: a nota continua pendente, com o código da rejeição.
+                    # Nota já autorizada/cancelada mantém status e cStat (ex.: 204 duplicidade).
+                    db_nfcom.cstat = str(cStat).strip()[:3]
+                    db.commit()
 
-                    return {"status_code": response.status_code, "cStat": cStat, "xMotivo": xMotivo, "nProt": nProt, "content": response.text, "xml_enviado": soap_body, "headers": dict(response.headers), "soap_file": soap_file_path, "soap_response_file": resp_file_path}
-                else:
-                    # Retorna o corpo da resposta mesmo quando inesperado
-                    print("=== RESPOSTA SEFAZ (estrutura inesperada) ===")
-                    print(f"Conteúdo: {response.text[:1000]}")  # Primeiros 1000 caracteres
-                    print("=" * 50)
-                    return {"status_code": response.status_code, "error": "Resposta inesperada", "content": response.text, "xml_enviado": soap_body, "headers": dict(response.headers), "soap_file": soap_file_path, "soap_response_file": resp_file_path}
-            except Exception:
-                # Se não conseguiu parsear como XML SOAP, devolve o texto cru também
-                print("ERRO ao processar resposta SEFAZ (parsing):\n", traceback.format_exc())
-                return {"status_code": response.status_code, "content": response.text, "xml_enviado": soap_body, "headers": dict(response.headers), "soap_file": soap_file_path, "soap_response_file": resp_file_path}
+                return {"status_code": response.status_code, "cStat": cStat, "xMotivo": xMotivo, "nProt": nProt, "content": response.text, "xml_enviado": soap_body, "headers": dict(response.headers), "soap_file": soap_file_path, "soap_response_file": resp_file_path}
+            else:
+                # Retorna o corpo da resposta mesmo quando inesperado
+                print("=== RESPOSTA SEFAZ (estrutura inesperada) ===")
+                print(f"Conteúdo: {response.text[:1000]}")  # Primeiros 1000 caracteres
+                print("=" * 50)
+                return {"status_code": response.status_code, "error": "Resposta inesperada", "content": response.text, "xml_enviado": soap_body, "headers": dict(response.headers), "soap_file": soap_file_path, "soap_response_file": resp_file_path}
+        except Exception:
+            # Se não conseguiu parsear como XML SOAP, devolve o texto cru também
+            print("ERRO ao processar resposta SEFAZ (parsing):\n", traceback.format_exc())
+            return {"status_code": response.status_code, "content": response.text, "xml_enviado": soap_body, "headers": dict(response.headers), "soap_file": soap_file_path, "soap_response_file": resp_file_path}
 
-        # Se por algum motivo não houve resposta, retorna erro genérico com o XML enviado
-        return {"status_code": None, "error": "Sem resposta da SEFAZ", "xml_enviado": soap_body, "soap_file": soap_file_path}
+    # Se por algum motivo não houve resposta, retorna erro genérico com o XML enviado
+    return {"status_code": None, "error": "Sem resposta da SEFAZ", "xml_enviado": soap_body, "soap_file": soap_file_path}
 
-    except requests.exceptions.RequestException as e:
+
+def _transmission_error(e: Exception, soap_body: str, soap_file_path) -> HTTPException:
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, requests.exceptions.RequestException):
         print("ERRO de comunicação com a SEFAZ:\n", traceback.format_exc())
-        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Erro de comunicação com a SEFAZ: {str(e)}\nXML enviado: {soap_body}\nSOAP file: {soap_file_path}")
+        return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Erro de comunicação com a SEFAZ: {str(e)}\nXML enviado: {soap_body}\nSOAP file: {soap_file_path}")
+    print("ERRO inesperado durante a transmissão:\n", traceback.format_exc())
+    # Retorna um HTTPException com detalhe para debug local
+    return HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Erro inesperado durante a transmissão: {str(e)}. Veja logs no servidor para o traceback. XML enviado: {soap_body}\nSOAP file: {soap_file_path}")
+
+
+def transmit_nfcom(db: Session, nfcom_id: int, empresa_id: int, sefaz_session: Optional[SefazSession] = None) -> dict:
+    """
+    Transmite uma NFCom para o webservice da SEFAZ.
+    SEMPRE gera e assina o XML na hora da transmissão para garantir formato correto.
+
+    `sefaz_session` permite reaproveitar o certificado/conexões de um lote;
+    sem ela, uma sessão é aberta e fechada só para esta nota. Notas canceladas
+    ou já autorizadas são recusadas sem gerar XML nem contatar a SEFAZ.
+    """
+    db_nfcom = get_nfcom(db, nfcom_id=nfcom_id, empresa_id=empresa_id)
+    skip = _transmission_skip(db_nfcom) if db_nfcom else None
+    if skip:
+        if skip.get("error") == "cancelled":
+            detail = "NFCom cancelada não pode ser transmitida"
+        else:
+            detail = f"NFCom já autorizada (protocolo {db_nfcom.protocolo_autorizacao})"
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+
+    db_nfcom, empresa_raw, xml_assinado, soap_body, soap_file_path, sefaz_url = _prepare_transmission(db, nfcom_id, empresa_id)
+
+    own_session = sefaz_session is None
+    try:
+        if own_session:
+            sefaz_session = _open_sefaz_session(empresa_raw, pool_size=1)
+        response = sefaz_session.post(sefaz_url, soap_body.encode('utf-8'))
+        return _process_sefaz_response(db, db_nfcom, response, xml_assinado, soap_body, soap_file_path)
     except Exception as e:
-        print("ERRO inesperado durante a transmissão:\n", traceback.format_exc())
-        # Retorna um HTTPException com detalhe para debug local
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Erro inesperado durante a transmissão: {str(e)}. Veja logs no servidor para o traceback. XML enviado: {soap_body}\nSOAP file: {soap_file_path}")
+        raise _transmission_error(e, soap_body, soap_file_path)
     finally:
-        # Garante que o arquivo PEM temporário seja excluído
-        if pem_file_path and os.path.exists(pem_file_path):
-            os.remove(pem_file_path)
\ No newline at end of file
+        if own_session and sefaz_session is not None:
+            sefaz_session.close()
+
+
+def _transmission_skip(db_nfcom) -> Optional[dict]:
+    """Item de resultado para notas que não devem ser enviadas num lote (ou None)."""
+    # se cancelada, trata como erro
+    if getattr(db_nfcom, 'status', None) == 'cancelada':
+        return {"nfcom_id": db_nfcom.id, "error": "cancelled"}
+    # se já autorizada, não transmite novamente — consideramos sucesso
+    if getattr(db_nfcom, 'protocolo_autorizacao', None):
+        return {"nfcom_id": db_nfcom.id, "status": "already_authorized"}
+    return None
+
+
+def _transmission_outcome(nfcom_id: int, resultado: dict):
+    cStat = resultado.get('cStat') if isinstance(resultado, dict) else None
+    if cStat and str(cStat) == '100':
+        return True, {"nfcom_id": nfcom_id, "status": "authorized", "cStat": cStat}
+    detail_msg = None
+    if isinstance(resultado, dict):
+        detail_msg = resultado.get('xMotivo') or resultado.get('error') or str(resultado)
+    return False, {"nfcom_id": nfcom_id, "error": "transmit_failed", "cStat": cStat, "message": detail_msg, "resultado": resultado}
+
+
+def _sign_and_post(sefaz_session: SefazSession, job):
+    """Executado no pool: gera/assina o XML da nota e envia à SEFAZ.
+
+    Retorna (xml_assinado, soap_body, soap_file_path, response, erro).
+    """
+    xml_assinado = soap_body = soap_file_path = None
+    try:
+        xml_assinado, soap_body, soap_file_path = _build_transmission_envelope(job)
+        response = sefaz_session.post(job.sefaz_url, soap_body.encode('utf-8'))
+        return xml_assinado, soap_body, soap_file_path, response, None
+    except Exception as e:
+        return xml_assinado, soap_body, soap_file_path, None, e
+
+
+def transmit_nfcoms(
+    db: Session,
+    empresa_id: int,
+    nfcom_ids: list,
+    max_in_flight: Optional[int] = None,
+    stop_on_failure: bool = False,
+):
+    """Transmite várias NFComs da empresa, com até `max_in_flight` envios simultâneos.
+
+    Gerador de (ok, item) na ordem em que as respostas chegam; `item` tem o
+    formato usado em successes/failures do bulk-transmit. Busca da nota,
+    chave de acesso e gravação do retorno ficam na thread chamadora (a
+    Session não é thread-safe); geração/assinatura do XML e o POST para a
+    SEFAZ rodam no pool, reaproveitando uma única SefazSession (certificado
+    carregado uma vez, conexões keep-alive).
+    Com `stop_on_failure`, nenhuma nota nova é enviada após a primeira
+    falha, mas as que já estão em voo têm o retorno processado.
+    """
+    max_in_flight = max(1, max_in_flight or NFCOM_SEFAZ_MAX_IN_FLIGHT)
+    sefaz_session = None
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    # future -> db_nfcom
+    in_flight = {}
+    failed = False
+
+    def _collect(done):
+        for future in done:
+            db_nfcom = in_flight.pop(future)
+            xml_assinado, soap_body, soap_file_path, response, erro = future.result()
+            try:
+                if xml_assinado is not None:
+                    _store_xml_gerado(db, db_nfcom, xml_assinado)
+                if erro is not None:
+                    raise erro
+                resultado = _process_sefaz_response(db, db_nfcom, response, xml_assinado, soap_body, soap_file_path)
+            except Exception as e:
+                try:
+                    db.rollback()
+                except Exception:
+                    pass
+                he = _transmission_error(e, soap_body, soap_file_path)
+                yield False, {"nfcom_id": db_nfcom.id, "error": "exception", "message": getattr(he, 'detail', str(he))}
+                continue
+            yield _transmission_outcome(db_nfcom.id, resultado)
+
+    try:
+        for nf_id in nfcom_ids:
+            if failed and stop_on_failure:
+                break
+
+            # Reporta o que já terminou antes de preparar a próxima nota
+            done = [f for f in in_flight if f.done()]
+            if len(in_flight) - len(done) >= max_in_flight:
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for ok, item in _collect(done):
+                failed = failed or not ok
+                yield ok, item
+            if failed and stop_on_failure:
+                break
+
+            db_nfcom = get_nfcom(db, nfcom_id=nf_id, empresa_id=empresa_id)
+            if not db_nfcom:
+                failed = True
+                yield False, {"nfcom_id": nf_id, "error": "not_found"}
+                continue
+            skip = _transmission_skip(db_nfcom)
+            if skip:
+                ok = skip.get("status") == "already_authorized"
+                failed = failed or not ok
+                yield ok, skip
+                continue
+
+            try:
+                db_nfcom, empresa_raw, job = _transmission_job(db, nf_id, empresa_id)
+                if sefaz_session is None:
+                    sefaz_session = _open_sefaz_session(empresa_raw, pool_size=max_in_flight)
+            except Exception as e:
+                failed = True
+                he = _transmission_error(e, None, None)
+                yield False, {"nfcom_id": nf_id, "error": "exception", "message": getattr(he, 'detail', str(he))}
+                continue
+
+            future = executor.submit(_sign_and_post, sefaz_session, job)
+            in_flight[future] = db_nfcom
+
+        while in_flight:
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for ok, item in _collect(done):
+                yield ok, item
+    finally:
+        executor.shutdown(wait=True)
+        if sefaz_session is not None:
+            sefaz_session.close()
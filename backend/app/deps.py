@@ -5,8 +5,8 @@ from sqlalchemy.orm import Session
 
 from app.core.database import get_db
 from app.routes.auth import get_current_active_user
-from app.models.models import Empresa, UsuarioEmpresa, Usuario
-from app.crud import crud_empresa
+from app.models.models import Empresa, Usuario
+from app.services import access_cache
 
 
 def get_active_empresa(
@@ -31,17 +31,13 @@ def get_active_empresa(
     if empresa_id is None:
         raise HTTPException(status_code=400, detail="Nenhuma empresa ativa selecionada")
 
-    empresa = crud_empresa.get_empresa(db, empresa_id=empresa_id)
+    empresa = access_cache.get_empresa(db, empresa_id)
     if not empresa:
         raise HTTPException(status_code=404, detail="Empresa não encontrada")
 
     # Se usuário não é superuser, validar associação
     if not current_user.is_superuser:
-        assoc = db.query(UsuarioEmpresa).filter(
-            UsuarioEmpresa.usuario_id == current_user.id,
-            UsuarioEmpresa.empresa_id == empresa_id
-        ).first()
-        if not assoc:
+        if not access_cache.get_membership(db, current_user.id, empresa_id).is_associated:
             raise HTTPException(status_code=403, detail="Usuário não está associado à empresa selecionada")
 
     # Verificar Licença (Bloqueio do sistema se inválida)
@@ -58,7 +54,7 @@ def check_empresa_access(db: Session, empresa_id: int, current_user: Usuario):
     Lança 403 se o usuário não tiver permissão.
     Lança 402 se a licença estiver inválida.
     """
-    db_empresa = crud_empresa.get_empresa(db, empresa_id=empresa_id)
+    db_empresa = access_cache.get_empresa(db, empresa_id)
     if not db_empresa:
         raise HTTPException(status_code=404, detail="Empresa não encontrada")
 
@@ -71,12 +67,7 @@ def check_empresa_access(db: Session, empresa_id: int, current_user: Usuario):
         return db_empresa
 
     # Verificar associação
-    assoc = db.query(UsuarioEmpresa).filter(
-        UsuarioEmpresa.usuario_id == current_user.id,
-        UsuarioEmpresa.empresa_id == empresa_id
-    ).first()
-    
-    if not assoc:
+    if not access_cache.get_membership(db, current_user.id, empresa_id).is_associated:
         raise HTTPException(status_code=403, detail="Usuário não tem permissão para acessar esta empresa")
 
     return db_empresa
@@ -264,6 +264,10 @@ def on_startup():
     # Inicia a fila assíncrona de envio de mensagens do WhatsApp
     from app.services.whatsapp_queue import start_whatsapp_worker
     start_whatsapp_worker()
+
+    # Inicia o worker de desbloqueio de rede em lote (pagamentos confirmados)
+    from app.services.unblock_dispatcher import start_unblock_worker
+    start_unblock_worker()
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 
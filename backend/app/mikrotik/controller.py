@@ -5,6 +5,7 @@ Instalar dependência recomendada (exemplo): `pip install librouteros` ou `route
 Este módulo provê uma camada abstrata para: criar/atualizar/remover usuários PPPoE/Hotspot,
 gerenciar ARP, controlar queues (limites de banda) e aplicar regras firewall/nat.
 """
+import os
 from typing import Optional
 
 try:
@@ -17,6 +18,11 @@ try:
 except Exception:  # pragma: no cover - optional dependency
     librouteros = None
 
+# Limite de entradas de conntrack removidas por chamada de kill_client_connections
+CONNTRACK_KILL_MAX_ENTRIES = int(os.environ.get("MIKROTIK_CONNTRACK_KILL_MAX", "5000"))
+# IDs por comando `remove` no modo sem /execute
+CONNTRACK_REMOVE_BATCH = 100
+
 
 class MikrotikController:
     def __init__(
@@ -27,7 +33,8 @@ class MikrotikController:
         port: int = 8728,
         use_ssl: bool = False,
         plaintext_login: bool = True,
-        api_encoding: str = None
+        api_encoding: str = None,
+        timeout: Optional[float] = None
     ):
         self.host = host
         self.username = username
@@ -35,6 +42,8 @@ class MikrotikController:
         self.port = port
         self.use_ssl = use_ssl
         self.plaintext_login = plaintext_login
+        # Timeout (s) do socket da API: limita a conexão e cada leitura/escrita
+        self.timeout = timeout
         
         # Se api_encoding não for informado, tenta buscar a configuração do banco de dados pelo IP do Router
         if not api_encoding:
@@ -90,6 +99,8 @@ class MikrotikController:
                     port=self.port,
                     plaintext_login=self.plaintext_login,
                 )
+                if self.timeout:
+                    self._pool.set_timeout(self.timeout)
                 self._api = self._pool.get_api()
                 logger.info("✅ Conexão com routeros_api estabelecida")
             except Exception as e:
@@ -105,7 +116,8 @@ class MikrotikController:
                     username=self.username,
                     password=self.password,
                     port=self.port,
-                    encoding=self.api_encoding
+                    encoding=self.api_encoding,
+                    **({'timeout': self.timeout} if self.timeout else {})
                 )
                 logger.info("✅ Conexão com librouteros estabelecida (fallback)")
             except Exception as e:
@@ -123,6 +135,12 @@ class MikrotikController:
                 pass
             self._pool = None
             self._api = None
+        if self._librouteros_api is not None:
+            try:
+                self._librouteros_api.close()
+            except Exception:
+                pass
+            self._librouteros_api = None
 
     def get_connection_status(self):
         """Retorna status de conexão para debug: routeros_api e librouteros.
@@ -662,32 +680,84 @@ class MikrotikController:
             logging.getLogger(__name__).error(f"Falha ao adicionar na address-list: {e}")
             return False
 
-    def kill_client_connections(self, ip: str):
-        """Remove todas as conexões ativas de um IP na tabela de Connection Tracking."""
+    def kill_client_connections(self, ip: str, max_entries: Optional[int] = None):
+        """Remove as conexões ativas de um IP na tabela de Connection Tracking.
+
+        O filtro é feito no próprio RouterOS: um script (/execute) executa o
+        `find` por src/dst-address e remove as entradas, sem transferir a tabela
+        de conntrack (centenas de milhares de entradas em CGNAT) pela API. O
+        script roda em background no router e remove no máximo `max_entries`.
+
+        Se /execute não estiver disponível, lê apenas `.id,src-address,dst-address`
+        e remove em lotes de IDs, respeitando o mesmo limite.
+        """
+        import ipaddress
+        import logging
+        logger = logging.getLogger(__name__)
         self.connect()
+        max_entries = max_entries or CONNTRACK_KILL_MAX_ENTRIES
+
+        ip_clean = ip.split('/')[0]
+        try:
+            # Validação também impede injeção no script abaixo
+            is_ipv4 = ipaddress.ip_address(ip_clean).version == 4
+        except ValueError:
+            logger.error(f"Falha ao derrubar conexões: IP inválido '{ip}'")
+            return False
+
+        if is_ipv4:
+            regex = '^' + ip_clean.replace('.', '\\\\.') + ':'
+            script = (
+                ':local n 0; '
+                f':foreach c in=[/ip firewall connection find where (src-address="{ip_clean}" or dst-address="{ip_clean}" '
+                f'or src-address~"{regex}" or dst-address~"{regex}")] do={{ '
+                f':if ($n < {int(max_entries)}) do={{ :do {{ /ip firewall connection remove $c }} on-error={{}}; :set n ($n + 1) }} }}'
+            )
+            try:
+                self._api.get_resource('/').call('execute', {'script': script})
+                logger.info(f"Remoção de conexões do IP {ip_clean} agendada no router (máx. {max_entries})")
+                return True
+            except Exception as e:
+                logger.warning(f"/execute indisponível para derrubar conexões de {ip_clean} ({e}); usando leitura enxuta")
+
         try:
             resource = self._api.get_resource('ip/firewall/connection')
-            ip_clean = ip.split('/')[0]
-            
-            # Busca todas as conexões e filtra localmente ou via query se suportado
-            # Usar o operador '~' (contém) é mais seguro para pegar IP:Porta
-            all_conns = resource.get()
-            count = 0
-            for conn in all_conns:
-                src = conn.get('src-address', '')
-                dst = conn.get('dst-address', '')
-                if ip_clean in src or ip_clean in dst:
+            conns = resource.call('print', {'.proplist': '.id,src-address,dst-address'})
+
+            def _host(addr):
+                # "1.2.3.4:5678" / "1.2.3.4" / "[2001:db8::1]:443"
+                if addr.startswith('['):
+                    return addr[1:].split(']')[0]
+                return addr.rsplit(':', 1)[0] if addr.count(':') == 1 else addr
+
+            ids = []
+            for conn in conns:
+                if _host(conn.get('src-address', '')) == ip_clean or _host(conn.get('dst-address', '')) == ip_clean:
                     cid = conn.get('.id') or conn.get('id')
                     if cid:
-                        resource.remove(id=cid)
-                        count += 1
-            
-            import logging
-            logging.getLogger(__name__).info(f"Derrubadas {count} conexões do IP {ip_clean}")
+                        ids.append(cid)
+                        if len(ids) >= max_entries:
+                            break
+
+            count = 0
+            for i in range(0, len(ids), CONNTRACK_REMOVE_BATCH):
+                lote = ids[i:i + CONNTRACK_REMOVE_BATCH]
+                try:
+                    resource.call('remove', {'.id': ','.join(lote)})
+                    count += len(lote)
+                except Exception:
+                    # Alguma conexão do lote já expirou: remove individualmente
+                    for cid in lote:
+                        try:
+                            resource.call('remove', {'.id': cid})
+                            count += 1
+                        except Exception:
+                            pass
+
+            logger.info(f"Derrubadas {count} conexões do IP {ip_clean}")
             return True
         except Exception as e:
-            import logging
-            logging.getLogger(__name__).error(f"Falha ao derrubar conexões do IP {ip}: {e}")
+            logger.error(f"Falha ao derrubar conexões do IP {ip}: {e}")
             return False
 
     def setup_suspension_nat_rule(self, notice_url: str):
@@ -1058,6 +1128,110 @@ class MikrotikController:
         return True
 
 
+    def sync_address_list(self, list_name: str, desired_set, comments: Optional[dict] = None,
+                          remove_extra: bool = True, absent_set=None, batch_size: int = 100,
+                          removable=None):
+        """Sincroniza uma Address List com o conjunto desejado de endereços.
+
+        A lista é lida UMA vez; apenas a diferença é aplicada. As adições são
+        enviadas em pipeline (vários comandos em voo na mesma sessão) e as
+        remoções agrupadas em um único `remove` por lote de IDs.
+
+        Args:
+            list_name: Nome da Address List (ex: 'pg_corte').
+            desired_set: Endereços que devem estar na lista.
+            comments: Comentário por endereço (opcional). Entradas existentes com
+                comentário diferente são atualizadas.
+            remove_extra: True = reconciliação completa (remove tudo que não está em
+                desired_set); False = incremental (remove apenas absent_set).
+            absent_set: Endereços a remover no modo incremental.
+            removable: Função (entrada -> bool) que limita as remoções da
+                reconciliação completa às entradas gerenciadas pelo sistema
+                (ex.: pelo comentário); as demais entradas fora de desired_set
+                são mantidas.
+
+        Returns:
+            Dict com as contagens (added, removed, updated, errors) e, em
+            'failed', os endereços cuja adição ou remoção falhou.
+        """
+        import logging
+        logger = logging.getLogger(__name__)
+        self.connect()
+        resource = self._api.get_resource('ip/firewall/address-list')
+
+        comments = {k.split('/')[0]: v for k, v in (comments or {}).items()}
+        desired = {ip.split('/')[0] for ip in desired_set if ip}
+        absent = {ip.split('/')[0] for ip in (absent_set or ()) if ip} - desired
+
+        existing = {}
+        to_remove = []
+        to_update = []
+        addr_by_id = {}
+        for e in resource.get(list=list_name):
+            # Entradas dinâmicas (ex: address-list do PPP profile) são gerenciadas pelo RouterOS
+            if e.get('dynamic') == 'true':
+                continue
+            eid = e.get('.id') or e.get('id')
+            addr = e.get('address', '').split('/')[0]
+            if not eid:
+                continue
+            addr_by_id[eid] = addr
+            if addr in existing:
+                to_remove.append(eid)  # duplicata
+            elif addr in absent or (remove_extra and addr not in desired and (removable is None or removable(e))):
+                to_remove.append(eid)
+            else:
+                existing[addr] = eid
+                wanted_comment = comments.get(addr)
+                if addr in desired and wanted_comment and e.get('comment') != wanted_comment:
+                    to_update.append((eid, wanted_comment))
+
+        result = {'added': 0, 'removed': 0, 'updated': 0, 'errors': 0}
+        failed = set()
+
+        def _drain(promises, key):
+            for label, promise in promises:
+                try:
+                    promise.get()
+                    result[key] += len(label) if isinstance(label, list) else 1
+                except Exception as e:
+                    result['errors'] += 1
+                    if key == 'removed':
+                        failed.update(addr_by_id.get(eid) for eid in label)
+                    elif key == 'added':
+                        failed.add(label)
+                    logger.warning(f"Falha ao sincronizar address-list '{list_name}' ({key}: {label}): {e}")
+
+        # Remoções: um comando por lote de IDs
+        promises = []
+        for i in range(0, len(to_remove), batch_size):
+            ids = to_remove[i:i + batch_size]
+            promises.append((ids, resource.call_async('remove', {'.id': ','.join(ids)})))
+        _drain(promises, 'removed')
+
+        # Adições e atualizações de comentário: em pipeline, até batch_size em voo
+        pending = []
+        for addr in sorted(desired - set(existing)):
+            data = {'address': addr, 'list': list_name}
+            if comments.get(addr):
+                data['comment'] = comments[addr]
+            pending.append(('added', addr, 'add', data))
+        for eid, comment in to_update:
+            pending.append(('updated', eid, 'set', {'.id': eid, 'comment': comment}))
+
+        for i in range(0, len(pending), batch_size):
+            lote = pending[i:i + batch_size]
+            promises = [(key, label, resource.call_async(cmd, data)) for key, label, cmd, data in lote]
+            for key, label, promise in promises:
+                _drain([(label, promise)], key)
+
+        logger.info(
+            f"Address-list '{list_name}' sincronizada: +{result['added']} -{result['removed']} "
+            f"~{result['updated']} (erros: {result['errors']})"
+        )
+        result['failed'] = sorted(failed)
+        return result
+
     def get_dhcp_servers(self):
         """Busca servidores DHCP configurados (/ip/dhcp-server)."""
         self.connect()
@@ -1186,6 +1360,8 @@ class MikrotikController:
         Returns:
             True se a sessão foi encerrada, False se o usuário não estava conectado.
         """
+        import logging
+        logger = logging.getLogger(__name__)
         self.connect()
         disconnected = False
         try:
@@ -1522,8 +1698,13 @@ class MikrotikController:
         
         return True
 
-    def suspend_client_connection(self, contrato_id: int, metodo_autenticacao: str, assigned_ip: str = None, comment: str = None):
-        """Bloqueia a conexão do cliente no router."""
+    def suspend_client_connection(self, contrato_id: int, metodo_autenticacao: str, assigned_ip: str = None, comment: str = None,
+                                  address_list_synced: bool = False):
+        """Bloqueia a conexão do cliente no router.
+
+        address_list_synced=True indica que o IP (IP_MAC) já foi incluído na
+        'pg_corte' em lote via sync_address_list.
+        """
         self.connect()
         import logging
         logger = logging.getLogger(__name__)
@@ -1570,7 +1751,8 @@ class MikrotikController:
             try:
                 # Usa o nome do cliente se disponível, senão usa o padrão
                 list_comment = comment if comment else f"Bloqueio Contrato {contrato_id}"
-                self.add_to_address_list(assigned_ip, 'pg_corte', list_comment)
+                if not address_list_synced:
+                    self.add_to_address_list(assigned_ip, 'pg_corte', list_comment)
                 # Derruba conexões ativas para o bloqueio ser instantâneo
                 self.kill_client_connections(assigned_ip)
             except Exception as e:
@@ -1601,8 +1783,13 @@ class MikrotikController:
 
         return False
 
-    def unsuspend_client_connection(self, contrato_id: int, metodo_autenticacao: str, assigned_ip: str = None, mac_address: str = None, interface: str = None, comment: str = None):
-        """Desbloqueia a conexão do cliente no router."""
+    def unsuspend_client_connection(self, contrato_id: int, metodo_autenticacao: str, assigned_ip: str = None, mac_address: str = None, interface: str = None, comment: str = None,
+                                    address_list_synced: bool = False):
+        """Desbloqueia a conexão do cliente no router.
+
+        address_list_synced=True indica que o IP (IP_MAC) já foi retirado da
+        'pg_corte' em lote via sync_address_list.
+        """
         self.connect()
         
         if metodo_autenticacao == 'PPPOE':
@@ -1631,10 +1818,11 @@ class MikrotikController:
             if not assigned_ip:
                 return False
             # 1. Remover da Address List de bloqueio
-            try:
-                self.remove_from_address_list(assigned_ip, 'pg_corte')
-            except Exception:
-                pass
+            if not address_list_synced:
+                try:
+                    self.remove_from_address_list(assigned_ip, 'pg_corte')
+                except Exception:
+                    pass
             
             # 2. Garantir que a entrada ARP e DHCP existem (caso tenham sido removidas)
             if mac_address and interface:
@@ -10,4 +10,4 @@ from .isp import IspClient
 from .subscription import Subscription, SubscriptionStatus, AuthMethod
 from .license import CompanyLicense, LicenseStatus, LicensePlan
 from .license_plan import LicensePricingPlan
-from .ftth import OLT, CTO, FTTHMonitorSnapshot, StatusONU, FabricanteOLT
\ No newline at end of file
+from .ftth import OLT, CTO, FTTHMonitorSnapshot, FTTHOnuCurrentStatus, FTTHMonitorRollup, StatusONU, FabricanteOLT
\ No newline at end of file
@@ -1,5 +1,5 @@
 import enum
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, Text, Float, JSON
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, Text, Float, JSON, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -55,6 +55,9 @@ class OLT(Base):
 class CTO(Base):
     """Caixa de Terminação Óptica — ponto de distribuição de fibra para os clientes."""
     __tablename__ = "ctos"
+    __table_args__ = (
+        Index("ix_ctos_empresa_lat_lng", "empresa_id", "latitude", "longitude"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     nome = Column(String(100), nullable=False, index=True)
@@ -63,6 +66,8 @@ class CTO(Base):
     splitter_ratio = Column(String(20), nullable=True)              # Relação do splitter (ex: "1:8", "1:16", "1:32")
     capacidade = Column(Integer, nullable=True)                     # Capacidade máxima de ONUs
     coordenadas_gps = Column(String(50), nullable=True)             # Lat,Lng (ex: "-23.1234,-46.5678")
+    latitude = Column(Float, nullable=True)                         # Derivados de coordenadas_gps
+    longitude = Column(Float, nullable=True)
     endereco = Column(String(255), nullable=True)                   # Endereço físico da CTO
     descricao = Column(Text, nullable=True)
     is_active = Column(Boolean, default=True)
@@ -114,3 +119,70 @@ class FTTHMonitorSnapshot(Base):
     # Relacionamentos
     contrato = relationship("ServicoContratado")
     empresa = relationship("Empresa")
+
+
+class FTTHOnuCurrentStatus(Base):
+    """Último status conhecido de cada ONU (uma linha por contrato).
+
+    Mantida pelo poller (upsert a cada ciclo) e pelas verificações manuais.
+    Dashboard, listagem, filtros por status e alertas leem desta tabela em
+    vez de buscar o snapshot mais recente de cada contrato no histórico.
+    """
+    __tablename__ = "ftth_onu_current_status"
+    __table_args__ = (
+        Index("ix_ftth_onu_current_status_empresa_status", "empresa_id", "status"),
+    )
+
+    contrato_id = Column(Integer, ForeignKey("servicos_contratados.id", ondelete="CASCADE"), primary_key=True)
+    empresa_id = Column(Integer, ForeignKey("empresas.id"), nullable=False)
+
+    status = Column(String(20), nullable=False, default="DESCONHECIDO")
+    rx_power = Column(Float, nullable=True)
+    tx_power = Column(Float, nullable=True)
+    latencia_ms = Column(Float, nullable=True)
+    is_reachable = Column(Boolean, nullable=True)
+    metodo_coleta = Column(String(20), nullable=True)
+    detalhe_erro = Column(Text, nullable=True)
+    ip_verificado = Column(String(45), nullable=True)
+
+    timestamp = Column(DateTime(timezone=True), nullable=False)  # Momento da última verificação
+
+
+class FTTHMonitorRollup(Base):
+    """Agregado de snapshots de uma ONU por hora ou por dia.
+
+    Gerado pelo job de compactação (app/scripts/ftth_compactor.py) a partir
+    de ftth_monitor_snapshots (HORA) e dos próprios agregados horários (DIA).
+    Permite apagar os snapshots brutos antigos sem perder o histórico.
+    """
+    __tablename__ = "ftth_monitor_rollups"
+    __table_args__ = (
+        UniqueConstraint("contrato_id", "resolucao", "bucket_inicio", name="uq_ftth_rollup_contrato_bucket"),
+        Index("ix_ftth_rollup_resolucao_bucket", "resolucao", "bucket_inicio"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    contrato_id = Column(Integer, ForeignKey("servicos_contratados.id", ondelete="CASCADE"), nullable=False)
+    empresa_id = Column(Integer, ForeignKey("empresas.id"), nullable=False)
+
+    resolucao = Column(String(10), nullable=False)           # HORA, DIA
+    bucket_inicio = Column(DateTime, nullable=False)         # Início do intervalo (UTC)
+
+    # Contagens usadas para disponibilidade e para médias ponderadas na agregação diária
+    amostras = Column(Integer, nullable=False, default=0)
+    amostras_disponivel = Column(Integer, nullable=False, default=0)   # ONLINE ou DEGRADADO
+    amostras_latencia = Column(Integer, nullable=False, default=0)
+    amostras_sinal = Column(Integer, nullable=False, default=0)
+    disponibilidade_percentual = Column(Float, nullable=True)
+
+    latencia_min = Column(Float, nullable=True)
+    latencia_avg = Column(Float, nullable=True)
+    latencia_max = Column(Float, nullable=True)
+
+    rx_power_min = Column(Float, nullable=True)
+    rx_power_avg = Column(Float, nullable=True)
+    rx_power_max = Column(Float, nullable=True)
+
+    tx_power_min = Column(Float, nullable=True)
+    tx_power_avg = Column(Float, nullable=True)
+    tx_power_max = Column(Float, nullable=True)
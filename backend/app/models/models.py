@@ -1,4 +1,4 @@
-from sqlalchemy import (Column, Integer, String, Boolean, DateTime, Date, Float, ForeignKey, Text, Enum as SQLAlchemyEnum)
+from sqlalchemy import (Column, Integer, String, Boolean, DateTime, Date, Float, ForeignKey, Index, Text, UniqueConstraint, Enum as SQLAlchemyEnum)
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.sql import func
 from app.core.database import Base
@@ -299,6 +299,11 @@ class TipoFaturamento(str, enum.Enum):
 class NFCom(Base):
     """Modelo da Nota Fiscal de Comunicação (NFCom - Modelo 62)."""
     __tablename__ = "nfcom"
+    __table_args__ = (
+        # Listagem/filtros por situação e período; numeração por série
+        Index("ix_nfcom_empresa_status_data_emissao", "empresa_id", "status", "data_emissao"),
+        Index("ix_nfcom_empresa_serie_numero", "empresa_id", "serie", "numero_nf"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     empresa_id = Column(Integer, ForeignKey("empresas.id"), nullable=False)
@@ -337,6 +342,11 @@ class NFCom(Base):
     valor_cofins = Column(Float)
     
     informacoes_adicionais = Column(Text)
+
+    # Situação da nota: 'pendente', 'emitida' ou 'cancelada', gravada pelo crud_nfcom no retorno da SEFAZ
+    status = Column(String(20), nullable=False, default='pendente', server_default='pendente')
+    # Último cStat da SEFAZ na autorização ou no evento de cancelamento (inclusive rejeições)
+    cstat = Column(String(3), nullable=True)
     
     xml_gerado = Column(Text)
     pdf_url = Column(String(500))
@@ -358,6 +368,11 @@ class NFCom(Base):
     email_sent_at = Column(DateTime(timezone=True))
     email_error = Column(Text)
 
+
+# cStat de retorno do evento de cancelamento que marcam a nota como cancelada
+# (135=evento vinculado, 136=vinculação prejudicada, 134=NFCom em situação diferente)
+NFCOM_CANCEL_CSTATS = ('135', '136', '134')
+
 class NFComEmailJob(Base):
     __tablename__ = 'nfcom_email_jobs'
     id = Column(Integer, primary_key=True, index=True)
@@ -379,6 +394,23 @@ class NFComEmailStatus(Base):
     error_message = Column(Text)
     sent_at = Column(DateTime(timezone=True))
 
+class NFComNumeracao(Base):
+    """Último número de NFCom reservado por empresa e série.
+
+    A linha é travada (SELECT ... FOR UPDATE) para reservar faixas de
+    números; ver crud_nfcom.reserve_numeros_nf.
+    """
+    __tablename__ = 'nfcom_numeracao'
+    __table_args__ = (
+        UniqueConstraint('empresa_id', 'serie', name='uq_nfcom_numeracao_empresa_serie'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    empresa_id = Column(Integer, ForeignKey('empresas.id'), nullable=False)
+    serie = Column(Integer, nullable=False)
+    ultimo_numero = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
 class NFComItem(Base):
     """Modelo de Item da NFCom."""
     __tablename__ = "nfcom_itens"
@@ -593,6 +625,12 @@ class Receivable(Base):
     para integração com registradoras de boletos (ex: SICOB).
     """
     __tablename__ = "receivables"
+    __table_args__ = (
+        # Verificação de meses já faturados na geração em lote (intervalo de vencimento)
+        Index("ix_receivables_empresa_due_date", "empresa_id", "due_date"),
+        # Recebimentos por período no dashboard
+        Index("ix_receivables_empresa_status_paid_at", "empresa_id", "status", "paid_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     empresa_id = Column(Integer, ForeignKey("empresas.id"), nullable=False)
@@ -764,6 +802,12 @@ class CategoriaTicket(str, enum.Enum):
 class Ticket(Base):
     """Modelo de Ticket de Suporte."""
     __tablename__ = "tickets"
+    __table_args__ = (
+        # Quadro de tickets: paginação por (created_at, id) dentro da empresa
+        Index("ix_tickets_empresa_created_id", "empresa_id", "created_at", "id"),
+        # Busca textual por título/descrição (MATCH ... AGAINST no MySQL)
+        Index("ix_tickets_titulo_descricao_ft", "titulo", "descricao", mysql_prefix="FULLTEXT"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     empresa_id = Column(Integer, ForeignKey("empresas.id"), nullable=False)
@@ -902,3 +946,50 @@ class CaixaMovimentacao(Base):
     sessao = relationship("CaixaSessao")
     usuario = relationship("Usuario")
 
+
+class WhatsAppMessage(Base):
+    """Mensagem de WhatsApp na fila de saída (ver app/services/whatsapp_queue.py)."""
+    __tablename__ = "whatsapp_outbox"
+    __table_args__ = (
+        Index("ix_whatsapp_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    empresa_id = Column(Integer, ForeignKey("empresas.id"), nullable=True, index=True)
+    instance = Column(String(100), nullable=False)  # Instância da Evolution API (chave do rate limit)
+
+    to_phone = Column(String(30), nullable=False)
+    message = Column(Text, nullable=True)  # Texto ou legenda do documento
+    is_media = Column(Boolean, nullable=False, default=False)
+    file_name = Column(String(255), nullable=True)
+    file_data = Column(Text(length=16777215), nullable=True)  # Documento em base64
+
+    status = Column(String(20), nullable=False, default="pending", server_default="pending")  # pending, sending, sent, failed
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    next_attempt_at = Column(DateTime, nullable=False)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(String(500), nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime, nullable=True)
+
+
+class UnblockRequest(Base):
+    """Desbloqueio de rede pendente após pagamento (ver app/services/unblock_dispatcher.py)."""
+    __tablename__ = "unblock_outbox"
+    __table_args__ = (
+        Index("ix_unblock_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    contrato_id = Column(Integer, ForeignKey("servicos_contratados.id"), nullable=False, index=True)
+
+    status = Column(String(20), nullable=False, default="pending", server_default="pending")  # pending, processing, done, skipped, failed
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    next_attempt_at = Column(DateTime, nullable=False)
+    locked_at = Column(DateTime, nullable=True)
+    claim_token = Column(String(36), nullable=True, index=True)  # lote que reservou o pedido
+    last_error = Column(String(500), nullable=True)
+
+    created_at = Column(DateTime, nullable=False)
+    processed_at = Column(DateTime, nullable=True)
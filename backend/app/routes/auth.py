@@ -13,6 +13,7 @@ from app.schemas.usuario import Token, UsuarioRegister, UsuarioCreate, UsuarioRe
 import random
 from app.services.email_service import EmailService
 from app.crud import crud_password_reset
+from app.services import access_cache
 from app.schemas.password_reset import PasswordResetRequest, PasswordResetVerify, PasswordResetConfirm
 
 router = APIRouter(prefix="/auth", tags=["Autenticação"])
@@ -33,7 +34,7 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     user_id = payload.get("sub")
     if user_id is None:
         raise credentials_exception
-    user = crud_usuario.get_usuario(db, usuario_id=int(user_id))
+    user = access_cache.get_user(db, int(user_id))
     if user is None:
         raise credentials_exception
     return user
@@ -49,7 +50,7 @@ def get_current_user_optional(token: str = Depends(oauth2_scheme_optional), db:
         user_id = payload.get("sub")
         if user_id is None:
             return None
-        return crud_usuario.get_usuario(db, usuario_id=int(user_id))
+        return access_cache.get_user(db, int(user_id))
     except Exception:
         return None
 
@@ -453,21 +453,17 @@ def generate_boletos(
         Receivable.empresa_id == empresa_id
     ).all()
     
-    results = []
     for r in receivables:
         r.bank_account_id = bank_account_id
-        # Para Sicredi, o BillingService._register_sicredi apenas marca como pendente de remessa
-        # Para Sicoob, ele tenta registrar via API
-        # Como register_receivable_with_bank é assíncrono, precisamos rodar com loop
-        try:
-            # Simplificando para marcar apenas
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            success = loop.run_until_complete(BillingService.register_receivable_with_bank(db, r))
-            loop.close()
-            results.append({"id": r.id, "success": success})
-        except Exception as e:
-            results.append({"id": r.id, "success": False, "error": str(e)})
+
+    # Para Sicredi, o BillingService._register_sicredi apenas marca como pendente de remessa
+    # Para Sicoob, ele tenta registrar via API; contas BB registram em lote (register_bb_bulk).
+    # A rota é síncrona (threadpool), então um único asyncio.run atende todas as cobranças.
+    try:
+        registered = asyncio.run(BillingService.register_receivables_bulk(db, receivables))
+        results = [{"id": r.id, "success": registered.get(r.id, False)} for r in receivables]
+    except Exception as e:
+        results = [{"id": r.id, "success": False, "error": str(e)} for r in receivables]
             
     db.commit()
     return {"results": results}
@@ -514,26 +510,29 @@ def delete_bank_account(empresa_id: int, bank_account_id: int, db: Session = Dep
     return {'ok': True}
 
 @router.post('/{bank_account_id}/retorno')
-async def upload_retorno(
+def upload_retorno(
     empresa_id: int,
     bank_account_id: int,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
     current_user: Usuario = Depends(get_current_active_user)
 ):
+    """Processa um arquivo de retorno CNAB 240/400 e baixa as cobranças da conta (ver cnab_retorno)."""
     deps.permission_checker('receivables_manage')(db=db, current_user=current_user)
-    # Aqui viria a lógica de processamento do arquivo de retorno
-    # Por enquanto, apenas simulamos o sucesso
-    filename = file.filename
-    content = await file.read()
-    
-    # TODO: Implementar parser de CNAB 240/400 retorno
-    
+    from app.services.cnab_retorno import process_retorno
+
+    ba = db.query(BankAccount).filter(BankAccount.id == bank_account_id, BankAccount.empresa_id == empresa_id).first()
+    if not ba:
+        raise HTTPException(status_code=404, detail='Conta bancária não encontrada')
+
+    result = process_retorno(db, empresa_id, bank_account_id, file.file)
     return {
         "status": "success",
-        "message": f"Arquivo {filename} recebido com sucesso. O processamento automático de retorno será implementado em breve.",
-        "processed_count": 0
+        "message": f"Arquivo {file.filename} processado: {result['paid']} liquidação(ões), "
+                   f"{result['cancelled']} baixa(s), {result['rejected']} rejeição(ões).",
+        **result,
     }
+
 @router.post('/{bank_account_id}/register-boletos-api')
 async def register_boletos_api(
     empresa_id: int,
@@ -556,13 +555,11 @@ async def register_boletos_api(
         Receivable.empresa_id == empresa_id
     ).all()
     
+    registered = await BillingService.register_bb_bulk(db, receivables, ba)
     results = []
     for r in receivables:
-        try:
-            success, error_msg = await BillingService._register_bb(db, r, ba)
-            results.append({"id": r.id, "ok": success, "error": None if success else error_msg})
-        except Exception as e:
-            results.append({"id": r.id, "ok": False, "error": str(e)})
+        success, error_msg = registered.get(r.id, (False, "Não processado"))
+        results.append({"id": r.id, "ok": success, "error": None if success else error_msg})
             
     db.commit()
     return {"results": results}
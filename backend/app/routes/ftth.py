@@ -82,10 +82,10 @@ def get_ont(
 
     cliente = db.query(Cliente).filter(Cliente.id == contrato.cliente_id).first()
 
-    from app.models.ftth import FTTHMonitorSnapshot
-    ultimo = db.query(FTTHMonitorSnapshot).filter(
-        FTTHMonitorSnapshot.contrato_id == contrato_id
-    ).order_by(FTTHMonitorSnapshot.timestamp.desc()).first()
+    from app.models.ftth import FTTHOnuCurrentStatus
+    ultimo = db.query(FTTHOnuCurrentStatus).filter(
+        FTTHOnuCurrentStatus.contrato_id == contrato_id
+    ).first()
 
     return {
         "contrato_id": contrato.id,
@@ -173,7 +173,7 @@ def poll_onu(
 @router.get("/onts/{contrato_id}/historico", response_model=List[FTTHMonitorSnapshotOut])
 def get_onu_historico(
     contrato_id: int,
-    horas: int = Query(24, ge=1, le=720, description="Número de horas de histórico (máx 720 = 30 dias)"),
+    horas: int = Query(24, ge=1, le=8760, description="Número de horas de histórico (máx 8760 = 1 ano; acima de 48h usa agregados)"),
     _: bool = Depends(deps.permission_checker("network_manage")),
     current_user: Usuario = Depends(deps.get_current_active_user),
     active_empresa: Empresa = Depends(deps.get_active_empresa),
@@ -321,6 +321,7 @@ def list_ctos(
     olt_id: Optional[int] = None,
     search: Optional[str] = Query(None, description="Termo de busca para nome, endereço ou descrição da CTO"),
     proximidade_gps: Optional[str] = Query(None, description="Coordenadas GPS do cliente no formato 'lat,lng' para ordenar por proximidade"),
+    raio_metros: Optional[float] = Query(None, gt=0, description="Com proximidade_gps, retorna apenas as CTOs dentro deste raio"),
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=10000),
     _: bool = Depends(deps.permission_checker("network_manage")),
@@ -335,6 +336,7 @@ def list_ctos(
         olt_id=olt_id,
         search=search,
         proximidade_gps=proximidade_gps,
+        raio_metros=raio_metros,
         skip=skip,
         limit=limit
     )
@@ -455,7 +457,8 @@ def get_map_data(
     db: Session = Depends(get_db)
 ):
     """Retorna dados de CTOs com coordenadas GPS e status para exibição em mapa."""
-    from app.models.ftth import CTO, FTTHMonitorSnapshot
+    from sqlalchemy import func, case
+    from app.models.ftth import CTO, FTTHOnuCurrentStatus
     from app.models.models import ServicoContratado
     ctos = db.query(CTO).filter(
         CTO.empresa_id == active_empresa.id,
@@ -463,29 +466,26 @@ def get_map_data(
         CTO.is_active == True
     ).all()
 
-    result = []
-    for cto in ctos:
-        # Conta quantas ONUs estão conectadas a esta CTO (pelo nome)
-        onus_count = db.query(ServicoContratado).filter(
+    # Conta ONUs e ONUs offline por CTO (pelo nome) numa única consulta agrupada
+    contagem = {
+        cto_nome: (total, offline)
+        for cto_nome, total, offline in db.query(
+            ServicoContratado.cto_nome,
+            func.count(ServicoContratado.id),
+            func.sum(case((FTTHOnuCurrentStatus.status == "OFFLINE", 1), else_=0)),
+        ).outerjoin(
+            FTTHOnuCurrentStatus, FTTHOnuCurrentStatus.contrato_id == ServicoContratado.id
+        ).filter(
             ServicoContratado.empresa_id == active_empresa.id,
-            ServicoContratado.cto_nome == cto.nome,
+            ServicoContratado.cto_nome.in_([cto.nome for cto in ctos]),
             ServicoContratado.is_active == True
-        ).count()
+        ).group_by(ServicoContratado.cto_nome).all()
+    }
 
-        # Conta ONUs offline nesta CTO
-        onus_ids = db.query(ServicoContratado.id).filter(
-            ServicoContratado.empresa_id == active_empresa.id,
-            ServicoContratado.cto_nome == cto.nome,
-            ServicoContratado.is_active == True
-        ).all()
-
-        offline_count = 0
-        for (cid,) in onus_ids:
-            ultimo = db.query(FTTHMonitorSnapshot).filter(
-                FTTHMonitorSnapshot.contrato_id == cid
-            ).order_by(FTTHMonitorSnapshot.timestamp.desc()).first()
-            if ultimo and ultimo.status == "OFFLINE":
-                offline_count += 1
+    result = []
+    for cto in ctos:
+        onus_count, offline_count = contagem.get(cto.nome, (0, 0))
+        offline_count = int(offline_count or 0)
 
         lat, lng = None, None
         if cto.coordenadas_gps:
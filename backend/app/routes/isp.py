@@ -6,11 +6,22 @@ from app.api import deps
 from app import crud, models
 from app.schemas.isp import IspClientCreate, IspClientResponse
 from app.mikrotik.controller import MikrotikController
+from app.services import unblock_dispatcher
 from app.core.security import decrypt_password
 
 router = APIRouter(prefix="/isp", tags=["ISP"])
 
 
+@router.get("/unblock-queue/status")
+def get_unblock_queue_status(
+    db: Session = Depends(deps.get_db),
+    current_user: models.Usuario = Depends(deps.get_current_active_user),
+    _: bool = Depends(deps.permission_checker("network_manage")),
+):
+    """Situação da fila de desbloqueio após pagamento da empresa ativa (profundidade e latência)."""
+    return unblock_dispatcher.queue_status(db, current_user.active_empresa_id)
+
+
 @router.post("/clients/", response_model=IspClientResponse)
 def create_isp_client(
     *,
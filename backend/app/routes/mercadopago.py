@@ -1,15 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 import mercadopago
 import logging
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 
 from app.core.database import get_db
 from app.models.models import Usuario, Empresa, Receivable, BankAccount
 from app.routes.auth import get_current_active_user
 from app.schemas.mercadopago import MercadoPagoPaymentRequest, MercadoPagoResponse
-from app.services import isp_service
+from app.services import mercadopago_client, unblock_dispatcher
 from app.api import deps
 from app.core.config import settings
 
@@ -137,19 +139,12 @@ def get_receivable_by_token(token: str, db: Session = Depends(get_db)):
         }
     }
 
-@router.post("/process", response_model=MercadoPagoResponse)
-async def process_payment(
-    payload: MercadoPagoPaymentRequest,
-    request: Request,
-    db: Session = Depends(get_db),
-    current_user: Optional[Usuario] = Depends(deps.get_current_user_optional)
-):
-    """Processa um pagamento vindo do Mercado Pago Brick."""
-    # Buscar os recebíveis para validar valor e empresa
+def _load_payment_context(db: Session, payload: MercadoPagoPaymentRequest) -> dict:
+    """Valida as cobranças do pagamento e devolve os dados necessários para criá-lo no MP."""
     receivables = db.query(Receivable).filter(Receivable.id.in_(payload.receivable_ids)).all()
     if not receivables:
         raise HTTPException(status_code=404, detail="Cobranças não encontradas")
-    
+
     # Validar que todos pertencem à mesma empresa
     empresa_id = receivables[0].empresa_id
     for r in receivables:
@@ -167,13 +162,51 @@ async def process_payment(
     if abs(total_amount - payload.transaction_amount) > 0.01:
         raise HTTPException(status_code=400, detail=f"Valor total incorreto. Esperado: {total_amount}, Recebido: {payload.transaction_amount}")
 
-    # Inicializar SDK
-    sdk = mercadopago.SDK(empresa.mp_access_token)
+    return {
+        "access_token": empresa.mp_access_token,
+        "empresa_nome": empresa.nome_fantasia or empresa.razao_social,
+        "receivable_ids": [r.id for r in receivables],
+    }
+
+
+def _apply_payment(db: Session, receivable_ids: List[int], mp_id: str, mp_status: str, mp_method: str) -> List[int]:
+    """Grava o pagamento criado nas cobranças; retorna os contratos a desbloquear."""
+    contratos = set()
+    receivables = db.query(Receivable).filter(Receivable.id.in_(receivable_ids)).all()
+    for r in receivables:
+        r.mp_payment_id = mp_id
+        r.mp_payment_status = mp_status
+        r.mp_payment_method = mp_method
+
+        if mp_status == "approved" and r.status != "PAID":
+            r.status = "PAID"
+            r.paid_at = datetime.now()
+            # Se for ISP, processar desbloqueio
+            if r.servico_contratado_id:
+                contratos.add(r.servico_contratado_id)
+
+    db.commit()
+    return sorted(contratos)
+
+
+@router.post("/process", response_model=MercadoPagoResponse)
+async def process_payment(
+    payload: MercadoPagoPaymentRequest,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: Optional[Usuario] = Depends(deps.get_current_user_optional)
+):
+    """Processa um pagamento vindo do Mercado Pago Brick.
+
+    O acesso ao banco roda no threadpool e a chamada ao MP usa o cliente
+    assíncrono; o desbloqueio ISP vai para a fila de desbloqueio em lote.
+    """
+    ctx = await run_in_threadpool(_load_payment_context, db, payload)
 
     payment_data = {
         "transaction_amount": float(payload.transaction_amount),
         "token": payload.token,
-        "description": f"Pagamento de {len(receivables)} faturas - {empresa.nome_fantasia or empresa.razao_social}",
+        "description": f"Pagamento de {len(ctx['receivable_ids'])} faturas - {ctx['empresa_nome']}",
         "payment_method_id": payload.payment_method_id,
         "installments": 1,
         "payer": {
@@ -195,9 +228,9 @@ async def process_payment(
         logger.warning(f"Pagamento processado em ambiente LOCAL ({base_url}). Webhook não será enviado para o Mercado Pago.")
 
     try:
-        payment_response = sdk.payment().create(payment_data)
+        payment_response = await mercadopago_client.create_payment(ctx["access_token"], payment_data)
         payment = payment_response["response"]
-        
+
         if payment_response["status"] not in [200, 201]:
             logger.error(f"Erro Mercado Pago: {payment_response}")
             raise HTTPException(status_code=400, detail=f"Erro ao processar pagamento no Mercado Pago: {payment.get('message', 'Erro desconhecido')}")
@@ -205,23 +238,11 @@ async def process_payment(
         # Atualizar recebíveis com o ID do pagamento e status inicial
         mp_id = str(payment["id"])
         mp_status = payment["status"]
-        
-        for r in receivables:
-            r.mp_payment_id = mp_id
-            r.mp_payment_status = mp_status
-            r.mp_payment_method = payload.payment_method_id
-            
-            if mp_status == "approved":
-                r.status = "PAID"
-                r.paid_at = datetime.now()
-                # Se for ISP, processar desbloqueio
-                if r.servico_contratado_id:
-                    try:
-                        isp_service.process_unblock_if_needed(db, r.servico_contratado_id)
-                    except Exception as e:
-                        logger.error(f"Erro no desbloqueio ISP: {e}")
-
-        db.commit()
+
+        contratos = await run_in_threadpool(
+            _apply_payment, db, ctx["receivable_ids"], mp_id, mp_status, payload.payment_method_id
+        )
+        await run_in_threadpool(unblock_dispatcher.enqueue, contratos)
 
         return {
             "payment_id": mp_id,
@@ -229,59 +250,107 @@ async def process_payment(
             "detail": payment
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro ao processar pagamento MP: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erro interno ao processar pagamento: {str(e)}")
 
+
+# Notificações em processamento por mp_payment_id. Uma notificação repetida
+# enquanto a anterior ainda roda só marca que o status deve ser consultado de
+# novo ao final (True), em vez de repetir o trabalho em paralelo.
+_webhook_inflight: Dict[str, bool] = {}
+
+
+def _webhook_context(db: Session, mp_payment_id: str):
+    """(empresa_id, access_token) do pagamento, ou None se ele não for deste sistema."""
+    return db.query(Receivable.empresa_id, Empresa.mp_access_token).outerjoin(
+        Empresa, Empresa.id == Receivable.empresa_id
+    ).filter(Receivable.mp_payment_id == mp_payment_id).first()
+
+
+def _apply_webhook_status(db: Session, mp_payment_id: str, new_status: str) -> List[int]:
+    """Aplica o status do MP às cobranças do pagamento; retorna os contratos a desbloquear.
+
+    Idempotente: só grava o que mudou, e a baixa (PAID) é feita com as linhas
+    travadas e apenas nas cobranças ainda não pagas, então uma notificação
+    repetida não baixa nem desbloqueia de novo.
+    """
+    db.query(Receivable).filter(
+        Receivable.mp_payment_id == mp_payment_id,
+        or_(Receivable.mp_payment_status.is_(None), Receivable.mp_payment_status != new_status),
+    ).update({Receivable.mp_payment_status: new_status}, synchronize_session=False)
+
+    contratos = set()
+    if new_status == "approved":
+        pendentes = db.query(Receivable.id, Receivable.servico_contratado_id).filter(
+            Receivable.mp_payment_id == mp_payment_id,
+            Receivable.status != "PAID",
+        ).with_for_update().all()
+        if pendentes:
+            db.query(Receivable).filter(
+                Receivable.id.in_([row.id for row in pendentes]),
+            ).update({Receivable.status: "PAID", Receivable.paid_at: datetime.now()}, synchronize_session=False)
+            # Se for ISP, processar desbloqueio
+            contratos = {row.servico_contratado_id for row in pendentes if row.servico_contratado_id}
+
+    db.commit()
+    return sorted(contratos)
+
+
+async def _sync_payment_status(db: Session, mp_payment_id: str) -> dict:
+    ctx = await run_in_threadpool(_webhook_context, db, mp_payment_id)
+    if not ctx:
+        logger.warning(f"Pagamento {mp_payment_id} não encontrado no banco local")
+        return {"status": "not_found"}
+
+    if not ctx.mp_access_token:
+        logger.error(f"Empresa {ctx.empresa_id} sem token MP para webhook")
+        return {"status": "error"}
+
+    # Consultar status atualizado no MP
+    payment_info = await mercadopago_client.get_payment(ctx.mp_access_token, mp_payment_id)
+    if payment_info["status"] != 200:
+        return {"status": "ignored"}
+
+    new_status = payment_info["response"]["status"]
+    logger.info(f"Atualizando status do pagamento {mp_payment_id} para {new_status}")
+
+    contratos = await run_in_threadpool(_apply_webhook_status, db, mp_payment_id, new_status)
+    await run_in_threadpool(unblock_dispatcher.enqueue, contratos)
+    return {"status": "ok"}
+
+
 @router.post("/webhook")
 async def webhook(request: Request, db: Session = Depends(get_db)):
     """Recebe notificações de alteração de status do Mercado Pago."""
     try:
         data = await request.json()
         logger.info(f"Webhook Mercado Pago recebido: {data}")
-        
+
         # O MP envia o ID do recurso em data.id
         resource_id = data.get("data", {}).get("id")
         topic = data.get("type") or data.get("topic")
 
-        if topic == "payment" and resource_id:
-            # Buscar qualquer recebível que tenha este mp_payment_id para descobrir a empresa
-            receivables = db.query(Receivable).filter(Receivable.mp_payment_id == str(resource_id)).all()
-            if not receivables:
-                logger.warning(f"Pagamento {resource_id} não encontrado no banco local")
-                return {"status": "not_found"}
+        if topic != "payment" or not resource_id:
+            return {"status": "ignored"}
 
-            empresa = receivables[0].empresa
-            if not empresa or not empresa.mp_access_token:
-                logger.error(f"Empresa {receivables[0].empresa_id} sem token MP para webhook")
-                return {"status": "error"}
+        mp_payment_id = str(resource_id)
+        if mp_payment_id in _webhook_inflight:
+            _webhook_inflight[mp_payment_id] = True
+            logger.info(f"Pagamento {mp_payment_id} já em processamento; notificação agregada")
+            return {"status": "ok"}
 
-            # Consultar status atualizado no MP
-            sdk = mercadopago.SDK(empresa.mp_access_token)
-            payment_info = sdk.payment().get(resource_id)
-            
-            if payment_info["status"] == 200:
-                payment = payment_info["response"]
-                new_status = payment["status"]
-                
-                logger.info(f"Atualizando status do pagamento {resource_id} para {new_status}")
-                
-                for r in receivables:
-                    r.mp_payment_status = new_status
-                    if new_status == "approved" and r.status != "PAID":
-                        r.status = "PAID"
-                        r.paid_at = datetime.now()
-                        # Se for ISP, processar desbloqueio
-                        if r.servico_contratado_id:
-                            try:
-                                isp_service.process_unblock_if_needed(db, r.servico_contratado_id)
-                            except Exception as e:
-                                logger.error(f"Erro no desbloqueio ISP via webhook: {e}")
-                
-                db.commit()
-                return {"status": "ok"}
-
-        return {"status": "ignored"}
+        _webhook_inflight[mp_payment_id] = False
+        try:
+            while True:
+                result = await _sync_payment_status(db, mp_payment_id)
+                if result["status"] != "ok" or not _webhook_inflight[mp_payment_id]:
+                    return result
+                _webhook_inflight[mp_payment_id] = False
+        finally:
+            _webhook_inflight.pop(mp_payment_id, None)
     except Exception as e:
         logger.error(f"Erro no webhook Mercado Pago: {str(e)}")
         return {"status": "error", "message": str(e)}
@@ -1,5 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Response, Body, Query, Request
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from starlette.background import BackgroundTask
 from sqlalchemy.orm import Session
 from typing import List
@@ -15,6 +15,8 @@ from app.models.models import Usuario, Empresa, UsuarioEmpresa, NFCom
 from app.models import models
 from app.services.email_service import EmailService
 from app.services.danfe_generator import generate_danfe
+from app.services import nfcom_artifacts, nfcom_zip
+import json
 import os
 import tempfile
 import threading
@@ -57,6 +59,23 @@ def _check_user_permission_for_empresa(empresa_id: int, current_user: Usuario, d
     """Helper function to check if a user can access a company's resources and if license is valid."""
     return deps.check_empresa_access(db, empresa_id, current_user)
 
+def _danfe_pdf_file(nfcom):
+    """Retorna (caminho, temporario) de um PDF do DANFE da nota.
+
+    Notas autorizadas usam o arquivo do armazenamento de artefatos; para as
+    demais o PDF é gerado em um arquivo temporário, que quem chama remove.
+    """
+    stored = nfcom_artifacts.danfe_path(nfcom, generate_danfe)
+    if stored is not None:
+        return str(stored), False
+    pdf_buffer = generate_danfe(nfcom)
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+    try:
+        tmp.write(pdf_buffer.getvalue())
+    finally:
+        tmp.close()
+    return tmp.name, True
+
 @router.post("/", response_model=EmpresaResponse, status_code=status.HTTP_201_CREATED)
 def create_empresa(
     empresa: EmpresaCreate,
@@ -164,7 +183,12 @@ def bulk_emit_nfcom_from_contracts(
     db: Session = Depends(get_db),
     current_user: Usuario = Depends(get_current_active_user)
 ):
-    """Emite NFCom em massa para uma lista de contratos selecionados."""
+    """Emite NFCom em massa para uma lista de contratos selecionados.
+
+    Com `stream = true` a resposta é NDJSON: uma linha por contrato assim que
+    seu resultado fica pronto (e uma por nota transmitida) e, por fim, uma
+    linha com o resumo no formato de BulkEmitNFComResponse.
+    """
     _check_user_permission_for_empresa(empresa_id, current_user, db)
     # Backend permission: require nfcom_manage to emit NFComs in bulk
     deps.permission_checker('nfcom_manage')(db=db, current_user=current_user)
@@ -173,19 +197,55 @@ def bulk_emit_nfcom_from_contracts(
         raise HTTPException(status_code=400, detail="Lista de contratos não pode estar vazia")
 
     # Segurança adicional: garantir que TODOS os contratos solicitados pertencem
-    # à empresa informada. Fazemos uma pré-validação e removemos/registramos
-    # contratos inválidos antes de chamar a função CRUD que cria as NFs.
-    from app.crud import crud_servico_contratado
+    # à empresa informada. Fazemos uma pré-validação (uma consulta para a lista
+    # toda) e removemos/registramos contratos inválidos antes de chamar a função
+    # CRUD que cria as NFs.
+    da_empresa = {
+        row[0] for row in db.query(models.ServicoContratado.id).filter(
+            models.ServicoContratado.id.in_(request.contract_ids),
+            models.ServicoContratado.empresa_id == empresa_id
+        ).all()
+    }
 
     valid_ids = []
     invalids = []
     for cid in request.contract_ids:
-        c = crud_servico_contratado.get_servico_contratado(db, contrato_id=cid, empresa_id=empresa_id)
-        if c is None:
+        if cid not in da_empresa:
             invalids.append({"contract_id": cid, "error": "Contrato não pertence à empresa ou não encontrado"})
         else:
             valid_ids.append(cid)
 
+    execute = getattr(request, 'execute', False)
+    transmit = getattr(request, 'transmit', False)
+
+    if getattr(request, 'stream', False):
+        def _stream():
+            for item in invalids:
+                yield json.dumps({"event": "failure", **item}, default=str) + "\n"
+            report = crud_nfcom.BulkEmitReport()
+            if valid_ids:
+                # A sessão da requisição não sobrevive ao streaming: usar uma própria
+                stream_db = SessionLocal()
+                try:
+                    for tipo, item in crud_nfcom.iter_bulk_emit_nfcom(
+                        stream_db, valid_ids, empresa_id, execute=execute, transmit=transmit
+                    ):
+                        report.add(tipo, item)
+                        yield json.dumps({"event": tipo, **item}, default=str) + "\n"
+                finally:
+                    stream_db.close()
+            failures = report.failures + invalids
+            summary = BulkEmitNFComResponse(
+                successes=report.successes,
+                failures=failures,
+                total_processed=len(request.contract_ids),
+                total_success=len(report.successes),
+                total_failed=len(failures)
+            )
+            yield json.dumps({"summary": summary.model_dump()}, default=str) + "\n"
+
+        return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
     if not valid_ids:
         # Nenhum contrato válido para processar
         return BulkEmitNFComResponse(
@@ -201,20 +261,12 @@ def bulk_emit_nfcom_from_contracts(
         db=db,
         contract_ids=valid_ids,
         empresa_id=empresa_id,
-        execute=getattr(request, 'execute', False),
-        transmit=getattr(request, 'transmit', False)
+        execute=execute,
+        transmit=transmit
     )
 
     # Mesclar falhas pré-validadas com as que vieram do processamento
-    results_failures = results.get('failures', [])
-    results_failures.extend(invalids)
-
-    # Preparar resposta (usar falhas mescladas)
-    merged_failures = results.get('failures', [])
-    # results_failures já estendeu invalids, mas garantir união segura
-    if results_failures is not merged_failures:
-        # Se por algum motivo não for a mesma lista, reconstruir
-        merged_failures = results.get('failures', []) + invalids
+    merged_failures = results.get('failures', []) + invalids
 
     response = BulkEmitNFComResponse(
         successes=results.get("successes", []),
@@ -310,13 +362,9 @@ def bulk_email_nfcoms(
                         dbbg.commit()
                         continue
 
-                    # gerar DANFE temporário
+                    # DANFE armazenado (ou temporário para notas não armazenadas)
                     try:
-                        pdf_buffer = generate_danfe(nf)
-                        tmpf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-                        tmpf.write(pdf_buffer.getvalue())
-                        tmpf.close()
-                        pdf_path = tmpf.name
+                        pdf_path, pdf_temporario = _danfe_pdf_file(nf)
                     except Exception as e:
                         status_row.status = 'failed'
                         status_row.error_message = f'Erro ao gerar DANFE: {str(e)}'
@@ -340,10 +388,11 @@ def bulk_email_nfcoms(
                         sent_err = str(e)
 
                     # remover arquivo temporário
-                    try:
-                        os.unlink(pdf_path)
-                    except Exception:
-                        pass
+                    if pdf_temporario:
+                        try:
+                            os.unlink(pdf_path)
+                        except Exception:
+                            pass
 
                     if sent:
                         status_row.status = 'sent'
@@ -591,6 +640,11 @@ def download_empresa_nfcom_xml(
     if not db_nfcom.xml_gerado:
         raise HTTPException(status_code=404, detail="XML não disponível para esta NFCom")
 
+    filename = f"nfcom_{db_nfcom.numero_nf}_{db_nfcom.serie}.xml"
+    stored = nfcom_artifacts.xml_path(db_nfcom)
+    if stored is not None:
+        return FileResponse(path=str(stored), filename=filename, media_type="application/xml")
+
     return Response(
         content=db_nfcom.xml_gerado,
         media_type="application/xml",
@@ -622,10 +676,10 @@ def visualizar_danfe_nfcom(
     if not db_nfcom:
         raise HTTPException(status_code=404, detail="NFCom não encontrada nesta empresa")
 
-    # 3. Gera o DANFE
+    # 3. Usa o DANFE armazenado (notas autorizadas) ou gera na hora
     try:
-        pdf_buffer = generate_danfe(db_nfcom)
-        pdf_content = pdf_buffer.getvalue()
+        stored = nfcom_artifacts.danfe_path(db_nfcom, generate_danfe)
+        pdf_content = None if stored is not None else generate_danfe(db_nfcom).getvalue()
     except Exception as e:
         raise HTTPException(
             status_code=500, 
@@ -641,6 +695,9 @@ def visualizar_danfe_nfcom(
     else:
         content_disposition = f"inline; filename={filename}"
 
+    if stored is not None:
+        return FileResponse(path=str(stored), media_type="application/pdf", headers={"Content-Disposition": content_disposition})
+
     return Response(
         content=pdf_content,
         media_type="application/pdf",
@@ -758,15 +815,10 @@ def transmitir_empresa_nfcom(
                     cliente_email = getattr(cliente, 'email', None)
 
                 if cliente_email:
-                    # Gerar DANFE (PDF) em buffer e escrever em arquivo temporário
+                    # DANFE (PDF) do armazenamento de artefatos, já que a nota foi autorizada
                     try:
-                        pdf_buffer = generate_danfe(db_nfcom)
-                        import tempfile, os
-                        tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+                        pdf_path, pdf_temporario = _danfe_pdf_file(db_nfcom)
                         try:
-                            tmp.write(pdf_buffer.getvalue())
-                            tmp.flush()
-                            tmp.close()
                             # Obter objeto ORM da empresa (contém smtp_password criptografada)
                             from app.crud import crud_empresa as _crud_empresa
                             orm_empresa = _crud_empresa.get_empresa_raw(db, empresa_id=empresa_id)
@@ -774,7 +826,7 @@ def transmitir_empresa_nfcom(
                                 'numero_nf': db_nfcom.numero_nf,
                                 'serie': db_nfcom.serie,
                                 'protocolo_autorizacao': getattr(db_nfcom, 'protocolo_autorizacao', None)
-                            }, pdf_path=tmp.name)
+                            }, pdf_path=pdf_path)
                             resp['email_sent'] = bool(sent)
                             resp['email_message'] = 'Email enviado' if sent else 'Falha ao enviar email'
                             # Persistir status de envio na NFCom para frontend
@@ -792,10 +844,11 @@ def transmitir_empresa_nfcom(
                             except Exception:
                                 db.rollback()
                         finally:
-                            try:
-                                os.unlink(tmp.name)
-                            except Exception:
-                                pass
+                            if pdf_temporario:
+                                try:
+                                    os.unlink(pdf_path)
+                                except Exception:
+                                    pass
                     except Exception as e:
                         # Não falhar a transmissão por conta de erro no envio de email
                         resp['email_sent'] = False
@@ -945,8 +998,7 @@ def send_emails_for_nfcoms(
         if not db_nfcom:
             invalid.append({"nfcom_id": nf_id, "reason": "not_found"})
             continue
-        info = (getattr(db_nfcom, 'informacoes_adicionais', '') or '')
-        is_cancelled = any(code in info for code in ['cStat=135', 'cStat=136', 'cStat=134'])
+        is_cancelled = db_nfcom.status == 'cancelada'
         is_authorized = bool(getattr(db_nfcom, 'protocolo_autorizacao', None))
         if is_cancelled:
             invalid.append({"nfcom_id": nf_id, "reason": "cancelled"})
@@ -970,15 +1022,10 @@ def send_emails_for_nfcoms(
                 results.append({"nfcom_id": nf_id, "sent": False, "message": "Cliente sem email cadastrado"})
                 continue
 
-            # Gerar PDF e enviar
+            # Obter o PDF (armazenado ou temporário) e enviar
             try:
-                pdf_buffer = generate_danfe(db_nfcom)
-                import tempfile, os
-                tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+                pdf_path, pdf_temporario = _danfe_pdf_file(db_nfcom)
                 try:
-                    tmp.write(pdf_buffer.getvalue())
-                    tmp.flush()
-                    tmp.close()
                     # Obter ORM da empresa para envio (tem smtp_password criptografada)
                     from app.crud import crud_empresa as _crud_empresa
                     orm_empresa = _crud_empresa.get_empresa_raw(db, empresa_id=empresa_id)
@@ -986,7 +1033,7 @@ def send_emails_for_nfcoms(
                         'numero_nf': db_nfcom.numero_nf,
                         'serie': db_nfcom.serie,
                         'protocolo_autorizacao': getattr(db_nfcom, 'protocolo_autorizacao', None)
-                    }, pdf_path=tmp.name)
+                    }, pdf_path=pdf_path)
                     # Update NFCom record with email result
                     try:
                         if sent:
@@ -1003,10 +1050,11 @@ def send_emails_for_nfcoms(
 
                     results.append({"nfcom_id": nf_id, "sent": bool(sent), "message": 'Email enviado' if sent else 'Falha ao enviar email'})
                 finally:
-                    try:
-                        os.unlink(tmp.name)
-                    except Exception:
-                        pass
+                    if pdf_temporario:
+                        try:
+                            os.unlink(pdf_path)
+                        except Exception:
+                            pass
             except Exception as e:
                 # Update NFCom with error
                 try:
@@ -1033,74 +1081,50 @@ def bulk_transmit_nfcoms(
 ):
     """Transmite em massa as NFComs listadas em `payload['nfcom_ids']`.
 
-    O envio ocorre na ordem da lista. Ao encontrar a primeira nota que retorna
-    erro (cStat diferente de 100) ou lançar exceção, a operação para e a
-    resposta indica quais foram transmitidas com sucesso e qual foi a falha.
+    As notas são preparadas na ordem da lista e enviadas com alguns envios
+    simultâneos por autorizador (certificado carregado uma vez por lote).
+    Ao encontrar a primeira nota que retorna erro (cStat diferente de 100)
+    ou lança exceção, nenhuma nota nova é enviada; as que já estavam em
+    envio têm o retorno registrado normalmente.
+
+    Com `payload['stream'] = true` a resposta é NDJSON: uma linha por nota
+    assim que o retorno chega e, por fim, uma linha com o resumo.
     """
     _check_user_permission_for_empresa(empresa_id, current_user, db)
     nfcom_ids = payload.get('nfcom_ids')
     if not nfcom_ids or not isinstance(nfcom_ids, list):
         raise HTTPException(status_code=400, detail="Parâmetro 'nfcom_ids' obrigatório e deve ser uma lista")
 
-    results_success = []
-    results_failure = []
+    def _summary(results_success, results_failure):
+        return {
+            "successes": results_success,
+            "failures": results_failure,
+            "total_requested": len(nfcom_ids),
+            "total_success": len(results_success),
+            "total_failed": len(results_failure)
+        }
+
+    if payload.get('stream'):
+        def _stream():
+            # A sessão da requisição não sobrevive ao streaming: usar uma própria
+            stream_db = SessionLocal()
+            results_success, results_failure = [], []
+            try:
+                for ok, item in crud_nfcom.transmit_nfcoms(stream_db, empresa_id, nfcom_ids, stop_on_failure=True):
+                    (results_success if ok else results_failure).append(item)
+                    yield json.dumps({"ok": ok, **item}, default=str) + "\n"
+            finally:
+                stream_db.close()
+            yield json.dumps({"summary": _summary(results_success, results_failure)}, default=str) + "\n"
 
-    for nf_id in nfcom_ids:
-        # buscar e validar pertence/estado
-        db_nfcom = crud_nfcom.get_nfcom(db, nfcom_id=nf_id, empresa_id=empresa_id)
-        if not db_nfcom:
-            # nota não encontrada: considera erro e para o lote
-            results_failure.append({"nfcom_id": nf_id, "error": "not_found"})
-            break
-
-        info = (getattr(db_nfcom, 'informacoes_adicionais', '') or '')
-        # se cancelada, trata como erro e para o lote
-        if any(code in info for code in ['cStat=135', 'cStat=136', 'cStat=134']):
-            results_failure.append({"nfcom_id": nf_id, "error": "cancelled"})
-            break
-
-        # se já autorizada, não transmite novamente — consideramos sucesso e continua
-        if getattr(db_nfcom, 'protocolo_autorizacao', None):
-            results_success.append({"nfcom_id": nf_id, "status": "already_authorized"})
-            continue
+        return StreamingResponse(_stream(), media_type="application/x-ndjson")
 
-        try:
-            resultado = crud_nfcom.transmit_nfcom(db, nfcom_id=nf_id, empresa_id=empresa_id)
-        except HTTPException as he:
-            # Propaga erro com detalhe para o frontend e para no lote
-            msg = getattr(he, 'detail', str(he))
-            results_failure.append({"nfcom_id": nf_id, "error": "exception", "message": msg})
-            break
-        except Exception as e:
-            results_failure.append({"nfcom_id": nf_id, "error": "exception", "message": str(e)})
-            break
-
-        # Checar retorno da transmissão
-        cStat = None
-        xMotivo = None
-        if isinstance(resultado, dict):
-            cStat = resultado.get('cStat')
-            xMotivo = resultado.get('xMotivo')
-
-        if cStat and str(cStat) == '100':
-            results_success.append({"nfcom_id": nf_id, "status": "authorized", "cStat": cStat})
-            # continuar para próxima nota
-            continue
-        else:
-            # se retorno não contém cStat==100, registra falha e para lote
-            detail_msg = None
-            if isinstance(resultado, dict):
-                detail_msg = resultado.get('xMotivo') or resultado.get('error') or str(resultado)
-            results_failure.append({"nfcom_id": nf_id, "error": "transmit_failed", "cStat": cStat, "message": detail_msg, "resultado": resultado})
-            break
+    results_success = []
+    results_failure = []
+    for ok, item in crud_nfcom.transmit_nfcoms(db, empresa_id, nfcom_ids, stop_on_failure=True):
+        (results_success if ok else results_failure).append(item)
 
-    return {
-        "successes": results_success,
-        "failures": results_failure,
-        "total_requested": len(nfcom_ids),
-        "total_success": len(results_success),
-        "total_failed": len(results_failure)
-    }
+    return _summary(results_success, results_failure)
 
 
 
@@ -1123,66 +1147,33 @@ def download_nfcoms_zip(
     if typ not in ('xml', 'danfe'):
         raise HTTPException(status_code=400, detail="Parâmetro 'type' deve ser 'xml' ou 'danfe'")
 
-    import zipfile, tempfile, os
-
-    tmp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-    tmp_zip.close()
-
-    try:
-        # Validação prévia: proibir ações em notas canceladas; proibir geração de DANFE para pendentes
-        invalid = []
-        for nf_id in nfcom_ids:
-            db_nfcom = crud_nfcom.get_nfcom(db, nfcom_id=nf_id, empresa_id=empresa_id)
-            if not db_nfcom:
-                invalid.append({"nfcom_id": nf_id, "reason": "not_found"})
-                continue
-            info = (getattr(db_nfcom, 'informacoes_adicionais', '') or '')
-            is_cancelled = any(code in info for code in ['cStat=135', 'cStat=136', 'cStat=134'])
-            is_authorized = bool(getattr(db_nfcom, 'protocolo_autorizacao', None))
-            if is_cancelled:
-                invalid.append({"nfcom_id": nf_id, "reason": "cancelled"})
-                continue
-            if typ == 'danfe' and not is_authorized:
-                invalid.append({"nfcom_id": nf_id, "reason": "pending"})
-                continue
-
-        if invalid:
-            raise HTTPException(status_code=400, detail={"invalid": invalid})
-
-        with zipfile.ZipFile(tmp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for nf_id in nfcom_ids:
-                db_nfcom = crud_nfcom.get_nfcom(db, nfcom_id=nf_id, empresa_id=empresa_id)
-                if not db_nfcom:
-                    continue
-
-                if typ == 'xml':
-                    xml_bytes = getattr(db_nfcom, 'xml_gerado', None)
-                    if not xml_bytes:
-                        continue
-                    filename = f"nfcom_{db_nfcom.numero_nf}_{db_nfcom.serie}.xml"
-                    zf.writestr(filename, xml_bytes)
+    # Validação prévia em lotes: proibir ações em notas canceladas; proibir geração de DANFE para pendentes
+    found = {}
+    for i in range(0, len(nfcom_ids), nfcom_zip.NFCOM_ZIP_BATCH):
+        batch = nfcom_ids[i:i + nfcom_zip.NFCOM_ZIP_BATCH]
+        for row in db.query(NFCom.id, NFCom.status, NFCom.protocolo_autorizacao).filter(
+            NFCom.id.in_(batch), NFCom.empresa_id == empresa_id
+        ).all():
+            found[row.id] = row
 
-                else:  # danfe
-                    try:
-                        pdf_buffer = generate_danfe(db_nfcom)
-                        filename = f"danfe_nfcom_{db_nfcom.numero_nf}_{db_nfcom.serie}.pdf"
-                        zf.writestr(filename, pdf_buffer.getvalue())
-                    except Exception:
-                        # pular notas cuja geração de DANFE falhar
-                        continue
+    invalid = []
+    for nf_id in nfcom_ids:
+        row = found.get(nf_id)
+        if row is None:
+            invalid.append({"nfcom_id": nf_id, "reason": "not_found"})
+            continue
+        if row.status == 'cancelada':
+            invalid.append({"nfcom_id": nf_id, "reason": "cancelled"})
+            continue
+        if typ == 'danfe' and not row.protocolo_autorizacao:
+            invalid.append({"nfcom_id": nf_id, "reason": "pending"})
 
-        # Retornar o arquivo com BackgroundTask para remover após envio
-        def _cleanup(path: str):
-            try:
-                os.unlink(path)
-            except Exception:
-                pass
+    if invalid:
+        raise HTTPException(status_code=400, detail={"invalid": invalid})
 
-        bt = BackgroundTask(_cleanup, tmp_zip.name)
-        return FileResponse(path=tmp_zip.name, filename=os.path.basename(tmp_zip.name), media_type='application/zip', background=bt)
-    except Exception as e:
-        try:
-            os.unlink(tmp_zip.name)
-        except Exception:
-            pass
-        raise HTTPException(status_code=500, detail=f"Erro ao gerar ZIP: {str(e)}")
\ No newline at end of file
+    # O ZIP é gerado enquanto é enviado (ver app/services/nfcom_zip.py)
+    return StreamingResponse(
+        nfcom_zip.iter_nfcom_zip(empresa_id, nfcom_ids, typ),
+        media_type='application/zip',
+        headers={"Content-Disposition": f"attachment; filename=nfcom_{typ}_{empresa_id}.zip"},
+    )
\ No newline at end of file
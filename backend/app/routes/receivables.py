@@ -11,7 +11,7 @@ from app.core.database import get_db
 from app.routes.auth import get_current_active_user
 from app.api import deps
 from app.models.models import Usuario, Receivable, BankAccount, Empresa, CaixaSessao, CaixaMovimentacao
-from app.services import isp_service
+from app.services import unblock_dispatcher
 from app.schemas import caixa as schema_caixa
 from app.crud import crud_caixa
 from app.services.receivable_service import generate_receivables_for_company, generate_receivables_for_company_range, build_boleto_context
@@ -154,6 +154,7 @@ def reconcile_bb_payments(
     total_updated = 0
     total_errors = 0
     details = []
+    contratos_pagos = set()
 
     # Busca apenas os boletos selecionados (que sejam PENDING ou REGISTERED e do BB)
     receivables = db.query(Receivable).filter(
@@ -225,10 +226,7 @@ def reconcile_bb_payments(
                             except (ValueError, TypeError):
                                 pass
                         if r.servico_contratado_id:
-                            try:
-                                isp_service.process_unblock_if_needed(db, r.servico_contratado_id)
-                            except Exception as e:
-                                logger.error(f"Reconcile: erro desbloqueio contrato {r.servico_contratado_id}: {e}")
+                            contratos_pagos.add(r.servico_contratado_id)
 
                     db.add(r)
                     total_updated += 1
@@ -245,6 +243,8 @@ def reconcile_bb_payments(
         logger.exception("Reconcile BB: erro ao salvar no banco")
         raise HTTPException(status_code=500, detail="Erro ao salvar alterações no banco de dados.")
 
+    unblock_dispatcher.enqueue(contratos_pagos)
+
     return {
         "checked": total_checked,
         "updated": total_updated,
@@ -554,36 +554,29 @@ def settle_receivable(receivable_id: int, payload: SettlePayload = Body(...), db
         except Exception as e:
             logger.error(f"Erro ao solicitar baixa no BB para boleto {receivable.bb_boleto_numero}: {e}")
 
-    # Se a cobrança estiver vinculada a um contrato ISP, realiza o desbloqueio automático
+    db.commit()
+    db.refresh(receivable)
+
+    # Se a cobrança estiver vinculada a um contrato ISP, agenda o desbloqueio automático
+    # (aplicado em lote pelo unblock_dispatcher, sem esperar o Router/Radius aqui)
     unblock_attempted = False
     unblock_success = False
     unblock_message = None
 
     if receivable.servico_contratado_id:
         unblock_attempted = True
-        try:
-            # Sincroniza com o router e passa raise_on_error=True para obtermos a resposta precisa
-            success = isp_service.process_unblock_if_needed(db, receivable.servico_contratado_id, raise_on_error=True)
-            if success:
-                unblock_success = True
-                unblock_message = f"Contrato #{receivable.servico_contratado_id} reativado com absoluto sucesso no Router/Radius!"
-            else:
-                from app.models.models import ServicoContratado, StatusContrato
-                contrato = db.query(ServicoContratado).filter(ServicoContratado.id == receivable.servico_contratado_id).first()
-                if contrato and contrato.status == StatusContrato.ATIVO:
-                    unblock_success = True
-                    unblock_message = "O contrato associado já estava ativo."
-                else:
-                    unblock_success = False
-                    unblock_message = "O contrato associado não exige desbloqueio no momento."
-        except Exception as e:
-            unblock_success = False
-            unblock_message = f"Falha de comunicação com o Router/Radius: {str(e)}"
-            logger.error(f"Erro ao processar desbloqueio automático ISP para contrato {receivable.servico_contratado_id}: {e}")
+        from app.models.models import ServicoContratado, StatusContrato
+        contrato = db.query(ServicoContratado).filter(ServicoContratado.id == receivable.servico_contratado_id).first()
+        if contrato and contrato.status in (StatusContrato.SUSPENSO, StatusContrato.PENDENTE_INSTALACAO):
+            unblock_dispatcher.enqueue([contrato.id])
+            unblock_success = True
+            unblock_message = f"Desbloqueio do contrato #{contrato.id} agendado; será aplicado no Router/Radius em instantes."
+        elif contrato and contrato.status == StatusContrato.ATIVO:
+            unblock_success = True
+            unblock_message = "O contrato associado já estava ativo."
+        else:
+            unblock_message = "O contrato associado não exige desbloqueio no momento."
 
-    db.commit()
-    db.refresh(receivable)
-    
     response_obj = ReceivableResponse.from_orm(receivable)
     response_obj.unblock_attempted = unblock_attempted
     response_obj.unblock_success = unblock_success
@@ -39,29 +39,25 @@ def get_tickets(
     cliente_id: Optional[int] = None,
     atribuido_para_id: Optional[int] = None,
     search: Optional[str] = None,
+    cursor: Optional[str] = Query(None, description="next_cursor da página anterior (paginação por created_at/id)"),
     _: bool = Depends(deps.permission_checker("tickets_view")),
     current_user: Usuario = Depends(deps.get_current_active_user),
     active_empresa: Empresa = Depends(deps.get_active_empresa),
     db: Session = Depends(get_db)
 ):
-    """Lista tickets com filtros opcionais."""
+    """Lista tickets com filtros opcionais.
+
+    Retorna a página, o total filtrado e o next_cursor; com `cursor` a
+    página continua a partir do último ticket da anterior (ignora `skip`).
+    """
     empresa_id = active_empresa.id
-    
-    # Calcular total para paginação
-    total = TicketService.count_tickets(
-        db, empresa_id, status, prioridade,
-        categoria, cliente_id, atribuido_para_id, search,
-        current_user_id=current_user.id
-    )
-        
-    tickets = TicketService.get_tickets(
+
+    return TicketService.list_tickets(
         db, empresa_id, skip, limit, status, prioridade,
         categoria, cliente_id, atribuido_para_id, search,
-        current_user_id=current_user.id
+        current_user_id=current_user.id, cursor=cursor
     )
 
-    return {"data": tickets, "total": total}
-
 
 @router.get("/{ticket_id}", response_model=TicketDetail)
 def get_ticket(
@@ -11,6 +11,7 @@ from app.routes.auth import get_current_user
 from app.api import deps
 from app.core.database import get_db
 from app.models.models import Usuario
+from app.services import nfcom_cache
 
 router = APIRouter(
     prefix="/uploads",
@@ -138,6 +139,7 @@ async def upload_empresa_certificado(
             db.close()
 
         file_path = _save_uploaded_file(file, "certificates", empresa_id, use_certificates_dir=True)
+        nfcom_cache.invalidate_certificate(empresa_id)
         return JSONResponse(
             content={
                 "message": "Certificado enviado com sucesso",
@@ -6,7 +6,7 @@ from decimal import Decimal
 
 from app.core.database import get_db
 from app.models.models import Receivable
-from app.services import bb_api_service, isp_service
+from app.services import bb_api_service, unblock_dispatcher
 
 router = APIRouter(prefix="/webhooks", tags=["Webhooks"])
 logger = logging.getLogger(__name__)
@@ -49,6 +49,7 @@ async def bb_webhook(
         return {"ok": True, "processed": 0}
 
     processed = []
+    contratos_pagos = set()
 
     for b in boletos:
         if not isinstance(b, dict):
@@ -150,15 +151,9 @@ async def bb_webhook(
                 except (ValueError, TypeError):
                     pass
 
-            # Se a cobrança estiver vinculada a um contrato ISP, realiza o desbloqueio automático
+            # Se a cobrança estiver vinculada a um contrato ISP, agenda o desbloqueio automático
             if ar.servico_contratado_id:
-                try:
-                    isp_service.process_unblock_if_needed(db, ar.servico_contratado_id)
-                except Exception as e:
-                    logger.error(
-                        f"BB webhook: Erro ao processar desbloqueio ISP para contrato "
-                        f"{ar.servico_contratado_id}: {e}"
-                    )
+                contratos_pagos.add(ar.servico_contratado_id)
 
         elif new_status == 'CANCELLED':
             logger.info(f"BB webhook: Boleto {numero} marcado como CANCELADO (ID={ar.id})")
@@ -169,6 +164,8 @@ async def bb_webhook(
     try:
         db.commit()
         logger.info(f"BB webhook: {len(processed)} evento(s) processado(s) com sucesso")
+        # Desbloqueio em lote, depois da resposta (ver unblock_dispatcher)
+        unblock_dispatcher.enqueue(contratos_pagos)
     except Exception:
         db.rollback()
         logger.exception("BB webhook: Erro ao salvar alterações no banco")
@@ -3,8 +3,10 @@ from sqlalchemy.orm import Session
 from typing import Optional
 import logging
 
+from app.api import deps
 from app.core.database import get_db
 from app.models.models import Empresa
+from app.services import whatsapp_queue
 from app.services.whatsapp_service import WhatsAppService
 
 logger = logging.getLogger(__name__)
@@ -18,6 +20,14 @@ def get_client_ip(request: Request) -> str:
         return forwarded.split(",")[0].strip()
     return request.headers.get("X-Real-IP") or request.client.host
 
+@router.get("/queue/status")
+def get_whatsapp_queue_status(
+    db: Session = Depends(get_db),
+    empresa: Empresa = Depends(deps.get_active_empresa)
+):
+    """Situação da fila de saída do WhatsApp da empresa ativa (contagem por status e por instância)."""
+    return whatsapp_queue.queue_status(db, empresa.id)
+
 @router.api_route("/send", methods=["GET", "POST"])
 async def send_whatsapp_gateway(
     request: Request,
@@ -92,7 +92,7 @@ class CTO(CTOBase):
 # ===== SNAPSHOT / STATUS SCHEMAS =====
 
 class FTTHMonitorSnapshotOut(BaseModel):
-    id: int
+    id: Optional[int] = None
     contrato_id: int
     empresa_id: int
     status: str
@@ -106,6 +106,14 @@ class FTTHMonitorSnapshotOut(BaseModel):
     detalhe_erro: Optional[str] = None
     ip_verificado: Optional[str] = None
     timestamp: datetime
+    # Preenchidos apenas em históricos agregados (resolucao HORA/DIA)
+    resolucao: Optional[str] = None
+    amostras: Optional[int] = None
+    disponibilidade_percentual: Optional[float] = None
+    latencia_min_ms: Optional[float] = None
+    latencia_max_ms: Optional[float] = None
+    rx_power_min: Optional[float] = None
+    rx_power_max: Optional[float] = None
 
     class Config:
         from_attributes = True
@@ -194,7 +194,8 @@ class BulkEmitNFComRequest(BaseModel):
     """Schema para requisição de emissão em massa de NFCom baseada em contratos."""
     contract_ids: List[int] = Field(..., description="Lista de IDs dos contratos para emissão")
     execute: Optional[bool] = Field(False, description="Se True, cria as NFComs no banco (modo apply). Se False, apenas valida (dry-run).")
-    transmit: Optional[bool] = Field(False, description="Se True, após criar cada NFCom chamará transmissão (transmit_nfcom). Requer certificados configurados.")
+    transmit: Optional[bool] = Field(False, description="Se True, transmite as NFComs criadas ao final da emissão (envios em paralelo, ver transmit_nfcoms). Requer certificados configurados.")
+    stream: Optional[bool] = Field(False, description="Se True, responde em NDJSON com o progresso de cada contrato e um resumo ao final.")
 
 
 class BulkEmitNFComResponse(BaseModel):
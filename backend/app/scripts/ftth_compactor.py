@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Script de Compactação do Histórico FTTH — Brazcom ISP Suite
+
+Executado pelo cron a cada hora para agregar os snapshots do poller em
+buckets por hora/dia e aplicar a retenção configurada
+(FTTH_RAW_RETENTION_DAYS, FTTH_HOURLY_RETENTION_DAYS, FTTH_DAILY_RETENTION_DAYS).
+
+Uso:
+    python -m app.scripts.ftth_compactor
+"""
+import sys
+import os
+import logging
+import time
+
+# Garante que o diretório pai (backend/) está no path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [FTTH_COMPACTOR] %(levelname)s — %(message)s",
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger(__name__)
+
+
+def run_compactor():
+    """Agrega as horas/dias fechados e remove os dados fora da retenção."""
+    from app.core.database import SessionLocal
+    from app.services.ftth_rollup_service import FTTHRollupService
+
+    db = SessionLocal()
+    inicio = time.monotonic()
+    try:
+        resumo = FTTHRollupService.compact(db)
+        logger.info(
+            f"Compactação concluída em {time.monotonic() - inicio:.1f}s — "
+            f"Horas={resumo['horas']} Dias={resumo['dias']} | "
+            f"Removidos: snapshots={resumo['snapshots_removidos']} "
+            f"horas={resumo['horas_removidas']} dias={resumo['dias_removidos']}"
+        )
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Erro crítico na compactação: {e}")
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    run_compactor()
@@ -8,6 +8,7 @@ das ONUs FTTH de todas as empresas ativas.
 Uso:
     python -m app.scripts.ftth_poller
     python -m app.scripts.ftth_poller --empresa-id 1   # Apenas uma empresa
+    python -m app.scripts.ftth_poller --sessions-per-router 4 --max-inflight 128
 """
 import sys
 import os
@@ -28,17 +29,26 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def run_poller(empresa_id: int = None):
+def run_poller(empresa_id: int = None, sessions_per_router: int = None, max_inflight: int = None):
     """
     Executa o polling de todas as ONUs FTTH.
     
     Args:
         empresa_id: Se informado, verifica apenas a empresa especificada.
                     Se None, verifica todas as empresas ativas.
+        sessions_per_router: Sessões RouterOS API por Roteador (padrão: FTTH_SESSIONS_PER_ROUTER).
+        max_inflight: Pings simultâneos por Roteador (padrão: FTTH_MAX_INFLIGHT_PER_ROUTER).
     """
     from app.core.database import SessionLocal
     from app.models.models import Empresa
-    from app.services.ftth_monitor_service import FTTHMonitorService
+    from app.services.ftth_poll_engine import FTTHPollEngine
+
+    engine_kwargs = {}
+    if sessions_per_router:
+        engine_kwargs["sessions_per_router"] = sessions_per_router
+    if max_inflight:
+        engine_kwargs["max_inflight_per_router"] = max_inflight
+    engine = FTTHPollEngine(**engine_kwargs)
 
     db = SessionLocal()
     try:
@@ -60,9 +70,15 @@ def run_poller(empresa_id: int = None):
         for empresa in empresas:
             try:
                 logger.info(f"  [{empresa.id}] {empresa.razao_social} — verificando ONUs...")
-                resumo = FTTHMonitorService.poll_all_onus(db, empresa.id)
+                resumo = engine.poll_empresa(db, empresa.id)
+                for r in sorted(resumo["routers"], key=lambda r: r["wall_time_s"], reverse=True):
+                    logger.info(
+                        f"  [{empresa.id}] Router={r['router_nome']} (id={r['router_id']}) | "
+                        f"{r['onus']} ONUs | {r['sessoes']} sessões | {r['wall_time_s']}s"
+                        f"{' | ' + r['erro'] if r['erro'] else ''}"
+                    )
                 logger.info(
-                    f"  [{empresa.id}] Resultado: {resumo['total']} ONUs | "
+                    f"  [{empresa.id}] Resultado: {resumo['total']} ONUs em {resumo['wall_time_s']}s | "
                     f"Online={resumo['ONLINE']} Offline={resumo['OFFLINE']} "
                     f"Degradado={resumo['DEGRADADO']} Desconhecido={resumo['DESCONHECIDO']}"
                 )
@@ -92,5 +108,21 @@ if __name__ == "__main__":
         default=None,
         help="ID da empresa específica a verificar (padrão: todas)"
     )
+    parser.add_argument(
+        "--sessions-per-router",
+        type=int,
+        default=None,
+        help="Sessões RouterOS API abertas por Roteador (padrão: FTTH_SESSIONS_PER_ROUTER ou 2)"
+    )
+    parser.add_argument(
+        "--max-inflight",
+        type=int,
+        default=None,
+        help="Pings simultâneos por Roteador (padrão: FTTH_MAX_INFLIGHT_PER_ROUTER ou 64)"
+    )
     args = parser.parse_args()
-    run_poller(empresa_id=args.empresa_id)
+    run_poller(
+        empresa_id=args.empresa_id,
+        sessions_per_router=args.sessions_per_router,
+        max_inflight=args.max_inflight,
+    )
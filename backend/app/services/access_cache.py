@@ -0,0 +1,223 @@
+"""
+Cache de processo para autenticação, empresa ativa, licença e permissões
+
+Toda requisição protegida carregava o usuário do token, a empresa, a
+associação usuário-empresa, a licença e as roles/permissões; rotas que
+chamam permission_checker manualmente repetiam as mesmas consultas. Aqui
+esses dados ficam em memória por ACCESS_CACHE_TTL segundos:
+
+- usuário: valores das colunas, religados à sessão da requisição com
+  merge(load=False), sem SELECT;
+- empresa: representação segura (crud_empresa.get_empresa);
+- licença: maior end_date ativa da empresa (a validade é comparada com o
+  horário atual em cada uso, então a expiração não depende do TTL);
+- (usuário, empresa): associação, flag de admin, nomes das roles globais
+  ou da empresa e das permissões dessas roles.
+
+Alterações feitas pela ORM em usuários, empresas, associações, licenças,
+roles e permissões (inclusive INSERT/UPDATE/DELETE executados pela sessão)
+invalidam as entradas afetadas quando a transação é confirmada. Cada
+invalidação incrementa a geração do usuário/empresa; uma leitura que começou
+antes disso não grava o resultado (possivelmente antigo) no cache (ver
+process_cache). Com vários processos (workers), cada um tem seu cache e o
+TTL limita a defasagem.
+"""
+import os
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from app.models.access_control import Permission, Role, role_permission_association, user_role_association
+from app.models.license import CompanyLicense, LicenseStatus
+from app.models.models import Empresa, Usuario, UsuarioEmpresa
+from app.services.process_cache import Generations, get_fresh, track_commits
+
+ACCESS_CACHE_TTL = float(os.environ.get("ACCESS_CACHE_TTL", "60"))
+
+_users: Dict[int, Tuple[float, dict]] = {}
+_empresas: Dict[int, Tuple[float, SimpleNamespace]] = {}
+_licenses: Dict[int, Tuple[float, Optional[datetime]]] = {}
+_memberships: Dict[Tuple[int, Optional[int]], Tuple[float, "Membership"]] = {}
+
+# Gerações por escopo (("user", id) ou ("empresa", id)), incrementadas pelas invalidações
+_generations = Generations()
+
+# Tabelas cujas alterações em massa (session.execute/query.update/delete) limpam o cache
+_TRACKED_TABLES = {
+    Usuario.__tablename__,
+    Empresa.__tablename__,
+    UsuarioEmpresa.__tablename__,
+    CompanyLicense.__tablename__,
+    Role.__tablename__,
+    Permission.__tablename__,
+    user_role_association.name,
+    role_permission_association.name,
+}
+
+_PENDING_KEY = "access_cache_pending"
+
+
+class Membership:
+    """Vínculo do usuário com uma empresa (ou com nenhuma, empresa_id None)."""
+
+    __slots__ = ("is_associated", "is_admin", "permissions", "roles")
+
+    def __init__(self, is_associated: bool, is_admin: bool, permissions: FrozenSet[str],
+                 roles: FrozenSet[str] = frozenset()):
+        self.is_associated = is_associated
+        self.is_admin = is_admin
+        self.permissions = permissions
+        self.roles = roles  # nomes em minúsculas
+
+
+def _put(cache: dict, key, value, generation: Tuple[int, ...], *scopes) -> None:
+    _generations.store(cache, key, value, ACCESS_CACHE_TTL, generation, *scopes)
+
+
+def get_user(db: Session, usuario_id: int) -> Optional[Usuario]:
+    """Usuário ligado à sessão `db`; só consulta o banco quando não está em cache."""
+    entry = get_fresh(_users, usuario_id)
+    if entry is not None:
+        user = Usuario(**entry[1])
+        make_transient_to_detached(user)
+        return db.merge(user, load=False)
+    generation = _generations.snapshot(("user", usuario_id))
+    user = db.query(Usuario).filter(Usuario.id == usuario_id).first()
+    if user is not None:
+        _put(_users, usuario_id, {
+            attr.key: getattr(user, attr.key) for attr in Usuario.__mapper__.column_attrs
+        }, generation, ("user", usuario_id))
+    return user
+
+
+def get_empresa(db: Session, empresa_id: int) -> Optional[SimpleNamespace]:
+    """Mesmo retorno de crud_empresa.get_empresa (uma cópia por chamada)."""
+    entry = get_fresh(_empresas, empresa_id)
+    if entry is None:
+        from app.crud import crud_empresa
+        generation = _generations.snapshot(("empresa", empresa_id))
+        empresa = crud_empresa.get_empresa(db, empresa_id=empresa_id)
+        if empresa is None:
+            return None
+        _put(_empresas, empresa_id, empresa, generation, ("empresa", empresa_id))
+        return SimpleNamespace(**vars(empresa))
+    return SimpleNamespace(**vars(entry[1]))
+
+
+def license_valid_until(db: Session, empresa_id: int) -> Optional[datetime]:
+    """Maior data de término entre as licenças ativas da empresa (None se não houver)."""
+    entry = get_fresh(_licenses, empresa_id)
+    if entry is not None:
+        return entry[1]
+    generation = _generations.snapshot(("empresa", empresa_id))
+    valid_until = db.query(func.max(CompanyLicense.end_date)).filter(
+        CompanyLicense.empresa_id == empresa_id,
+        CompanyLicense.status == LicenseStatus.ACTIVE,
+    ).scalar()
+    _put(_licenses, empresa_id, valid_until, generation, ("empresa", empresa_id))
+    return valid_until
+
+
+def get_membership(db: Session, usuario_id: int, empresa_id: Optional[int]) -> Membership:
+    """Associação, admin, roles e permissões do usuário na empresa.
+
+    Com empresa_id None vale a regra do permission_checker sem empresa ativa:
+    qualquer role atribuída ao usuário conta.
+    """
+    key = (usuario_id, empresa_id)
+    entry = get_fresh(_memberships, key)
+    if entry is not None:
+        return entry[1]
+    scopes = (("user", usuario_id), ("empresa", empresa_id))
+    generation = _generations.snapshot(*scopes)
+
+    assoc = None
+    if empresa_id is not None:
+        assoc = db.query(UsuarioEmpresa.is_admin).filter(
+            UsuarioEmpresa.usuario_id == usuario_id,
+            UsuarioEmpresa.empresa_id == empresa_id,
+        ).first()
+
+    q = db.query(Permission.name).join(
+        role_permission_association, Permission.id == role_permission_association.c.permission_id
+    ).join(
+        user_role_association, user_role_association.c.role_id == role_permission_association.c.role_id
+    ).filter(user_role_association.c.user_id == usuario_id)
+    roles_q = db.query(Role.name).join(
+        user_role_association, Role.id == user_role_association.c.role_id
+    ).filter(user_role_association.c.user_id == usuario_id)
+    if empresa_id is not None:
+        q = q.filter((user_role_association.c.empresa_id == None) | (user_role_association.c.empresa_id == empresa_id))
+        roles_q = roles_q.filter((user_role_association.c.empresa_id == None) | (user_role_association.c.empresa_id == empresa_id))
+
+    membership = Membership(
+        is_associated=assoc is not None,
+        is_admin=bool(assoc is not None and assoc.is_admin),
+        permissions=frozenset(name for (name,) in q.distinct().all()),
+        roles=frozenset(name.lower() for (name,) in roles_q.distinct().all() if name),
+    )
+    _put(_memberships, key, membership, generation, *scopes)
+    return membership
+
+
+def invalidate_user(usuario_id: int) -> None:
+    with _generations.lock:
+        _generations.bump(("user", usuario_id))
+        _users.pop(usuario_id, None)
+        for key in [k for k in _memberships if k[0] == usuario_id]:
+            _memberships.pop(key, None)
+
+
+def invalidate_empresa(empresa_id: int) -> None:
+    with _generations.lock:
+        _generations.bump(("empresa", empresa_id))
+        _empresas.pop(empresa_id, None)
+        _licenses.pop(empresa_id, None)
+        for key in [k for k in _memberships if k[1] == empresa_id]:
+            _memberships.pop(key, None)
+
+
+def invalidate_all() -> None:
+    with _generations.lock:
+        _generations.bump_all()
+        _users.clear()
+        _empresas.clear()
+        _licenses.clear()
+        _memberships.clear()
+
+
+def _object_scopes(obj):
+    if isinstance(obj, Usuario):
+        return [("user", obj.id)]
+    if isinstance(obj, Empresa):
+        return [("empresa", obj.id)]
+    if isinstance(obj, (UsuarioEmpresa, CompanyLicense)):
+        return [("empresa", obj.empresa_id)]
+    if isinstance(obj, (Role, Permission)):
+        # Uma role pode estar atribuída a qualquer usuário
+        return [None]
+    return None
+
+
+def _statement_scopes(orm_execute_state):
+    table = getattr(orm_execute_state.statement, "table", None)
+    if getattr(table, "name", None) in _TRACKED_TABLES:
+        return [None]
+    return None
+
+
+def _apply_changes(scopes) -> None:
+    if None in scopes:
+        invalidate_all()
+        return
+    for kind, scope_id in scopes:
+        if kind == "user":
+            invalidate_user(scope_id)
+        else:
+            invalidate_empresa(scope_id)
+
+
+track_commits(_PENDING_KEY, _object_scopes, _statement_scopes, _apply_changes)
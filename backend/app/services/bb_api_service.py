@@ -5,7 +5,11 @@ Sincronizado com Agrobraz.
 """
 
 from __future__ import annotations
+import asyncio
 import logging
+import os
+import random
+import threading
 import time
 from datetime import date, datetime
 from decimal import Decimal
@@ -33,6 +37,16 @@ _API_BASE = {
 _token_cache: Dict[int, tuple] = {}
 _last_auth_failure: Dict[int, float] = {}  # Cache de falhas para evitar loops de 429
 
+# Registro em lote (BBRegistroSession): requisições simultâneas por conta e
+# novas tentativas com backoff exponencial em 429/falha de conexão
+BB_REGISTRO_CONCURRENCY = int(os.environ.get("BB_REGISTRO_CONCURRENCY", "8"))
+BB_REGISTRO_RETRIES = int(os.environ.get("BB_REGISTRO_RETRIES", "4"))
+BB_REGISTRO_BACKOFF = float(os.environ.get("BB_REGISTRO_BACKOFF", "1.0"))
+
+# Clientes HTTP (keep-alive) por ambiente; cada thread tem os seus, pois o
+# httpx.Client síncrono não deve ser usado por várias threads ao mesmo tempo
+_http_clients = threading.local()
+
 TIPO_TITULO = {
     'DM': 2,   # Duplicata Mercantil
     'DS': 4,   # Duplicata de Serviço
@@ -78,8 +92,15 @@ def situacao_para_status(codigo: str) -> str:
 SANDBOX_PAGADOR_CPF = '12345678909'
 SANDBOX_PAGADOR_NOME = 'CLIENTE TESTE BB HOMOLOGACAO'
 
-def _make_http_client(sandbox: bool, company=None) -> httpx.Client:
-    return httpx.Client(timeout=30.0)
+def _http_client(sandbox: bool) -> httpx.Client:
+    """Cliente HTTP do ambiente na thread atual, reaproveitado entre chamadas (pool de conexões TLS)."""
+    clients = getattr(_http_clients, 'by_env', None)
+    if clients is None:
+        clients = _http_clients.by_env = {}
+    client = clients.get(sandbox)
+    if client is None or client.is_closed:
+        client = clients[sandbox] = httpx.Client(timeout=30.0)
+    return client
 
 def _fmt_date(d: Optional[date]) -> str:
     if d is None:
@@ -120,21 +141,20 @@ def get_access_token(bank_account_id: int, client_id: str, client_secret: str,
     app_key = app_key.strip()
     
     try:
-        with _make_http_client(sandbox, company) as client:
-            headers = {
-                'Content-Type': 'application/x-www-form-urlencoded',
-                'gw-dev-app-key': app_key,
-                'X-Developer-Application-Key': app_key
-            }
-            resp = client.post(
-                url,
-                data={
-                    'grant_type': 'client_credentials',
-                    'scope': 'cobrancas.boletos-info cobrancas.boletos-requisicao'
-                },
-                auth=(client_id, client_secret),
-                headers=headers,
-            )
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'gw-dev-app-key': app_key,
+            'X-Developer-Application-Key': app_key
+        }
+        resp = _http_client(sandbox).post(
+            url,
+            data={
+                'grant_type': 'client_credentials',
+                'scope': 'cobrancas.boletos-info cobrancas.boletos-requisicao'
+            },
+            auth=(client_id, client_secret),
+            headers=headers,
+        )
         
         if resp.status_code == 429:
             _last_auth_failure[bank_account_id] = now
@@ -162,14 +182,8 @@ def get_access_token(bank_account_id: int, client_id: str, client_secret: str,
     _last_auth_failure.pop(bank_account_id, None)
     return token
 
-def registrar_boleto(
-    db: Session,
-    bank_account: BankAccount,
-    receivable: Receivable,
-    usar_pix: bool = True
-) -> Dict[str, Any]:
-    ba = bank_account
-    sandbox = bool(ba.bb_sandbox)
+def _credentials(ba: BankAccount) -> tuple:
+    """(sandbox, client_id, client_secret decifrado, app_key) da conta."""
     client_id = ba.bb_client_id
     client_secret = ba.bb_client_secret
     app_key = (ba.bb_app_key or '').strip()
@@ -182,8 +196,54 @@ def registrar_boleto(
         client_secret_dec = decrypt_sensitive_data(client_secret)
     except:
         client_secret_dec = client_secret
+    return bool(ba.bb_sandbox), client_id, client_secret_dec, app_key
 
-    token = get_access_token(ba.id, client_id, client_secret_dec, app_key, sandbox)
+
+def _registro_result(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'numero': str(data.get('numero', '')),
+        'codigoLinhaDigitavel': data.get('codigoLinhaDigitavel', ''),
+        'textoUrl': data.get('textoUrl', ''),
+        'qrCode': data.get('qrCode') or {},
+    }
+
+
+def registrar_boleto(
+    db: Session,
+    bank_account: BankAccount,
+    receivable: Receivable,
+    usar_pix: bool = True
+) -> Dict[str, Any]:
+    sandbox, client_id, client_secret_dec, app_key = _credentials(bank_account)
+    token = get_access_token(bank_account.id, client_id, client_secret_dec, app_key, sandbox)
+    payload = montar_payload_boleto(db, bank_account, receivable, usar_pix)
+
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json',
+        'x-developer-application-key': app_key,
+    }
+
+    base_url = _API_BASE[sandbox]
+    url = f'{base_url}/cobrancas/v2/boletos'
+
+    resp = _http_client(sandbox).post(url, json=payload, headers=headers)
+    if resp.status_code == 201:
+        return _registro_result(resp.json())
+    else:
+        logger.error(f'BB Registro erro {resp.status_code}: {resp.text}')
+        raise ValueError(f'Erro no registro BB: {resp.text}')
+
+
+def montar_payload_boleto(
+    db: Session,
+    bank_account: BankAccount,
+    receivable: Receivable,
+    usar_pix: bool = True
+) -> Dict[str, Any]:
+    """Monta o corpo do POST /cobrancas/v2/boletos (consulta cliente e endereço no banco)."""
+    ba = bank_account
+    sandbox = bool(ba.bb_sandbox)
 
     # Dados do cliente
     cliente = db.query(Cliente).filter(Cliente.id == receivable.cliente_id).first()
@@ -221,8 +281,8 @@ def registrar_boleto(
         dv_conta_cedente  = SANDBOX_CEDENTE['digitoVerificadorConta']
         client_doc_use    = SANDBOX_PAGADOR_CPF
         client_name_use   = SANDBOX_PAGADOR_NOME
-        # Sandbox exige numeroTituloCliente único
-        seq_ts = str(int(time.time()))[-10:].zfill(10)
+        # Sandbox exige numeroTituloCliente único (o id evita repetição no registro em lote)
+        seq_ts = (str(int(time.time()))[-5:] + str(receivable.id)[-5:].zfill(5)).zfill(10)
         conv7  = str(SANDBOX_CEDENTE['numeroConvenio']).zfill(7)
         numero_titulo_cliente = '000' + conv7 + seq_ts
         
@@ -324,28 +384,100 @@ def registrar_boleto(
             'valor': float(desconto_valor) if desconto_tipo_bb == 1 else 0.0,
         }
 
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json',
-        'x-developer-application-key': app_key,
-    }
+    return payload
 
-    base_url = _API_BASE[sandbox]
-    url = f'{base_url}/cobrancas/v2/boletos'
 
-    with _make_http_client(sandbox) as client:
-        resp = client.post(url, json=payload, headers=headers)
-        if resp.status_code == 201:
-            data = resp.json()
-            return {
-                'numero': str(data.get('numero', '')),
-                'codigoLinhaDigitavel': data.get('codigoLinhaDigitavel', ''),
-                'textoUrl': data.get('textoUrl', ''),
-                'qrCode': data.get('qrCode') or {},
-            }
-        else:
-            logger.error(f'BB Registro erro {resp.status_code}: {resp.text}')
-            raise ValueError(f'Erro no registro BB: {resp.text}')
+class BBRegistroSession:
+    """
+    Registro de boletos em lote para uma conta BB.
+
+    Usa um único httpx.AsyncClient (conexões TLS reaproveitadas) e o token
+    OAuth da conta (cache de get_access_token, renovado uma vez em 401).
+    No máximo `concurrency` registros ficam em andamento ao mesmo tempo;
+    respostas 429 e falhas de conexão são repetidas com backoff exponencial
+    (respeitando Retry-After) até BB_REGISTRO_RETRIES vezes. O POST de
+    registro não é idempotente: um 5xx ou timeout de leitura pode ter
+    registrado o boleto, então vira erro em vez de ser reenviado.
+    """
+
+    def __init__(self, bank_account: BankAccount, concurrency: Optional[int] = None):
+        self.sandbox, self.client_id, self.client_secret, self.app_key = _credentials(bank_account)
+        self.bank_account_id = bank_account.id
+        self.url = f'{_API_BASE[self.sandbox]}/cobrancas/v2/boletos'
+        self.concurrency = max(1, concurrency or BB_REGISTRO_CONCURRENCY)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._client = httpx.AsyncClient(
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+        )
+        self._token: Optional[str] = None
+        self._token_lock = asyncio.Lock()
+
+    async def __aenter__(self) -> "BBRegistroSession":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self._client.aclose()
+
+    async def _get_token(self, stale: Optional[str] = None) -> str:
+        async with self._token_lock:
+            if stale is not None and self._token == stale:
+                # 401: descarta o token em cache e pede outro (uma vez por token)
+                _token_cache.pop(self.bank_account_id, None)
+                self._token = None
+            if self._token is None:
+                self._token = await asyncio.to_thread(
+                    get_access_token, self.bank_account_id, self.client_id,
+                    self.client_secret, self.app_key, self.sandbox
+                )
+            return self._token
+
+    @staticmethod
+    def _backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+        try:
+            if retry_after:
+                return min(60.0, float(retry_after))
+        except ValueError:
+            pass
+        return min(30.0, BB_REGISTRO_BACKOFF * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+    async def registrar(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Registra um boleto (payload de montar_payload_boleto); levanta ValueError em caso de erro."""
+        async with self._semaphore:
+            token = await self._get_token()
+            renovado = False
+            attempt = 0
+            while True:
+                headers = {
+                    'Authorization': f'Bearer {token}',
+                    'Content-Type': 'application/json',
+                    'x-developer-application-key': self.app_key,
+                }
+                try:
+                    resp = await self._client.post(self.url, json=payload, headers=headers)
+                except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as exc:
+                    # A requisição não chegou ao BB: pode repetir sem risco de registro duplicado
+                    if attempt >= BB_REGISTRO_RETRIES:
+                        raise ValueError(f'Falha na conexão com BB: {exc}')
+                    await asyncio.sleep(self._backoff(attempt))
+                    attempt += 1
+                    continue
+                except httpx.HTTPError as exc:
+                    raise ValueError(f'Falha na conexão com BB: {exc}')
+
+                if resp.status_code == 201:
+                    return _registro_result(resp.json())
+                if resp.status_code == 401 and not renovado:
+                    token = await self._get_token(stale=token)
+                    renovado = True
+                    continue
+                if resp.status_code == 429 and attempt < BB_REGISTRO_RETRIES:
+                    logger.warning(f'BB Registro {resp.status_code}, nova tentativa ({attempt + 1}/{BB_REGISTRO_RETRIES})')
+                    await asyncio.sleep(self._backoff(attempt, resp.headers.get('Retry-After')))
+                    attempt += 1
+                    continue
+                logger.error(f'BB Registro erro {resp.status_code}: {resp.text}')
+                raise ValueError(f'Erro no registro BB: {resp.text}')
 
 def solicitar_baixa(bank_account: BankAccount, bb_numero: str) -> bool:
     ba = bank_account
@@ -370,19 +502,18 @@ def solicitar_baixa(bank_account: BankAccount, bb_numero: str) -> bool:
         'x-developer-application-key': app_key,
     }
 
-    with _make_http_client(sandbox) as client:
-        resp = client.post(url, json={'numeroConvenio': int(ba.convenio or 0)}, headers=headers)
-        if resp.status_code not in [200, 204]:
-            logger.error(f'BB Baixa erro {resp.status_code}: {resp.text}')
+    resp = _http_client(sandbox).post(url, json={'numeroConvenio': int(ba.convenio or 0)}, headers=headers)
+    if resp.status_code not in [200, 204]:
+        logger.error(f'BB Baixa erro {resp.status_code}: {resp.text}')
+        
+        # Se o erro indicar que já está baixado/cancelado ou não encontrado, ignora para permitir a exclusão local
+        error_text = resp.text.lower()
+        if "já se encontra" in error_text or "baixado" in error_text or "cancelado" in error_text or "não encontrado" in error_text:
+            logger.info(f'BB Baixa aviso: Boleto {bb_numero} já baixado ou não encontrado no BB. {resp.text}')
+            return True
             
-            # Se o erro indicar que já está baixado/cancelado ou não encontrado, ignora para permitir a exclusão local
-            error_text = resp.text.lower()
-            if "já se encontra" in error_text or "baixado" in error_text or "cancelado" in error_text or "não encontrado" in error_text:
-                logger.info(f'BB Baixa aviso: Boleto {bb_numero} já baixado ou não encontrado no BB. {resp.text}')
-                return True
-                
-            raise ValueError(f'Erro da API ({resp.status_code}): {resp.text}')
-        return True
+        raise ValueError(f'Erro da API ({resp.status_code}): {resp.text}')
+    return True
 
 
 def consultar_boleto(bank_account: BankAccount, bb_numero: str) -> Dict[str, Any]:
@@ -418,12 +549,11 @@ def consultar_boleto(bank_account: BankAccount, bb_numero: str) -> Dict[str, Any
         'x-developer-application-key': app_key,
     }
 
-    with _make_http_client(sandbox) as client:
-        resp = client.get(url, headers=headers)
-        if resp.status_code == 200:
-            return resp.json()
-        else:
-            logger.warning(f'BB consultar_boleto: {bb_numero} -> {resp.status_code}: {resp.text[:300]}')
-            return None
+    resp = _http_client(sandbox).get(url, headers=headers)
+    if resp.status_code == 200:
+        return resp.json()
+    else:
+        logger.warning(f'BB consultar_boleto: {bb_numero} -> {resp.status_code}: {resp.text[:300]}')
+        return None
 
 
@@ -1,8 +1,10 @@
+import asyncio
 import logging
 import json
 import os
+from collections import defaultdict
 from datetime import datetime
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 from sqlalchemy.orm import Session
 from app.models.models import Receivable, BankAccount
 from app.services.sicoob_gateway import sicoob_gateway
@@ -11,6 +13,11 @@ from app.core.security import decrypt_sensitive_data
 
 logger = logging.getLogger(__name__)
 
+# Registro em lote no BB: cobranças persistidas (commit) a cada BB_REGISTRO_BATCH
+BB_REGISTRO_BATCH = int(os.environ.get("BB_REGISTRO_BATCH", "100"))
+
+_BB_BANKS = ("BANCO_DO_BRASIL", "BANCO DO BRASIL")
+
 class BillingService:
     """Serviço de cobrança integrado com gateways bancários."""
 
@@ -43,7 +50,7 @@ class BillingService:
                 return await BillingService._register_sicoob(db, receivable, bank_account)
             elif bank_account.bank == "SICREDI":
                 return await BillingService._register_sicredi(db, receivable, bank_account)
-            elif bank_account.bank in ["BANCO_DO_BRASIL", "BANCO DO BRASIL"]:
+            elif bank_account.bank in _BB_BANKS:
                 success, _ = await BillingService._register_bb(db, receivable, bank_account)
                 return success
             else:
@@ -410,28 +417,119 @@ class BillingService:
             resp = registrar_boleto(db=db, bank_account=bank_account, receivable=receivable, usar_pix=True)
             
             if resp:
-                receivable.bb_boleto_numero = resp.get("numero")
-                receivable.bb_boleto_url = resp.get("textoUrl")
-                qr = resp.get("qrCode") or {}
-                receivable.bb_pix_qrcode = qr.get("emv") or qr.get("url")
-                receivable.bb_pix_txid = qr.get("txId")
-                
-                receivable.nosso_numero = resp.get("numero")
-                receivable.linha_digitavel = resp.get("codigoLinhaDigitavel")
-                receivable.status = "REGISTERED"
-                receivable.registered_at = datetime.now()
-                receivable.bank_payload = json.dumps(resp, default=str)
-                
+                BillingService._apply_bb_registration(receivable, resp)
                 db.flush()
-                logger.info(f"Boleto BB {receivable.id} registrado com sucesso: {receivable.bb_boleto_numero}")
                 return True, "Sucesso"
                 
         except Exception as e:
             error_msg = str(e)
-            logger.error(f"Erro ao registrar boleto via BB: {error_msg}")
-            receivable.status = "REGISTRATION_FAILED"
-            receivable.registro_result = error_msg[:500]
+            BillingService._apply_bb_failure(receivable, error_msg)
             db.flush()
             return False, error_msg
         
         return False, "Resposta vazia da API"
+
+    @staticmethod
+    def _apply_bb_registration(receivable: Receivable, resp: Dict[str, Any]) -> None:
+        receivable.bb_boleto_numero = resp.get("numero")
+        receivable.bb_boleto_url = resp.get("textoUrl")
+        qr = resp.get("qrCode") or {}
+        receivable.bb_pix_qrcode = qr.get("emv") or qr.get("url")
+        receivable.bb_pix_txid = qr.get("txId")
+        
+        receivable.nosso_numero = resp.get("numero")
+        receivable.linha_digitavel = resp.get("codigoLinhaDigitavel")
+        receivable.status = "REGISTERED"
+        receivable.registered_at = datetime.now()
+        receivable.bank_payload = json.dumps(resp, default=str)
+        logger.info(f"Boleto BB {receivable.id} registrado com sucesso: {receivable.bb_boleto_numero}")
+
+    @staticmethod
+    def _apply_bb_failure(receivable: Receivable, error_msg: str) -> None:
+        logger.error(f"Erro ao registrar boleto {receivable.id} via BB: {error_msg}")
+        receivable.status = "REGISTRATION_FAILED"
+        receivable.registro_result = error_msg[:500]
+
+    @staticmethod
+    async def register_bb_bulk(
+        db: Session,
+        receivables: List[Receivable],
+        bank_account: BankAccount,
+        concurrency: Optional[int] = None
+    ) -> Dict[int, Tuple[bool, str]]:
+        """
+        Registra vários boletos na API do Banco do Brasil em paralelo.
+
+        Os payloads são montados nesta corrotina (a Session não é compartilhada),
+        os POSTs correm em uma BBRegistroSession (cliente HTTP e token únicos,
+        `concurrency` requisições simultâneas) e os resultados são gravados com
+        um commit a cada BB_REGISTRO_BATCH cobranças.
+
+        Returns:
+            {receivable_id: (sucesso, mensagem)}
+        """
+        from app.services.bb_api_service import BBRegistroSession, montar_payload_boleto
+
+        results: Dict[int, Tuple[bool, str]] = {}
+        try:
+            session = BBRegistroSession(bank_account, concurrency)
+        except Exception as e:
+            for r in receivables:
+                BillingService._apply_bb_failure(r, str(e))
+                results[r.id] = (False, str(e))
+            db.commit()
+            return results
+
+        async with session:
+            batch_size = max(1, BB_REGISTRO_BATCH)
+            for start in range(0, len(receivables), batch_size):
+                chunk = receivables[start:start + batch_size]
+                to_send = []
+                for r in chunk:
+                    try:
+                        to_send.append((r, montar_payload_boleto(db, bank_account, r, usar_pix=True)))
+                    except Exception as e:
+                        BillingService._apply_bb_failure(r, str(e))
+                        results[r.id] = (False, str(e))
+
+                outcomes = await asyncio.gather(
+                    *(session.registrar(payload) for _r, payload in to_send), return_exceptions=True
+                )
+                for (r, _payload), outcome in zip(to_send, outcomes):
+                    if isinstance(outcome, BaseException):
+                        BillingService._apply_bb_failure(r, str(outcome))
+                        results[r.id] = (False, str(outcome))
+                    else:
+                        BillingService._apply_bb_registration(r, outcome)
+                        results[r.id] = (True, "Sucesso")
+                db.commit()
+        return results
+
+    @staticmethod
+    async def register_receivables_bulk(db: Session, receivables: List[Receivable]) -> Dict[int, bool]:
+        """
+        Registra várias cobranças: as de contas BB em lote (register_bb_bulk, por
+        conta), as demais uma a uma via register_receivable_with_bank.
+
+        Returns:
+            {receivable_id: sucesso}
+        """
+        account_ids = {r.bank_account_id for r in receivables if r.bank_account_id}
+        accounts = {
+            ba.id: ba for ba in db.query(BankAccount).filter(BankAccount.id.in_(account_ids)).all()
+        } if account_ids else {}
+
+        results: Dict[int, bool] = {}
+        bb_groups: Dict[int, List[Receivable]] = defaultdict(list)
+        for r in receivables:
+            ba = accounts.get(r.bank_account_id)
+            if ba is not None and ba.bank in _BB_BANKS:
+                bb_groups[ba.id].append(r)
+            else:
+                results[r.id] = await BillingService.register_receivable_with_bank(db, r)
+
+        for bank_account_id, group in bb_groups.items():
+            bb_results = await BillingService.register_bb_bulk(db, group, accounts[bank_account_id])
+            for receivable_id, (success, _msg) in bb_results.items():
+                results[receivable_id] = success
+        return results
@@ -0,0 +1,311 @@
+"""
+Processamento de arquivos de retorno CNAB 240 / CNAB 400
+
+O arquivo é lido linha a linha (o UploadFile já fica em disco acima de 1 MB),
+então a memória usada não depende do tamanho do retorno:
+
+- CNAB 240 (FEBRABAN): cada título vem em um par de segmentos T (nosso
+  número, código de movimento, valor do título) e U (valor pago, datas de
+  ocorrência e crédito);
+- CNAB 400 (layout Sicredi): um registro de detalhe (tipo 1) por título.
+
+As ocorrências são agrupadas em lotes de CNAB_RETORNO_BATCH: uma consulta IN
+por nosso_numero localiza as cobranças da conta e o lote é confirmado em uma
+transação. Liquidações marcam a cobrança como PAID, baixas como CANCELLED e
+entradas rejeitadas como REGISTRATION_FAILED; reprocessar o mesmo arquivo não
+altera cobranças que já estão no status final.
+
+Ao final, os clientes com cobranças liquidadas que ficaram sem títulos
+vencidos além da tolerância da empresa (mesma regra do bloqueio automático)
+têm os contratos suspensos enfileirados no unblock_dispatcher, que aplica
+o desbloqueio em lote (agrupado por roteador) sem segurar o upload.
+"""
+import logging
+import os
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Set
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from app.models.models import Empresa, Receivable, ServicoContratado, StatusContrato
+
+logger = logging.getLogger(__name__)
+
+CNAB_RETORNO_BATCH = int(os.environ.get("CNAB_RETORNO_BATCH", "500"))
+
+# Ações internas derivadas do código de movimento/ocorrência do banco
+PAGO = "PAID"
+BAIXADO = "CANCELLED"
+REJEITADO = "REJECTED"
+CONFIRMADO = "REGISTERED"
+
+# CNAB 240 FEBRABAN: código de movimento retorno (segmento T, posições 16-17)
+_MOVIMENTOS_240 = {
+    "02": CONFIRMADO,  # Entrada confirmada
+    "03": REJEITADO,   # Entrada rejeitada
+    "06": PAGO,        # Liquidação
+    "09": BAIXADO,     # Baixa
+    "17": PAGO,        # Liquidação após baixa ou título não registrado
+}
+
+# CNAB 400 Sicredi: código de ocorrência (posições 109-110)
+_OCORRENCIAS_400 = {
+    "02": CONFIRMADO,  # Entrada confirmada
+    "03": REJEITADO,   # Entrada rejeitada
+    "06": PAGO,        # Liquidação normal
+    "09": BAIXADO,     # Baixado automaticamente via arquivo
+    "10": BAIXADO,     # Baixado conforme instruções
+    "15": PAGO,        # Liquidação em cartório
+    "16": PAGO,        # Liquidação após baixa
+    "17": PAGO,        # Liquidação após baixa ou título não registrado
+}
+
+# Títulos em aberto (mesma lista do bloqueio automático)
+_OPEN_STATUSES = ('PENDING', 'REGISTERED', 'PENDING_REMITTANCE', 'REMITTED')
+
+
+def _digits(value: str) -> str:
+    return ''.join(filter(str.isdigit, value))
+
+
+def _valor(campo: str) -> Optional[float]:
+    campo = campo.strip()
+    if not campo.isdigit():
+        campo = _digits(campo)
+    return int(campo) / 100 if campo and int(campo) else None
+
+
+def _data(campo: str, ano_curto: bool = False) -> Optional[date]:
+    """DDMMAAAA (CNAB 240) ou DDMMAA (CNAB 400); zeros, brancos ou data inválida -> None."""
+    campo = campo.strip()
+    if len(campo) != (6 if ano_curto else 8) or not campo.isdigit() or not int(campo):
+        return None
+    ano = int(campo[4:])
+    try:
+        return date(2000 + ano if ano_curto else ano, int(campo[2:4]), int(campo[:2]))
+    except ValueError:
+        return None
+
+
+def _nosso_numero_key(value: Optional[str]) -> str:
+    """Forma usada na comparação: só dígitos, sem zeros à esquerda."""
+    return _digits(value or '').lstrip('0')
+
+
+def _iter_lines(stream: IO) -> Iterator[str]:
+    for raw in stream:
+        line = raw.decode('latin-1') if isinstance(raw, bytes) else raw
+        line = line.rstrip('\r\n')
+        if line.strip():
+            yield line
+
+
+def _ocorrencia(codigo: str, acao: Optional[str], nosso_numero: str, **extra) -> Dict[str, Any]:
+    return {"codigo": codigo, "acao": acao, "nosso_numero": nosso_numero.strip(), **extra}
+
+
+def _parse_240(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    atual = None
+    for line in lines:
+        if len(line) < 240 or line[7] != '3':
+            continue  # headers, trailers e linhas truncadas
+        segmento = line[13]
+        if segmento == 'T':
+            if atual is not None:
+                yield atual
+            codigo = line[15:17]
+            atual = _ocorrencia(
+                codigo, _MOVIMENTOS_240.get(codigo), line[37:57],
+                valor_titulo=_valor(line[81:96]),
+                motivo=line[213:223].strip() or None,
+            )
+        elif segmento == 'U' and atual is not None:
+            atual["valor_pago"] = _valor(line[77:92])
+            atual["data_ocorrencia"] = _data(line[137:145])
+            atual["data_credito"] = _data(line[145:153])
+            yield atual
+            atual = None
+    if atual is not None:
+        yield atual
+
+
+def _parse_400(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    for line in lines:
+        if len(line) < 400 or line[0] != '1':
+            continue
+        codigo = line[108:110]
+        yield _ocorrencia(
+            codigo, _OCORRENCIAS_400.get(codigo), line[47:62],
+            valor_titulo=_valor(line[152:165]),
+            valor_pago=_valor(line[253:266]),
+            data_ocorrencia=_data(line[110:116], ano_curto=True),
+            motivo=line[318:328].strip() or None,
+        )
+
+
+def parse_retorno(stream: IO) -> Iterator[Dict[str, Any]]:
+    """Gera as ocorrências de título do arquivo; o layout é detectado pelo tamanho do header."""
+    lines = _iter_lines(stream)
+    header = next(lines, None)
+    if header is None:
+        raise ValueError("Arquivo de retorno vazio")
+    if len(header) == 240:
+        return _parse_240(lines)
+    if len(header) == 400:
+        return _parse_400(lines)
+    raise ValueError(f"Arquivo de retorno inválido: linhas de {len(header)} posições (esperado CNAB 240 ou 400)")
+
+
+def _batches(items: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _changes(status: str, amount: Optional[float], oc: Dict[str, Any], agora: datetime) -> Optional[Dict[str, Any]]:
+    """Colunas alteradas pela ocorrência em uma cobrança com o status dado (None = nada a fazer)."""
+    acao = oc["acao"]
+    if acao == PAGO:
+        if status == 'PAID':
+            return None
+        quando = oc.get("data_ocorrencia") or oc.get("data_credito")
+        return {
+            "status": 'PAID',
+            "paid_at": datetime(quando.year, quando.month, quando.day) if quando else agora,
+            "paid_amount": oc.get("valor_pago") or oc.get("valor_titulo") or amount,
+        }
+    if status in ('PAID', 'CANCELLED'):
+        return None
+    if acao == BAIXADO:
+        return {
+            "status": 'CANCELLED',
+            "registro_result": f"Baixa informada no arquivo de retorno (ocorrência {oc['codigo']})",
+        }
+    if acao == REJEITADO:
+        motivo = f", motivo {oc['motivo']}" if oc.get("motivo") else ""
+        return {
+            "status": 'REGISTRATION_FAILED',
+            "registro_result": f"Entrada rejeitada no arquivo de retorno (ocorrência {oc['codigo']}{motivo})",
+        }
+    if acao == CONFIRMADO and status in ('PENDING_REMITTANCE', 'REMITTED'):
+        return {
+            "status": 'REGISTERED',
+            "registered_at": agora,
+            "registro_result": "Entrada confirmada no arquivo de retorno",
+        }
+    return None
+
+
+def _settle_batch(db: Session, empresa_id: int, bank_account_id: int, batch: List[Dict[str, Any]],
+                  agora: datetime, counts: Counter, paid_clients: Set[int], not_found: List[str]) -> None:
+    keys = {_nosso_numero_key(oc["nosso_numero"]) for oc in batch} - {''}
+    # nosso_numero é gravado com zeros à esquerda (zfill(10)) ou sem eles
+    candidates = keys | {k.zfill(10) for k in keys}
+    by_key: Dict[str, List[Dict[str, Any]]] = {}
+    if candidates:
+        for row in db.query(
+            Receivable.id, Receivable.nosso_numero, Receivable.status, Receivable.cliente_id, Receivable.amount
+        ).filter(
+            Receivable.empresa_id == empresa_id,
+            Receivable.bank_account_id == bank_account_id,
+            Receivable.nosso_numero.in_(candidates),
+        ).all():
+            by_key.setdefault(_nosso_numero_key(row.nosso_numero), []).append(row._asdict())
+
+    updates: Dict[int, Dict[str, Any]] = {}
+    for oc in batch:
+        if oc["acao"] is None:
+            counts["ignored"] += 1
+            continue
+        recvs = by_key.get(_nosso_numero_key(oc["nosso_numero"]))
+        if not recvs:
+            counts["not_found"] += 1
+            if len(not_found) < 50:
+                not_found.append(oc["nosso_numero"])
+            continue
+        for recv in recvs:
+            changes = _changes(recv["status"], recv["amount"], oc, agora)
+            if changes is None:
+                counts["unchanged"] += 1
+                continue
+            # a mesma cobrança pode aparecer mais de uma vez no arquivo (ex.: 02 e depois 06)
+            recv["status"] = changes["status"]
+            updates.setdefault(recv["id"], {"id": recv["id"]}).update(changes)
+            counts[oc["acao"]] += 1
+            if oc["acao"] == PAGO:
+                paid_clients.add(recv["cliente_id"])
+
+    if updates:
+        # UPDATE em lote pela chave primária; ordenado pelas colunas alteradas para
+        # que cada conjunto de colunas vire um único executemany
+        db.execute(update(Receivable), sorted(updates.values(), key=lambda u: sorted(u)))
+    db.commit()
+
+
+def _unblock_current_clients(db: Session, empresa_id: int, cliente_ids: Set[int], agora: datetime) -> Dict[str, int]:
+    """Agenda a reativação dos contratos suspensos dos clientes que ficaram sem débitos vencidos."""
+    if not cliente_ids:
+        return {"unblock_queued": 0}
+    from app.services import unblock_dispatcher
+
+    empresa = db.query(Empresa).filter(Empresa.id == empresa_id).first()
+    limit_date = agora - timedelta(days=(empresa.dias_bloqueio_inadimplentes or 0) if empresa else 0)
+
+    devedores = {
+        cliente_id for (cliente_id,) in db.query(Receivable.cliente_id).filter(
+            Receivable.empresa_id == empresa_id,
+            Receivable.cliente_id.in_(cliente_ids),
+            Receivable.status.in_(_OPEN_STATUSES),
+            Receivable.due_date <= limit_date,
+        ).group_by(Receivable.cliente_id).all()
+    }
+    contratos = [
+        contrato_id for (contrato_id,) in db.query(ServicoContratado.id).filter(
+            ServicoContratado.empresa_id == empresa_id,
+            ServicoContratado.cliente_id.in_(cliente_ids - devedores),
+            ServicoContratado.status == StatusContrato.SUSPENSO,
+        ).order_by(ServicoContratado.id).all()
+    ]
+    if not contratos:
+        return {"unblock_queued": 0}
+    return {"unblock_queued": unblock_dispatcher.enqueue(contratos)}
+
+
+def process_retorno(db: Session, empresa_id: int, bank_account_id: int, stream: IO) -> Dict[str, Any]:
+    """Baixa as cobranças da conta a partir de um arquivo de retorno CNAB 240/400."""
+    tz_br = timezone(timedelta(hours=-3))
+    agora = datetime.now(tz_br).replace(tzinfo=None)
+
+    counts: Counter = Counter()
+    paid_clients: Set[int] = set()
+    not_found: List[str] = []
+    total = 0
+    for batch in _batches(parse_retorno(stream), max(1, CNAB_RETORNO_BATCH)):
+        total += len(batch)
+        _settle_batch(db, empresa_id, bank_account_id, batch, agora, counts, paid_clients, not_found)
+
+    unblock = _unblock_current_clients(db, empresa_id, paid_clients, agora)
+    logger.info(
+        f"Retorno CNAB (empresa {empresa_id}, conta {bank_account_id}): {total} ocorrência(s), "
+        f"{counts[PAGO]} liquidada(s), {counts[BAIXADO]} baixada(s), {counts[REJEITADO]} rejeitada(s), "
+        f"{counts['not_found']} não encontrada(s), {unblock['unblock_queued']} desbloqueio(s) agendado(s)"
+    )
+    return {
+        "processed_count": total,
+        "paid": counts[PAGO],
+        "cancelled": counts[BAIXADO],
+        "rejected": counts[REJEITADO],
+        "registered": counts[CONFIRMADO],
+        "unchanged": counts["unchanged"],
+        "ignored": counts["ignored"],
+        "not_found": counts["not_found"],
+        "not_found_sample": not_found,
+        **unblock,
+    }
@@ -0,0 +1,178 @@
+"""
+Índice espacial em memória das CTOs (grade lat/lng)
+
+Usado por FTTHMonitorService.list_ctos para ordenar CTOs por proximidade
+sem carregar e ordenar todas as CTOs da empresa a cada requisição.
+
+As CTOs são distribuídas em células de CELL_DEG graus. Uma busca dos k
+mais próximos percorre anéis de células ao redor do ponto até que
+nenhuma célula não visitada possa conter uma CTO mais próxima que a
+k-ésima já encontrada; a busca por raio visita apenas as células do
+retângulo que envolve o círculo.
+
+O índice de cada empresa fica em cache no processo e é descartado em
+create/update/delete de CTO (invalidate) ou após CTO_INDEX_TTL segundos,
+para refletir alterações feitas por outros workers.
+"""
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.models.ftth import CTO
+
+CTO_INDEX_TTL = int(os.environ.get("CTO_INDEX_TTL", "300"))
+CELL_DEG = 0.01  # ~1,1 km de latitude
+
+EARTH_RADIUS_M = 6371000.0
+
+# empresa_id -> (índice, expira_em)
+_index_cache: Dict[int, Tuple["CTOSpatialIndex", float]] = {}
+_index_lock = threading.Lock()
+
+
+def _distance_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Mesma aproximação equiretangular de FTTHMonitorService._calc_distance_m."""
+    lat_mean = math.radians((lat1 + lat2) / 2.0)
+    x = math.radians(lng1 - lng2) * math.cos(lat_mean)
+    y = math.radians(lat1 - lat2)
+    return math.sqrt(x * x + y * y) * EARTH_RADIUS_M
+
+
+class CTOSpatialIndex:
+    """Grade de CTOs georreferenciadas de uma empresa."""
+
+    def __init__(self, pontos: Iterable[Tuple[int, float, float, Optional[int]]]):
+        # (cx, cy) -> [(cto_id, lat, lng, olt_id)]
+        self.cells: Dict[Tuple[int, int], List[Tuple[int, float, float, Optional[int]]]] = {}
+        self.size = 0
+        for cto_id, lat, lng, olt_id in pontos:
+            self.cells.setdefault(self._cell(lat, lng), []).append((cto_id, lat, lng, olt_id))
+            self.size += 1
+        if self.cells:
+            xs = [c[0] for c in self.cells]
+            ys = [c[1] for c in self.cells]
+            self.bbox = (min(xs), min(ys), max(xs), max(ys))
+
+    @staticmethod
+    def _cell(lat: float, lng: float) -> Tuple[int, int]:
+        return int(math.floor(lat / CELL_DEG)), int(math.floor(lng / CELL_DEG))
+
+    def nearest(
+        self,
+        lat: float,
+        lng: float,
+        k: int,
+        accept: Optional[Callable[[int, Optional[int]], bool]] = None,
+    ) -> List[Tuple[int, float]]:
+        """Retorna até k pares (cto_id, distancia_m) em ordem crescente de distância."""
+        if k <= 0 or not self.size:
+            return []
+        cx, cy = self._cell(lat, lng)
+        encontrados: List[Tuple[float, int]] = []
+        # Anéis que não alcançam a área ocupada estão vazios: começa no primeiro que alcança
+        x0, y0, x1, y1 = self.bbox
+        r = max(x0 - cx, cx - x1, y0 - cy, cy - y1, 0)
+        while True:
+            # Anel grande demais: mais barato varrer as células ocupadas restantes
+            if 8 * r > len(self.cells):
+                encontrados += self._scan(lat, lng, accept, lambda c: max(abs(c[0] - cx), abs(c[1] - cy)) >= r)
+                encontrados.sort()
+                break
+            for cell in self._ring(cx, cy, r):
+                for cto_id, plat, plng, olt_id in self.cells.get(cell, ()):
+                    if accept is None or accept(cto_id, olt_id):
+                        encontrados.append((_distance_m(lat, lng, plat, plng), cto_id))
+            if len(encontrados) >= k:
+                encontrados.sort()
+                # Qualquer CTO fora dos anéis 0..r está a pelo menos r células de distância
+                lat_lim = min(89.9, abs(lat) + (r + 1) * CELL_DEG)
+                limite = math.radians(r * CELL_DEG) * math.cos(math.radians(lat_lim)) * EARTH_RADIUS_M
+                if encontrados[k - 1][0] <= limite:
+                    break
+            r += 1
+        return [(i, d) for d, i in encontrados[:k]]
+
+    def within(
+        self,
+        lat: float,
+        lng: float,
+        raio_m: float,
+        accept: Optional[Callable[[int, Optional[int]], bool]] = None,
+    ) -> List[Tuple[int, float]]:
+        """Retorna os pares (cto_id, distancia_m) dentro do raio, ordenados por distância."""
+        dlat = math.degrees(raio_m / EARTH_RADIUS_M)
+        lat_lim = min(89.9, abs(lat) + dlat)
+        dlng = dlat / math.cos(math.radians(lat_lim))
+        cx0, cy0 = self._cell(lat - dlat, lng - dlng)
+        cx1, cy1 = self._cell(lat + dlat, lng + dlng)
+
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            candidatos = self._scan(lat, lng, accept)
+        else:
+            candidatos = []
+            for x in range(cx0, cx1 + 1):
+                for y in range(cy0, cy1 + 1):
+                    for cto_id, plat, plng, olt_id in self.cells.get((x, y), ()):
+                        if accept is None or accept(cto_id, olt_id):
+                            candidatos.append((_distance_m(lat, lng, plat, plng), cto_id))
+        return [(i, d) for d, i in sorted(c for c in candidatos if c[0] <= raio_m)]
+
+    def _scan(self, lat, lng, accept, cell_filter=None) -> List[Tuple[float, int]]:
+        return [
+            (_distance_m(lat, lng, plat, plng), cto_id)
+            for cell, pontos in self.cells.items()
+            if cell_filter is None or cell_filter(cell)
+            for cto_id, plat, plng, olt_id in pontos
+            if accept is None or accept(cto_id, olt_id)
+        ]
+
+    @staticmethod
+    def _ring(cx: int, cy: int, r: int) -> Iterable[Tuple[int, int]]:
+        if r == 0:
+            yield cx, cy
+            return
+        for x in range(cx - r, cx + r + 1):
+            yield x, cy - r
+            yield x, cy + r
+        for y in range(cy - r + 1, cy + r):
+            yield cx - r, y
+            yield cx + r, y
+
+
+def get_index(db: Session, empresa_id: int) -> CTOSpatialIndex:
+    """Retorna o índice da empresa, construindo-o a partir do banco se necessário."""
+    agora = time.monotonic()
+    cached = _index_cache.get(empresa_id)
+    if cached and cached[1] > agora:
+        return cached[0]
+
+    from app.services.ftth_monitor_service import FTTHMonitorService
+
+    rows = db.query(
+        CTO.id, CTO.latitude, CTO.longitude, CTO.coordenadas_gps, CTO.olt_id
+    ).filter(CTO.empresa_id == empresa_id).all()
+
+    pontos = []
+    for cto_id, lat, lng, gps, olt_id in rows:
+        if lat is None or lng is None:
+            # Registros anteriores às colunas numéricas
+            coords = FTTHMonitorService._parse_gps(gps)
+            if not coords:
+                continue
+            lat, lng = coords
+        pontos.append((cto_id, lat, lng, olt_id))
+
+    index = CTOSpatialIndex(pontos)
+    with _index_lock:
+        _index_cache[empresa_id] = (index, agora + CTO_INDEX_TTL)
+    return index
+
+
+def invalidate(empresa_id: int) -> None:
+    """Descarta o índice da empresa (chamado após alterações de CTO)."""
+    with _index_lock:
+        _index_cache.pop(empresa_id, None)
@@ -0,0 +1,172 @@
+"""
+Estatísticas do dashboard por empresa
+
+Os totais de NFCom, clientes e contratos saem de uma única consulta (uma
+subconsulta escalar por contador) e os valores financeiros, incluindo o
+gráfico mensal, de uma consulta com agregação condicional sobre receivables.
+Os filtros de data comparam as colunas diretamente com intervalos
+[início, fim) para que os índices (empresa_id, due_date) e
+(empresa_id, status, paid_at) possam ser usados.
+
+O resultado fica em cache por empresa durante DASHBOARD_STATS_TTL segundos,
+então logins simultâneos de vários operadores custam uma única execução.
+Alterações feitas pela ORM em cobranças, contratos, clientes e NFComs
+invalidam o cache da empresa quando a transação é confirmada, para a baixa
+de um pagamento aparecer na hora; INSERT/UPDATE/DELETE em massa invalidam
+só a empresa do filtro por empresa_id, ou todas se não houver. Estatísticas
+calculadas enquanto a empresa era invalidada não são gravadas (ver
+process_cache).
+"""
+import os
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, case, func, or_, select
+from sqlalchemy.orm import Session
+
+from app.models.models import Cliente, NFCom, Receivable, ServicoContratado
+from app.services.process_cache import Generations, column_values, get_fresh, track_commits
+
+DASHBOARD_STATS_TTL = float(os.environ.get("DASHBOARD_STATS_TTL", "60"))
+
+# Status de cobranças ainda não pagas
+_OPEN_STATUSES = ('PENDING', 'REGISTERED', 'PRINTED', 'SENT')
+
+_cache: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+_generations = Generations()
+
+# Modelos que entram nas estatísticas
+_TRACKED_MODELS = (Receivable, ServicoContratado, Cliente, NFCom)
+_TRACKED_TABLES = {model.__tablename__ for model in _TRACKED_MODELS}
+
+_PENDING_KEY = "dashboard_cache_pending"
+
+
+def _month_start(day: date, months_back: int = 0) -> datetime:
+    index = day.year * 12 + (day.month - 1) - months_back
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+class DashboardService:
+    @staticmethod
+    def get_stats(db: Session, empresa_id: int) -> Dict[str, Any]:
+        """Estatísticas do dashboard da empresa (em cache por DASHBOARD_STATS_TTL)."""
+        cached = get_fresh(_cache, empresa_id)
+        if cached is not None:
+            return cached[1]
+        generation = _generations.snapshot(empresa_id)
+        stats = DashboardService.compute_stats(db, empresa_id)
+        _generations.store(_cache, empresa_id, stats, DASHBOARD_STATS_TTL, generation, empresa_id)
+        return stats
+
+    @staticmethod
+    def invalidate(empresa_id: Optional[int] = None) -> None:
+        with _generations.lock:
+            if empresa_id is None:
+                _generations.bump_all()
+                _cache.clear()
+            else:
+                _generations.bump(empresa_id)
+                _cache.pop(empresa_id, None)
+
+    @staticmethod
+    def compute_stats(db: Session, empresa_id: int) -> Dict[str, Any]:
+        today = date.today()
+        today_start = datetime(today.year, today.month, today.day)
+        first_day_of_month = _month_start(today)
+        next_month = _month_start(today, -1)
+
+        # --- NFCom, clientes e contratos: uma consulta ---
+        counts = db.execute(select(
+            select(func.count(NFCom.id)).where(NFCom.empresa_id == empresa_id).scalar_subquery().label('nfcom_total'),
+            select(func.coalesce(func.sum(NFCom.valor_total), 0.0)).where(NFCom.empresa_id == empresa_id).scalar_subquery().label('nfcom_valor'),
+            select(func.count(Cliente.id)).where(Cliente.empresa_id == empresa_id).scalar_subquery().label('clientes'),
+            select(func.count(ServicoContratado.id)).where(
+                ServicoContratado.empresa_id == empresa_id, ServicoContratado.status == 'ATIVO'
+            ).scalar_subquery().label('ativos'),
+            select(func.count(ServicoContratado.id)).where(
+                ServicoContratado.empresa_id == empresa_id, ServicoContratado.status == 'BLOQUEADO'
+            ).scalar_subquery().label('bloqueados'),
+        )).one()
+
+        # --- Receivables: uma consulta com agregação condicional ---
+        # Gráfico: meses completos dos últimos 6 meses (incluindo o atual)
+        months: List[Tuple[datetime, datetime]] = [
+            (_month_start(today, i), _month_start(today, i - 1)) for i in range(5, -1, -1)
+        ]
+        paid = Receivable.status == 'PAID'
+        is_open = Receivable.status.in_(_OPEN_STATUSES)
+
+        def _sum_if(cond):
+            return func.coalesce(func.sum(case((cond, Receivable.amount), else_=0.0)), 0.0)
+
+        columns = [
+            _sum_if(and_(paid, Receivable.paid_at >= first_day_of_month)).label('recebido_mes'),
+            _sum_if(and_(is_open, Receivable.due_date >= first_day_of_month, Receivable.due_date < next_month)).label('pendente_mes'),
+            _sum_if(and_(is_open, Receivable.due_date < today_start)).label('vencido_total'),
+        ]
+        columns += [
+            _sum_if(and_(paid, Receivable.paid_at >= start, Receivable.paid_at < end)).label(f'mes_{i}')
+            for i, (start, end) in enumerate(months)
+        ]
+        fin = db.execute(
+            select(*columns).where(
+                Receivable.empresa_id == empresa_id,
+                or_(
+                    and_(paid, Receivable.paid_at >= months[0][0]),
+                    and_(is_open, Receivable.due_date < next_month),
+                ),
+            )
+        ).one()
+
+        # Dados para gráfico de status (NFComs mantido como exemplo, ou pode ser contratos)
+        status_data = [
+            {"name": "Ativos", "value": counts.ativos, "color": "#10b981"},  # emerald-500
+            {"name": "Bloqueados", "value": counts.bloqueados, "color": "#f43f5e"},  # rose-500
+        ]
+        monthly_data = [
+            {"month": start.strftime("%b"), "valor": float(getattr(fin, f'mes_{i}') or 0.0)}
+            for i, (start, _end) in enumerate(months)
+        ]
+
+        return {
+            "stats": {
+                "clientes_total": counts.clientes,
+                "contratos_ativos": counts.ativos,
+                "contratos_bloqueados": counts.bloqueados,
+                "nfcom_emitidas": counts.nfcom_total,
+                "valor_total_nfcom": float(counts.nfcom_valor or 0.0),
+                "recebido_mes": float(fin.recebido_mes or 0.0),
+                "pendente_mes": float(fin.pendente_mes or 0.0),
+                "vencido_total": float(fin.vencido_total or 0.0),
+            },
+            "charts": {
+                "status": status_data,
+                "monthly": monthly_data
+            }
+        }
+
+
+def _object_scopes(obj):
+    if isinstance(obj, _TRACKED_MODELS):
+        return [obj.empresa_id]
+    return None
+
+
+def _statement_scopes(orm_execute_state):
+    table = getattr(orm_execute_state.statement, "table", None)
+    if getattr(table, "name", None) not in _TRACKED_TABLES:
+        return None
+    # Sem filtro por empresa_id o comando pode atingir qualquer empresa (None = todas)
+    return column_values(orm_execute_state, "empresa_id") or [None]
+
+
+def _apply_changes(empresas) -> None:
+    if None in empresas:
+        DashboardService.invalidate()
+        return
+    for empresa_id in empresas:
+        DashboardService.invalidate(empresa_id)
+
+
+track_commits(_PENDING_KEY, _object_scopes, _statement_scopes, _apply_changes)
@@ -13,17 +13,16 @@ import time
 import logging
 import os
 import subprocess
-import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Optional, List, Dict, Any, Tuple
 from datetime import datetime, timedelta
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import func
 
 from app.models.models import ServicoContratado, Cliente, StatusContrato
-from app.models.ftth import OLT, CTO, FTTHMonitorSnapshot
+from app.models.ftth import OLT, CTO, FTTHMonitorSnapshot, FTTHOnuCurrentStatus
 from app.models.network import Router
+from app.services import cto_spatial_index
 
 logger = logging.getLogger(__name__)
 
@@ -36,16 +35,16 @@ LATENCY_WARNING_THRESHOLD = 100.0
 LATENCY_CRITICAL_THRESHOLD = 500.0
 
 # ── Configuração de Paralelismo ────────────────────────────────────────────────
-# Número máximo de threads paralelas por empresa:
-#   - Cada OLT/Mikrotik ocupa 1 thread. Contratores sem OLT usam threads extras.
+# Número máximo de Roteadores/Mikrotiks verificados simultaneamente por empresa.
 #   - Aumentar se houver muitos provedores / OLTs. Reduzir se o servidor for limitado.
+#   - Sessões e pings simultâneos POR Roteador: ver app/services/ftth_poll_engine.py
 MAX_OLT_WORKERS = int(os.environ.get("FTTH_MAX_OLT_WORKERS", "20"))
 
-# Threads extras para contratos FTTH sem OLT configurada (ping ICMP puro)
+# Pings ICMP simultâneos para contratos FTTH sem Roteador configurado
 MAX_ICMP_WORKERS = int(os.environ.get("FTTH_MAX_ICMP_WORKERS", "15"))
 
-# Timeout total por thread de OLT antes de ser cancelada (segundos)
-OLT_THREAD_TIMEOUT = int(os.environ.get("FTTH_OLT_THREAD_TIMEOUT", "90"))
+# Busca textual ordenada por proximidade: CTOs candidatas conferidas por consulta IN
+CTO_SEARCH_CHUNK = 500
 # ────────────────────────────────────────────────────────────────────────
 
 
@@ -410,6 +409,63 @@ class FTTHMonitorService:
     # COLETA DE STATUS DE UMA ONU
     # =====================================================================
 
+    RADIUS_SEM_SESSAO = "Sem sessão PPPoE ativa no RADIUS (desconectado)"
+
+    @staticmethod
+    def _resolve_onu_ip(db: Session, contrato: ServicoContratado) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Descobre o IP a ser verificado para o contrato.
+
+        Usa o IP estático (assigned_ip) e, na falta dele, o IP da sessão PPPoE
+        ativa no RADIUS.
+
+        Returns:
+            (ip, detalhe_erro) — ip é None quando não foi possível determiná-lo.
+        """
+        if contrato.assigned_ip:
+            return contrato.assigned_ip, None
+        if not contrato.pppoe_username:
+            return None, None
+        try:
+            from app.models.radius import RadiusSession
+            session = db.query(RadiusSession).filter(
+                RadiusSession.username == contrato.pppoe_username,
+                RadiusSession.empresa_id == contrato.empresa_id,
+                RadiusSession.end_time.is_(None)
+            ).order_by(RadiusSession.start_time.desc()).first()
+            if session:
+                return session.ip_address, None
+            return None, FTTHMonitorService.RADIUS_SEM_SESSAO
+        except Exception as e:
+            logger.error(f"Erro ao buscar IP dinâmico no RADIUS: {e}")
+            return None, f"Erro no RADIUS: {e}"
+
+    @staticmethod
+    def _load_active_radius_ips(db: Session, empresa_id: int, usernames: List[str]) -> Dict[str, str]:
+        """
+        Versão em lote de _resolve_onu_ip para o poller: busca numa única
+        consulta (em blocos de IN) o IP da sessão PPPoE ativa de cada username.
+
+        Returns:
+            dict username → ip_address (a sessão mais recente prevalece).
+        """
+        from app.models.radius import RadiusSession
+
+        ips: Dict[str, str] = {}
+        usernames = sorted(set(u for u in usernames if u))
+        for i in range(0, len(usernames), 1000):
+            rows = db.query(
+                RadiusSession.username, RadiusSession.ip_address
+            ).filter(
+                RadiusSession.empresa_id == empresa_id,
+                RadiusSession.end_time.is_(None),
+                RadiusSession.username.in_(usernames[i:i + 1000])
+            ).order_by(RadiusSession.start_time.asc()).all()
+            for username, ip_address in rows:
+                if ip_address:
+                    ips[username] = ip_address
+        return ips
+
     @staticmethod
     def check_onu(db: Session, contrato: ServicoContratado) -> FTTHMonitorSnapshot:
         """
@@ -438,22 +494,8 @@ class FTTHMonitorService:
         metodo_coleta = "PING"
 
         # ── Se não há IP estático, busca sessão ativa do PPPoE no RADIUS ────────
-        if not ip and contrato.pppoe_username:
-            try:
-                from app.models.radius import RadiusSession
-                session = db.query(RadiusSession).filter(
-                    RadiusSession.username == contrato.pppoe_username,
-                    RadiusSession.empresa_id == contrato.empresa_id,
-                    RadiusSession.end_time.is_(None)
-                ).order_by(RadiusSession.start_time.desc()).first()
-                
-                if session:
-                    ip = session.ip_address
-                else:
-                    detalhe_erro = "Sem sessão PPPoE ativa no RADIUS (desconectado)"
-            except Exception as e:
-                logger.error(f"Erro ao buscar IP dinâmico no RADIUS: {e}")
-                detalhe_erro = f"Erro no RADIUS: {e}"
+        if not ip:
+            ip, detalhe_erro = FTTHMonitorService._resolve_onu_ip(db, contrato)
 
         if ip:
             # ── Tentativa Solução B: ping via API do Mikrotik ───────────────
@@ -517,53 +559,98 @@ class FTTHMonitorService:
             timestamp=datetime.utcnow()
         )
         db.add(snapshot)
+        FTTHMonitorService._upsert_current_status(db, [{
+            "contrato_id": contrato.id,
+            "empresa_id": contrato.empresa_id,
+            "status": status,
+            "rx_power": rx_power,
+            "tx_power": tx_power,
+            "latencia_ms": latencia_ms,
+            "is_reachable": is_reachable,
+            "metodo_coleta": metodo_coleta,
+            "detalhe_erro": detalhe_erro,
+            "ip_verificado": ip,
+            "timestamp": snapshot.timestamp,
+        }])
         db.commit()
         db.refresh(snapshot)
         return snapshot
 
+    @staticmethod
+    def _upsert_current_status(db: Session, rows: List[Dict[str, Any]]) -> None:
+        """
+        Grava o último status de cada ONU em ftth_onu_current_status
+        (INSERT ... ON DUPLICATE KEY UPDATE, uma instrução para todas as linhas).
+
+        Não faz commit: roda na mesma transação dos snapshots.
+        """
+        if not rows:
+            return
+        colunas = {c.name for c in FTTHOnuCurrentStatus.__table__.columns}
+        rows = [{k: v for k, v in r.items() if k in colunas} for r in rows]
+        atualizar = [k for k in rows[0] if k != "contrato_id"]
+
+        dialect = db.get_bind().dialect.name
+        if dialect == "mysql":
+            from sqlalchemy.dialects.mysql import insert as dialect_insert
+            stmt = dialect_insert(FTTHOnuCurrentStatus).values(rows)
+            stmt = stmt.on_duplicate_key_update({k: stmt.inserted[k] for k in atualizar})
+        else:
+            if dialect == "postgresql":
+                from sqlalchemy.dialects.postgresql import insert as dialect_insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert as dialect_insert
+            stmt = dialect_insert(FTTHOnuCurrentStatus).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["contrato_id"],
+                set_={k: stmt.excluded[k] for k in atualizar},
+            )
+        db.execute(stmt)
+
     # =====================================================================
     # DASHBOARD / ESTATÍSTICAS
     # =====================================================================
 
+    @staticmethod
+    def _contratos_ftth_filter(empresa_id: int):
+        """Critério de contrato FTTH ativo (tem onu_serial OU tipo_conexao == FIBRA)."""
+        return (
+            (ServicoContratado.empresa_id == empresa_id) &
+            (ServicoContratado.is_active == True) &
+            (ServicoContratado.status != StatusContrato.CANCELADO) &
+            (
+                (ServicoContratado.onu_serial.isnot(None)) |
+                (ServicoContratado.tipo_conexao == "FIBRA")
+            )
+        )
+
     @staticmethod
     def get_dashboard(db: Session, empresa_id: int) -> Dict[str, Any]:
         """
         Retorna os dados de resumo para o dashboard FTTH.
+
+        Os contadores vêm de uma única consulta agrupada sobre
+        ftth_onu_current_status (contratos sem verificação contam como DESCONHECIDO).
         """
-        # Busca todos os contratos FTTH ativos (tipo_conexao = FIBRA ou com onu_serial)
-        contratos_ftth = db.query(ServicoContratado).filter(
-            ServicoContratado.empresa_id == empresa_id,
-            ServicoContratado.is_active == True,
-            ServicoContratado.status != StatusContrato.CANCELADO,
+        status_col = func.coalesce(FTTHOnuCurrentStatus.status, "DESCONHECIDO")
+        rows = db.query(
+            status_col,
+            func.count(ServicoContratado.id),
+            func.max(FTTHOnuCurrentStatus.timestamp),
+        ).select_from(ServicoContratado).outerjoin(
+            FTTHOnuCurrentStatus, FTTHOnuCurrentStatus.contrato_id == ServicoContratado.id
         ).filter(
-            # Considera FTTH se tiver onu_serial OU tipo_conexao == FIBRA
-            (ServicoContratado.onu_serial.isnot(None)) |
-            (ServicoContratado.tipo_conexao == "FIBRA")
-        ).all()
-
-        total_onus = len(contratos_ftth)
+            FTTHMonitorService._contratos_ftth_filter(empresa_id)
+        ).group_by(status_col).all()
 
-        # Busca o status mais recente de cada contrato
         status_counts = {"ONLINE": 0, "OFFLINE": 0, "DEGRADADO": 0, "DESCONHECIDO": 0}
         ultima_atualizacao = None
+        for s, count, ts in rows:
+            status_counts[s if s in status_counts else "DESCONHECIDO"] += count
+            if ts and (ultima_atualizacao is None or ts > ultima_atualizacao):
+                ultima_atualizacao = ts
 
-        for contrato in contratos_ftth:
-            ultimo_snapshot = db.query(FTTHMonitorSnapshot).filter(
-                FTTHMonitorSnapshot.contrato_id == contrato.id
-            ).order_by(FTTHMonitorSnapshot.timestamp.desc()).first()
-
-            if ultimo_snapshot:
-                s = ultimo_snapshot.status
-                if s in status_counts:
-                    status_counts[s] += 1
-                else:
-                    status_counts["DESCONHECIDO"] += 1
-
-                if ultima_atualizacao is None or ultimo_snapshot.timestamp > ultima_atualizacao:
-                    ultima_atualizacao = ultimo_snapshot.timestamp
-            else:
-                status_counts["DESCONHECIDO"] += 1
-
+        total_onus = sum(status_counts.values())
         online = status_counts["ONLINE"]
         offline = status_counts["OFFLINE"]
         degradado = status_counts["DEGRADADO"]
@@ -601,21 +688,29 @@ class FTTHMonitorService:
         search: Optional[str] = None,
         skip: int = 0,
         limit: int = 100,
+        status_in: Optional[List[str]] = None,
     ) -> Tuple[List[Dict[str, Any]], int]:
         """
         Retorna a lista de ONUs com seu status atual e dados do contrato.
+
+        O status vem de ftth_onu_current_status (LEFT JOIN), então o filtro
+        por status é aplicado no SQL antes da contagem e da paginação.
         """
-        query = db.query(ServicoContratado, Cliente).join(
+        query = db.query(ServicoContratado, Cliente, FTTHOnuCurrentStatus).join(
             Cliente, ServicoContratado.cliente_id == Cliente.id
+        ).outerjoin(
+            FTTHOnuCurrentStatus, FTTHOnuCurrentStatus.contrato_id == ServicoContratado.id
         ).filter(
-            ServicoContratado.empresa_id == empresa_id,
-            ServicoContratado.is_active == True,
-            ServicoContratado.status != StatusContrato.CANCELADO,
-        ).filter(
-            (ServicoContratado.onu_serial.isnot(None)) |
-            (ServicoContratado.tipo_conexao == "FIBRA")
+            FTTHMonitorService._contratos_ftth_filter(empresa_id)
         )
 
+        statuses = [s.upper() for s in (status_in or ([status_filter] if status_filter else []))]
+        if statuses:
+            status_cond = FTTHOnuCurrentStatus.status.in_(statuses)
+            if "DESCONHECIDO" in statuses:
+                status_cond = status_cond | FTTHOnuCurrentStatus.contrato_id.is_(None)
+            query = query.filter(status_cond)
+
         if olt_nome_filter:
             query = query.filter(ServicoContratado.olt_nome.ilike(f"%{olt_nome_filter}%"))
         if cto_nome_filter:
@@ -629,21 +724,10 @@ class FTTHMonitorService:
             )
 
         total = query.count()
-        results = query.offset(skip).limit(limit).all()
+        results = query.order_by(ServicoContratado.id).offset(skip).limit(limit).all()
 
         onus = []
-        for contrato, cliente in results:
-            # Busca o snapshot mais recente
-            ultimo = db.query(FTTHMonitorSnapshot).filter(
-                FTTHMonitorSnapshot.contrato_id == contrato.id
-            ).order_by(FTTHMonitorSnapshot.timestamp.desc()).first()
-
-            onu_status = ultimo.status if ultimo else "DESCONHECIDO"
-
-            # Filtra por status depois de descobrir (evita subquery complexa)
-            if status_filter and onu_status != status_filter.upper():
-                continue
-
+        for contrato, cliente, atual in results:
             onus.append({
                 "contrato_id": contrato.id,
                 "cliente_nome": cliente.nome_razao_social,
@@ -661,13 +745,13 @@ class FTTHMonitorService:
                 "coordenadas_gps": contrato.coordenadas_gps,
                 "vlan_id": contrato.vlan_id,
                 "tipo_conexao": contrato.tipo_conexao.value if contrato.tipo_conexao else None,
-                "status": onu_status,
-                "latencia_ms": ultimo.latencia_ms if ultimo else None,
-                "rx_power": ultimo.rx_power if ultimo else None,
-                "tx_power": ultimo.tx_power if ultimo else None,
-                "is_reachable": ultimo.is_reachable if ultimo else None,
-                "ultima_verificacao": ultimo.timestamp if ultimo else None,
-                "metodo_coleta": ultimo.metodo_coleta if ultimo else None,
+                "status": atual.status if atual else "DESCONHECIDO",
+                "latencia_ms": atual.latencia_ms if atual else None,
+                "rx_power": atual.rx_power if atual else None,
+                "tx_power": atual.tx_power if atual else None,
+                "is_reachable": atual.is_reachable if atual else None,
+                "ultima_verificacao": atual.timestamp if atual else None,
+                "metodo_coleta": atual.metodo_coleta if atual else None,
             })
 
         return onus, total
@@ -678,9 +762,19 @@ class FTTHMonitorService:
         contrato_id: int,
         empresa_id: int,
         hours: int = 24
-    ) -> List[FTTHMonitorSnapshot]:
-        """Retorna o histórico de snapshots de uma ONU nas últimas N horas."""
+    ) -> List[Any]:
+        """
+        Retorna o histórico de uma ONU nas últimas N horas.
+
+        Períodos curtos usam os snapshots brutos; períodos longos usam os
+        agregados por hora/dia gerados pelo FTTHRollupService.
+        """
+        from app.services.ftth_rollup_service import FTTHRollupService
+
         since = datetime.utcnow() - timedelta(hours=hours)
+        resolucao = FTTHRollupService.pick_resolution(hours)
+        if resolucao != "RAW":
+            return FTTHRollupService.get_history(db, contrato_id, empresa_id, resolucao, since)
         return db.query(FTTHMonitorSnapshot).filter(
             FTTHMonitorSnapshot.contrato_id == contrato_id,
             FTTHMonitorSnapshot.empresa_id == empresa_id,
@@ -690,8 +784,10 @@ class FTTHMonitorService:
     @staticmethod
     def get_alertas(db: Session, empresa_id: int) -> List[Dict[str, Any]]:
         """Retorna ONUs com status OFFLINE ou DEGRADADO (alertas ativos)."""
-        onus, _ = FTTHMonitorService.get_onus_status(db, empresa_id, limit=500)
-        return [o for o in onus if o["status"] in ("OFFLINE", "DEGRADADO")]
+        onus, _ = FTTHMonitorService.get_onus_status(
+            db, empresa_id, status_in=["OFFLINE", "DEGRADADO"], limit=500
+        )
+        return onus
 
     # =====================================================================
     # OLT CRUD
@@ -791,6 +887,7 @@ class FTTHMonitorService:
         olt_id: Optional[int] = None,
         search: Optional[str] = None,
         proximidade_gps: Optional[str] = None,
+        raio_metros: Optional[float] = None,
         skip: int = 0,
         limit: int = 100
     ) -> Tuple[List[CTO], int]:
@@ -812,28 +909,91 @@ class FTTHMonitorService:
         if proximidade_gps:
             target_coords = FTTHMonitorService._parse_gps(proximidade_gps)
             if target_coords:
-                all_ctos = q.all()
-                total = len(all_ctos)
-                ctos_with_dist = []
-                for cto in all_ctos:
-                    cto_coords = FTTHMonitorService._parse_gps(cto.coordenadas_gps)
-                    if cto_coords:
-                        dist = FTTHMonitorService._calc_distance_m(target_coords, cto_coords)
-                        cto.distancia_metros = dist
-                    else:
-                        cto.distancia_metros = None
-                    ctos_with_dist.append(cto)
-                
-                # Sort: CTOs with distance first (sorted by distance ascending), then those without distance
-                ctos_with_dist.sort(key=lambda x: (x.distancia_metros is None, x.distancia_metros or 0))
-                
-                # Paginate in memory
-                return ctos_with_dist[skip:skip + limit], total
+                return FTTHMonitorService._list_ctos_by_proximity(
+                    db, empresa_id, q, target_coords, raio_metros, olt_id=olt_id, search=search,
+                    skip=skip, limit=limit
+                )
 
         total = q.count()
         results = q.order_by(CTO.nome).offset(skip).limit(limit).all()
         return results, total
 
+    @staticmethod
+    def _list_ctos_by_proximity(
+        db: Session,
+        empresa_id: int,
+        q,
+        target_coords: Tuple[float, float],
+        raio_metros: Optional[float],
+        olt_id: Optional[int],
+        search: Optional[str],
+        skip: int,
+        limit: int
+    ) -> Tuple[List[CTO], int]:
+        """
+        Ordena as CTOs por distância usando o índice espacial da empresa.
+
+        Sem raio, as CTOs sem coordenadas vêm depois das georreferenciadas
+        (ordenadas por nome); com raio, apenas as CTOs dentro dele são retornadas.
+        O filtro por OLT usa o olt_id guardado no índice; a busca textual é
+        conferida no banco só para as CTOs candidatas, das mais próximas para
+        as mais distantes.
+        """
+        index = cto_spatial_index.get_index(db, empresa_id)
+        accept = (lambda _cto_id, cto_olt_id: cto_olt_id == olt_id) if olt_id else None
+        conferidos: Dict[int, bool] = {}
+
+        def _matching(candidatos):
+            # Confere no banco (uma consulta IN por bloco) os ids ainda não vistos
+            novos = [cto_id for cto_id, _ in candidatos if cto_id not in conferidos]
+            for i in range(0, len(novos), CTO_SEARCH_CHUNK):
+                bloco = novos[i:i + CTO_SEARCH_CHUNK]
+                aceitos = {cto_id for (cto_id,) in q.with_entities(CTO.id).filter(CTO.id.in_(bloco)).all()}
+                conferidos.update((cto_id, cto_id in aceitos) for cto_id in bloco)
+            return [c for c in candidatos if conferidos[c[0]]]
+
+        lat, lng = target_coords
+        if raio_metros:
+            vizinhos = index.within(lat, lng, raio_metros, accept)
+            if search:
+                vizinhos = _matching(vizinhos)
+            total = len(vizinhos)
+        else:
+            total = q.count()
+            k = skip + limit
+            while True:
+                candidatos = index.nearest(lat, lng, k, accept)
+                vizinhos = _matching(candidatos) if search else candidatos
+                # Índice esgotado ou página completa
+                if len(candidatos) < k or len(vizinhos) >= skip + limit:
+                    break
+                k *= 2
+            vizinhos = vizinhos[:skip + limit]
+        pagina = vizinhos[skip:skip + limit]
+
+        ids = [cto_id for cto_id, _ in pagina]
+        ctos_por_id = {
+            c.id: c for c in q.options(joinedload(CTO.olt)).filter(CTO.id.in_(ids)).all()
+        } if ids else {}
+        results = []
+        for cto_id, dist in pagina:
+            cto = ctos_por_id.get(cto_id)
+            if cto:
+                cto.distancia_metros = dist
+                results.append(cto)
+
+        # Completa a página com as CTOs sem coordenadas
+        faltam = limit - len(results)
+        if not raio_metros and faltam > 0:
+            sem_coords = q.options(joinedload(CTO.olt)).filter(CTO.latitude.is_(None))
+            if vizinhos:
+                sem_coords = sem_coords.filter(CTO.id.notin_([cto_id for cto_id, _ in vizinhos]))
+            for cto in sem_coords.order_by(CTO.nome).offset(max(0, skip - len(vizinhos))).limit(faltam).all():
+                cto.distancia_metros = None
+                results.append(cto)
+
+        return results, total
+
     @staticmethod
     def get_cto(db: Session, cto_id: int, empresa_id: int) -> Optional[CTO]:
         return db.query(CTO).filter(
@@ -843,9 +1003,11 @@ class FTTHMonitorService:
     @staticmethod
     def create_cto(db: Session, data: dict, empresa_id: int) -> CTO:
         cto = CTO(**data, empresa_id=empresa_id)
+        FTTHMonitorService._sync_cto_coords(cto)
         db.add(cto)
         db.commit()
         db.refresh(cto)
+        cto_spatial_index.invalidate(empresa_id)
         return cto
 
     @staticmethod
@@ -855,8 +1017,10 @@ class FTTHMonitorService:
             return None
         for k, v in data.items():
             setattr(cto, k, v)
+        FTTHMonitorService._sync_cto_coords(cto)
         db.commit()
         db.refresh(cto)
+        cto_spatial_index.invalidate(empresa_id)
         return cto
 
     @staticmethod
@@ -866,398 +1030,31 @@ class FTTHMonitorService:
             return False
         db.delete(cto)
         db.commit()
+        cto_spatial_index.invalidate(empresa_id)
         return True
 
+    @staticmethod
+    def _sync_cto_coords(cto: CTO) -> None:
+        """Mantém latitude/longitude coerentes com o texto coordenadas_gps."""
+        coords = FTTHMonitorService._parse_gps(cto.coordenadas_gps)
+        cto.latitude, cto.longitude = coords if coords else (None, None)
+
     # =====================================================================
     # COLETA EM MASSA PARALELA (para o poller)
     # =====================================================================
 
     @staticmethod
-    def poll_all_onus(db: Session, empresa_id: int) -> Dict[str, int]:
-        """
-        Executa verificação PARALELA de todas as ONUs FTTH ativas de uma empresa.
-
-        Estratégia de paralelismo em dois níveis:
-
-        NÍVEL 1 — Paralelismo entre OLTs/Mikrotiks:
-          - Agrupa contratos por nome de OLT.
-          - Para cada OLT com Mikrotik API configurada, dispara 1 thread que:
-              • Verifica conectividade do Mikrotik (TCP check rápido).
-              • Se acessível, abre UMA única conexão API e pinga todas as ONUs
-                daquela OLT em sequência (muito mais eficiente que N conexões).
-              • Se inacessível, marca todas as ONUs daquela OLT como OFFLINE
-                instantaneamente sem esperar timeout por ONU.
-          - Todas as OLTs rodam em paralelo (ThreadPoolExecutor).
-
-        NÍVEL 2 — Paralelismo para ICMP puro:
-          - Contratos sem OLT configurada ou OLTs sem credenciais Mikrotik
-            são verificados com ping ICMP em threads independentes.
-
-        Cada thread tem sua própria Session SQLAlchemy (thread-safe).
-        O contador de resultados é protegido por threading.Lock().
-
-        Configurável via variáveis de ambiente:
-          FTTH_MAX_OLT_WORKERS   (padrão: 20) — threads por empresa para OLTs
-          FTTH_MAX_ICMP_WORKERS  (padrão: 15) — threads para ICMP sem OLT
-          FTTH_OLT_THREAD_TIMEOUT (padrão: 90s) — timeout por thread de OLT
+    def poll_all_onus(db: Session, empresa_id: int) -> Dict[str, Any]:
         """
-        from app.core.database import SessionLocal
-
-        # ── Busca contratos FTTH ativos ────────────────────────────────────
-        contratos = db.query(ServicoContratado).filter(
-            ServicoContratado.empresa_id == empresa_id,
-            ServicoContratado.is_active == True,
-            ServicoContratado.status != StatusContrato.CANCELADO,
-        ).filter(
-            (ServicoContratado.onu_serial.isnot(None)) |
-            (ServicoContratado.tipo_conexao == "FIBRA")
-        ).all()
-
-        total = len(contratos)
-        resumo = {"ONLINE": 0, "OFFLINE": 0, "DEGRADADO": 0, "DESCONHECIDO": 0, "total": total}
-
-        if total == 0:
-            return resumo
-
-        # ── Pré-carrega todos os Roteadores da empresa ───────────────────────────
-        routers_por_id: Dict[int, Router] = {
-            router.id: router
-            for router in db.query(Router).filter(
-                Router.empresa_id == empresa_id,
-                Router.is_active == True
-            ).all()
-        }
-
-        # ── Separa contratos em grupos por Roteador e sem-Roteador ──────────────────
-        # key: router_id → value: lista de contrato_ids
-        por_router: Dict[int, List[int]] = {}
-        sem_router: List[int] = []
-
-        for c in contratos:
-            if c.router_id and c.router_id in routers_por_id:
-                router = routers_por_id[c.router_id]
-                if router.ip and router.usuario and router.senha:
-                    por_router.setdefault(c.router_id, []).append(c.id)
-                    continue
-            sem_router.append(c.id)
-
-        # ── Lock para atualizar o resumo de forma thread-safe ─────────────
-        lock = threading.Lock()
-
-        def _update_resumo(status: str):
-            with lock:
-                if status in resumo:
-                    resumo[status] += 1
-                else:
-                    resumo["DESCONHECIDO"] += 1
-
-        # ── Worker: processa TODOS os contratos de um Roteador ────────────────
-        def _worker_router(router_id: int, contrato_ids: List[int]):
-            """
-            Thread que gerencia um Router/Mikrotik completo.
-            Abre UMA conexão API e verifica todas as ONUs do grupo.
-            """
-            thread_db = SessionLocal()
-            try:
-                router = routers_por_id[router_id]
-                statuses = FTTHMonitorService._poll_router_group_via_api(
-                    thread_db, router, contrato_ids
-                )
-                for st in statuses:
-                    _update_resumo(st)
-            except Exception as e:
-                logger.error(f"[THREAD ROUTER={router_id}] Erro inesperado: {e}")
-                for _ in contrato_ids:
-                    _update_resumo("DESCONHECIDO")
-            finally:
-                thread_db.close()
-
-        # ── Worker: processa um único contrato via ICMP ───────────────────
-        def _worker_icmp(contrato_id: int):
-            """
-            Thread independente para ping ICMP (fallback ou sem Router).
-            """
-            thread_db = SessionLocal()
-            try:
-                contrato = thread_db.query(ServicoContratado).filter_by(
-                    id=contrato_id
-                ).first()
-                if not contrato:
-                    _update_resumo("DESCONHECIDO")
-                    return
-                snapshot = FTTHMonitorService.check_onu(thread_db, contrato)
-                _update_resumo(snapshot.status)
-            except Exception as e:
-                logger.error(f"[THREAD ICMP contrato_id={contrato_id}] Erro: {e}")
-                _update_resumo("DESCONHECIDO")
-            finally:
-                thread_db.close()
-
-        # ── Dispara threads em paralelo ────────────────────────────────────
-        n_router_workers = min(MAX_OLT_WORKERS, len(por_router) + 1)
-        n_icmp_workers = min(MAX_ICMP_WORKERS, len(sem_router) + 1)
-        total_workers = n_router_workers + n_icmp_workers
-
-        logger.info(
-            f"[POLL empresa={empresa_id}] {total} ONUs | "
-            f"{len(por_router)} Roteadores (API) | {len(sem_router)} sem Router (ICMP) | "
-            f"workers Router={n_router_workers} ICMP={n_icmp_workers}"
-        )
+        Executa verificação de todas as ONUs FTTH ativas de uma empresa.
 
-        futures = []
-        with ThreadPoolExecutor(max_workers=total_workers, thread_name_prefix="ftth_poll") as executor:
-
-            # Submete 1 task por Roteador/Mikrotik
-            for r_id, c_ids in por_router.items():
-                futures.append(executor.submit(_worker_router, r_id, c_ids))
-
-            # Submete tasks individuais para ICMP
-            for c_id in sem_router:
-                futures.append(executor.submit(_worker_icmp, c_id))
-
-            # Aguarda conclusão com timeout global por thread
-            for future in as_completed(futures, timeout=OLT_THREAD_TIMEOUT):
-                try:
-                    future.result()  # propaga exceptions internas já tratadas
-                except Exception as e:
-                    logger.error(f"[POLL] Thread encerrada com erro: {e}")
-
-        logger.info(
-            f"[POLL empresa={empresa_id}] Concluído → "
-            f"Online={resumo['ONLINE']} Offline={resumo['OFFLINE']} "
-            f"Degradado={resumo['DEGRADADO']} Desconhecido={resumo['DESCONHECIDO']}"
-        )
-        return resumo
-
-    @staticmethod
-    def _poll_router_group_via_api(
-        db: Session,
-        router: Router,
-        contrato_ids: List[int]
-    ) -> List[str]:
-        """
-        Processa um grupo de contratos de um único Roteador usando UMA conexão
-        à API do Mikrotik (reutilizada para todas as ONUs do grupo).
-
-        Fluxo:
-          1. TCP check: verifica se o Mikrotik responde na porta da API.
-             - Se não responder: marca TODAS as ONUs como OFFLINE imediatamente.
-          2. Conecta à API do Mikrotik (UMA vez).
-          3. Para cada contrato: executa /ping via conexão existente, salva snapshot.
-          4. Fecha a conexão ao final.
-
-        Args:
-            db: Session SQLAlchemy exclusiva desta thread.
-            router: Instância do modelo Router com credenciais do Mikrotik.
-            contrato_ids: Lista de IDs de contratos a verificar.
-
-        Returns:
-            Lista de strings com o status de cada contrato (mesma ordem).
-        """
-        from app.mikrotik.controller import MikrotikController
-
-        host = router.ip
-        port = router.porta or 8728
-        statuses: List[str] = []
-
-        logger.info(
-            f"[Router={router.nome}] Iniciando verificação de {len(contrato_ids)} ONUs "
-            f"via API {host}:{port}..."
-        )
-
-        # ── ETAPA 1: TCP check ─────────────────────────────────────────────
-        if not FTTHMonitorService.check_mikrotik_reachable(host, port, timeout=3.0):
-            logger.warning(
-                f"[Router={router.nome}] Mikrotik {host}:{port} inacessível — "
-                f"marcando {len(contrato_ids)} ONUs como OFFLINE"
-            )
-            for c_id in contrato_ids:
-                contrato = db.query(ServicoContratado).filter_by(id=c_id).first()
-                if not contrato:
-                    statuses.append("DESCONHECIDO")
-                    continue
-                snap = FTTHMonitorSnapshot(
-                    contrato_id=c_id,
-                    empresa_id=contrato.empresa_id,
-                    status="OFFLINE",
-                    is_reachable=False,
-                    metodo_coleta="MIKROTIK_API",
-                    detalhe_erro=f"Mikrotik {host}:{port} inacessível (VPN offline ou host inativo)",
-                    ip_verificado=contrato.assigned_ip,
-                    timestamp=datetime.utcnow(),
-                )
-                db.add(snap)
-                statuses.append("OFFLINE")
-            db.commit()
-            return statuses
-
-        # ── ETAPA 2: Conecta à API (UMA vez para todo o grupo) ────────────
-        from app.core.security import decrypt_password
-        try:
-            password = decrypt_password(router.senha) if router.senha else ""
-        except Exception as e:
-            logger.warning(f"Falha ao descriptografar senha do roteador no lote, usando texto plano: {e}")
-            password = router.senha
-
-        ctrl = MikrotikController(
-            host=host,
-            username=router.usuario,
-            password=password,
-            port=port,
-        )
-        try:
-            ctrl.connect()
-            logger.info(f"[Router={router.nome}] Conexão API estabelecida — pingando {len(contrato_ids)} ONUs...")
-
-            for c_id in contrato_ids:
-                contrato = db.query(ServicoContratado).filter_by(id=c_id).first()
-                if not contrato:
-                    statuses.append("DESCONHECIDO")
-                    continue
-
-                ip = contrato.assigned_ip
-                detalhe_erro = None
-
-                # ── Se não há IP estático, busca sessão ativa do PPPoE no RADIUS ────────
-                if not ip and contrato.pppoe_username:
-                    try:
-                        from app.models.radius import RadiusSession
-                        session = db.query(RadiusSession).filter(
-                            RadiusSession.username == contrato.pppoe_username,
-                            RadiusSession.empresa_id == contrato.empresa_id,
-                            RadiusSession.end_time.is_(None)
-                        ).order_by(RadiusSession.start_time.desc()).first()
-                        
-                        if session:
-                            ip = session.ip_address
-                        else:
-                            detalhe_erro = "Sem sessão PPPoE ativa no RADIUS (desconectado)"
-                    except Exception as e:
-                        logger.error(f"Erro ao buscar IP dinâmico no RADIUS: {e}")
-                        detalhe_erro = f"Erro no RADIUS: {e}"
-
-                if not ip:
-                    is_radius_offline = (detalhe_erro == "Sem sessão PPPoE ativa no RADIUS (desconectado)")
-                    snap = FTTHMonitorSnapshot(
-                        contrato_id=c_id,
-                        empresa_id=contrato.empresa_id,
-                        status="OFFLINE" if is_radius_offline else "DESCONHECIDO",
-                        is_reachable=False if is_radius_offline else None,
-                        metodo_coleta="MIKROTIK_API",
-                        detalhe_erro=detalhe_erro or "IP não cadastrado no contrato",
-                        ip_verificado=None,
-                        timestamp=datetime.utcnow(),
-                    )
-                    db.add(snap)
-                    statuses.append("OFFLINE" if is_radius_offline else "DESCONHECIDO")
-                    continue
-
-                # ── Executa ping via conexão já aberta ─────────────────────
-                try:
-                    ping_result = FTTHMonitorService._execute_ping_on_ctrl(ctrl, ip)
-                except Exception as e:
-                    logger.warning(f"[Router={router.nome}] Ping para {ip} falhou: {e}")
-                    ping_result = {
-                        "is_reachable": False,
-                        "latencia_ms": None,
-                        "detalhe_erro": f"Erro ping via API: {e}"
-                    }
-
-                is_reachable = ping_result["is_reachable"]
-                latencia_ms = ping_result["latencia_ms"]
-                detalhe_erro = ping_result["detalhe_erro"]
-
-                if is_reachable:
-                    status = "DEGRADADO" if (latencia_ms and latencia_ms > LATENCY_CRITICAL_THRESHOLD) else "ONLINE"
-                else:
-                    status = "OFFLINE"
-
-                snap = FTTHMonitorSnapshot(
-                    contrato_id=c_id,
-                    empresa_id=contrato.empresa_id,
-                    status=status,
-                    is_reachable=is_reachable,
-                    latencia_ms=latencia_ms,
-                    metodo_coleta="MIKROTIK_API",
-                    detalhe_erro=detalhe_erro,
-                    ip_verificado=ip,
-                    timestamp=datetime.utcnow(),
-                )
-                db.add(snap)
-                statuses.append(status)
-
-            db.commit()
-            logger.info(f"[Router={router.nome}] Concluído — {len(statuses)} ONUs verificadas.")
-            return statuses
-
-        except Exception as e:
-            logger.error(f"[Router={router.nome}] Erro na verificação via API: {e}")
-            # Tenta salvar OFFLINE para os contratos não processados
-            processed = len(statuses)
-            remaining = contrato_ids[processed:]
-            for c_id in remaining:
-                contrato = db.query(ServicoContratado).filter_by(id=c_id).first()
-                if contrato:
-                    snap = FTTHMonitorSnapshot(
-                        contrato_id=c_id,
-                        empresa_id=contrato.empresa_id,
-                        status="OFFLINE",
-                        is_reachable=False,
-                        metodo_coleta="MIKROTIK_API",
-                        detalhe_erro=f"Erro conexão API: {e}",
-                        ip_verificado=contrato.assigned_ip,
-                        timestamp=datetime.utcnow(),
-                    )
-                    db.add(snap)
-                statuses.append("OFFLINE")
-            try:
-                db.commit()
-            except Exception:
-                db.rollback()
-            return statuses
-        finally:
-            try:
-                ctrl.close()
-            except Exception:
-                pass
-
-    @staticmethod
-    def _execute_ping_on_ctrl(ctrl, ip: str, count: int = 3) -> Dict[str, Any]:
-        """
-        Executa /ping em uma conexão Mikrotik já estabelecida.
-
-        Diferente de ping_via_mikrotik_api(), este método recebe o
-        MikrotikController já conectado para reutilização da conexão
-        no contexto do _poll_olt_group_via_api().
+        Delegado ao FTTHPollEngine (app/services/ftth_poll_engine.py), que
+        processa os Roteadores em paralelo via asyncio e envia vários /ping
+        simultâneos por Roteador sobre um pequeno pool de sessões RouterOS API.
 
         Returns:
-            dict com: is_reachable (bool), latencia_ms (float|None), detalhe_erro (str|None)
+            dict com os contadores por status, "total", "wall_time_s" e
+            "routers" (tempo gasto em cada Roteador).
         """
-        # Tenta via routeros_api (primário)
-        if ctrl._api is not None:
-            try:
-                resource = ctrl._api.get_resource('ping')
-                results = resource.call(
-                    **{'address': ip, 'count': str(count), 'interval': '0.2'}
-                )
-                return FTTHMonitorService._parse_mikrotik_ping_result(results, ip)
-            except Exception as e:
-                logger.debug(f"_execute_ping_on_ctrl via routeros_api falhou para {ip}: {e}")
-
-        # Fallback: librouteros
-        if ctrl._librouteros_api is not None:
-            try:
-                results = list(ctrl._librouteros_api(
-                    '/ping',
-                    **{'address': ip, 'count': str(count)}
-                ))
-                return FTTHMonitorService._parse_mikrotik_ping_result(results, ip)
-            except Exception as e:
-                logger.debug(f"_execute_ping_on_ctrl via librouteros falhou para {ip}: {e}")
-                raise
-
-        return {
-            "is_reachable": False,
-            "latencia_ms": None,
-            "detalhe_erro": "Nenhuma biblioteca RouterOS disponível"
-        }
+        from app.services.ftth_poll_engine import FTTHPollEngine
+        return FTTHPollEngine().poll_empresa(db, empresa_id)
@@ -0,0 +1,487 @@
+"""
+Motor de Polling FTTH assíncrono
+
+Substitui o modelo "1 thread por Roteador, 1 ping por vez" do poller antigo.
+Para cada Roteador/Mikrotik:
+  - Abre um pequeno pool de sessões RouterOS API (FTTH_SESSIONS_PER_ROUTER).
+  - Em cada sessão, envia vários /ping com `.tag` distintos sem esperar a
+    resposta do anterior (pipelining do protocolo RouterOS), mantendo até
+    FTTH_MAX_INFLIGHT_PER_ROUTER pings em andamento por Roteador.
+  - Mede o tempo total (wall time) gasto com o Roteador.
+
+Os Roteadores são processados em paralelo pelo event loop (asyncio). As
+bibliotecas RouterOS são bloqueantes, então cada sessão é drenada em uma
+thread de um executor dedicado; TCP check, ping ICMP (subprocess) e timeouts
+por Roteador são nativamente assíncronos.
+
+Configurável via variáveis de ambiente:
+  FTTH_SESSIONS_PER_ROUTER      (padrão: 2)   — sessões API abertas por Roteador
+  FTTH_MAX_INFLIGHT_PER_ROUTER  (padrão: 64)  — pings simultâneos por Roteador
+  FTTH_PING_COUNT               (padrão: 3)   — pacotes ICMP por ONU
+  FTTH_ROUTER_TIMEOUT           (padrão: 240s) — tempo máximo por Roteador
+  FTTH_SNAPSHOT_CHUNK           (padrão: 1000) — linhas por INSERT de snapshots
+
+Acesso ao banco é feito em lote: contratos e IPs RADIUS ativos são carregados
+em poucas consultas por empresa e os snapshots são gravados com INSERT
+multi-linha (executemany) em blocos, sem um objeto ORM por ONU.
+"""
+import asyncio
+import logging
+import os
+import platform
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session, load_only
+
+from app.models.models import ServicoContratado, StatusContrato
+from app.models.ftth import FTTHMonitorSnapshot
+from app.models.network import Router
+from app.services.ftth_monitor_service import (
+    FTTHMonitorService,
+    LATENCY_CRITICAL_THRESHOLD,
+    MAX_OLT_WORKERS,
+    MAX_ICMP_WORKERS,
+)
+
+logger = logging.getLogger(__name__)
+
+SESSIONS_PER_ROUTER = int(os.environ.get("FTTH_SESSIONS_PER_ROUTER", "2"))
+MAX_INFLIGHT_PER_ROUTER = int(os.environ.get("FTTH_MAX_INFLIGHT_PER_ROUTER", "64"))
+PING_COUNT = int(os.environ.get("FTTH_PING_COUNT", "3"))
+PING_INTERVAL = os.environ.get("FTTH_PING_INTERVAL", "0.2")
+ROUTER_TIMEOUT = float(os.environ.get("FTTH_ROUTER_TIMEOUT", "240"))
+SNAPSHOT_CHUNK = int(os.environ.get("FTTH_SNAPSHOT_CHUNK", "1000"))
+
+
+class FTTHPollEngine:
+    """Executa o polling de todas as ONUs FTTH de uma empresa usando asyncio."""
+
+    def __init__(
+        self,
+        sessions_per_router: int = SESSIONS_PER_ROUTER,
+        max_inflight_per_router: int = MAX_INFLIGHT_PER_ROUTER,
+        ping_count: int = PING_COUNT,
+        router_timeout: float = ROUTER_TIMEOUT,
+        max_routers: int = MAX_OLT_WORKERS,
+        max_icmp: int = MAX_ICMP_WORKERS,
+    ):
+        self.sessions_per_router = max(1, sessions_per_router)
+        self.max_inflight_per_router = max(self.sessions_per_router, max_inflight_per_router)
+        self.window_per_session = max(1, self.max_inflight_per_router // self.sessions_per_router)
+        self.ping_count = max(1, ping_count)
+        self.router_timeout = router_timeout
+        self.max_routers = max(1, max_routers)
+        self.max_icmp = max(1, max_icmp)
+
+    # =====================================================================
+    # ENTRADA
+    # =====================================================================
+
+    def poll_empresa(self, db: Session, empresa_id: int) -> Dict[str, Any]:
+        """
+        Verifica todas as ONUs FTTH ativas da empresa e grava os snapshots.
+
+        Returns:
+            dict com os contadores por status, "total", "wall_time_s" e
+            "routers" (lista com o tempo gasto em cada Roteador).
+        """
+        inicio = time.monotonic()
+        contratos = db.query(ServicoContratado).options(
+            load_only(
+                ServicoContratado.id,
+                ServicoContratado.empresa_id,
+                ServicoContratado.router_id,
+                ServicoContratado.assigned_ip,
+                ServicoContratado.pppoe_username,
+            )
+        ).filter(
+            ServicoContratado.empresa_id == empresa_id,
+            ServicoContratado.is_active == True,
+            ServicoContratado.status != StatusContrato.CANCELADO,
+        ).filter(
+            (ServicoContratado.onu_serial.isnot(None)) |
+            (ServicoContratado.tipo_conexao == "FIBRA")
+        ).all()
+
+        resumo: Dict[str, Any] = {
+            "ONLINE": 0, "OFFLINE": 0, "DEGRADADO": 0, "DESCONHECIDO": 0,
+            "total": len(contratos), "routers": [], "wall_time_s": 0.0,
+        }
+        if not contratos:
+            return resumo
+
+        routers_por_id: Dict[int, Router] = {
+            r.id: r for r in db.query(Router).filter(
+                Router.empresa_id == empresa_id,
+                Router.is_active == True
+            ).all()
+        }
+
+        # ── IPs dinâmicos (PPPoE) de todos os contratos sem IP fixo ────────
+        try:
+            radius_ips = FTTHMonitorService._load_active_radius_ips(
+                db, empresa_id, [c.pppoe_username for c in contratos if not c.assigned_ip]
+            )
+            radius_erro = None
+        except Exception as e:
+            logger.error(f"Erro ao buscar IPs dinâmicos no RADIUS: {e}")
+            radius_ips, radius_erro = {}, f"Erro no RADIUS: {e}"
+
+        # ── Resolve o IP de cada ONU e agrupa por Roteador ─────────────────
+        por_router: Dict[int, List[Dict[str, Any]]] = {}
+        sem_router: List[Dict[str, Any]] = []
+        resultados: List[Dict[str, Any]] = []
+
+        for c in contratos:
+            ip, detalhe_erro = c.assigned_ip, None
+            if not ip and c.pppoe_username:
+                ip = radius_ips.get(c.pppoe_username)
+                if not ip:
+                    detalhe_erro = radius_erro or FTTHMonitorService.RADIUS_SEM_SESSAO
+            router = routers_por_id.get(c.router_id) if c.router_id else None
+            usa_api = bool(router and router.ip and router.usuario and router.senha)
+            metodo = "MIKROTIK_API" if usa_api else "PING"
+
+            if not ip:
+                resultados.append(self._resultado_sem_ip(c, detalhe_erro, metodo))
+                continue
+
+            alvo = {"contrato_id": c.id, "empresa_id": c.empresa_id, "ip": ip}
+            if usa_api:
+                por_router.setdefault(router.id, []).append(alvo)
+            else:
+                sem_router.append(alvo)
+
+        logger.info(
+            f"[ENGINE empresa={empresa_id}] {len(contratos)} ONUs | "
+            f"{len(por_router)} Roteadores (API) | {len(sem_router)} sem Router (ICMP) | "
+            f"sessões/Router={self.sessions_per_router} in-flight/Router={self.max_inflight_per_router}"
+        )
+
+        resultados.extend(asyncio.run(self._poll_async(routers_por_id, por_router, sem_router, resumo)))
+
+        self._save_snapshots(db, resultados)
+        for r in resultados:
+            status = r["status"] if r["status"] in resumo else "DESCONHECIDO"
+            resumo[status] += 1
+
+        resumo["wall_time_s"] = round(time.monotonic() - inicio, 2)
+        logger.info(
+            f"[ENGINE empresa={empresa_id}] Concluído em {resumo['wall_time_s']}s → "
+            f"Online={resumo['ONLINE']} Offline={resumo['OFFLINE']} "
+            f"Degradado={resumo['DEGRADADO']} Desconhecido={resumo['DESCONHECIDO']}"
+        )
+        return resumo
+
+    # =====================================================================
+    # ORQUESTRAÇÃO ASSÍNCRONA
+    # =====================================================================
+
+    async def _poll_async(
+        self,
+        routers_por_id: Dict[int, Router],
+        por_router: Dict[int, List[Dict[str, Any]]],
+        sem_router: List[Dict[str, Any]],
+        resumo: Dict[str, Any],
+    ) -> List[Dict[str, Any]]:
+        n_routers = min(self.max_routers, len(por_router)) or 1
+        executor = ThreadPoolExecutor(
+            max_workers=n_routers * self.sessions_per_router,
+            thread_name_prefix="ftth_engine",
+        )
+        router_sem = asyncio.Semaphore(n_routers)
+        icmp_sem = asyncio.Semaphore(self.max_icmp)
+
+        async def _router_task(router_id: int, alvos: List[Dict[str, Any]]):
+            async with router_sem:
+                return await self._poll_router(routers_por_id[router_id], alvos, executor, resumo)
+
+        async def _icmp_task(alvo: Dict[str, Any]):
+            async with icmp_sem:
+                return [await self._ping_icmp(alvo)]
+
+        try:
+            tasks = [_router_task(r_id, alvos) for r_id, alvos in por_router.items()]
+            tasks += [_icmp_task(alvo) for alvo in sem_router]
+            grupos = await asyncio.gather(*tasks)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return [r for grupo in grupos for r in grupo]
+
+    async def _poll_router(
+        self,
+        router: Router,
+        alvos: List[Dict[str, Any]],
+        executor: ThreadPoolExecutor,
+        resumo: Dict[str, Any],
+    ) -> List[Dict[str, Any]]:
+        """
+        Pinga todas as ONUs de um Roteador através de um pool de sessões API.
+
+        Nunca levanta exceção: ONUs sem resposta (erro de conexão, timeout do
+        Roteador) são devolvidas como OFFLINE com o motivo em detalhe_erro.
+        """
+        host = router.ip
+        port = router.porta or 8728
+        inicio = time.monotonic()
+        resultados: Dict[int, Dict[str, Any]] = {}
+        erro: Optional[str] = None
+        cancelado = threading.Event()
+        sessoes: List[Any] = []
+
+        try:
+            if not await self._tcp_check(host, port):
+                erro = f"Mikrotik {host}:{port} inacessível (VPN offline ou host inativo)"
+            else:
+                loop = asyncio.get_running_loop()
+                n_sessoes = min(self.sessions_per_router, len(alvos))
+                conectadas = await asyncio.gather(
+                    *[loop.run_in_executor(executor, self._open_session, router) for _ in range(n_sessoes)],
+                    return_exceptions=True,
+                )
+                sessoes = [s for s in conectadas if not isinstance(s, BaseException)]
+                if not sessoes:
+                    erro = f"Erro conexão API: {conectadas[0]}"
+                else:
+                    pendentes = deque(alvos)
+                    await asyncio.wait_for(
+                        asyncio.gather(*[
+                            loop.run_in_executor(
+                                executor, self._drain_session, ctrl, pendentes, resultados, cancelado
+                            )
+                            for ctrl in sessoes
+                        ]),
+                        timeout=self.router_timeout,
+                    )
+        except asyncio.TimeoutError:
+            erro = f"Timeout de {self.router_timeout:.0f}s no Roteador {router.nome}"
+            cancelado.set()
+        except Exception as e:
+            logger.error(f"[Router={router.nome}] Erro na verificação via API: {e}")
+            erro = f"Erro conexão API: {e}"
+            cancelado.set()
+        finally:
+            for ctrl in sessoes:
+                try:
+                    ctrl.close()
+                except Exception:
+                    pass
+
+        saida: List[Dict[str, Any]] = []
+        for alvo in alvos:
+            ping = resultados.get(alvo["contrato_id"]) or {
+                "is_reachable": False,
+                "latencia_ms": None,
+                "detalhe_erro": erro or "Ping não executado",
+            }
+            saida.append(self._resultado_ping(alvo, ping, "MIKROTIK_API"))
+
+        wall_time = round(time.monotonic() - inicio, 2)
+        resumo["routers"].append({
+            "router_id": router.id,
+            "router_nome": router.nome,
+            "onus": len(alvos),
+            "sessoes": len(sessoes),
+            "wall_time_s": wall_time,
+            "erro": erro,
+        })
+        logger.info(
+            f"[Router={router.nome}] {len(alvos)} ONUs em {wall_time}s "
+            f"({len(sessoes)} sessões){' — ' + erro if erro else ''}"
+        )
+        return saida
+
+    @staticmethod
+    async def _tcp_check(host: str, port: int, timeout: float = 3.0) -> bool:
+        """Equivalente assíncrono de FTTHMonitorService.check_mikrotik_reachable."""
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=timeout)
+            writer.close()
+            return True
+        except (asyncio.TimeoutError, OSError) as e:
+            logger.debug(f"Mikrotik {host}:{port} inacessível: {e}")
+            return False
+
+    # =====================================================================
+    # SESSÕES ROUTEROS (executadas no executor)
+    # =====================================================================
+
+    @staticmethod
+    def _open_session(router: Router):
+        from app.mikrotik.controller import MikrotikController
+        from app.core.security import decrypt_password
+
+        try:
+            password = decrypt_password(router.senha) if router.senha else ""
+        except Exception as e:
+            logger.warning(f"Falha ao descriptografar senha do roteador, usando texto plano: {e}")
+            password = router.senha
+
+        ctrl = MikrotikController(
+            host=router.ip,
+            username=router.usuario,
+            password=password,
+            port=router.porta or 8728,
+            api_encoding=router.api_encoding or "utf-8",
+        )
+        ctrl.connect()
+        return ctrl
+
+    def _drain_session(
+        self,
+        ctrl,
+        pendentes: deque,
+        resultados: Dict[int, Dict[str, Any]],
+        cancelado: threading.Event,
+    ) -> None:
+        """
+        Consome a fila compartilhada do Roteador mantendo até `window_per_session`
+        pings em andamento nesta sessão.
+
+        Com routeros_api cada /ping é enviado com um `.tag` próprio (call_async)
+        e as respostas são lidas em ordem de envio; enquanto a mais antiga não
+        termina, as demais continuam sendo processadas pelo Roteador.
+        Com librouteros (fallback) não há pipelining e os pings são sequenciais.
+        """
+        args = {"count": str(self.ping_count), "interval": PING_INTERVAL}
+
+        if ctrl._api is None:
+            while not cancelado.is_set():
+                try:
+                    alvo = pendentes.popleft()
+                except IndexError:
+                    return
+                try:
+                    rows = list(ctrl._librouteros_api('/ping', address=alvo["ip"], count=args["count"]))
+                    resultados[alvo["contrato_id"]] = FTTHMonitorService._parse_mikrotik_ping_result(rows, alvo["ip"])
+                except Exception as e:
+                    resultados[alvo["contrato_id"]] = self._erro_ping(e)
+            return
+
+        root = ctrl._api.get_resource('/')
+        janela: deque = deque()
+        while not cancelado.is_set():
+            while len(janela) < self.window_per_session:
+                try:
+                    alvo = pendentes.popleft()
+                except IndexError:
+                    break
+                try:
+                    janela.append((alvo, root.call_async('ping', dict(args, address=alvo["ip"]))))
+                except Exception as e:
+                    resultados[alvo["contrato_id"]] = self._erro_ping(e)
+            if not janela:
+                return
+            alvo, promessa = janela.popleft()
+            try:
+                resultados[alvo["contrato_id"]] = FTTHMonitorService._parse_mikrotik_ping_result(
+                    list(promessa.get()), alvo["ip"]
+                )
+            except Exception as e:
+                resultados[alvo["contrato_id"]] = self._erro_ping(e)
+
+    @staticmethod
+    def _erro_ping(e: Exception) -> Dict[str, Any]:
+        return {"is_reachable": False, "latencia_ms": None, "detalhe_erro": f"Erro ping via API: {e}"}
+
+    # =====================================================================
+    # ICMP DIRETO (sem Roteador configurado)
+    # =====================================================================
+
+    async def _ping_icmp(self, alvo: Dict[str, Any], timeout: float = 2.0) -> Dict[str, Any]:
+        """Versão assíncrona de FTTHMonitorService.ping_host (subprocess não bloqueante)."""
+        ip = alvo["ip"]
+        system = platform.system().lower()
+        if system == "windows":
+            cmd = ["ping", "-n", str(self.ping_count), "-w", str(int(timeout * 1000)), ip]
+        else:
+            cmd = ["ping", "-c", str(self.ping_count), "-W", str(int(timeout)), "-q", ip]
+
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=timeout * self.ping_count + 2)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                ping = {"is_reachable": False, "latencia_ms": None, "detalhe_erro": "Timeout ao executar ping"}
+            else:
+                if proc.returncode == 0:
+                    latencia = FTTHMonitorService._parse_ping_latency(stdout.decode(errors="ignore"), system)
+                    ping = {"is_reachable": True, "latencia_ms": latencia, "detalhe_erro": None}
+                else:
+                    ping = {
+                        "is_reachable": False,
+                        "latencia_ms": None,
+                        "detalhe_erro": f"Host não responde (exit code {proc.returncode})",
+                    }
+        except FileNotFoundError:
+            ping = {"is_reachable": False, "latencia_ms": None, "detalhe_erro": "Comando ping não encontrado no sistema"}
+        except Exception as e:
+            logger.error(f"Erro ao fazer ping para {ip}: {e}")
+            ping = {"is_reachable": False, "latencia_ms": None, "detalhe_erro": str(e)}
+
+        return self._resultado_ping(alvo, ping, "PING")
+
+    # =====================================================================
+    # RESULTADOS / PERSISTÊNCIA
+    # =====================================================================
+
+    @staticmethod
+    def _resultado_ping(alvo: Dict[str, Any], ping: Dict[str, Any], metodo: str) -> Dict[str, Any]:
+        latencia_ms = ping["latencia_ms"]
+        if ping["is_reachable"]:
+            status = "DEGRADADO" if (latencia_ms and latencia_ms > LATENCY_CRITICAL_THRESHOLD) else "ONLINE"
+        else:
+            status = "OFFLINE"
+        return {
+            "contrato_id": alvo["contrato_id"],
+            "empresa_id": alvo["empresa_id"],
+            "status": status,
+            "is_reachable": ping["is_reachable"],
+            "latencia_ms": latencia_ms,
+            "metodo_coleta": metodo,
+            "detalhe_erro": ping["detalhe_erro"],
+            "ip_verificado": alvo["ip"],
+        }
+
+    @staticmethod
+    def _resultado_sem_ip(contrato: ServicoContratado, detalhe_erro: Optional[str], metodo: str) -> Dict[str, Any]:
+        is_radius_offline = detalhe_erro == FTTHMonitorService.RADIUS_SEM_SESSAO
+        return {
+            "contrato_id": contrato.id,
+            "empresa_id": contrato.empresa_id,
+            "status": "OFFLINE" if is_radius_offline else "DESCONHECIDO",
+            "is_reachable": False if is_radius_offline else None,
+            "latencia_ms": None,
+            "metodo_coleta": metodo,
+            "detalhe_erro": detalhe_erro or "IP não cadastrado no contrato",
+            "ip_verificado": None,
+        }
+
+    @staticmethod
+    def _save_snapshots(db: Session, resultados: List[Dict[str, Any]]) -> None:
+        """
+        Grava os snapshots com INSERT multi-linha e atualiza
+        ftth_onu_current_status (upsert), um commit por bloco de SNAPSHOT_CHUNK.
+        """
+        agora = datetime.utcnow()
+        rows = [dict(r, timestamp=agora) for r in resultados]
+        for i in range(0, len(rows), SNAPSHOT_CHUNK):
+            try:
+                db.execute(insert(FTTHMonitorSnapshot), rows[i:i + SNAPSHOT_CHUNK])
+                FTTHMonitorService._upsert_current_status(db, rows[i:i + SNAPSHOT_CHUNK])
+                db.commit()
+            except Exception as e:
+                logger.error(f"[ENGINE] Erro ao gravar snapshots ({i}-{i + SNAPSHOT_CHUNK}): {e}")
+                db.rollback()
+                raise
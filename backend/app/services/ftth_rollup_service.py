@@ -0,0 +1,328 @@
+"""
+Compactação e retenção do histórico FTTH
+
+O poller grava um FTTHMonitorSnapshot por ONU a cada 5 minutos. Este serviço:
+  - Agrega os snapshots brutos em buckets HORA (disponibilidade, latência
+    min/avg/max, potência rx/tx min/avg/max) por contrato.
+  - Agrega os buckets HORA em buckets DIA (médias ponderadas pelas amostras).
+  - Apaga snapshots brutos e agregados horários mais antigos que a janela
+    de retenção — nunca antes de estarem cobertos pelo nível seguinte.
+  - Escolhe a resolução adequada para o histórico de uma ONU conforme o
+    período solicitado.
+
+Configurável via variáveis de ambiente:
+  FTTH_RAW_RETENTION_DAYS     (padrão: 7)   — dias de snapshots brutos
+  FTTH_HOURLY_RETENTION_DAYS  (padrão: 90)  — dias de agregados por hora
+  FTTH_DAILY_RETENTION_DAYS   (padrão: 730) — dias de agregados por dia
+  FTTH_HISTORY_RAW_MAX_HOURS  (padrão: 48)  — acima disso o histórico usa agregados
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import case, func, insert
+from sqlalchemy.orm import Session
+
+from app.models.ftth import FTTHMonitorSnapshot, FTTHMonitorRollup
+
+logger = logging.getLogger(__name__)
+
+RAW_RETENTION_DAYS = int(os.environ.get("FTTH_RAW_RETENTION_DAYS", "7"))
+HOURLY_RETENTION_DAYS = int(os.environ.get("FTTH_HOURLY_RETENTION_DAYS", "90"))
+DAILY_RETENTION_DAYS = int(os.environ.get("FTTH_DAILY_RETENTION_DAYS", "730"))
+HISTORY_RAW_MAX_HOURS = int(os.environ.get("FTTH_HISTORY_RAW_MAX_HOURS", "48"))
+
+RESOLUCAO_HORA = "HORA"
+RESOLUCAO_DIA = "DIA"
+
+# Tamanho dos lotes de DELETE (evita transações gigantes e locks longos)
+PRUNE_BATCH_SIZE = 5000
+
+
+class FTTHRollupService:
+
+    # =====================================================================
+    # COMPACTAÇÃO
+    # =====================================================================
+
+    @staticmethod
+    def compact(db: Session, now: Optional[datetime] = None) -> Dict[str, int]:
+        """
+        Executa um ciclo completo: agrega horas e dias fechados e aplica a retenção.
+
+        Idempotente: cada bucket é processado uma única vez (a partir do último
+        bucket já existente) e pode ser reexecutado a qualquer momento.
+        """
+        now = now or datetime.utcnow()
+        resumo = {
+            "horas": FTTHRollupService.rollup_hours(db, now),
+            "dias": FTTHRollupService.rollup_days(db, now),
+        }
+        resumo.update(FTTHRollupService.prune(db, now))
+        return resumo
+
+    @staticmethod
+    def rollup_hours(db: Session, now: datetime) -> int:
+        """Agrega os snapshots brutos de cada hora fechada ainda não compactada."""
+        fim = now.replace(minute=0, second=0, microsecond=0)
+        ultimo = FTTHRollupService._last_bucket(db, RESOLUCAO_HORA)
+        if ultimo:
+            hora = ultimo + timedelta(hours=1)
+        else:
+            primeiro = db.query(func.min(FTTHMonitorSnapshot.timestamp)).scalar()
+            if not primeiro:
+                return 0
+            hora = primeiro.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+        S = FTTHMonitorSnapshot
+        disponivel = case((S.status.in_(["ONLINE", "DEGRADADO"]), 1), else_=0)
+        processadas = 0
+        while hora < fim:
+            rows = db.query(
+                S.contrato_id,
+                func.max(S.empresa_id),
+                func.count(S.id),
+                func.sum(disponivel),
+                func.count(S.latencia_ms),
+                func.count(S.rx_power),
+                func.min(S.latencia_ms), func.avg(S.latencia_ms), func.max(S.latencia_ms),
+                func.min(S.rx_power), func.avg(S.rx_power), func.max(S.rx_power),
+                func.min(S.tx_power), func.avg(S.tx_power), func.max(S.tx_power),
+            ).filter(
+                S.timestamp >= hora,
+                S.timestamp < hora + timedelta(hours=1),
+            ).group_by(S.contrato_id).all()
+
+            FTTHRollupService._replace_bucket(db, RESOLUCAO_HORA, hora, [
+                FTTHRollupService._row_to_rollup(RESOLUCAO_HORA, hora, *r) for r in rows
+            ])
+            processadas += 1
+            hora += timedelta(hours=1)
+
+        if processadas:
+            logger.info(f"[ROLLUP] {processadas} hora(s) compactada(s) até {fim.isoformat()}")
+        return processadas
+
+    @staticmethod
+    def rollup_days(db: Session, now: datetime) -> int:
+        """Agrega os buckets HORA de cada dia fechado ainda não compactado."""
+        fim = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        ultimo = FTTHRollupService._last_bucket(db, RESOLUCAO_DIA)
+        if ultimo:
+            dia = ultimo + timedelta(days=1)
+        else:
+            primeiro = db.query(func.min(FTTHMonitorRollup.bucket_inicio)).filter(
+                FTTHMonitorRollup.resolucao == RESOLUCAO_HORA
+            ).scalar()
+            if not primeiro:
+                return 0
+            dia = primeiro.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        R = FTTHMonitorRollup
+        processados = 0
+        while dia < fim:
+            rows = db.query(
+                R.contrato_id,
+                func.max(R.empresa_id),
+                func.sum(R.amostras),
+                func.sum(R.amostras_disponivel),
+                func.sum(R.amostras_latencia),
+                func.sum(R.amostras_sinal),
+                func.min(R.latencia_min), func.sum(R.latencia_avg * R.amostras_latencia), func.max(R.latencia_max),
+                func.min(R.rx_power_min), func.sum(R.rx_power_avg * R.amostras_sinal), func.max(R.rx_power_max),
+                func.min(R.tx_power_min), func.sum(R.tx_power_avg * R.amostras_sinal), func.max(R.tx_power_max),
+            ).filter(
+                R.resolucao == RESOLUCAO_HORA,
+                R.bucket_inicio >= dia,
+                R.bucket_inicio < dia + timedelta(days=1),
+            ).group_by(R.contrato_id).all()
+
+            rollups = []
+            for (contrato_id, empresa_id, amostras, disponivel, n_lat, n_sinal,
+                 lat_min, lat_soma, lat_max, rx_min, rx_soma, rx_max, tx_min, tx_soma, tx_max) in rows:
+                rollups.append(FTTHRollupService._row_to_rollup(
+                    RESOLUCAO_DIA, dia, contrato_id, empresa_id, amostras, disponivel, n_lat, n_sinal,
+                    lat_min, FTTHRollupService._div(lat_soma, n_lat), lat_max,
+                    rx_min, FTTHRollupService._div(rx_soma, n_sinal), rx_max,
+                    tx_min, FTTHRollupService._div(tx_soma, n_sinal), tx_max,
+                ))
+            FTTHRollupService._replace_bucket(db, RESOLUCAO_DIA, dia, rollups)
+            processados += 1
+            dia += timedelta(days=1)
+
+        if processados:
+            logger.info(f"[ROLLUP] {processados} dia(s) compactado(s) até {fim.date().isoformat()}")
+        return processados
+
+    # =====================================================================
+    # RETENÇÃO
+    # =====================================================================
+
+    @staticmethod
+    def prune(db: Session, now: datetime) -> Dict[str, int]:
+        """
+        Remove dados fora da janela de retenção.
+
+        Snapshots brutos só são removidos até a última hora já compactada e
+        agregados horários até o último dia compactado.
+        """
+        removidos = {"snapshots_removidos": 0, "horas_removidas": 0, "dias_removidos": 0}
+
+        ultima_hora = FTTHRollupService._last_bucket(db, RESOLUCAO_HORA)
+        if ultima_hora:
+            corte = min(now - timedelta(days=RAW_RETENTION_DAYS), ultima_hora + timedelta(hours=1))
+            removidos["snapshots_removidos"] = FTTHRollupService._delete_in_batches(
+                db, FTTHMonitorSnapshot, FTTHMonitorSnapshot.timestamp < corte
+            )
+
+        ultimo_dia = FTTHRollupService._last_bucket(db, RESOLUCAO_DIA)
+        if ultimo_dia:
+            corte = min(now - timedelta(days=HOURLY_RETENTION_DAYS), ultimo_dia + timedelta(days=1))
+            removidos["horas_removidas"] = FTTHRollupService._delete_in_batches(
+                db, FTTHMonitorRollup,
+                (FTTHMonitorRollup.resolucao == RESOLUCAO_HORA) & (FTTHMonitorRollup.bucket_inicio < corte)
+            )
+
+        removidos["dias_removidos"] = FTTHRollupService._delete_in_batches(
+            db, FTTHMonitorRollup,
+            (FTTHMonitorRollup.resolucao == RESOLUCAO_DIA) &
+            (FTTHMonitorRollup.bucket_inicio < now - timedelta(days=DAILY_RETENTION_DAYS))
+        )
+
+        if any(removidos.values()):
+            logger.info(f"[ROLLUP] Retenção aplicada: {removidos}")
+        return removidos
+
+    @staticmethod
+    def _delete_in_batches(db: Session, model, condition) -> int:
+        total = 0
+        while True:
+            ids = [i for (i,) in db.query(model.id).filter(condition).limit(PRUNE_BATCH_SIZE).all()]
+            if not ids:
+                return total
+            db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+            total += len(ids)
+
+    # =====================================================================
+    # LEITURA DO HISTÓRICO
+    # =====================================================================
+
+    @staticmethod
+    def pick_resolution(hours: int) -> str:
+        """Escolhe RAW, HORA ou DIA de acordo com o período e as janelas de retenção."""
+        if hours <= min(HISTORY_RAW_MAX_HOURS, RAW_RETENTION_DAYS * 24):
+            return "RAW"
+        if hours <= min(31 * 24, HOURLY_RETENTION_DAYS * 24):
+            return RESOLUCAO_HORA
+        return RESOLUCAO_DIA
+
+    @staticmethod
+    def get_history(
+        db: Session,
+        contrato_id: int,
+        empresa_id: int,
+        resolucao: str,
+        since: datetime,
+    ) -> List[Dict[str, Any]]:
+        """
+        Retorna os agregados de uma ONU no formato de FTTHMonitorSnapshotOut
+        (status derivado da disponibilidade, valores médios) mais os campos
+        específicos do agregado (min/max, disponibilidade, amostras).
+        """
+        from app.services.ftth_monitor_service import LATENCY_CRITICAL_THRESHOLD
+
+        rollups = db.query(FTTHMonitorRollup).filter(
+            FTTHMonitorRollup.contrato_id == contrato_id,
+            FTTHMonitorRollup.empresa_id == empresa_id,
+            FTTHMonitorRollup.resolucao == resolucao,
+            FTTHMonitorRollup.bucket_inicio >= since.replace(minute=0, second=0, microsecond=0),
+        ).order_by(FTTHMonitorRollup.bucket_inicio.asc()).all()
+
+        historico = []
+        for r in rollups:
+            disp = r.disponibilidade_percentual or 0.0
+            if disp == 0:
+                status = "OFFLINE"
+            elif disp < 100 or (r.latencia_avg and r.latencia_avg > LATENCY_CRITICAL_THRESHOLD):
+                status = "DEGRADADO"
+            else:
+                status = "ONLINE"
+            historico.append({
+                "id": r.id,
+                "contrato_id": r.contrato_id,
+                "empresa_id": r.empresa_id,
+                "status": status,
+                "rx_power": r.rx_power_avg,
+                "tx_power": r.tx_power_avg,
+                "latencia_ms": r.latencia_avg,
+                "is_reachable": disp > 0,
+                "metodo_coleta": f"ROLLUP_{resolucao}",
+                "timestamp": r.bucket_inicio,
+                "resolucao": resolucao,
+                "amostras": r.amostras,
+                "disponibilidade_percentual": r.disponibilidade_percentual,
+                "latencia_min_ms": r.latencia_min,
+                "latencia_max_ms": r.latencia_max,
+                "rx_power_min": r.rx_power_min,
+                "rx_power_max": r.rx_power_max,
+            })
+        return historico
+
+    # =====================================================================
+    # AUXILIARES
+    # =====================================================================
+
+    @staticmethod
+    def _last_bucket(db: Session, resolucao: str) -> Optional[datetime]:
+        return db.query(func.max(FTTHMonitorRollup.bucket_inicio)).filter(
+            FTTHMonitorRollup.resolucao == resolucao
+        ).scalar()
+
+    @staticmethod
+    def _replace_bucket(db: Session, resolucao: str, bucket: datetime, rollups: List[Dict[str, Any]]) -> None:
+        """Grava (com INSERT multi-linha) os agregados de um bucket, substituindo os existentes."""
+        db.query(FTTHMonitorRollup).filter(
+            FTTHMonitorRollup.resolucao == resolucao,
+            FTTHMonitorRollup.bucket_inicio == bucket,
+        ).delete(synchronize_session=False)
+        if rollups:
+            db.execute(insert(FTTHMonitorRollup), rollups)
+        db.commit()
+
+    @staticmethod
+    def _row_to_rollup(
+        resolucao, bucket, contrato_id, empresa_id, amostras, disponivel, n_lat, n_sinal,
+        lat_min, lat_avg, lat_max, rx_min, rx_avg, rx_max, tx_min, tx_avg, tx_max,
+    ) -> Dict[str, Any]:
+        amostras = int(amostras or 0)
+        disponivel = int(disponivel or 0)
+        return {
+            "contrato_id": contrato_id,
+            "empresa_id": empresa_id,
+            "resolucao": resolucao,
+            "bucket_inicio": bucket,
+            "amostras": amostras,
+            "amostras_disponivel": disponivel,
+            "amostras_latencia": int(n_lat or 0),
+            "amostras_sinal": int(n_sinal or 0),
+            "disponibilidade_percentual": round(disponivel / amostras * 100, 2) if amostras else None,
+            "latencia_min": lat_min,
+            "latencia_avg": FTTHRollupService._round(lat_avg),
+            "latencia_max": lat_max,
+            "rx_power_min": rx_min,
+            "rx_power_avg": FTTHRollupService._round(rx_avg),
+            "rx_power_max": rx_max,
+            "tx_power_min": tx_min,
+            "tx_power_avg": FTTHRollupService._round(tx_avg),
+            "tx_power_max": tx_max,
+        }
+
+    @staticmethod
+    def _div(soma, n) -> Optional[float]:
+        return float(soma) / float(n) if soma is not None and n else None
+
+    @staticmethod
+    def _round(value) -> Optional[float]:
+        return round(float(value), 2) if value is not None else None
@@ -1,5 +1,12 @@
 import logging
 import os
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Set, Tuple
+
 from sqlalchemy.orm import Session
 from app.models.models import ServicoContratado, Router, StatusContrato, MetodoAutenticacao
 from app.mikrotik.controller import MikrotikController
@@ -9,8 +16,258 @@ from app.services.radius_sync_service import RadiusSyncService
 
 logger = logging.getLogger(__name__)
 
-# Cache global de Roteadores offline/com erro para evitar timeouts sucessivos
-FAILED_ROUTERS = set()
+# ── Execução em lote (rotina noturna de bloqueio) ─────────────────────────────
+# Roteadores processados em paralelo; cada um usa UMA sessão RouterOS para todos
+# os seus contratos.
+ROUTER_ACTION_WORKERS = int(os.environ.get("ROUTER_ACTION_WORKERS", "8"))
+# Tempo máximo (s) de processamento de um Roteador; as ações restantes falham.
+# Ao atingir o limite a sessão RouterOS é fechada, interrompendo o comando em curso.
+ROUTER_ACTION_TIMEOUT = int(os.environ.get("ROUTER_ACTION_TIMEOUT", "600"))
+# Timeout (s) do socket da API RouterOS no lote (conexão e cada comando)
+ROUTER_API_TIMEOUT = float(os.environ.get("ROUTER_API_TIMEOUT", "15"))
+
+ACAO_BLOQUEIO = "BLOCK"
+ACAO_DESBLOQUEIO = "UNBLOCK"
+ACAO_CANCELAMENTO = "CANCEL"
+
+
+# =====================================================================
+# AUXILIARES (compartilhados entre o fluxo individual e o lote)
+# =====================================================================
+
+def _router_password(router_db: Router) -> str:
+    try:
+        return decrypt_password(router_db.senha) if router_db.senha else ""
+    except Exception:
+        return router_db.senha
+
+
+def _router_controller(router_db: Router) -> MikrotikController:
+    return MikrotikController(
+        host=router_db.ip,
+        username=router_db.usuario,
+        password=_router_password(router_db),
+        port=router_db.porta or 8728,
+        api_encoding=router_db.api_encoding or "utf-8"
+    )
+
+
+def _comment_key(contrato: ServicoContratado) -> str:
+    # Usamos "contrato_id-nome" como chave única na RB para evitar
+    # colisão entre múltiplos contratos do mesmo cliente
+    cliente_nome = contrato.cliente.nome_razao_social if contrato.cliente else "Cliente"
+    return f"{contrato.id}-{cliente_nome}"
+
+
+# Comentários que o sistema grava na pg_corte: _comment_key ou o padrão do controller
+_MANAGED_COMMENT_RE = re.compile(r'^(\d+-|Bloqueio Contrato \d+$)')
+
+
+def _is_managed_comment(comment: Optional[str]) -> bool:
+    return bool(comment and _MANAGED_COMMENT_RE.match(comment))
+
+
+def _mk_username(contrato: ServicoContratado) -> str:
+    # Se for RADIUS, o username no Mikrotik é o username do Radius
+    if contrato.metodo_autenticacao == MetodoAutenticacao.RADIUS and contrato.cliente and contrato.cliente.radius_user:
+        return contrato.cliente.radius_user.username
+    return f"contrato_{contrato.id}"
+
+
+def _radius_block(contrato: ServicoContratado) -> Tuple[bool, Any]:
+    """Suspende o usuário no FreeRadius. Retorna (sucesso, radius_user)."""
+    if contrato.metodo_autenticacao != MetodoAutenticacao.RADIUS:
+        return True, None
+    if not (contrato.cliente and contrato.cliente.radius_user):
+        return True, None
+    radius_user = contrato.cliente.radius_user
+    try:
+        if RadiusSessionLocal:
+            with RadiusSessionLocal() as radius_db:
+                sync = RadiusSyncService(radius_db)
+                sync.disable_user(radius_user.username)
+                logger.info(f"Usuário Radius '{radius_user.username}' suspenso no FreeRadius.")
+    except Exception as e:
+        logger.error(f"Erro ao suspender usuário Radius '{radius_user.username}': {e}. Abortando bloqueio.")
+        return False, None
+    return True, radius_user
+
+
+def _radius_username(contrato: ServicoContratado) -> Optional[str]:
+    """Usuário do FreeRadius a suspender junto com o contrato (None se não se aplica)."""
+    if contrato.metodo_autenticacao != MetodoAutenticacao.RADIUS:
+        return None
+    if not (contrato.cliente and contrato.cliente.radius_user):
+        return None
+    return contrato.cliente.radius_user.username
+
+
+def _radius_set_enabled(username: str, enabled: bool) -> bool:
+    """Habilita/suspende o usuário no FreeRadius sem tocar na sessão principal (seguro em workers)."""
+    try:
+        if RadiusSessionLocal:
+            with RadiusSessionLocal() as radius_db:
+                sync = RadiusSyncService(radius_db)
+                if enabled:
+                    sync.enable_user(username)
+                else:
+                    sync.disable_user(username)
+                logger.info(f"Usuário Radius '{username}' {'reativado' if enabled else 'suspenso'} no FreeRadius.")
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao {'reativar' if enabled else 'suspender'} usuário Radius '{username}': {e}")
+        return False
+
+
+def _radius_unblock(db: Session, contrato: ServicoContratado, raise_on_error: bool = False) -> bool:
+    """Reativa o usuário no FreeRadius (e marca radius_user como ativo)."""
+    if contrato.metodo_autenticacao != MetodoAutenticacao.RADIUS:
+        return True
+    if not (contrato.cliente and contrato.cliente.radius_user):
+        return True
+    radius_user = contrato.cliente.radius_user
+    try:
+        if RadiusSessionLocal:
+            with RadiusSessionLocal() as radius_db:
+                sync = RadiusSyncService(radius_db)
+                sync.enable_user(radius_user.username)
+                logger.info(f"Usuário Radius '{radius_user.username}' reativado no FreeRadius.")
+
+        radius_user.is_active = True
+        db.add(radius_user)
+    except Exception as e:
+        logger.error(f"Erro ao reativar usuário Radius '{radius_user.username}': {e}")
+        if raise_on_error:
+            raise RuntimeError(f"Erro ao reativar no Radius: {str(e)}")
+        return False
+    return True
+
+
+def _block_job(contrato: ServicoContratado) -> Dict[str, Any]:
+    """Dados (sem objetos ORM) necessários para bloquear o contrato no Roteador."""
+    notice_url = contrato.empresa.suspension_url if contrato.empresa and contrato.empresa.suspension_url else os.getenv("NOTICE_PAGE_URL", f"http://isp.brazcom.com.br/aviso/{contrato.empresa_id}")
+    return {
+        "contrato_id": contrato.id,
+        "metodo_autenticacao": contrato.metodo_autenticacao,
+        "assigned_ip": contrato.assigned_ip,
+        "comment": _comment_key(contrato),
+        "mk_username": _mk_username(contrato),
+        "notice_url": notice_url,
+    }
+
+
+def _unblock_job(db: Session, contrato: ServicoContratado) -> Dict[str, Any]:
+    """Dados (sem objetos ORM) necessários para desbloquear o contrato no Roteador."""
+    # Buscar nome da interface para IP_MAC
+    interface_name = ""
+    if contrato.interface_id:
+        from app.models.network import RouterInterface
+        ifce = db.query(RouterInterface).filter(RouterInterface.id == contrato.interface_id).first()
+        if ifce:
+            interface_name = ifce.nome
+
+    # Banda original (Simple Queue e DHCP) com base no serviço
+    profile_name = None
+    max_limit = None
+    if contrato.servico_id:
+        from app.crud import crud_servico
+        servico = crud_servico.get_servico(db, servico_id=contrato.servico_id, empresa_id=contrato.empresa_id)
+        if servico:
+            max_limit = getattr(servico, 'max_limit', None)
+            if getattr(servico, 'ppp_profile_id', None):
+                from app.models.network import PPPProfile
+                ppp_profile = db.query(PPPProfile).filter(PPPProfile.id == servico.ppp_profile_id).first()
+                if ppp_profile:
+                    profile_name = ppp_profile.nome
+
+    return {
+        "contrato_id": contrato.id,
+        "metodo_autenticacao": contrato.metodo_autenticacao,
+        "assigned_ip": contrato.assigned_ip,
+        "mac_address": contrato.mac_address,
+        "interface": interface_name,
+        "comment": _comment_key(contrato),
+        "mk_username": _mk_username(contrato),
+        "sync": bool(contrato.servico_id) and bool(max_limit or contrato.metodo_autenticacao == 'IP_MAC'),
+        "profile": profile_name,
+        "max_limit": max_limit,
+    }
+
+
+def _prepare_router_for_block(mk: MikrotikController, notice_url: Optional[str]) -> None:
+    # Configurar regra de redirecionamento se necessário
+    if notice_url:
+        mk.setup_suspension_nat_rule(notice_url)
+        mk.setup_suspension_firewall_rules()
+
+
+def _run_block_job(mk: MikrotikController, job: Dict[str, Any], address_list_synced: bool = False) -> None:
+    mk.suspend_client_connection(
+        contrato_id=job["contrato_id"],
+        metodo_autenticacao=job["metodo_autenticacao"],
+        assigned_ip=job["assigned_ip"],
+        comment=job["comment"],
+        address_list_synced=address_list_synced
+    )
+
+    if job["metodo_autenticacao"] in [MetodoAutenticacao.PPPOE, MetodoAutenticacao.RADIUS]:
+        mk.disconnect_pppoe_active(job["mk_username"])
+
+
+def _run_unblock_job(mk: MikrotikController, job: Dict[str, Any], address_list_synced: bool = False) -> bool:
+    # Desbloquear primário (remover da pg_corte e regras estritas)
+    success = mk.unsuspend_client_connection(
+        contrato_id=job["contrato_id"],
+        metodo_autenticacao=job["metodo_autenticacao"],
+        assigned_ip=job["assigned_ip"],
+        mac_address=job["mac_address"],
+        interface=job["interface"],
+        comment=job["comment"],
+        address_list_synced=address_list_synced
+    )
+
+    # Se for RADIUS ou PPPOE, tenta derrubar a sessão ativa para forçar re-conexão com status novo
+    if job["metodo_autenticacao"] in [MetodoAutenticacao.PPPOE, MetodoAutenticacao.RADIUS]:
+        mk.disconnect_pppoe_active(job["mk_username"])
+
+    # Força a atualização da velocidade
+    if success and job["sync"]:
+        mk.sync_client_connection(
+            contrato_id=job["contrato_id"],
+            metodo_autenticacao=job["metodo_autenticacao"],
+            assigned_ip=job["assigned_ip"],
+            mac_address=job["mac_address"],
+            interface=job["interface"],
+            comment=job["comment"],
+            profile=job["profile"],
+            max_limit=job["max_limit"]
+        )
+    return success
+
+
+def _mark_blocked(db: Session, contrato: ServicoContratado, radius_user=None) -> None:
+    contrato.status = StatusContrato.SUSPENSO
+    db.add(contrato)
+
+    if radius_user:
+        radius_user.is_active = False
+        db.add(radius_user)
+
+
+def _mark_unblocked(db: Session, contrato: ServicoContratado) -> None:
+    contrato.status = StatusContrato.ATIVO
+    db.add(contrato)
+
+
+def _mark_cancelled(db: Session, contrato: ServicoContratado) -> None:
+    contrato.status = StatusContrato.CANCELADO
+    contrato.is_active = False
+    db.add(contrato)
+
+
+# =====================================================================
+# AÇÕES INDIVIDUAIS
+# =====================================================================
 
 def process_unblock_if_needed(db: Session, contrato_id: int, raise_on_error: bool = False):
     """
@@ -21,112 +278,23 @@ def process_unblock_if_needed(db: Session, contrato_id: int, raise_on_error: boo
     if not contrato:
         logger.warning(f"Contrato {contrato_id} não encontrado para desbloqueio")
         return False
-    
+
     # Se o contrato estiver suspenso ou pendente, vamos garantir que ele seja ativado
     if contrato.status not in [StatusContrato.SUSPENSO, StatusContrato.PENDENTE_INSTALACAO]:
         return False
-    
-    old_status = contrato.status
 
     # 1. Desbloqueio no RADIUS (se aplicável)
-    if contrato.metodo_autenticacao == MetodoAutenticacao.RADIUS:
-        if contrato.cliente and contrato.cliente.radius_user:
-            radius_user = contrato.cliente.radius_user
-            try:
-                if RadiusSessionLocal:
-                    with RadiusSessionLocal() as radius_db:
-                        sync = RadiusSyncService(radius_db)
-                        sync.enable_user(radius_user.username)
-                        logger.info(f"Usuário Radius '{radius_user.username}' reativado no FreeRadius.")
-                
-                radius_user.is_active = True
-                db.add(radius_user)
-            except Exception as e:
-                logger.error(f"Erro ao reativar usuário Radius '{radius_user.username}': {e}")
-                if raise_on_error:
-                    raise RuntimeError(f"Erro ao reativar no Radius: {str(e)}")
-                return False
-    
+    if not _radius_unblock(db, contrato, raise_on_error):
+        return False
+
     # Se tiver router configurado, realiza o desbloqueio técnico
     if contrato.router_id:
         router_db = db.query(Router).filter(Router.id == contrato.router_id).first()
         if router_db:
             try:
-                # Tentar descriptografar a senha
-                try:
-                    password = decrypt_password(router_db.senha) if router_db.senha else ""
-                except Exception:
-                    password = router_db.senha
-                
-                mk = MikrotikController(
-                    host=router_db.ip,
-                    username=router_db.usuario,
-                    password=password,
-                    port=router_db.porta or 8728
-                )
-                
-                # Buscar nome da interface para IP_MAC
-                interface_name = ""
-                if contrato.interface_id:
-                    from app.models.network import RouterInterface
-                    ifce = db.query(RouterInterface).filter(RouterInterface.id == contrato.interface_id).first()
-                    if ifce:
-                        interface_name = ifce.nome
-                
-                # Buscar nome do cliente para o comentário
-                # Usamos "contrato_id-nome" como chave única na RB para evitar
-                # colisão entre múltiplos contratos do mesmo cliente
-                cliente_nome = "Cliente"
-                if contrato.cliente:
-                    cliente_nome = contrato.cliente.nome_razao_social
-                comment_key = f"{contrato.id}-{cliente_nome}"
- 
-                # Desbloquear primário (remover da pg_corte e regras estritas)
-                # Se for RADIUS, o username no Mikrotik é o username do Radius
-                mk_username = f"contrato_{contrato.id}"
-                if contrato.metodo_autenticacao == MetodoAutenticacao.RADIUS and contrato.cliente.radius_user:
-                    mk_username = contrato.cliente.radius_user.username
- 
-                success = mk.unsuspend_client_connection(
-                    contrato_id=contrato.id,
-                    metodo_autenticacao=contrato.metodo_autenticacao,
-                    assigned_ip=contrato.assigned_ip,
-                    mac_address=contrato.mac_address,
-                    interface=interface_name,
-                    comment=comment_key
-                )
-                
-                # Se for RADIUS ou PPPOE, tenta derrubar a sessão ativa para forçar re-conexão com status novo
-                if contrato.metodo_autenticacao in [MetodoAutenticacao.PPPOE, MetodoAutenticacao.RADIUS]:
-                    mk.disconnect_pppoe_active(mk_username)
- 
-                # Restaurar a banda original (Simple Queue e DHCP) com base no serviço
-                if success and contrato.servico_id:
-                    profile_name = None
-                    max_limit = None
-                    from app.crud import crud_servico
-                    servico = crud_servico.get_servico(db, servico_id=contrato.servico_id, empresa_id=contrato.empresa_id)
-                    if servico:
-                        max_limit = getattr(servico, 'max_limit', None)
-                        if getattr(servico, 'ppp_profile_id', None):
-                            from app.models.network import PPPProfile
-                            ppp_profile = db.query(PPPProfile).filter(PPPProfile.id == servico.ppp_profile_id).first()
-                            if ppp_profile:
-                                profile_name = ppp_profile.nome
-                    
-                    # Força a atualização da velocidade
-                    if max_limit or contrato.metodo_autenticacao == 'IP_MAC':
-                        mk.sync_client_connection(
-                            contrato_id=contrato.id,
-                            metodo_autenticacao=contrato.metodo_autenticacao,
-                            assigned_ip=contrato.assigned_ip,
-                            mac_address=contrato.mac_address,
-                            interface=interface_name,
-                            comment=comment_key,
-                            profile=profile_name,
-                            max_limit=max_limit
-                        )
-                
+                job = _unblock_job(db, contrato)
+                mk = _router_controller(router_db)
+                success = _run_unblock_job(mk, job)
                 mk.close()
                 if success:
                     logger.info(f"Contrato {contrato_id} desbloqueado com sucesso no router {router_db.ip}")
@@ -142,42 +310,33 @@ def process_unblock_if_needed(db: Session, contrato_id: int, raise_on_error: boo
                 return False
 
     # 3. Atualizar o banco de dados APENAS se as etapas acima foram executadas com absoluto sucesso
-    contrato.status = StatusContrato.ATIVO
-    db.add(contrato)
+    _mark_unblocked(db, contrato)
     return True
 
-def process_block_if_needed(db: Session, contrato_id: int):
+def process_block_if_needed(db: Session, contrato_id: int, failed_routers: Optional[Set[int]] = None):
     """
     Bloqueia o contrato no router/RADIUS e muda status para SUSPENSO apenas se bem-sucedido.
+
+    failed_routers: conjunto (da execução corrente) de Roteadores que já falharam;
+    contratos nesses Roteadores são ignorados e novas falhas são registradas nele.
     """
     contrato = db.query(ServicoContratado).filter(ServicoContratado.id == contrato_id).first()
     if not contrato:
         return False
-    
+
     if contrato.status == StatusContrato.SUSPENSO:
         return False
 
     # Se o roteador deste contrato já falhou nesta execução, não tenta novamente para poupar tempo
-    if contrato.router_id and contrato.router_id in FAILED_ROUTERS:
+    if failed_routers is not None and contrato.router_id and contrato.router_id in failed_routers:
         logger.warning(f"Ignorando tentativa de bloqueio do contrato {contrato_id}: Roteador {contrato.router_id} está offline.")
         return False
 
-    radius_user = None
-
     # 1. Bloqueio no RADIUS (se aplicável)
-    if contrato.metodo_autenticacao == MetodoAutenticacao.RADIUS:
-        if contrato.cliente and contrato.cliente.radius_user:
-            radius_user = contrato.cliente.radius_user
-            try:
-                if RadiusSessionLocal:
-                    with RadiusSessionLocal() as radius_db:
-                        sync = RadiusSyncService(radius_db)
-                        sync.disable_user(radius_user.username)
-                        logger.info(f"Usuário Radius '{radius_user.username}' suspenso no FreeRadius.")
-            except Exception as e:
-                logger.error(f"Erro ao suspender usuário Radius '{radius_user.username}': {e}. Abortando bloqueio.")
-                return False
-    
+    ok, radius_user = _radius_block(contrato)
+    if not ok:
+        return False
+
     # 2. Bloqueio no MikroTik RouterOS (se aplicável)
     if contrato.router_id:
         if os.getenv("SKIP_ROUTER_CONNECTION") == "true":
@@ -186,70 +345,33 @@ def process_block_if_needed(db: Session, contrato_id: int):
             router_db = db.query(Router).filter(Router.id == contrato.router_id).first()
             if router_db:
                 try:
-                    try:
-                        password = decrypt_password(router_db.senha) if router_db.senha else ""
-                    except Exception:
-                        password = router_db.senha
-                    
-                    mk = MikrotikController(
-                        host=router_db.ip,
-                        username=router_db.usuario,
-                        password=password,
-                        port=router_db.porta or 8728
-                    )
-                    
-                    # Configurar regra de redirecionamento se necessário
-                    notice_url = contrato.empresa.suspension_url if contrato.empresa and contrato.empresa.suspension_url else os.getenv("NOTICE_PAGE_URL", f"http://isp.brazcom.com.br/aviso/{contrato.empresa_id}")
-                    
-                    if notice_url:
-                        mk.setup_suspension_nat_rule(notice_url)
-                        mk.setup_suspension_firewall_rules()
-                    
-                    cliente_nome = contrato.cliente.nome_razao_social if contrato.cliente else "Cliente"
-                    comment_key = f"{contrato.id}-{cliente_nome}"
-
-                    mk_username = f"contrato_{contrato.id}"
-                    if contrato.metodo_autenticacao == MetodoAutenticacao.RADIUS and contrato.cliente and contrato.cliente.radius_user:
-                        mk_username = contrato.cliente.radius_user.username
-
-                    mk.suspend_client_connection(
-                        contrato_id=contrato.id,
-                        metodo_autenticacao=contrato.metodo_autenticacao,
-                        assigned_ip=contrato.assigned_ip,
-                        comment=comment_key
-                    )
-
-                    if contrato.metodo_autenticacao in [MetodoAutenticacao.PPPOE, MetodoAutenticacao.RADIUS]:
-                        mk.disconnect_pppoe_active(mk_username)
-
+                    job = _block_job(contrato)
+                    mk = _router_controller(router_db)
+                    _prepare_router_for_block(mk, job["notice_url"])
+                    _run_block_job(mk, job)
                     mk.close()
                     logger.info(f"Contrato {contrato_id} bloqueado com sucesso no router {router_db.ip}")
                 except Exception as e:
                     logger.error(f"Erro ao bloquear contrato {contrato_id} no router {router_db.ip}: {e}")
                     # Marca este roteador como falho para não tentar mais conexões com ele nesta execução
-                    FAILED_ROUTERS.add(contrato.router_id)
+                    if failed_routers is not None:
+                        failed_routers.add(contrato.router_id)
                     return False
-                
+
     # 3. Atualizar o banco de dados APENAS se as etapas acima foram executadas com absoluto sucesso
-    contrato.status = StatusContrato.SUSPENSO
-    db.add(contrato)
-    
-    if radius_user:
-        radius_user.is_active = False
-        db.add(radius_user)
-        
+    _mark_blocked(db, contrato, radius_user)
     return True
 
 
 def process_cancel_if_needed(db: Session, contrato_id: int):
     """
-    Cancela o contrato no router/RADIUS (desativando o usuário/conexão) 
+    Cancela o contrato no router/RADIUS (desativando o usuário/conexão)
     e muda status para CANCELADO e is_active = False.
     """
     contrato = db.query(ServicoContratado).filter(ServicoContratado.id == contrato_id).first()
     if not contrato:
         return False
-    
+
     if contrato.status == StatusContrato.CANCELADO:
         return False
 
@@ -257,9 +379,426 @@ def process_cancel_if_needed(db: Session, contrato_id: int):
     if contrato.status != StatusContrato.SUSPENSO:
         # Tentar suspender primeiro no equipamento
         process_block_if_needed(db, contrato_id)
-        
+
     # Independente do sucesso do equipamento (pois pode já ter sido removido), marcamos como cancelado
-    contrato.status = StatusContrato.CANCELADO
-    contrato.is_active = False
-    db.add(contrato)
+    _mark_cancelled(db, contrato)
     return True
+
+
+# =====================================================================
+# EXECUÇÃO EM LOTE POR ROTEADOR
+# =====================================================================
+
+def run_router_actions(
+    db: Session,
+    actions: List[Tuple[str, int]],
+    max_workers: Optional[int] = None,
+    router_timeout: Optional[int] = None,
+    reconcile_router_ids: Optional[List[int]] = None,
+) -> Dict[int, bool]:
+    """
+    Executa bloqueios, desbloqueios e cancelamentos em lote.
+
+    actions: lista de (ACAO_BLOQUEIO | ACAO_DESBLOQUEIO | ACAO_CANCELAMENTO, contrato_id).
+    reconcile_router_ids: Roteadores cuja Address List 'pg_corte' deve ser
+    reconciliada por completo ao final (ver _suspension_list_spec).
+
+    As etapas de banco rodam nesta thread; os comandos RouterOS são agrupados
+    por router_id e cada Roteador é processado por um worker com uma única
+    sessão reaproveitada para todos os seus contratos. Um Roteador que falha
+    (conexão ou bloqueio) é ignorado pelo resto da execução.
+
+    Nos bloqueios com Roteador, o usuário RADIUS é suspenso pelo worker logo
+    antes do comando no Roteador (já conectado) e reativado se esse comando
+    falhar; bloqueios não executados (Roteador inacessível, falha anterior ou
+    tempo limite) não mexem no RADIUS.
+
+    Mesma semântica das funções process_*_if_needed; retorna {contrato_id: sucesso}.
+    O commit fica a cargo do chamador.
+    """
+    max_workers = max_workers or ROUTER_ACTION_WORKERS
+    router_timeout = router_timeout or ROUTER_ACTION_TIMEOUT
+    skip_router = os.getenv("SKIP_ROUTER_CONNECTION") == "true"
+
+    resultados: Dict[int, bool] = {}
+    # contrato_id -> (acao, contrato, radius_user)
+    pendentes: Dict[int, Tuple[str, ServicoContratado, Any]] = {}
+    jobs_por_router: Dict[int, List[Tuple[str, Dict[str, Any]]]] = defaultdict(list)
+    routers: Dict[int, Router] = {}
+
+    def _router(router_id):
+        if router_id not in routers:
+            routers[router_id] = db.query(Router).filter(Router.id == router_id).first()
+        return routers[router_id]
+
+    # 1. Validação, RADIUS e montagem dos jobs (thread principal — Session não é thread-safe)
+    for acao, contrato_id in actions:
+        contrato = db.query(ServicoContratado).filter(ServicoContratado.id == contrato_id).first()
+        if not contrato:
+            resultados[contrato_id] = False
+            continue
+
+        if acao == ACAO_DESBLOQUEIO:
+            if contrato.status not in [StatusContrato.SUSPENSO, StatusContrato.PENDENTE_INSTALACAO]:
+                resultados[contrato_id] = False
+                continue
+            if not _radius_unblock(db, contrato):
+                resultados[contrato_id] = False
+                continue
+            router_db = _router(contrato.router_id) if contrato.router_id else None
+            if router_db:
+                try:
+                    jobs_por_router[router_db.id].append((ACAO_DESBLOQUEIO, _unblock_job(db, contrato)))
+                    pendentes[contrato_id] = (acao, contrato, None)
+                except Exception as e:
+                    logger.error(f"Erro ao preparar desbloqueio do contrato {contrato_id}: {e}")
+                    resultados[contrato_id] = False
+            else:
+                _mark_unblocked(db, contrato)
+                resultados[contrato_id] = True
+            continue
+
+        # Bloqueio / cancelamento
+        if acao == ACAO_CANCELAMENTO and contrato.status == StatusContrato.CANCELADO:
+            resultados[contrato_id] = False
+            continue
+        if acao == ACAO_BLOQUEIO and contrato.status == StatusContrato.SUSPENSO:
+            resultados[contrato_id] = False
+            continue
+
+        bloqueado = False
+        radius_user = None
+        if contrato.status != StatusContrato.SUSPENSO:
+            router_db = _router(contrato.router_id) if contrato.router_id and not skip_router else None
+            if router_db:
+                # RADIUS suspenso pelo worker, só se o comando no Roteador for executado
+                job = _block_job(contrato)
+                job["radius_username"] = _radius_username(contrato)
+                jobs_por_router[router_db.id].append((ACAO_BLOQUEIO, job))
+                pendentes[contrato_id] = (acao, contrato, contrato.cliente.radius_user if job["radius_username"] else None)
+                continue
+            ok, radius_user = _radius_block(contrato)
+            bloqueado = ok
+        resultados[contrato_id] = _finish_action(db, acao, contrato, radius_user, bloqueado)
+
+    # Reconciliação completa da pg_corte: estado esperado calculado aqui a partir do banco
+    reconcile_specs: Dict[int, Dict[int, Dict[str, Any]]] = {}
+    for router_id in reconcile_router_ids or []:
+        if skip_router or not _router(router_id):
+            continue
+        reconcile_specs[router_id] = _suspension_list_spec(db, router_id)
+        jobs_por_router.setdefault(router_id, [])
+
+    # 2. Comandos RouterOS, um worker por Roteador
+    if jobs_por_router:
+        router_results = _execute_router_groups(
+            {rid: routers[rid] for rid in jobs_por_router}, jobs_por_router, max_workers, router_timeout,
+            reconcile_specs
+        )
+        # 3. Persistência do resultado (thread principal)
+        for contrato_id, (acao, contrato, radius_user) in pendentes.items():
+            resultados[contrato_id] = _finish_action(
+                db, acao, contrato, radius_user, router_results.get(contrato_id, False)
+            )
+
+    return resultados
+
+
+def _suspension_list_spec(db: Session, router_id: int) -> Dict[int, Dict[str, Any]]:
+    """
+    Contratos do Roteador que devem permanecer na 'pg_corte' (SUSPENSO/CANCELADO),
+    exceto IPs hoje atribuídos a contratos ativos.
+    """
+    contratos = db.query(ServicoContratado).filter(
+        ServicoContratado.router_id == router_id,
+        ServicoContratado.status.in_([StatusContrato.SUSPENSO, StatusContrato.CANCELADO])
+    ).all()
+    ips_ativos = {
+        ip for (ip,) in db.query(ServicoContratado.assigned_ip).filter(
+            ServicoContratado.router_id == router_id,
+            ServicoContratado.status == StatusContrato.ATIVO,
+            ServicoContratado.assigned_ip.isnot(None)
+        ).all()
+    }
+    spec = {}
+    for contrato in contratos:
+        if contrato.assigned_ip and contrato.assigned_ip in ips_ativos:
+            continue
+        spec[contrato.id] = {
+            "contrato_id": contrato.id,
+            "metodo_autenticacao": contrato.metodo_autenticacao,
+            "assigned_ip": contrato.assigned_ip,
+            "comment": _comment_key(contrato),
+            "mk_username": _mk_username(contrato),
+        }
+    return spec
+
+
+def _finish_action(db: Session, acao: str, contrato: ServicoContratado, radius_user, router_ok: bool) -> bool:
+    if acao == ACAO_DESBLOQUEIO:
+        if router_ok:
+            _mark_unblocked(db, contrato)
+        return router_ok
+    if router_ok:
+        _mark_blocked(db, contrato, radius_user)
+    if acao == ACAO_CANCELAMENTO:
+        if not router_ok and radius_user is not None:
+            # Cancelado mesmo sem o Roteador: o acesso via RADIUS não pode continuar
+            if _radius_set_enabled(radius_user.username, False):
+                radius_user.is_active = False
+                db.add(radius_user)
+        # Independente do sucesso do equipamento, marcamos como cancelado
+        _mark_cancelled(db, contrato)
+        return True
+    return router_ok
+
+
+def _execute_router_groups(
+    routers: Dict[int, Router],
+    jobs_por_router: Dict[int, List[Tuple[str, Dict[str, Any]]]],
+    max_workers: int,
+    router_timeout: int,
+    reconcile_specs: Optional[Dict[int, Dict[int, Dict[str, Any]]]] = None,
+) -> Dict[int, bool]:
+    """Processa os grupos em paralelo e retorna {contrato_id: sucesso no Roteador}."""
+    reconcile_specs = reconcile_specs or {}
+    resultados: Dict[int, bool] = {}
+    conexoes = {
+        rid: {
+            "id": r.id,
+            "nome": r.nome,
+            "ip": r.ip,
+            "usuario": r.usuario,
+            "senha": _router_password(r),
+            "porta": r.porta or 8728,
+            "api_encoding": r.api_encoding or "utf-8",
+        }
+        for rid, r in routers.items()
+    }
+
+    # routeros_api aplica o encoding num estado global do módulo: Roteadores com
+    # encodings diferentes não são processados ao mesmo tempo.
+    por_encoding: Dict[str, List[int]] = defaultdict(list)
+    for rid, info in conexoes.items():
+        por_encoding[info["api_encoding"]].append(rid)
+
+    for encoding, router_ids in por_encoding.items():
+        executor = ThreadPoolExecutor(max_workers=min(max_workers, len(router_ids)))
+        futures = {
+            executor.submit(
+                _run_router_group, conexoes[rid], jobs_por_router[rid], router_timeout, reconcile_specs.get(rid)
+            ): rid
+            for rid in router_ids
+        }
+        done, not_done = wait(futures, timeout=router_timeout + 60)
+        for future in done:
+            try:
+                resultados.update(future.result())
+            except Exception as e:
+                rid = futures[future]
+                logger.error(f"[ROUTER {conexoes[rid]['nome']}] Falha inesperada no lote: {e}")
+        for future in not_done:
+            rid = futures[future]
+            logger.error(f"[ROUTER {conexoes[rid]['nome']}] Tempo limite de {router_timeout}s excedido; ações não confirmadas.")
+        executor.shutdown(wait=not not_done)
+
+    return resultados
+
+
+def _run_router_group(
+    info: Dict[str, Any],
+    jobs: List[Tuple[str, Dict[str, Any]]],
+    router_timeout: int,
+    reconcile_spec: Optional[Dict[int, Dict[str, Any]]] = None,
+) -> Dict[int, bool]:
+    """Executa (em um worker) todos os jobs de um Roteador sobre uma única sessão."""
+    inicio = time.monotonic()
+    deadline = inicio + router_timeout
+    resultados = {job["contrato_id"]: False for _, job in jobs}
+
+    mk = MikrotikController(
+        host=info["ip"],
+        username=info["usuario"],
+        password=info["senha"],
+        port=info["porta"],
+        api_encoding=info["api_encoding"],
+        timeout=min(ROUTER_API_TIMEOUT, router_timeout)
+    )
+    # Ao fim do prazo a sessão é fechada: um comando travado falha em vez de segurar o worker
+    watchdog = threading.Timer(router_timeout, _abort_router_session, args=(mk, info))
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        mk.connect()
+    except Exception as e:
+        watchdog.cancel()
+        logger.error(f"[ROUTER {info['nome']}] Roteador {info['ip']} inacessível: {e}. {len(jobs)} ação(ões) ignorada(s).")
+        return resultados
+
+    bloqueio_falhou = False
+    try:
+        bloqueios = [job for acao, job in jobs if acao == ACAO_BLOQUEIO]
+        if bloqueios:
+            _prepare_router_for_block(mk, bloqueios[0]["notice_url"])
+
+        # IPs (IP_MAC) entram/saem da pg_corte em um único sync depois do loop,
+        # só para os jobs que chegaram até lá, em vez de um get da lista por contrato
+        bloqueios_lista: List[Dict[str, Any]] = []
+        desbloqueios_lista: List[Dict[str, Any]] = []
+
+        for acao, job in jobs:
+            contrato_id = job["contrato_id"]
+            if time.monotonic() > deadline:
+                logger.error(f"[ROUTER {info['nome']}] Tempo limite de {router_timeout}s excedido; ações restantes ignoradas.")
+                break
+            if acao == ACAO_BLOQUEIO:
+                # Roteador já falhou ao bloquear nesta execução: não tenta novamente
+                if bloqueio_falhou:
+                    continue
+                radius_username = job.get("radius_username")
+                if radius_username and not _radius_set_enabled(radius_username, False):
+                    logger.error(f"Bloqueio do contrato {contrato_id} abortado: falha ao suspender no RADIUS.")
+                    continue
+                if _uses_address_list(job):
+                    bloqueios_lista.append(job)
+                    continue
+                try:
+                    _run_block_job(mk, job)
+                    resultados[contrato_id] = True
+                    logger.info(f"Contrato {contrato_id} bloqueado com sucesso no router {info['ip']}")
+                except Exception as e:
+                    logger.error(f"Erro ao bloquear contrato {contrato_id} no router {info['ip']}: {e}")
+                    bloqueio_falhou = True
+                    # Contrato continua ATIVO no banco: desfaz a suspensão no RADIUS
+                    if radius_username:
+                        _radius_set_enabled(radius_username, True)
+            else:
+                try:
+                    if _uses_address_list(job):
+                        if _run_unblock_job(mk, job, True):
+                            desbloqueios_lista.append(job)
+                        else:
+                            logger.warning(f"Comando de desbloqueio enviado mas o router retornou falha para o contrato {contrato_id}")
+                        continue
+                    resultados[contrato_id] = _run_unblock_job(mk, job)
+                    if resultados[contrato_id]:
+                        logger.info(f"Contrato {contrato_id} desbloqueado com sucesso no router {info['ip']}")
+                    else:
+                        logger.warning(f"Comando de desbloqueio enviado mas o router retornou falha para o contrato {contrato_id}")
+                except Exception as e:
+                    logger.error(f"Erro ao desbloquear contrato {contrato_id} no router: {e}")
+
+        if bloqueios_lista or desbloqueios_lista:
+            _flush_suspension_list(mk, info, bloqueios_lista, desbloqueios_lista, resultados)
+
+        if reconcile_spec is not None and time.monotonic() <= deadline:
+            _reconcile_suspension_list(mk, info, reconcile_spec, jobs, resultados)
+    finally:
+        watchdog.cancel()
+        mk.close()
+
+    logger.info(
+        f"[ROUTER {info['nome']}] {sum(resultados.values())}/{len(jobs)} ações concluídas "
+        f"em {time.monotonic() - inicio:.1f}s"
+    )
+    return resultados
+
+
+def _flush_suspension_list(
+    mk: MikrotikController,
+    info: Dict[str, Any],
+    bloqueios: List[Dict[str, Any]],
+    desbloqueios: List[Dict[str, Any]],
+    resultados: Dict[int, bool],
+) -> None:
+    """
+    Aplica na 'pg_corte', em um único sync, os IPs dos bloqueios e desbloqueios IP_MAC
+    que passaram pelas demais etapas. Só conta como sucesso o contrato cujo IP foi de
+    fato adicionado/removido; bloqueio que não entrou na lista tem o RADIUS reativado.
+    """
+    ips_bloqueio = {job["assigned_ip"]: job["comment"] for job in bloqueios}
+    try:
+        sync = mk.sync_address_list(
+            'pg_corte', set(ips_bloqueio), comments=ips_bloqueio,
+            remove_extra=False, absent_set={job["assigned_ip"] for job in desbloqueios}
+        )
+        falhas = set(sync['failed'])
+    except Exception as e:
+        logger.error(f"[ROUTER {info['nome']}] Falha ao sincronizar a pg_corte em lote: {e}")
+        falhas = set(ips_bloqueio) | {job["assigned_ip"] for job in desbloqueios}
+
+    for job in bloqueios:
+        contrato_id = job["contrato_id"]
+        try:
+            if job["assigned_ip"] in falhas:
+                raise RuntimeError(f"IP {job['assigned_ip']} não foi adicionado à pg_corte")
+            _run_block_job(mk, job, True)
+            resultados[contrato_id] = True
+            logger.info(f"Contrato {contrato_id} bloqueado com sucesso no router {info['ip']}")
+        except Exception as e:
+            logger.error(f"Erro ao bloquear contrato {contrato_id} no router {info['ip']}: {e}")
+            if job["assigned_ip"] not in falhas:
+                # O IP já está na pg_corte: o bloqueio vale mesmo sem derrubar as conexões
+                resultados[contrato_id] = True
+            elif job.get("radius_username"):
+                _radius_set_enabled(job["radius_username"], True)
+
+    for job in desbloqueios:
+        contrato_id = job["contrato_id"]
+        if job["assigned_ip"] in falhas:
+            logger.error(f"Erro ao desbloquear contrato {contrato_id}: IP {job['assigned_ip']} continua na pg_corte")
+        else:
+            resultados[contrato_id] = True
+            logger.info(f"Contrato {contrato_id} desbloqueado com sucesso no router {info['ip']}")
+
+
+def _abort_router_session(mk: MikrotikController, info: Dict[str, Any]) -> None:
+    logger.error(f"[ROUTER {info['nome']}] Tempo limite excedido; encerrando a sessão RouterOS.")
+    mk.close()
+
+
+def _uses_address_list(job: Dict[str, Any]) -> bool:
+    return job["metodo_autenticacao"] == MetodoAutenticacao.IP_MAC and bool(job["assigned_ip"])
+
+
+def _reconcile_suspension_list(
+    mk: MikrotikController,
+    info: Dict[str, Any],
+    spec: Dict[int, Dict[str, Any]],
+    jobs: List[Tuple[str, Dict[str, Any]]],
+    resultados: Dict[int, bool],
+) -> None:
+    """
+    Deixa a 'pg_corte' exatamente igual ao esperado: IPs fixos (IP_MAC) e IPs das
+    sessões PPPoE ativas dos contratos bloqueados, já considerando as ações desta execução.
+    """
+    esperados = dict(spec)
+    for acao, job in jobs:
+        if not resultados.get(job["contrato_id"]):
+            continue
+        if acao == ACAO_BLOQUEIO:
+            esperados[job["contrato_id"]] = job
+        else:
+            esperados.pop(job["contrato_id"], None)
+
+    desejado: Dict[str, str] = {}
+    usuarios_ppp = {}
+    for job in esperados.values():
+        if job["metodo_autenticacao"] in [MetodoAutenticacao.PPPOE, MetodoAutenticacao.RADIUS]:
+            usuarios_ppp[job["mk_username"]] = job["comment"]
+        elif job["assigned_ip"]:
+            desejado[job["assigned_ip"]] = job["comment"]
+
+    try:
+        if usuarios_ppp:
+            for sessao in mk._api.get_resource('ppp/active').get():
+                nome = sessao.get('name')
+                if nome in usuarios_ppp and sessao.get('address'):
+                    desejado[sessao['address']] = usuarios_ppp[nome]
+        # Entradas sem o comentário do sistema foram criadas à mão pelo operador e são mantidas
+        mk.sync_address_list(
+            'pg_corte', set(desejado), comments=desejado, remove_extra=True,
+            removable=lambda entrada: _is_managed_comment(entrada.get('comment'))
+        )
+    except Exception as e:
+        logger.error(f"[ROUTER {info['nome']}] Falha ao reconciliar a pg_corte: {e}")
@@ -0,0 +1,69 @@
+"""
+Cliente assíncrono da API de pagamentos do Mercado Pago
+
+Substitui o mercadopago.SDK (síncrono) nas rotas async: as chamadas usam um
+httpx.AsyncClient compartilhado (pool de conexões) e não bloqueiam o event
+loop. O retorno tem o mesmo formato do SDK: {"status": <HTTP>, "response": <json>}.
+"""
+import asyncio
+import os
+import uuid
+from typing import Any, Dict, Optional
+
+import httpx
+
+
+MP_API_URL = os.environ.get("MP_API_URL", "https://api.mercadopago.com")
+MP_HTTP_TIMEOUT = float(os.environ.get("MP_HTTP_TIMEOUT", "30"))
+
+_client: Optional[httpx.AsyncClient] = None
+_client_loop = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    # As conexões pertencem ao event loop em que foram abertas
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=MP_API_URL,
+            timeout=MP_HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        )
+        _client_loop = loop
+    return _client
+
+
+def _headers(access_token: str, idempotency_key: Optional[str] = None) -> Dict[str, str]:
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
+    if idempotency_key:
+        headers["X-Idempotency-Key"] = idempotency_key
+    return headers
+
+
+def _result(resp: httpx.Response) -> Dict[str, Any]:
+    try:
+        body = resp.json()
+    except ValueError:
+        body = {"message": resp.text}
+    return {"status": resp.status_code, "response": body}
+
+
+async def create_payment(access_token: str, payment_data: Dict[str, Any],
+                         idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+    """POST /v1/payments (equivalente a sdk.payment().create)."""
+    resp = await _get_client().post(
+        "/v1/payments",
+        json=payment_data,
+        headers=_headers(access_token, idempotency_key or str(uuid.uuid4())),
+    )
+    return _result(resp)
+
+
+async def get_payment(access_token: str, payment_id: str) -> Dict[str, Any]:
+    """GET /v1/payments/{id} (equivalente a sdk.payment().get)."""
+    resp = await _get_client().get(f"/v1/payments/{payment_id}", headers=_headers(access_token))
+    return _result(resp)
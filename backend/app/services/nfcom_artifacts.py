@@ -0,0 +1,117 @@
+"""
+Armazenamento em disco dos artefatos de NFComs autorizadas (XML e DANFE)
+
+Cada nota autorizada tem um diretório por chave de acesso e os arquivos são
+nomeados pelo hash do XML gravado (xml_gerado):
+
+    NFCOM_ARTIFACTS_DIR/<UF>/<chave_acesso>/<hash>.xml
+    NFCOM_ARTIFACTS_DIR/<UF>/<chave_acesso>/<hash>.pdf
+
+O XML é gravado na autorização e o DANFE na primeira vez em que é pedido;
+depois disso downloads, ZIPs e emails usam os arquivos sem renderizar o PDF
+de novo. Se o XML da nota mudar, o hash muda e os arquivos antigos deixam de
+ser usados; edição, exclusão e eventos de cancelamento chamam invalidate
+para remover o diretório da chave. Notas pendentes ou canceladas não são
+armazenadas (o conteúdo é gerado a cada pedido, como antes).
+
+O diretório não deve ficar dentro de UPLOAD_DIR, que é servido publicamente
+em /files.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Callable, Optional
+
+NFCOM_ARTIFACTS_DIR = os.environ.get("NFCOM_ARTIFACTS_DIR", "storage/nfcom")
+
+def _chave_dir(chave_acesso: str) -> Path:
+    return Path(NFCOM_ARTIFACTS_DIR) / chave_acesso[:2] / chave_acesso
+
+
+def content_hash(xml: str) -> str:
+    return hashlib.sha256(xml.encode('utf-8')).hexdigest()[:32]
+
+
+def is_storable(nfcom) -> bool:
+    """Só notas autorizadas, não canceladas e com XML gravado vão para o disco."""
+    chave = getattr(nfcom, 'chave_acesso', None) or ''
+    if len(chave) != 44 or not chave.isdigit():
+        return False
+    if not getattr(nfcom, 'protocolo_autorizacao', None) or not getattr(nfcom, 'xml_gerado', None):
+        return False
+    return getattr(nfcom, 'status', None) != 'cancelada'
+
+
+def _artifact_path(nfcom, ext: str) -> Path:
+    return _chave_dir(nfcom.chave_acesso) / f"{content_hash(nfcom.xml_gerado)}.{ext}"
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def store_xml(nfcom) -> Optional[Path]:
+    """Grava o XML autorizado da nota (idempotente). Retorna o caminho ou None."""
+    if not is_storable(nfcom):
+        return None
+    path = _artifact_path(nfcom, 'xml')
+    if not path.exists():
+        _write_atomic(path, nfcom.xml_gerado.encode('utf-8'))
+    return path
+
+
+def xml_path(nfcom) -> Optional[Path]:
+    """Caminho do XML autorizado armazenado (gravando-o se ainda não existir)."""
+    try:
+        return store_xml(nfcom)
+    except OSError as e:
+        print(f"WARN: falha ao gravar XML da NFCom {getattr(nfcom, 'id', None)} no armazenamento: {e}")
+        return None
+
+
+def existing_danfe_path(nfcom) -> Optional[Path]:
+    """Caminho do DANFE se ele já estiver armazenado (sem renderizar)."""
+    if not is_storable(nfcom):
+        return None
+    path = _artifact_path(nfcom, 'pdf')
+    return path if path.exists() else None
+
+
+def danfe_path(nfcom, render: Callable) -> Optional[Path]:
+    """Caminho do DANFE armazenado, renderizando com `render(nfcom)` na primeira vez.
+
+    Retorna None para notas que não são armazenadas; nesse caso quem chama
+    deve gerar o PDF diretamente.
+    """
+    if not is_storable(nfcom):
+        return None
+    path = _artifact_path(nfcom, 'pdf')
+    if path.exists():
+        return path
+    data = render(nfcom).getvalue()
+    try:
+        _write_atomic(path, data)
+    except OSError as e:
+        print(f"WARN: falha ao gravar DANFE da NFCom {getattr(nfcom, 'id', None)} no armazenamento: {e}")
+        return None
+    return path
+
+
+def invalidate(chave_acesso: Optional[str]) -> None:
+    """Remove os artefatos da chave (edição, exclusão ou evento de cancelamento)."""
+    if not chave_acesso or len(chave_acesso) < 2:
+        return
+    shutil.rmtree(_chave_dir(chave_acesso), ignore_errors=True)
@@ -0,0 +1,119 @@
+"""
+Caches de processo para emissão de NFCom
+
+- Schemas XSD compilados, por caminho + mtime do arquivo. Cada thread tem
+  sua própria cópia, pois o XMLSchema do lxml guarda o error_log no objeto.
+- Material de assinatura (chave privada e certificado extraídos do PFX),
+  por empresa + certificado (caminho, mtime) + senha. Substituir o arquivo
+  muda o mtime e invalida a entrada; uploads e alterações de senha chamam
+  invalidate_certificate para liberar a entrada imediatamente.
+"""
+import base64
+import hashlib
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from cryptography.hazmat.primitives import serialization
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+_schemas = threading.local()
+
+# (empresa_id, certificado_path, hash da senha) -> SigningMaterial
+_materials: Dict[Tuple, "SigningMaterial"] = {}
+_materials_lock = threading.Lock()
+
+
+def get_xml_schema(xsd_path) -> etree.XMLSchema:
+    """Retorna o XMLSchema compilado de `xsd_path`, recompilando se o arquivo mudar."""
+    path = str(xsd_path)
+    mtime = os.stat(path).st_mtime_ns
+    cache = getattr(_schemas, "by_path", None)
+    if cache is None:
+        cache = _schemas.by_path = {}
+    cached = cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    schema = etree.XMLSchema(etree.parse(path))
+    cache[path] = (mtime, schema)
+    return schema
+
+
+class SigningMaterial:
+    """Chave e certificados A1 já decodificados do PFX de uma empresa."""
+
+    def __init__(self, path: Path, private_key, certificate, additional_certificates=None):
+        self.path = path
+        self.mtime_ns = os.stat(path).st_mtime_ns
+        self.private_key = private_key
+        self.certificate = certificate
+        self.key_pem = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+        self.cert_pem = certificate.public_bytes(serialization.Encoding.PEM)
+        self.chain_pem = b""
+        for extra in additional_certificates or ():
+            try:
+                self.chain_pem += extra.public_bytes(serialization.Encoding.PEM)
+            except Exception:
+                continue
+        self.cert_b64 = base64.b64encode(certificate.public_bytes(serialization.Encoding.DER)).decode("utf-8")
+        self._xmlsec_key = None
+        self._lock = threading.Lock()
+
+    @property
+    def full_pem(self) -> bytes:
+        """Chave + certificado + cadeia, no formato esperado por ssl.load_cert_chain."""
+        return self.key_pem + self.cert_pem + self.chain_pem
+
+    def is_current(self) -> bool:
+        try:
+            return os.stat(self.path).st_mtime_ns == self.mtime_ns
+        except OSError:
+            return False
+
+    def xmlsec_key(self):
+        """xmlsec.Key com o certificado carregado (SignatureContext.key faz uma cópia)."""
+        if self._xmlsec_key is None:
+            import xmlsec
+            with self._lock:
+                if self._xmlsec_key is None:
+                    key = xmlsec.Key.from_memory(self.key_pem, xmlsec.KeyFormat.PEM, None)
+                    try:
+                        key.load_cert_from_memory(self.cert_pem, xmlsec.KeyFormat.CERT_PEM)
+                    except Exception as e:
+                        # Não é fatal: o X509Certificate é preenchido manualmente na assinatura
+                        logger.error(f"Falha ao carregar o certificado na chave xmlsec: {e}")
+                    self._xmlsec_key = key
+        return self._xmlsec_key
+
+
+def get_signing_material(
+    empresa_id: Optional[int],
+    certificado_path: str,
+    certificado_senha: Optional[str],
+    loader: Callable[[], SigningMaterial],
+) -> SigningMaterial:
+    """Retorna o material de assinatura em cache ou carrega com `loader()`."""
+    senha_hash = hashlib.sha256((certificado_senha or "").encode("utf-8")).hexdigest()
+    key = (empresa_id, certificado_path or "", senha_hash)
+    material = _materials.get(key)
+    if material is not None and material.is_current():
+        return material
+    material = loader()
+    with _materials_lock:
+        _materials[key] = material
+    return material
+
+
+def invalidate_certificate(empresa_id: int) -> None:
+    """Descarta o material de assinatura da empresa (upload/troca de certificado ou senha)."""
+    with _materials_lock:
+        for key in [k for k in _materials if k[0] == empresa_id]:
+            _materials.pop(key, None)
@@ -0,0 +1,86 @@
+"""
+Sessão HTTPS com a SEFAZ para transmissão de NFCom
+
+O certificado A1 da empresa é carregado uma única vez em um SSLContext e
+reaproveitado por uma requests.Session com keep-alive, evitando reler o
+PFX, gerar um PEM temporário e abrir uma nova conexão TLS a cada nota.
+
+Cada autorizador (URL do webservice) aceita no máximo
+NFCOM_SEFAZ_MAX_IN_FLIGHT requisições simultâneas neste processo,
+independentemente de quantos lotes estejam transmitindo ao mesmo tempo.
+"""
+import os
+import ssl
+import threading
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+NFCOM_SEFAZ_MAX_IN_FLIGHT = int(os.environ.get("NFCOM_SEFAZ_MAX_IN_FLIGHT", "4"))
+NFCOM_SEFAZ_TIMEOUT = int(os.environ.get("NFCOM_SEFAZ_TIMEOUT", "30"))
+
+# Alguns endpoints rejeitam o parâmetro charset; usar Content-Type sem charset pode evitar rejeição 599
+SOAP_HEADERS = {'Content-Type': 'application/soap+xml'}
+
+# URL do autorizador -> vagas de requisições simultâneas
+_authorizer_slots: Dict[str, threading.BoundedSemaphore] = {}
+_slots_lock = threading.Lock()
+
+
+def _authorizer_slot(url: str) -> threading.BoundedSemaphore:
+    with _slots_lock:
+        slot = _authorizer_slots.get(url)
+        if slot is None:
+            slot = _authorizer_slots[url] = threading.BoundedSemaphore(NFCOM_SEFAZ_MAX_IN_FLIGHT)
+        return slot
+
+
+class _SSLContextAdapter(HTTPAdapter):
+    """HTTPAdapter que usa um SSLContext já carregado com o certificado do cliente."""
+
+    def __init__(self, ssl_context: ssl.SSLContext, pool_maxsize: int):
+        self.ssl_context = ssl_context
+        super().__init__(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super().proxy_manager_for(*args, **kwargs)
+
+
+class SefazSession:
+    """Conexões mTLS reutilizáveis com a SEFAZ para o certificado de uma empresa.
+
+    `pem_path` deve conter a chave privada e a cadeia de certificados; o
+    arquivo só é lido na construção e pode ser removido em seguida.
+    Thread-safe: várias notas podem ser enviadas em paralelo pela mesma sessão.
+    """
+
+    def __init__(self, pem_path: str, pool_size: int = NFCOM_SEFAZ_MAX_IN_FLIGHT):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        # Homologação pode não ter certificado válido (equivalente a verify=False)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.load_cert_chain(pem_path)
+
+        self._session = requests.Session()
+        self._session.headers.update(SOAP_HEADERS)
+        self._session.mount('https://', _SSLContextAdapter(context, max(1, pool_size)))
+
+    def post(self, url: str, body: bytes, timeout: int = NFCOM_SEFAZ_TIMEOUT) -> requests.Response:
+        """Envia o envelope SOAP, respeitando o limite de requisições simultâneas do autorizador."""
+        with _authorizer_slot(url):
+            return self._session.post(url, data=body, verify=False, timeout=timeout)
+
+    def close(self) -> None:
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
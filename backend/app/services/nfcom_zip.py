@@ -0,0 +1,194 @@
+"""
+Exportação em ZIP (streaming) de XMLs e DANFEs de NFCom
+
+O ZIP é escrito direto na resposta: o ZipFile grava em um destino sem seek
+(_ZipSink) e cada entrada é entregue ao cliente assim que termina, então o
+download começa no primeiro arquivo e a memória usada não depende da
+quantidade de notas.
+
+As notas são lidas em lotes de NFCOM_ZIP_BATCH (uma consulta IN por lote).
+DANFEs que ainda não estão no armazenamento de artefatos são renderizados
+em um pool de processos (NFCOM_DANFE_WORKERS), até 2x o número de workers
+à frente da nota que está sendo escrita; cada worker abre a própria sessão,
+renderiza e grava o PDF no armazenamento, e devolve o caminho.
+"""
+import multiprocessing
+import os
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Iterator, List
+
+from sqlalchemy.orm import Session
+
+from app.models import models
+from app.services import nfcom_artifacts
+
+NFCOM_ZIP_BATCH = int(os.environ.get("NFCOM_ZIP_BATCH", "100"))
+NFCOM_DANFE_WORKERS = int(os.environ.get("NFCOM_DANFE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Colunas necessárias para nomear as entradas e localizar os artefatos
+_ZIP_COLUMNS = (
+    models.NFCom.id,
+    models.NFCom.numero_nf,
+    models.NFCom.serie,
+    models.NFCom.chave_acesso,
+    models.NFCom.protocolo_autorizacao,
+    models.NFCom.status,
+    models.NFCom.xml_gerado,
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _danfe_pool(reset: bool = False) -> ProcessPoolExecutor:
+    # spawn: os workers não herdam conexões do engine nem threads do servidor
+    global _pool
+    with _pool_lock:
+        if reset and _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=max(1, NFCOM_DANFE_WORKERS),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _render_danfe(nfcom_id: int):
+    """Executado no pool: renderiza o DANFE da nota e grava no armazenamento.
+
+    Retorna o caminho do PDF armazenado ou, para notas que não são
+    armazenadas, os bytes do PDF.
+    """
+    from app.core.database import SessionLocal
+    from app.services.danfe_generator import generate_danfe
+
+    db = SessionLocal()
+    try:
+        nf = db.query(models.NFCom).filter(models.NFCom.id == nfcom_id).first()
+        if nf is None:
+            return None
+        path = nfcom_artifacts.danfe_path(nf, generate_danfe)
+        if path is not None:
+            return str(path)
+        return generate_danfe(nf).getvalue()
+    finally:
+        db.close()
+
+
+def _submit_danfe(nfcom_id: int):
+    try:
+        return _danfe_pool().submit(_render_danfe, nfcom_id)
+    except BrokenProcessPool:
+        # Um worker morreu (ex.: OOM): recria o pool e tenta de novo
+        return _danfe_pool(reset=True).submit(_render_danfe, nfcom_id)
+
+
+def _iter_rows(db: Session, empresa_id: int, nfcom_ids: List[int]) -> Iterator:
+    """Linhas das notas da empresa, em lotes, na ordem de `nfcom_ids`."""
+    for i in range(0, len(nfcom_ids), NFCOM_ZIP_BATCH):
+        batch = nfcom_ids[i:i + NFCOM_ZIP_BATCH]
+        rows = {
+            row.id: row for row in db.query(*_ZIP_COLUMNS).filter(
+                models.NFCom.id.in_(batch),
+                models.NFCom.empresa_id == empresa_id,
+            ).all()
+        }
+        for nf_id in batch:
+            row = rows.get(nf_id)
+            if row is not None:
+                yield row
+
+
+def _iter_entries(db: Session, empresa_id: int, nfcom_ids: List[int], typ: str) -> Iterator:
+    """Gera (nome, conteúdo) das entradas; conteúdo é um caminho (str) ou bytes."""
+    if typ == 'xml':
+        for nf in _iter_rows(db, empresa_id, nfcom_ids):
+            if not nf.xml_gerado:
+                continue
+            stored = nfcom_artifacts.xml_path(nf)
+            content = str(stored) if stored is not None else nf.xml_gerado.encode('utf-8')
+            yield f"nfcom_{nf.numero_nf}_{nf.serie}.xml", content
+        return
+
+    lookahead = max(2, 2 * NFCOM_DANFE_WORKERS)
+    pendentes = deque()
+
+    def _resolve(item):
+        filename, source = item
+        if isinstance(source, str):
+            return filename, source
+        try:
+            return filename, source.result()
+        except Exception as e:
+            # pular notas cuja geração de DANFE falhar
+            print(f"WARN: falha ao gerar DANFE para o ZIP ({filename}): {e}")
+            return filename, None
+
+    try:
+        for nf in _iter_rows(db, empresa_id, nfcom_ids):
+            filename = f"danfe_nfcom_{nf.numero_nf}_{nf.serie}.pdf"
+            stored = nfcom_artifacts.existing_danfe_path(nf)
+            pendentes.append((filename, str(stored) if stored is not None else _submit_danfe(nf.id)))
+            while len(pendentes) > lookahead:
+                yield _resolve(pendentes.popleft())
+        while pendentes:
+            yield _resolve(pendentes.popleft())
+    finally:
+        # Download interrompido: não renderizar o que ainda não começou
+        for _filename, source in pendentes:
+            if not isinstance(source, str):
+                source.cancel()
+
+
+class _ZipSink:
+    """Destino sem seek para o ZipFile: acumula os bytes até o próximo drain()."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_nfcom_zip(empresa_id: int, nfcom_ids: Iterable[int], typ: str) -> Iterator[bytes]:
+    """Gera os bytes de um ZIP com os XMLs (`typ='xml'`) ou DANFEs (`typ='danfe'`).
+
+    Usa uma sessão própria, pois é consumido pela StreamingResponse depois
+    que a sessão da requisição já foi fechada. Notas inexistentes, sem XML
+    ou cujo DANFE falhar são omitidas.
+    """
+    from app.core.database import SessionLocal
+
+    db = SessionLocal()
+    sink = _ZipSink()
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for filename, content in _iter_entries(db, empresa_id, list(nfcom_ids), typ):
+                if content is None:
+                    continue
+                if isinstance(content, str):
+                    zf.write(content, filename)
+                else:
+                    zf.writestr(filename, content)
+                data = sink.drain()
+                if data:
+                    yield data
+        # Diretório central, escrito ao fechar o ZipFile
+        yield sink.drain()
+    finally:
+        db.close()
@@ -0,0 +1,139 @@
+"""
+Base comum dos caches de processo invalidados no commit
+
+Usado por access_cache e dashboard_service:
+
+- Generations: geração por escopo (ex.: ("user", id) ou um empresa_id),
+  incrementada a cada invalidação. Uma leitura guarda a geração antes de
+  consultar o banco e store() só grava o resultado se nada foi invalidado
+  nesse meio tempo; senão o cache poderia guardar um valor anterior a uma
+  alteração já confirmada.
+- track_commits: listeners de sessão que juntam os escopos alterados pela
+  ORM durante a transação (flush e INSERT/UPDATE/DELETE em massa) e chamam
+  a invalidação quando a transação é confirmada. O escopo None significa
+  "tudo".
+"""
+import threading
+import time
+from typing import Callable, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+
+
+class Generations:
+    """Gerações por escopo; `lock` protege também os dicionários do cache dono."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._by_scope: Dict[Hashable, int] = {}
+        self._global = 0
+
+    def _current(self, scopes) -> Tuple[int, ...]:
+        return (self._global,) + tuple(self._by_scope.get(scope, 0) for scope in scopes)
+
+    def snapshot(self, *scopes) -> Tuple[int, ...]:
+        """Geração dos escopos no início da leitura; repassada ao store()."""
+        with self.lock:
+            return self._current(scopes)
+
+    def store(self, cache: dict, key, value, ttl: float, generation: Tuple[int, ...], *scopes) -> None:
+        if ttl <= 0:
+            return
+        with self.lock:
+            # Invalidado durante a leitura: o valor pode ser anterior à alteração
+            if self._current(scopes) != generation:
+                return
+            cache[key] = (time.monotonic() + ttl, value)
+
+    def bump(self, scope) -> None:
+        """Invalida um escopo (chamar com `lock` adquirido)."""
+        self._by_scope[scope] = self._by_scope.get(scope, 0) + 1
+
+    def bump_all(self) -> None:
+        """Invalida todos os escopos (chamar com `lock` adquirido)."""
+        self._global += 1
+        self._by_scope.clear()
+
+
+def get_fresh(cache: dict, key):
+    """Entrada (expira_em, valor) ainda dentro do TTL, ou None."""
+    entry = cache.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry
+    return None
+
+
+def column_values(orm_execute_state, column_name: str) -> Optional[Set]:
+    """Valores de `column_name` a que um INSERT/UPDATE/DELETE se restringe.
+
+    INSERT: valores do parâmetro `column_name` de todas as linhas.
+    UPDATE/DELETE: um `coluna == valor` ou `coluna IN (...)` no nível de AND
+    do WHERE. Retorna None quando o comando pode atingir qualquer valor.
+    """
+    statement = orm_execute_state.statement
+    table = getattr(statement, "table", None)
+    if table is None:
+        return None
+    if orm_execute_state.is_insert:
+        rows = orm_execute_state.parameters
+        rows = [rows] if isinstance(rows, dict) else list(rows or [])
+        if rows and all(isinstance(row, dict) and row.get(column_name) is not None for row in rows):
+            return {row[column_name] for row in rows}
+        return None
+    where = getattr(statement, "whereclause", None)
+    if where is None or column_name not in table.c:
+        return None
+    column = table.c[column_name]
+    clauses = where.clauses if isinstance(where, BooleanClauseList) and where.operator is operators.and_ else [where]
+    for clause in clauses:
+        if not isinstance(clause, BinaryExpression) or not isinstance(clause.right, BindParameter):
+            continue
+        if not clause.left.shares_lineage(column):
+            continue
+        value = clause.right.effective_value
+        if clause.operator is operators.eq and value is not None:
+            return {value}
+        if clause.operator is operators.in_op and value is not None:
+            return set(value)
+    return None
+
+
+def track_commits(
+    key: str,
+    object_scopes: Callable[[object], Iterable],
+    statement_scopes: Callable[[object], Iterable],
+    apply: Callable[[Set], None],
+) -> None:
+    """Registra os listeners de sessão de um cache.
+
+    - object_scopes(obj): escopos afetados por um objeto gravado no flush;
+    - statement_scopes(orm_execute_state): escopos de um INSERT/UPDATE/DELETE
+      executado pela sessão;
+    - apply(escopos): chamado após o commit com os escopos da transação.
+    """
+    def _pending(session) -> set:
+        return session.info.setdefault(key, set())
+
+    @event.listens_for(Session, "after_flush")
+    def _collect_changes(session, flush_context):
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            scopes = object_scopes(obj)
+            if scopes:
+                _pending(session).update(scopes)
+
+    @event.listens_for(Session, "do_orm_execute")
+    def _collect_bulk_changes(orm_execute_state):
+        if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+            return
+        scopes = statement_scopes(orm_execute_state)
+        if scopes:
+            _pending(orm_execute_state.session).update(scopes)
+
+    @event.listens_for(Session, "after_commit")
+    def _apply_changes(session):
+        scopes = session.info.pop(key, None)
+        if scopes:
+            apply(scopes)
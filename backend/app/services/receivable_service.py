@@ -2,6 +2,7 @@ from datetime import date, datetime, timedelta
 from decimal import Decimal
 import calendar
 from typing import Optional
+from sqlalchemy import func, insert, select, update
 from sqlalchemy.orm import Session
 import json
 import logging
@@ -11,6 +12,9 @@ from app.core.config import settings
 
 from app.models.models import ServicoContratado, Receivable, BankAccount, Empresa, Bank
 
+# Tamanho dos lotes de INSERT/IN na geração automática de cobranças
+RECEIVABLE_INSERT_BATCH = int(os.environ.get("RECEIVABLE_INSERT_BATCH", "1000"))
+
 
 def _mask_cpf_cnpj(doc: str) -> str:
     if not doc:
@@ -43,12 +47,45 @@ def prorated_amount_for_period(full_amount: float, start_date: date, billing_dat
         return round(full_amount, 2)
 
 
-def generate_receivable_from_contract(db: Session, contrato: ServicoContratado, target_date: date) -> Receivable:
-    """Gera um objeto Receivable em memória (não comita) a partir de um contrato para `target_date`.
+def _bank_account_snapshot(bank_account: BankAccount) -> str:
+    """Snapshot JSON da conta bancária (sem credenciais) gravado na cobrança."""
+    snapshot = {
+        "id": bank_account.id,
+        "bank": bank_account.bank,
+        "codigo_banco": bank_account.codigo_banco,
+        "agencia": bank_account.agencia,
+        "agencia_dv": bank_account.agencia_dv,
+        "conta": bank_account.conta,
+        "conta_dv": bank_account.conta_dv,
+        "titular": bank_account.titular,
+        "cpf_cnpj_titular": bank_account.cpf_cnpj_titular,
+        "carteira": bank_account.carteira,
+        "convenio": bank_account.convenio,
+        "is_default": bool(bank_account.is_default),
+        "multa_atraso_percentual": bank_account.multa_atraso_percentual,
+        "juros_atraso_percentual": bank_account.juros_atraso_percentual,
+        "desconto_pontualidade_tipo": getattr(bank_account, 'desconto_pontualidade_tipo', 'VALOR'),
+        "desconto_pontualidade_valor": getattr(bank_account, 'desconto_pontualidade_valor', 0.0),
+        "desconto_pontualidade_dias": getattr(bank_account, 'desconto_pontualidade_dias', 0),
+    }
+    return json.dumps(snapshot, default=str)
 
-    - Respeita `d_contrato_ini` para prorrata quando necessário
-    - Usa `valor_unitario * quantidade` como base
-    - Respeita `taxa_instalacao` se for apropriado (isso pode ser ajustado posteriormente)
+
+def _uses_nosso_numero(recv: Receivable, bank_account: Optional[BankAccount]) -> bool:
+    return bool(bank_account) and recv.tipo == 'BOLETO' and bank_account.bank != 'MERCADO_PAGO'
+
+
+def _build_receivable(
+    contrato: ServicoContratado,
+    target_date: date,
+    bank_account: Optional[BankAccount],
+    snapshot: Optional[str] = None,
+    issue_date: Optional[datetime] = None,
+) -> Receivable:
+    """Monta o Receivable de `contrato` para `target_date` sem acessar o banco.
+
+    O `nosso_numero` não é atribuído aqui: quem chama reserva a sequência
+    (uma a uma em generate_receivable_from_contract, em faixas no lote).
     """
     base = (contrato.valor_unitario or 0.0) * (contrato.quantidade or 1.0)
     # por enquanto não somamos taxa_instalacao automaticamente (configurável)
@@ -87,7 +124,7 @@ def generate_receivable_from_contract(db: Session, contrato: ServicoContratado,
         empresa_id=contrato.empresa_id,
         cliente_id=contrato.cliente_id,
         servico_contratado_id=contrato.id,
-        issue_date=datetime.now(),
+        issue_date=issue_date or datetime.now(),
         due_date=due_date,
         amount=amount,
         discount=0.0,
@@ -108,18 +145,6 @@ def generate_receivable_from_contract(db: Session, contrato: ServicoContratado,
     else:
         recv.tipo = 'BOLETO'
 
-    # Determinar qual conta bancária usar: preferir a do contrato, senão a default da empresa
-    bank_account = None
-    try:
-        if getattr(contrato, "bank_account_id", None):
-            bank_account = db.query(BankAccount).filter(BankAccount.id == contrato.bank_account_id).first()
-        if not bank_account:
-            empresa = db.query(Empresa).filter(Empresa.id == contrato.empresa_id).first()
-            if empresa and getattr(empresa, "default_bank_account_id", None):
-                bank_account = db.query(BankAccount).filter(BankAccount.id == empresa.default_bank_account_id).first()
-    except Exception:
-        logging.exception("Erro ao buscar conta bancária para geração de cobrança")
-
     if bank_account:
         # Aplicar configurações de cobrança da conta bancária
         recv.fine_percent = bank_account.multa_atraso_percentual or 0.0
@@ -127,12 +152,6 @@ def generate_receivable_from_contract(db: Session, contrato: ServicoContratado,
         
         # Popular referência à conta e snapshot (sem credenciais)
         recv.bank_account_id = bank_account.id
-        
-        if recv.tipo == 'BOLETO' and bank_account.bank != 'MERCADO_PAGO':
-            seq = bank_account.nosso_numero_sequence or 1
-            recv.nosso_numero = str(seq)
-            bank_account.nosso_numero_sequence = seq + 1
-            db.add(bank_account)
         try:
             # Se possível, atribuir enum Bank a coluna receivable.bank
             recv.bank = Bank(bank_account.bank)
@@ -140,26 +159,7 @@ def generate_receivable_from_contract(db: Session, contrato: ServicoContratado,
             # fallback: atribuir string (SQLAlchemy pode converter)
             recv.bank = bank_account.bank
 
-        snapshot = {
-            "id": bank_account.id,
-            "bank": bank_account.bank,
-            "codigo_banco": bank_account.codigo_banco,
-            "agencia": bank_account.agencia,
-            "agencia_dv": bank_account.agencia_dv,
-            "conta": bank_account.conta,
-            "conta_dv": bank_account.conta_dv,
-            "titular": bank_account.titular,
-            "cpf_cnpj_titular": bank_account.cpf_cnpj_titular,
-            "carteira": bank_account.carteira,
-            "convenio": bank_account.convenio,
-            "is_default": bool(bank_account.is_default),
-            "multa_atraso_percentual": bank_account.multa_atraso_percentual,
-            "juros_atraso_percentual": bank_account.juros_atraso_percentual,
-            "desconto_pontualidade_tipo": getattr(bank_account, 'desconto_pontualidade_tipo', 'VALOR'),
-            "desconto_pontualidade_valor": getattr(bank_account, 'desconto_pontualidade_valor', 0.0),
-            "desconto_pontualidade_dias": getattr(bank_account, 'desconto_pontualidade_dias', 0),
-        }
-        recv.bank_account_snapshot = json.dumps(snapshot, default=str)
+        recv.bank_account_snapshot = snapshot or _bank_account_snapshot(bank_account)
     else:
         # Fallback: usar configurações do contrato se não houver conta bancária
         recv.fine_percent = contrato.multa_atraso_percentual or 0.0
@@ -167,6 +167,36 @@ def generate_receivable_from_contract(db: Session, contrato: ServicoContratado,
     return recv
 
 
+def generate_receivable_from_contract(db: Session, contrato: ServicoContratado, target_date: date) -> Receivable:
+    """Gera um objeto Receivable em memória (não comita) a partir de um contrato para `target_date`.
+
+    - Respeita `d_contrato_ini` para prorrata quando necessário
+    - Usa `valor_unitario * quantidade` como base
+    - Respeita `taxa_instalacao` se for apropriado (isso pode ser ajustado posteriormente)
+    """
+    # Determinar qual conta bancária usar: preferir a do contrato, senão a default da empresa
+    bank_account = None
+    try:
+        if getattr(contrato, "bank_account_id", None):
+            bank_account = db.query(BankAccount).filter(BankAccount.id == contrato.bank_account_id).first()
+        if not bank_account:
+            empresa = db.query(Empresa).filter(Empresa.id == contrato.empresa_id).first()
+            if empresa and getattr(empresa, "default_bank_account_id", None):
+                bank_account = db.query(BankAccount).filter(BankAccount.id == empresa.default_bank_account_id).first()
+    except Exception:
+        logging.exception("Erro ao buscar conta bancária para geração de cobrança")
+
+    recv = _build_receivable(contrato, target_date, bank_account)
+
+    if _uses_nosso_numero(recv, bank_account):
+        seq = bank_account.nosso_numero_sequence or 1
+        recv.nosso_numero = str(seq)
+        bank_account.nosso_numero_sequence = seq + 1
+        db.add(bank_account)
+
+    return recv
+
+
 def create_and_persist_receivable(db: Session, recv: Receivable) -> Receivable:
     db.add(recv)
     db.flush()
@@ -212,6 +242,178 @@ def should_generate_for_contract(contrato: ServicoContratado, target_date: date,
         return True
 
 
+def add_months_date(sourcedate: date, months: int) -> date:
+    month = sourcedate.month - 1 + months
+    year = sourcedate.year + month // 12
+    month = month % 12 + 1
+    day = min(sourcedate.day, calendar.monthrange(year, month)[1])
+    return date(year, month, day)
+
+
+def _month_start(d) -> datetime:
+    return datetime(d.year, d.month, 1)
+
+
+def _next_month_start(d) -> datetime:
+    return datetime(d.year + 1, 1, 1) if d.month == 12 else datetime(d.year, d.month + 1, 1)
+
+
+# Colunas gravadas pelo INSERT em lote (as demais ficam com o default do modelo)
+_BULK_FIELDS = (
+    "empresa_id", "cliente_id", "servico_contratado_id", "tipo", "issue_date", "due_date",
+    "amount", "discount", "interest_percent", "fine_percent", "bank", "nosso_numero",
+    "status", "bank_account_snapshot", "payment_token", "payment_url", "bank_account_id",
+)
+
+
+class _BillingBatch:
+    """Faturamento em lote de uma empresa.
+
+    Substitui, para a geração automática, o caminho por contrato de
+    generate_receivable_from_contract: empresa e contas bancárias são lidas
+    uma vez, os meses já faturados vêm de uma única consulta por intervalo
+    de vencimento, o `nosso_numero` é reservado em faixas (um UPDATE por
+    conta) e as cobranças são inseridas em lote.
+    """
+
+    def __init__(self, db: Session, empresa_id: int, contratos: list):
+        self.db = db
+        self.empresa_id = empresa_id
+        self.issue_date = datetime.now().replace(microsecond=0)
+        self.empresa = db.query(Empresa).filter(Empresa.id == empresa_id).first()
+
+        account_ids = {c.bank_account_id for c in contratos if getattr(c, "bank_account_id", None)}
+        self.default_account_id = getattr(self.empresa, "default_bank_account_id", None) if self.empresa else None
+        if self.default_account_id:
+            account_ids.add(self.default_account_id)
+        self.accounts = {}
+        if account_ids:
+            self.accounts = {
+                ba.id: ba for ba in db.query(BankAccount).filter(BankAccount.id.in_(account_ids)).all()
+            }
+        self.snapshots = {ba_id: _bank_account_snapshot(ba) for ba_id, ba in self.accounts.items()}
+        # (receivable, contrato) na ordem de geração
+        self.candidates = []
+
+    def bank_account_for(self, contrato: ServicoContratado) -> Optional[BankAccount]:
+        """Conta do contrato, senão a default da empresa (mesma regra de generate_receivable_from_contract)."""
+        bank_account = None
+        if getattr(contrato, "bank_account_id", None):
+            bank_account = self.accounts.get(contrato.bank_account_id)
+        if not bank_account and self.default_account_id:
+            bank_account = self.accounts.get(self.default_account_id)
+        return bank_account
+
+    def build(self, contrato: ServicoContratado, target_date: date) -> Receivable:
+        bank_account = self.bank_account_for(contrato)
+        return _build_receivable(
+            contrato,
+            target_date,
+            bank_account,
+            snapshot=self.snapshots.get(bank_account.id) if bank_account else None,
+            issue_date=self.issue_date,
+        )
+
+    def add(self, recv: Receivable, contrato: ServicoContratado) -> None:
+        self.candidates.append((recv, contrato))
+
+    def _billed_keys(self) -> tuple:
+        """Meses de vencimento já faturados, por contrato e por cliente (cobranças avulsas)."""
+        por_contrato, avulsas = set(), set()
+        if not self.candidates:
+            return por_contrato, avulsas
+        dues = [r.due_date for r, _ in self.candidates]
+        rows = self.db.query(
+            Receivable.servico_contratado_id, Receivable.cliente_id, Receivable.due_date
+        ).filter(
+            Receivable.empresa_id == self.empresa_id,
+            Receivable.due_date >= _month_start(min(dues)),
+            Receivable.due_date < _next_month_start(max(dues)),
+        ).all()
+        for contrato_id, cliente_id, due in rows:
+            if contrato_id is None:
+                avulsas.add((cliente_id, due.year, due.month))
+            else:
+                por_contrato.add((contrato_id, due.year, due.month))
+        return por_contrato, avulsas
+
+    def _reserve_nosso_numero(self, pending: list) -> None:
+        """Atribui `nosso_numero` reservando uma faixa por conta em um único UPDATE."""
+        por_conta = {}
+        for recv in pending:
+            ba = self.accounts.get(recv.bank_account_id) if recv.bank_account_id else None
+            if _uses_nosso_numero(recv, ba):
+                por_conta.setdefault(ba.id, []).append(recv)
+
+        for ba_id, recvs in por_conta.items():
+            n = len(recvs)
+            # O UPDATE trava a linha da conta até o commit: outra geração
+            # concorrente recebe a faixa seguinte
+            self.db.execute(
+                update(BankAccount)
+                .where(BankAccount.id == ba_id)
+                .values(nosso_numero_sequence=func.coalesce(BankAccount.nosso_numero_sequence, 1) + n)
+                .execution_options(synchronize_session=False)
+            )
+            fim = self.db.execute(
+                select(BankAccount.nosso_numero_sequence).where(BankAccount.id == ba_id)
+            ).scalar()
+            self.db.expire(self.accounts[ba_id], ["nosso_numero_sequence"])
+            for seq, recv in enumerate(recvs, start=fim - n):
+                recv.nosso_numero = str(seq)
+
+    def persist(self) -> list:
+        """Descarta meses já faturados, insere o restante em lote e retorna os Receivables persistidos."""
+        por_contrato, avulsas = self._billed_keys()
+        pending = []
+        for recv, contrato in self.candidates:
+            key = (recv.due_date.year, recv.due_date.month)
+            # Mesmo critério da verificação anterior: cobrança do contrato no mês de
+            # vencimento, ou cobrança avulsa do cliente no mesmo mês
+            if (contrato.id,) + key in por_contrato or (contrato.cliente_id,) + key in avulsas:
+                continue
+            por_contrato.add((contrato.id,) + key)
+            pending.append(recv)
+        if not pending:
+            return []
+
+        self._reserve_nosso_numero(pending)
+
+        rows = []
+        for recv in pending:
+            row = {}
+            for field in _BULK_FIELDS:
+                value = getattr(recv, field)
+                if value is not None:
+                    row[field] = getattr(value, "value", value)
+            rows.append(row)
+        for i in range(0, len(rows), RECEIVABLE_INSERT_BATCH):
+            self.db.execute(insert(Receivable), rows[i:i + RECEIVABLE_INSERT_BATCH])
+
+        # Recarregar os registros inseridos (com id) na ordem de geração
+        ordem = {(r.servico_contratado_id, r.due_date.year, r.due_date.month): i for i, r in enumerate(pending)}
+        contrato_ids = sorted({r.servico_contratado_id for r in pending})
+        created = []
+        for i in range(0, len(contrato_ids), RECEIVABLE_INSERT_BATCH):
+            created += self.db.query(Receivable).filter(
+                Receivable.empresa_id == self.empresa_id,
+                Receivable.issue_date == self.issue_date,
+                Receivable.servico_contratado_id.in_(contrato_ids[i:i + RECEIVABLE_INSERT_BATCH]),
+            ).all()
+        created = [r for r in created if (r.servico_contratado_id, r.due_date.year, r.due_date.month) in ordem]
+        created.sort(key=lambda r: ordem[(r.servico_contratado_id, r.due_date.year, r.due_date.month)])
+        return created
+
+
+def _touch_last_emission(db: Session, contrato_ids) -> None:
+    contrato_ids = sorted(contrato_ids)
+    agora = datetime.now()
+    for i in range(0, len(contrato_ids), RECEIVABLE_INSERT_BATCH):
+        db.query(ServicoContratado).filter(
+            ServicoContratado.id.in_(contrato_ids[i:i + RECEIVABLE_INSERT_BATCH])
+        ).update({ServicoContratado.last_emission: agora}, synchronize_session="evaluate")
+
+
 def generate_receivables_for_company(db: Session, empresa_id: int, target_date: date):
     """Gera receivables para contratos elegíveis de uma empresa para `target_date`.
 
@@ -223,7 +425,8 @@ def generate_receivables_for_company(db: Session, empresa_id: int, target_date:
         ServicoContratado.is_active == True,
         ServicoContratado.auto_emit == True
     ).all()
-    created = []
+    batch = _BillingBatch(db, empresa_id, contratos)
+    emitidos = []
     for c in contratos:
         ref_date = c.data_inicio_cobranca or c.d_contrato_ini
         if ref_date and ref_date > target_date:
@@ -235,54 +438,22 @@ def generate_receivables_for_company(db: Session, empresa_id: int, target_date:
         if not should_generate_for_contract(c, target_date):
             continue
 
-        import datetime as _dt
-        import calendar
-
-        def add_months_date(sourcedate, months):
-            month = sourcedate.month - 1 + months
-            year = sourcedate.year + month // 12
-            month = month % 12 + 1
-            day = min(sourcedate.day, calendar.monthrange(year, month)[1])
-            return _dt.date(year, month, day)
-
         iterations = 6 if c.periodicidade == 'SEMESTRAL' else 1
 
+        # Normalizar a data alvo usando o dia_emissao do contrato para evitar
+        # que a execução atrasada da rotina interfira nas regras de vencimento.
+        base_day = min(c.dia_emissao or 1, calendar.monthrange(target_date.year, target_date.month)[1])
+        base_target = date(target_date.year, target_date.month, base_day)
         for i in range(iterations):
-            # Normalizar a data alvo usando o dia_emissao do contrato para evitar
-            # que a execução atrasada da rotina interfira nas regras de vencimento.
-            base_day = min(c.dia_emissao or 1, calendar.monthrange(target_date.year, target_date.month)[1])
-            base_target = _dt.date(target_date.year, target_date.month, base_day)
-            
-            current_target = add_months_date(base_target, i)
-
-            # gerar a simulação do receivable para saber as datas
-            recv_simul = generate_receivable_from_contract(db, c, current_target)
-
-            # Para evitar duplicados, checamos se já existe fatura para o mesmo contrato e mesmo mês/ano de VENCIMENTO.
-            # Isso é mais seguro que issue_date, especialmente para carnês gerados todos no mesmo dia.
-            from sqlalchemy import extract, or_, and_
-            existing_recv = db.query(Receivable).filter(
-                or_(
-                    Receivable.servico_contratado_id == c.id,
-                    and_(
-                        Receivable.cliente_id == c.cliente_id,
-                        Receivable.servico_contratado_id == None
-                    )
-                ),
-                extract('year', Receivable.due_date) == recv_simul.due_date.year,
-                extract('month', Receivable.due_date) == recv_simul.due_date.month
-            ).first()
+            batch.add(batch.build(c, add_months_date(base_target, i)), c)
 
-            if existing_recv:
-                # Já existe uma cobrança para este contrato neste mês de faturamento!
-                continue
+        emitidos.append(c.id)
 
-            # Se não existe, podemos persistir o gerado
-            create_and_persist_receivable(db, recv_simul)
-            created.append(recv_simul)
-            
-        # atualizar last_emission após o loop
-        c.last_emission = datetime.now()
+    # Duplicados (mesmo contrato e mês/ano de VENCIMENTO) são descartados em persist().
+    # Isso é mais seguro que issue_date, especialmente para carnês gerados todos no mesmo dia.
+    created = batch.persist()
+    # atualizar last_emission dos contratos processados
+    _touch_last_emission(db, emitidos)
     return created
 
 
@@ -304,7 +475,7 @@ def generate_receivables_for_company_range(
         query = query.filter(ServicoContratado.cliente_id == cliente_id)
         
     contratos = query.all()
-    created = []
+    batch = _BillingBatch(db, empresa_id, contratos)
     
     for c in contratos:
         # Determinar os meses candidatos
@@ -334,7 +505,6 @@ def generate_receivables_for_company_range(
                 curr_month += 1
                 
         # Verificar cada mês candidato
-        contract_generated = False
         for yr, mo in candidate_months:
             t_day = min(c.dia_emissao or 1, days_in_month(yr, mo))
             target_date = date(yr, mo, t_day)
@@ -352,48 +522,18 @@ def generate_receivables_for_company_range(
                 continue
                 
             iterations = 6 if c.periodicidade == 'SEMESTRAL' else 1
-            
-            import datetime as _dt
-            import calendar
-
-            def add_months_date(sourcedate, months):
-                month = sourcedate.month - 1 + months
-                year = sourcedate.year + month // 12
-                month = month % 12 + 1
-                day = min(sourcedate.day, calendar.monthrange(year, month)[1])
-                return _dt.date(year, month, day)
 
             for i in range(iterations):
-                current_target = add_months_date(target_date, i)
-                recv_simul = generate_receivable_from_contract(db, c, current_target)
+                recv_simul = batch.build(c, add_months_date(target_date, i))
                 
                 # Filtrar pelo intervalo de due_date solicitado
                 sim_due = recv_simul.due_date.date() if isinstance(recv_simul.due_date, datetime) else recv_simul.due_date
                 if start_due_date <= sim_due <= end_due_date:
-                    # Evitar duplicados no BD para este contrato e mês/ano de vencimento
-                    from sqlalchemy import extract, or_, and_
-                    existing_recv = db.query(Receivable).filter(
-                        or_(
-                            Receivable.servico_contratado_id == c.id,
-                            and_(
-                                Receivable.cliente_id == c.cliente_id,
-                                Receivable.servico_contratado_id == None
-                            )
-                        ),
-                        extract('year', Receivable.due_date) == recv_simul.due_date.year,
-                        extract('month', Receivable.due_date) == recv_simul.due_date.month
-                    ).first()
-                    
-                    if existing_recv:
-                        continue
-                        
-                    create_and_persist_receivable(db, recv_simul)
-                    created.append(recv_simul)
-                    contract_generated = True
-                    
-        if contract_generated:
-            c.last_emission = datetime.now()
-            
+                    batch.add(recv_simul, c)
+
+    # Evitar duplicados no BD para este contrato e mês/ano de vencimento
+    created = batch.persist()
+    _touch_last_emission(db, {r.servico_contratado_id for r in created})
     return created
 
 
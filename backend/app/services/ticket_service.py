@@ -1,11 +1,36 @@
+import base64
+import os
+import re
+
 from sqlalchemy.orm import Session, aliased
-from sqlalchemy import func, and_, or_, case
+from sqlalchemy import func, and_, or_, case, select
+from sqlalchemy.dialects.mysql import match as mysql_match
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
 from fastapi import HTTPException
 
 from app.models.models import Ticket, TicketComment, StatusTicket, Usuario, Cliente, EmpresaCliente, ServicoContratado
 from app.schemas.ticket import TicketCreate, TicketUpdate, TicketCommentCreate, TicketCommentUpdate, TicketStats
+from app.services import access_cache
+
+# innodb_ft_min_token_size: palavras menores não entram no índice FULLTEXT
+TICKET_SEARCH_MIN_TERM = int(os.environ.get("TICKET_SEARCH_MIN_TERM", "3"))
+
+# Colunas do ticket devolvidas nas listagens (além dos dados relacionados)
+_TICKET_FIELDS = (
+    'id', 'empresa_id', 'cliente_id', 'contrato_id', 'criado_por_id', 'atribuido_para_id',
+    'titulo', 'descricao', 'status', 'prioridade', 'categoria', 'resolucao',
+    'resolvido_em', 'resolvido_por_id', 'prazo_resolucao', 'tempo_gasto_minutos',
+    'is_active', 'created_at', 'updated_at',
+    'foto_onu_serial', 'foto_equipamentos', 'foto_velocidade', 'foto_cto',
+    'splitter_cto', 'material_utilizado', 'problema_encontrado',
+)
+
+
+def _ticket_dict(ticket: Ticket, **related) -> Dict[str, Any]:
+    data = {field: getattr(ticket, field) for field in _TICKET_FIELDS}
+    data.update(related)
+    return data
 
 
 class TicketService:
@@ -139,7 +164,101 @@ class TicketService:
         return None
 
     @staticmethod
-    def get_tickets(
+    def _restrict_to_assignee(db: Session, empresa_id: int, current_user_id: int) -> bool:
+        """True se o usuário tiver a role "technical" sem ser superuser nem admin da empresa.
+
+        Usa o access_cache (já carregado pelo permission_checker da mesma
+        requisição), então não consulta Usuario/UsuarioEmpresa/Role de novo.
+        """
+        user = access_cache.get_user(db, current_user_id)
+        if user is not None and user.is_superuser:
+            return False
+        membership = access_cache.get_membership(db, current_user_id, empresa_id)
+        return not membership.is_admin and "technical" in membership.roles
+
+    @staticmethod
+    def _search_condition(db: Session, search: str):
+        """MATCH ... AGAINST no índice FULLTEXT (MySQL); ilike nos demais casos.
+
+        O índice não guarda palavras com menos de TICKET_SEARCH_MIN_TERM letras,
+        então buscas com termos curtos (ou sem palavras) continuam com ilike.
+        """
+        terms = re.findall(r"\w+", search)
+        if (
+            terms
+            and all(len(t) >= TICKET_SEARCH_MIN_TERM for t in terms)
+            and db.get_bind().dialect.name == "mysql"
+        ):
+            return mysql_match(
+                Ticket.titulo, Ticket.descricao,
+                against=" ".join(f"+{t}*" for t in terms),
+            ).in_boolean_mode()
+        search_filter = f"%{search}%"
+        return or_(
+            Ticket.titulo.ilike(search_filter),
+            Ticket.descricao.ilike(search_filter)
+        )
+
+    @staticmethod
+    def _filter_conditions(
+        db: Session,
+        empresa_id: int,
+        status: Optional[str] = None,
+        prioridade: Optional[str] = None,
+        categoria: Optional[str] = None,
+        cliente_id: Optional[int] = None,
+        atribuido_para_id: Optional[int] = None,
+        search: Optional[str] = None,
+        current_user_id: Optional[int] = None
+    ) -> list:
+        """Condições WHERE comuns à listagem e à contagem."""
+        conditions = [
+            Ticket.empresa_id == empresa_id,
+            Ticket.is_active == True
+        ]
+
+        # Técnico: apenas tickets atribuídos ao próprio técnico ou não atribuídos (None)
+        if current_user_id and TicketService._restrict_to_assignee(db, empresa_id, current_user_id):
+            conditions.append(or_(
+                Ticket.atribuido_para_id == None,
+                Ticket.atribuido_para_id == current_user_id
+            ))
+
+        if status:
+            status_list = [s.strip() for s in status.split(',')]
+            if len(status_list) == 1:
+                conditions.append(Ticket.status == status_list[0])
+            else:
+                conditions.append(Ticket.status.in_(status_list))
+        if prioridade:
+            conditions.append(Ticket.prioridade == prioridade)
+        if categoria:
+            conditions.append(Ticket.categoria == categoria)
+        if cliente_id:
+            conditions.append(Ticket.cliente_id == cliente_id)
+        if atribuido_para_id:
+            conditions.append(Ticket.atribuido_para_id == atribuido_para_id)
+        if search:
+            conditions.append(TicketService._search_condition(db, search))
+        return conditions
+
+    @staticmethod
+    def encode_cursor(created_at: datetime, ticket_id: int) -> str:
+        raw = f"{created_at.isoformat()}|{ticket_id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        """(created_at, id) de um cursor gerado por encode_cursor; ValueError se inválido."""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+            created_at, ticket_id = raw.rsplit("|", 1)
+            return datetime.fromisoformat(created_at), int(ticket_id)
+        except (ValueError, UnicodeDecodeError) as e:
+            raise ValueError("Cursor de paginação inválido") from e
+
+    @staticmethod
+    def list_tickets(
         db: Session,
         empresa_id: int,
         skip: int = 0,
@@ -150,23 +269,62 @@ class TicketService:
         cliente_id: Optional[int] = None,
         atribuido_para_id: Optional[int] = None,
         search: Optional[str] = None,
-        current_user_id: Optional[int] = None
-    ) -> List[Dict[str, Any]]:
-        """Busca tickets com filtros opcionais."""
+        current_user_id: Optional[int] = None,
+        cursor: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Página de tickets (mais novos primeiro) e total filtrado em uma consulta.
+
+        O total vem de COUNT(*) OVER () sobre os tickets filtrados, antes da
+        paginação. Com `cursor` (next_cursor da página anterior) a página
+        continua depois de (created_at, id) e `skip` é ignorado.
+        Retorna {"data", "total", "next_cursor"}.
+        """
+        conditions = TicketService._filter_conditions(
+            db, empresa_id, status, prioridade, categoria,
+            cliente_id, atribuido_para_id, search, current_user_id
+        )
+
+        filtrados = select(
+            Ticket.id.label('id'),
+            Ticket.created_at.label('created_at'),
+            func.count().over().label('total')
+        ).where(*conditions).subquery('filtrados')
+
+        pagina = select(filtrados.c.id, filtrados.c.total)
+        if cursor:
+            cursor_created_at, cursor_id = TicketService.decode_cursor(cursor)
+            pagina = pagina.where(or_(
+                filtrados.c.created_at < cursor_created_at,
+                and_(filtrados.c.created_at == cursor_created_at, filtrados.c.id < cursor_id)
+            ))
+        elif skip:
+            pagina = pagina.offset(skip)
+        pagina = pagina.order_by(
+            filtrados.c.created_at.desc(), filtrados.c.id.desc()
+        ).limit(limit).subquery('pagina')
+
         # Usar aliases para evitar conflito de nomes na tabela users
         criado_por_alias = aliased(Usuario, name='criado_por')
         atribuido_para_alias = aliased(Usuario, name='atribuido_para')
         resolvido_por_alias = aliased(Usuario, name='resolvido_por')
-        
-        query = db.query(
+
+        # Contagem de comentários só para as linhas da página
+        comentarios_count = select(func.count(TicketComment.id)).where(
+            TicketComment.ticket_id == Ticket.id
+        ).correlate(Ticket).scalar_subquery()
+
+        rows = db.query(
             Ticket,
+            pagina.c.total,
             Cliente.nome_razao_social.label('cliente_nome'),
             criado_por_alias.full_name.label('criado_por_nome'),
             atribuido_para_alias.full_name.label('atribuido_para_nome'),
             resolvido_por_alias.full_name.label('resolvido_por_nome'),
-            func.count(TicketComment.id).label('comentarios_count'),
+            comentarios_count.label('comentarios_count'),
             ServicoContratado.numero_contrato.label('contrato_numero'),
             ServicoContratado.endereco_instalacao.label('contrato_endereco')
+        ).select_from(pagina).join(
+            Ticket, Ticket.id == pagina.c.id
         ).outerjoin(
             Cliente, Ticket.cliente_id == Cliente.id
         ).outerjoin(
@@ -177,127 +335,57 @@ class TicketService:
             atribuido_para_alias, Ticket.atribuido_para_id == atribuido_para_alias.id
         ).outerjoin(
             resolvido_por_alias, Ticket.resolvido_por_id == resolvido_por_alias.id
-        ).outerjoin(
-            TicketComment, Ticket.id == TicketComment.ticket_id
-        ).filter(
-            Ticket.empresa_id == empresa_id,
-            Ticket.is_active == True
-        ).group_by(
-            Ticket.id, 
-            Cliente.nome_razao_social, 
-            criado_por_alias.full_name,
-            ServicoContratado.numero_contrato,
-            ServicoContratado.endereco_instalacao
-        )
-
-        # Filtragem por role "technical"
-        if current_user_id:
-            # 1. Verificar se o usuário é superuser ou administrador da empresa
-            is_admin_or_superuser = False
-            user = db.query(Usuario).filter(Usuario.id == current_user_id).first()
-            if user:
-                if user.is_superuser:
-                    is_admin_or_superuser = True
-                else:
-                    from app.models.models import UsuarioEmpresa
-                    assoc = db.query(UsuarioEmpresa).filter(
-                        UsuarioEmpresa.usuario_id == current_user_id,
-                        UsuarioEmpresa.empresa_id == empresa_id
-                    ).first()
-                    if assoc and assoc.is_admin:
-                        is_admin_or_superuser = True
-
-            # 2. Se não for admin nem superuser, verificar se tem a role "technical"
-            if not is_admin_or_superuser:
-                from app.models.access_control import Role, user_role_association
-                is_technical = db.query(Role).join(
-                    user_role_association,
-                    Role.id == user_role_association.c.role_id
-                ).filter(
-                    user_role_association.c.user_id == current_user_id,
-                    Role.name.ilike("technical"),
-                    or_(
-                        user_role_association.c.empresa_id == empresa_id,
-                        user_role_association.c.empresa_id == None
-                    )
-                ).first() is not None
-
-                # 3. Se for técnico, aplicar restrição: apenas tickets atribuídos ao próprio técnico ou não atribuídos (None)
-                if is_technical:
-                    query = query.filter(
-                        or_(
-                            Ticket.atribuido_para_id == None,
-                            Ticket.atribuido_para_id == current_user_id
-                        )
-                    )
-
-        if status:
-            status_list = [s.strip() for s in status.split(',')]
-            if len(status_list) == 1:
-                query = query.filter(Ticket.status == status_list[0])
-            else:
-                query = query.filter(Ticket.status.in_(status_list))
-        if prioridade:
-            query = query.filter(Ticket.prioridade == prioridade)
-        if categoria:
-            query = query.filter(Ticket.categoria == categoria)
-        if cliente_id:
-            query = query.filter(Ticket.cliente_id == cliente_id)
-        if atribuido_para_id:
-            query = query.filter(Ticket.atribuido_para_id == atribuido_para_id)
-        if search:
-            search_filter = f"%{search}%"
-            query = query.filter(
-                or_(
-                    Ticket.titulo.ilike(search_filter),
-                    Ticket.descricao.ilike(search_filter)
-                )
+        ).order_by(
+            Ticket.created_at.desc(), Ticket.id.desc()
+        ).all()
+
+        if rows:
+            total = rows[0].total
+        elif cursor or skip:
+            # Página vazia depois do fim: o total não veio na consulta
+            total = db.query(func.count(Ticket.id)).filter(*conditions).scalar() or 0
+        else:
+            total = 0
+
+        tickets = [
+            _ticket_dict(
+                row.Ticket,
+                cliente_nome=row.cliente_nome,
+                criado_por_nome=row.criado_por_nome,
+                atribuido_para_nome=row.atribuido_para_nome,
+                resolvido_por_nome=row.resolvido_por_nome,
+                comentarios_count=row.comentarios_count or 0,
+                contrato_numero=row.contrato_numero,
+                contrato_endereco=row.contrato_endereco,
             )
+            for row in rows
+        ]
 
-        query = query.order_by(Ticket.created_at.desc())
-        results = query.offset(skip).limit(limit).all()
-
-        # Converte os resultados para objetos Ticket com dados relacionados
-        tickets = []
-        for row in results:
-            ticket_dict = {
-                'id': row[0].id,
-                'empresa_id': row[0].empresa_id,
-                'cliente_id': row[0].cliente_id,
-                'contrato_id': row[0].contrato_id,
-                'criado_por_id': row[0].criado_por_id,
-                'atribuido_para_id': row[0].atribuido_para_id,
-                'titulo': row[0].titulo,
-                'descricao': row[0].descricao,
-                'status': row[0].status,
-                'prioridade': row[0].prioridade,
-                'categoria': row[0].categoria,
-                'resolucao': row[0].resolucao,
-                'resolvido_em': row[0].resolvido_em,
-                'resolvido_por_id': row[0].resolvido_por_id,
-                'prazo_resolucao': row[0].prazo_resolucao,
-                'tempo_gasto_minutos': row[0].tempo_gasto_minutos,
-                'is_active': row[0].is_active,
-                'created_at': row[0].created_at,
-                'updated_at': row[0].updated_at,
-                'cliente_nome': row[1],
-                'criado_por_nome': row[2],
-                'atribuido_para_nome': row[3],
-                'resolvido_por_nome': row[4],
-                'comentarios_count': row[5] or 0,
-                'contrato_numero': row[6],
-                'contrato_endereco': row[7],
-                'foto_onu_serial': row[0].foto_onu_serial,
-                'foto_equipamentos': row[0].foto_equipamentos,
-                'foto_velocidade': row[0].foto_velocidade,
-                'foto_cto': row[0].foto_cto,
-                'splitter_cto': row[0].splitter_cto,
-                'material_utilizado': row[0].material_utilizado,
-                'problema_encontrado': row[0].problema_encontrado
-            }
-            tickets.append(ticket_dict)
+        next_cursor = None
+        if len(rows) == limit and rows[-1].Ticket.created_at is not None:
+            next_cursor = TicketService.encode_cursor(rows[-1].Ticket.created_at, rows[-1].Ticket.id)
 
-        return tickets
+        return {"data": tickets, "total": total, "next_cursor": next_cursor}
+
+    @staticmethod
+    def get_tickets(
+        db: Session,
+        empresa_id: int,
+        skip: int = 0,
+        limit: int = 100,
+        status: Optional[str] = None,
+        prioridade: Optional[str] = None,
+        categoria: Optional[str] = None,
+        cliente_id: Optional[int] = None,
+        atribuido_para_id: Optional[int] = None,
+        search: Optional[str] = None,
+        current_user_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Busca tickets com filtros opcionais."""
+        return TicketService.list_tickets(
+            db, empresa_id, skip, limit, status, prioridade,
+            categoria, cliente_id, atribuido_para_id, search, current_user_id
+        )["data"]
 
     @staticmethod
     def count_tickets(
@@ -312,76 +400,11 @@ class TicketService:
         current_user_id: Optional[int] = None
     ) -> int:
         """Conta o total de tickets com filtros opcionais."""
-        query = db.query(func.count(Ticket.id)).filter(
-            Ticket.empresa_id == empresa_id,
-            Ticket.is_active == True
+        conditions = TicketService._filter_conditions(
+            db, empresa_id, status, prioridade, categoria,
+            cliente_id, atribuido_para_id, search, current_user_id
         )
-
-        # Filtragem por role "technical"
-        if current_user_id:
-            # 1. Verificar se o usuário é superuser ou administrador da empresa
-            is_admin_or_superuser = False
-            user = db.query(Usuario).filter(Usuario.id == current_user_id).first()
-            if user:
-                if user.is_superuser:
-                    is_admin_or_superuser = True
-                else:
-                    from app.models.models import UsuarioEmpresa
-                    assoc = db.query(UsuarioEmpresa).filter(
-                        UsuarioEmpresa.usuario_id == current_user_id,
-                        UsuarioEmpresa.empresa_id == empresa_id
-                    ).first()
-                    if assoc and assoc.is_admin:
-                        is_admin_or_superuser = True
-
-            # 2. Se não for admin nem superuser, verificar se tem a role "technical"
-            if not is_admin_or_superuser:
-                from app.models.access_control import Role, user_role_association
-                is_technical = db.query(Role).join(
-                    user_role_association,
-                    Role.id == user_role_association.c.role_id
-                ).filter(
-                    user_role_association.c.user_id == current_user_id,
-                    Role.name.ilike("technical"),
-                    or_(
-                        user_role_association.c.empresa_id == empresa_id,
-                        user_role_association.c.empresa_id == None
-                    )
-                ).first() is not None
-
-                # 3. Se for técnico, aplicar restrição: apenas tickets atribuídos ao próprio técnico ou não atribuídos (None)
-                if is_technical:
-                    query = query.filter(
-                        or_(
-                            Ticket.atribuido_para_id == None,
-                            Ticket.atribuido_para_id == current_user_id
-                        )
-                    )
-
-        if status:
-            status_list = [s.strip() for s in status.split(',')]
-            if len(status_list) == 1:
-                query = query.filter(Ticket.status == status_list[0])
-            else:
-                query = query.filter(Ticket.status.in_(status_list))
-        if prioridade:
-            query = query.filter(Ticket.prioridade == prioridade)
-        if categoria:
-            query = query.filter(Ticket.categoria == categoria)
-        if cliente_id:
-            query = query.filter(Ticket.cliente_id == cliente_id)
-        if atribuido_para_id:
-            query = query.filter(Ticket.atribuido_para_id == atribuido_para_id)
-        if search:
-            search_filter = f"%{search}%"
-            query = query.filter(
-                or_(
-                    Ticket.titulo.ilike(search_filter),
-                    Ticket.descricao.ilike(search_filter)
-                )
-            )
-
-        return query.scalar() or 0
+        return db.query(func.count(Ticket.id)).filter(*conditions).scalar() or 0
 
     @staticmethod
     def get_ticket_by_id(db: Session, ticket_id: int, empresa_id: int) -> Optional[Dict[str, Any]]:
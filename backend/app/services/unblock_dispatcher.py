@@ -0,0 +1,294 @@
+"""
+Desbloqueio de rede adiado e em lote após a confirmação de pagamento
+
+As rotas de pagamento (webhooks do BB e do Mercado Pago, pagamento pelo
+checkout, baixa manual/caixa, conciliação BB e retorno CNAB) e o script de
+reconciliação chamam enqueue() com os contratos depois do commit e seguem
+sem esperar o roteador. Ações administrativas (ativação de contrato
+suspenso, bloqueio automático por roteador) continuam síncronas.
+Os pedidos ficam na tabela unblock_outbox, então sobrevivem a
+restart/deploy e são vistos por todos os processos.
+
+Um worker em background junta os pedidos que chegarem em
+UNBLOCK_BATCH_WINDOW segundos (contando a partir do mais antigo na fila) e
+aplica tudo com uma única chamada a isp_service.run_router_actions, que
+agrupa por roteador e usa uma sessão RouterOS por roteador, em vez de um
+login por cobrança:
+
+- um contrato com pedido pendente não é enfileirado de novo;
+- o lote é reservado com UPDATE ... WHERE status = 'pending' e um
+  claim_token, então mais de um processo pode rodar o worker;
+- contratos que não estão mais suspensos/pendentes de instalação ficam
+  como 'skipped'; falhas voltam para a fila com backoff exponencial a
+  partir de UNBLOCK_RETRY_BASE segundos, até UNBLOCK_MAX_ATTEMPTS
+  tentativas, e depois ficam como 'failed' (o bloqueio automático,
+  scripts/auto_block_clients.py, continua como rede de segurança);
+- pedidos presos em 'processing' por mais de UNBLOCK_PROCESSING_TIMEOUT
+  segundos (processo encerrado no meio do lote) voltam para 'pending'.
+
+queue_status() expõe a profundidade da fila e a latência entre o
+enfileiramento e o desbloqueio.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.models.models import ServicoContratado, StatusContrato, UnblockRequest
+
+logger = logging.getLogger(__name__)
+
+UNBLOCK_BATCH_WINDOW = float(os.environ.get("UNBLOCK_BATCH_WINDOW", "3"))
+UNBLOCK_MAX_BATCH = int(os.environ.get("UNBLOCK_MAX_BATCH", "500"))
+UNBLOCK_MAX_ATTEMPTS = int(os.environ.get("UNBLOCK_MAX_ATTEMPTS", "3"))
+UNBLOCK_RETRY_BASE = float(os.environ.get("UNBLOCK_RETRY_BASE", "60"))
+UNBLOCK_RETRY_MAX = float(os.environ.get("UNBLOCK_RETRY_MAX", "1800"))
+UNBLOCK_PROCESSING_TIMEOUT = float(os.environ.get("UNBLOCK_PROCESSING_TIMEOUT", "600"))
+UNBLOCK_QUEUE_POLL = float(os.environ.get("UNBLOCK_QUEUE_POLL", "2"))
+
+STATUSES = ('pending', 'processing', 'done', 'skipped', 'failed')
+_OPEN = ('pending', 'processing')
+_UNBLOCKABLE = (StatusContrato.SUSPENSO, StatusContrato.PENDENTE_INSTALACAO)
+
+_lock = threading.Lock()
+_wake = threading.Event()
+_worker_thread: Optional[threading.Thread] = None
+
+
+def enqueue(contrato_ids: Iterable[Optional[int]]) -> int:
+    """Agenda o desbloqueio dos contratos (ids nulos são ignorados). Retorna quantos entraram na fila.
+
+    Deve ser chamado depois do commit da baixa, para o worker ver o pagamento gravado.
+    """
+    ids = {contrato_id for contrato_id in contrato_ids if contrato_id}
+    if not ids:
+        return 0
+
+    from app.core.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        na_fila = {
+            contrato_id for (contrato_id,) in db.query(UnblockRequest.contrato_id).filter(
+                UnblockRequest.contrato_id.in_(ids),
+                UnblockRequest.status.in_(_OPEN),
+            ).distinct()
+        }
+        now = datetime.now()
+        novos = sorted(ids - na_fila)
+        for contrato_id in novos:
+            db.add(UnblockRequest(
+                contrato_id=contrato_id,
+                status='pending',
+                attempts=0,
+                next_attempt_at=now,
+                created_at=now,
+            ))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"[Unblock] Erro ao enfileirar desbloqueio dos contratos {sorted(ids)}: {e}", exc_info=True)
+        return 0
+    finally:
+        db.close()
+    if novos:
+        _wake.set()
+    return len(novos)
+
+
+def _backoff(attempts: int) -> float:
+    return min(UNBLOCK_RETRY_MAX, UNBLOCK_RETRY_BASE * (2 ** max(0, attempts - 1)))
+
+
+def recover_stale(db: Session) -> int:
+    """Devolve para 'pending' os pedidos presos em 'processing' há mais de UNBLOCK_PROCESSING_TIMEOUT."""
+    limit = datetime.now() - timedelta(seconds=UNBLOCK_PROCESSING_TIMEOUT)
+    count = db.query(UnblockRequest).filter(
+        UnblockRequest.status == 'processing',
+        UnblockRequest.locked_at < limit,
+    ).update({
+        UnblockRequest.status: 'pending',
+        UnblockRequest.locked_at: None,
+        UnblockRequest.claim_token: None,
+    }, synchronize_session=False)
+    db.commit()
+    if count:
+        logger.warning(f"[Unblock] {count} pedido(s) preso(s) em processamento voltaram para a fila")
+    return count
+
+
+def _claim_batch(db: Session) -> Optional[str]:
+    """Reserva até UNBLOCK_MAX_BATCH pedidos vencidos; retorna o claim_token (None se nada foi reservado)."""
+    ids = [
+        request_id for (request_id,) in db.query(UnblockRequest.id).filter(
+            UnblockRequest.status == 'pending',
+            UnblockRequest.next_attempt_at <= datetime.now(),
+        ).order_by(UnblockRequest.id).limit(max(1, UNBLOCK_MAX_BATCH))
+    ]
+    if not ids:
+        return None
+    token = str(uuid.uuid4())
+    claimed = db.query(UnblockRequest).filter(
+        UnblockRequest.id.in_(ids),
+        UnblockRequest.status == 'pending',
+    ).update({
+        UnblockRequest.status: 'processing',
+        UnblockRequest.claim_token: token,
+        UnblockRequest.locked_at: datetime.now(),
+        UnblockRequest.attempts: UnblockRequest.attempts + 1,
+    }, synchronize_session=False)
+    db.commit()
+    return token if claimed else None  # 0: reservados por outro processo
+
+
+def run_batch(db: Session, token: str) -> Dict[int, bool]:
+    """Aplica os desbloqueios do lote reservado com `token`; retorna {contrato_id: sucesso}."""
+    from app.services.isp_service import ACAO_DESBLOQUEIO, run_router_actions
+
+    started = time.monotonic()
+    pedidos = db.query(UnblockRequest).filter(UnblockRequest.claim_token == token).all()
+    contratos = sorted({req.contrato_id for req in pedidos})
+    desbloqueaveis = {
+        contrato_id for (contrato_id,) in db.query(ServicoContratado.id).filter(
+            ServicoContratado.id.in_(contratos),
+            ServicoContratado.status.in_(_UNBLOCKABLE),
+        )
+    }
+    error = None
+    try:
+        resultados = run_router_actions(
+            db, [(ACAO_DESBLOQUEIO, contrato_id) for contrato_id in contratos if contrato_id in desbloqueaveis]
+        )
+    except Exception as e:
+        db.rollback()
+        logger.error(f"[Unblock] Erro ao desbloquear lote de {len(contratos)} contrato(s): {e}", exc_info=True)
+        pedidos = db.query(UnblockRequest).filter(UnblockRequest.claim_token == token).all()
+        resultados, error = {}, str(e) or e.__class__.__name__
+
+    # O resultado dos pedidos é gravado na mesma transação que o status dos contratos
+    now = datetime.now()
+    falhas = []
+    for req in pedidos:
+        req.locked_at = None
+        req.claim_token = None
+        if req.contrato_id not in desbloqueaveis:
+            req.status = 'skipped'
+            req.processed_at = now
+        elif resultados.get(req.contrato_id):
+            req.status = 'done'
+            req.processed_at = now
+            req.last_error = None
+        else:
+            falhas.append(req.contrato_id)
+            req.last_error = (error or "Desbloqueio não confirmado pelo roteador/RADIUS")[:500]
+            if req.attempts < UNBLOCK_MAX_ATTEMPTS:
+                req.status = 'pending'
+                req.next_attempt_at = now + timedelta(seconds=_backoff(req.attempts))
+            else:
+                req.status = 'failed'
+                req.processed_at = now
+    db.commit()
+
+    logger.info(
+        f"[Unblock] Lote de {len(contratos)} contrato(s) em {time.monotonic() - started:.2f}s "
+        f"(ignorados: {len(contratos) - len(desbloqueaveis)}, falhas: {len(falhas)})"
+    )
+    if falhas:
+        logger.warning(f"[Unblock] Contratos não desbloqueados: {falhas}")
+    return {contrato_id: bool(resultados.get(contrato_id)) for contrato_id in contratos}
+
+
+def dispatch_pending(db: Session) -> float:
+    """Processa um lote quando o pedido mais antigo completa a janela.
+
+    Retorna quantos segundos o worker pode esperar antes da próxima rodada.
+    """
+    oldest = db.query(func.min(UnblockRequest.next_attempt_at)).filter(
+        UnblockRequest.status == 'pending',
+    ).scalar()
+    if oldest is None:
+        return UNBLOCK_QUEUE_POLL
+    restante = UNBLOCK_BATCH_WINDOW - (datetime.now() - oldest).total_seconds()
+    if restante > 0:
+        return min(UNBLOCK_QUEUE_POLL, restante)
+    token = _claim_batch(db)
+    if token is not None:
+        run_batch(db, token)
+    return 0.0
+
+
+def queue_status(db: Session, empresa_id: Optional[int] = None) -> Dict[str, Any]:
+    """Pedidos por status, idade do mais antigo na fila e latência enfileiramento -> desbloqueio."""
+    def _scoped(q):
+        if empresa_id is None:
+            return q
+        return q.join(ServicoContratado, ServicoContratado.id == UnblockRequest.contrato_id).filter(
+            ServicoContratado.empresa_id == empresa_id
+        )
+
+    totals = dict.fromkeys(STATUSES, 0)
+    for status, count in _scoped(
+        db.query(UnblockRequest.status, func.count(UnblockRequest.id))
+    ).group_by(UnblockRequest.status).all():
+        totals[status] = count
+
+    now = datetime.now()
+    oldest = _scoped(db.query(func.min(UnblockRequest.created_at))).filter(
+        UnblockRequest.status.in_(_OPEN)
+    ).scalar()
+    recentes = _scoped(db.query(UnblockRequest.created_at, UnblockRequest.processed_at)).filter(
+        UnblockRequest.status == 'done'
+    ).order_by(UnblockRequest.processed_at.desc()).limit(200).all()
+    latencias = sorted((processed - created).total_seconds() for created, processed in recentes)
+    return {
+        "totals": totals,
+        "oldest_pending_seconds": round((now - oldest).total_seconds(), 3) if oldest is not None else None,
+        "last_unblock_at": recentes[0][1] if recentes else None,
+        "latency_seconds": {
+            "samples": len(latencias),
+            "avg": round(sum(latencias) / len(latencias), 3) if latencias else None,
+            "p95": round(latencias[int(0.95 * (len(latencias) - 1))], 3) if latencias else None,
+            "max": round(latencias[-1], 3) if latencias else None,
+        },
+        "batch_window": UNBLOCK_BATCH_WINDOW,
+        "worker_alive": _worker_thread is not None and _worker_thread.is_alive(),
+    }
+
+
+def _unblock_worker():
+    """Loop do worker: acorda a cada enfileiramento ou UNBLOCK_QUEUE_POLL e processa os lotes vencidos."""
+    from app.core.database import SessionLocal
+    logger.info("[Unblock] Iniciando worker de desbloqueio em lote...")
+
+    last_recover = None
+    while True:
+        _wake.clear()
+        wait = UNBLOCK_QUEUE_POLL
+        db = SessionLocal()
+        try:
+            if last_recover is None or time.monotonic() - last_recover >= UNBLOCK_PROCESSING_TIMEOUT / 2:
+                recover_stale(db)
+                last_recover = time.monotonic()
+            wait = dispatch_pending(db)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"[Unblock] Erro no worker de desbloqueio: {e}", exc_info=True)
+        finally:
+            db.close()
+        _wake.wait(max(0.05, wait))
+
+
+def start_unblock_worker():
+    # Thread em modo daemon: será encerrada automaticamente quando o servidor FastAPI parar
+    global _worker_thread
+    with _lock:
+        if _worker_thread is not None and _worker_thread.is_alive():
+            return
+        _worker_thread = threading.Thread(target=_unblock_worker, name="unblock-dispatcher", daemon=True)
+        _worker_thread.start()
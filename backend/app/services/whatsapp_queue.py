@@ -1,67 +1,329 @@
+"""
+Fila de saída do WhatsApp persistida no banco (tabela whatsapp_outbox)
+
+O WhatsAppService grava as mensagens com enqueue() e retorna na hora; um
+dispatcher em background entrega as pendentes, inclusive as que ficaram na
+tabela de antes de um restart/deploy:
+
+- cada instância da Evolution API tem um token bucket próprio
+  (WHATSAPP_RATE_PER_MIN mensagens por minuto, rajada de até
+  WHATSAPP_RATE_BURST), no lugar da espera fixa de 5 s após cada envio;
+- instâncias diferentes enviam em paralelo (até WHATSAPP_WORKERS envios
+  simultâneos); cada instância tem no máximo um envio em andamento, na
+  ordem de chegada;
+- falhas temporárias (WhatsAppSendError, inclusive instância desconectada,
+  ou exceção) voltam para a fila com backoff exponencial a partir de
+  WHATSAPP_RETRY_BASE segundos, até WHATSAPP_MAX_ATTEMPTS tentativas;
+  depois disso, ou se o envio for recusado (ex.: telefone inválido), a
+  mensagem fica como 'failed'.
+
+A mensagem é reservada com UPDATE ... WHERE status = 'pending', então mais
+de um processo pode rodar o dispatcher sem envio duplicado (o rate limit é
+por processo). Mensagens presas em 'sending' por mais de
+WHATSAPP_SENDING_TIMEOUT segundos (processo encerrado no meio do envio)
+voltam para 'pending'.
+"""
+import logging
+import os
 import threading
-import queue
 import time
-import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.models.models import Empresa, WhatsAppMessage
 
 logger = logging.getLogger(__name__)
 
-# Fila thread-safe em memória
-wa_queue = queue.Queue()
+WHATSAPP_RATE_PER_MIN = float(os.environ.get("WHATSAPP_RATE_PER_MIN", "12"))
+WHATSAPP_RATE_BURST = int(os.environ.get("WHATSAPP_RATE_BURST", "1"))
+WHATSAPP_WORKERS = int(os.environ.get("WHATSAPP_WORKERS", "4"))
+WHATSAPP_MAX_ATTEMPTS = int(os.environ.get("WHATSAPP_MAX_ATTEMPTS", "5"))
+WHATSAPP_RETRY_BASE = float(os.environ.get("WHATSAPP_RETRY_BASE", "30"))
+WHATSAPP_RETRY_MAX = float(os.environ.get("WHATSAPP_RETRY_MAX", "1800"))
+WHATSAPP_SENDING_TIMEOUT = float(os.environ.get("WHATSAPP_SENDING_TIMEOUT", "300"))
+WHATSAPP_QUEUE_POLL = float(os.environ.get("WHATSAPP_QUEUE_POLL", "2"))
+
+STATUSES = ('pending', 'sending', 'sent', 'failed')
+
 
 class MockEmpresa:
     """Classe mock para não passar instâncias do SQLAlchemy entre threads"""
     pass
 
-def _wa_worker():
-    """
-    Worker que processa os disparos do WhatsApp em background.
-    Garante o intervalo fixo de 5 segundos entre as mensagens para evitar
-    quedas na Evolution API (anti-spam).
+
+class _TokenBucket:
+    """Token bucket de uma instância (rate <= 0 desliga o limite)."""
+
+    def __init__(self, rate_per_min: float, burst: int):
+        self.rate = rate_per_min / 60.0
+        self.capacity = float(max(1, burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self) -> float:
+        """Segundos até haver um token disponível (0 se já houver)."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+_buckets: Dict[str, _TokenBucket] = {}
+_busy = set()  # instâncias com envio em andamento
+_lock = threading.Lock()
+_wake = threading.Event()
+_executor: Optional[ThreadPoolExecutor] = None
+_dispatcher_thread: Optional[threading.Thread] = None
+
+
+def enqueue(
+    empresa,
+    to_phone: str,
+    message: Optional[str],
+    is_media: bool = False,
+    file_data: Optional[str] = None,
+    file_name: Optional[str] = None,
+) -> bool:
+    """Grava a mensagem na fila (sessão própria, já confirmada). Retorna False se não gravar."""
+    from app.core.database import SessionLocal
+    from app.services.whatsapp_service import WhatsAppService
+
+    db = SessionLocal()
+    try:
+        db.add(WhatsAppMessage(
+            empresa_id=getattr(empresa, "id", None),
+            instance=WhatsAppService._instance_name(empresa),
+            to_phone=to_phone,
+            message=message,
+            is_media=is_media,
+            file_name=file_name,
+            file_data=file_data,
+            status='pending',
+            attempts=0,
+            next_attempt_at=datetime.now(),
+        ))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"[WA Queue] Erro ao enfileirar mensagem para {to_phone}: {e}", exc_info=True)
+        return False
+    finally:
+        db.close()
+    _wake.set()
+    return True
+
+
+def _backoff(attempts: int) -> float:
+    return min(WHATSAPP_RETRY_MAX, WHATSAPP_RETRY_BASE * (2 ** max(0, attempts - 1)))
+
+
+def _bucket(instance: str) -> _TokenBucket:
+    bucket = _buckets.get(instance)
+    if bucket is None:
+        bucket = _buckets[instance] = _TokenBucket(WHATSAPP_RATE_PER_MIN, WHATSAPP_RATE_BURST)
+    return bucket
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(1, WHATSAPP_WORKERS), thread_name_prefix="wa-send")
+    return _executor
+
+
+def recover_stale(db: Session) -> int:
+    """Devolve para 'pending' as mensagens presas em 'sending' há mais de WHATSAPP_SENDING_TIMEOUT."""
+    limit = datetime.now() - timedelta(seconds=WHATSAPP_SENDING_TIMEOUT)
+    count = db.query(WhatsAppMessage).filter(
+        WhatsAppMessage.status == 'sending',
+        WhatsAppMessage.locked_at < limit,
+    ).update({WhatsAppMessage.status: 'pending', WhatsAppMessage.locked_at: None}, synchronize_session=False)
+    db.commit()
+    if count:
+        logger.warning(f"[WA Queue] {count} mensagem(ns) presa(s) em envio voltaram para a fila")
+    return count
+
+
+def _claim(db: Session, message_id: int) -> bool:
+    claimed = db.query(WhatsAppMessage).filter(
+        WhatsAppMessage.id == message_id,
+        WhatsAppMessage.status == 'pending',
+    ).update({
+        WhatsAppMessage.status: 'sending',
+        WhatsAppMessage.locked_at: datetime.now(),
+        WhatsAppMessage.attempts: WhatsAppMessage.attempts + 1,
+    }, synchronize_session=False)
+    db.commit()
+    return claimed == 1
+
+
+def dispatch_pending(db: Session) -> float:
+    """Reserva e despacha a próxima mensagem de cada instância liberada pelo rate limit.
+
+    Retorna quantos segundos o dispatcher pode esperar antes da próxima rodada.
     """
+    with _lock:
+        busy = set(_busy)
+    if len(busy) >= WHATSAPP_WORKERS:
+        return WHATSAPP_QUEUE_POLL
+
+    q = db.query(WhatsAppMessage.instance, func.min(WhatsAppMessage.id)).filter(
+        WhatsAppMessage.status == 'pending',
+        WhatsAppMessage.next_attempt_at <= datetime.now(),
+    )
+    if busy:
+        q = q.filter(WhatsAppMessage.instance.notin_(busy))
+    heads = q.group_by(WhatsAppMessage.instance).order_by(func.min(WhatsAppMessage.id)).all()
+
+    wait = WHATSAPP_QUEUE_POLL
+    for instance, message_id in heads:
+        if len(busy) >= WHATSAPP_WORKERS:
+            break
+        bucket = _bucket(instance)
+        delay = bucket.wait_time()
+        if delay > 0:
+            wait = min(wait, delay)
+            continue
+        if not _claim(db, message_id):
+            continue  # reservada por outro processo
+        bucket.take()
+        busy.add(instance)
+        with _lock:
+            _busy.add(instance)
+        _get_executor().submit(_deliver, message_id, instance)
+    return wait
+
+
+def _empresa_for(db: Session, msg: WhatsAppMessage) -> MockEmpresa:
+    empresa = MockEmpresa()
+    db_empresa = db.get(Empresa, msg.empresa_id) if msg.empresa_id else None
+    empresa.id = msg.empresa_id
+    empresa.razao_social = getattr(db_empresa, "razao_social", None) or "Desconhecida"
+    empresa.whatsapp_api_server = getattr(db_empresa, "whatsapp_api_server", None)
+    empresa.whatsapp_api_system = getattr(db_empresa, "whatsapp_api_system", None)
+    empresa.whatsapp_api_instance = msg.instance
+    return empresa
+
+
+def _deliver(message_id: int, instance: str) -> None:
+    """Executado no pool: envia uma mensagem reservada e grava o resultado."""
+    from app.core.database import SessionLocal
     from app.services.whatsapp_service import WhatsAppService
+
+    db = SessionLocal()
+    try:
+        msg = db.get(WhatsAppMessage, message_id)
+        if msg is None:
+            return
+        logger.info(f"[WA Queue] Processando mensagem {msg.id} para {msg.to_phone} (instância {instance})")
+        error = None
+        try:
+            empresa = _empresa_for(db, msg)
+            if msg.is_media:
+                sent = WhatsAppService._send_document_sync_real(
+                    empresa, msg.to_phone, msg.message or "", msg.file_data, msg.file_name, raise_on_error=True
+                )
+            else:
+                sent = WhatsAppService._send_message_sync_real(empresa, msg.to_phone, msg.message or "", raise_on_error=True)
+            retry = False
+            if not sent:
+                error = "Envio recusado"
+        except Exception as e:
+            sent, retry, error = False, True, str(e) or e.__class__.__name__
+
+        msg.locked_at = None
+        if sent:
+            msg.status = 'sent'
+            msg.sent_at = datetime.now()
+            msg.last_error = None
+            msg.file_data = None  # o documento não é mais necessário
+        elif retry and msg.attempts < WHATSAPP_MAX_ATTEMPTS:
+            delay = _backoff(msg.attempts)
+            msg.status = 'pending'
+            msg.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+            msg.last_error = error[:500]
+            logger.warning(f"[WA Queue] Falha ao enviar mensagem {msg.id} ({error}); nova tentativa em {delay:.0f}s")
+        else:
+            msg.status = 'failed'
+            msg.last_error = error[:500]
+            logger.error(f"[WA Queue] Mensagem {msg.id} para {msg.to_phone} falhou após {msg.attempts} tentativa(s): {error}")
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"[WA Queue] Erro ao processar a mensagem {message_id}: {e}", exc_info=True)
+    finally:
+        db.close()
+        with _lock:
+            _busy.discard(instance)
+        _wake.set()
+
+
+def queue_status(db: Session, empresa_id: int) -> Dict[str, Any]:
+    """Quantidade de mensagens da empresa por status, no total e por instância."""
+    rows = db.query(
+        WhatsAppMessage.instance, WhatsAppMessage.status, func.count(WhatsAppMessage.id)
+    ).filter(
+        WhatsAppMessage.empresa_id == empresa_id
+    ).group_by(WhatsAppMessage.instance, WhatsAppMessage.status).all()
+
+    totals = dict.fromkeys(STATUSES, 0)
+    instances: Dict[str, Dict[str, int]] = {}
+    for instance, status, count in rows:
+        totals[status] = totals.get(status, 0) + count
+        instances.setdefault(instance, dict.fromkeys(STATUSES, 0))[status] = count
+
+    next_pending = db.query(func.min(WhatsAppMessage.next_attempt_at)).filter(
+        WhatsAppMessage.empresa_id == empresa_id,
+        WhatsAppMessage.status == 'pending',
+    ).scalar()
+    return {
+        "totals": totals,
+        "instances": instances,
+        "next_attempt_at": next_pending,
+        "rate_per_min": WHATSAPP_RATE_PER_MIN,
+        "workers": WHATSAPP_WORKERS,
+    }
+
+
+def _wa_dispatcher():
+    """Loop do dispatcher: acorda a cada enfileiramento, envio concluído ou WHATSAPP_QUEUE_POLL."""
+    from app.core.database import SessionLocal
     logger.info("[WA Queue] Iniciando worker de fila do WhatsApp (Brazcom ISP)...")
-    
+
+    last_recover = None
     while True:
+        _wake.clear()
+        wait = WHATSAPP_QUEUE_POLL
+        db = SessionLocal()
         try:
-            task = wa_queue.get()
-            if task is None:
-                # Sinal para finalizar a thread (usado no shutdown)
-                break
-                
-            empresa_data = task.get("empresa")
-            to_phone = task.get("to_phone")
-            message = task.get("message")
-            is_media = task.get("is_media", False)
-            file_data = task.get("file_data")
-            file_name = task.get("file_name")
-            
-            # Recria o objeto mock da empresa para o WhatsAppService
-            empresa = MockEmpresa()
-            for k, v in empresa_data.items():
-                setattr(empresa, k, v)
-                
-            logger.info(f"[WA Queue] Processando mensagem para {to_phone}")
-            
-            # Chama o método síncrono real de envio na WhatsAppService
-            if is_media:
-                WhatsAppService._send_document_sync_real(empresa, to_phone, message, file_data, file_name)
-            else:
-                WhatsAppService._send_message_sync_real(empresa, to_phone, message)
-                
-            # Informa que a tarefa foi concluída
-            wa_queue.task_done()
-            
-            # RATE LIMIT (5 Segundos de espera obrigatória entre envios)
-            time.sleep(5)
-            
+            if last_recover is None or time.monotonic() - last_recover >= WHATSAPP_SENDING_TIMEOUT / 2:
+                recover_stale(db)
+                last_recover = time.monotonic()
+            wait = dispatch_pending(db)
         except Exception as e:
+            db.rollback()
             logger.error(f"[WA Queue] Erro no processamento da fila: {e}", exc_info=True)
-            time.sleep(5)
+        finally:
+            db.close()
+        _wake.wait(max(0.05, wait))
 
-# Thread em modo daemon: será encerrada automaticamente quando o servidor FastAPI parar
-_worker_thread = threading.Thread(target=_wa_worker, daemon=True)
 
 def start_whatsapp_worker():
-    if not _worker_thread.is_alive():
-        _worker_thread.start()
-        logger.info("[WA Queue] Fila iniciada com sucesso.")
+    # Thread em modo daemon: será encerrada automaticamente quando o servidor FastAPI parar
+    global _dispatcher_thread
+    with _lock:
+        if _dispatcher_thread is not None and _dispatcher_thread.is_alive():
+            return
+        _dispatcher_thread = threading.Thread(target=_wa_dispatcher, name="wa-dispatcher", daemon=True)
+        _dispatcher_thread.start()
+    logger.info("[WA Queue] Fila iniciada com sucesso.")
@@ -2,12 +2,25 @@ import logging
 import os
 import re
 import requests
+import threading
 import time
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 from app.models.models import Empresa
 
 logger = logging.getLogger(__name__)
 
+# Por quanto tempo (segundos) o estado de conexão de uma instância é reaproveitado pelos envios da fila
+WHATSAPP_CONN_STATE_TTL = float(os.getenv("WHATSAPP_CONN_STATE_TTL", "30"))
+
+DEFAULT_INSTANCE = 'mega-net-telecom'
+
+_conn_state_cache: Dict[Tuple[str, str], Tuple[float, Dict[str, Any]]] = {}
+_conn_state_lock = threading.Lock()
+
+
+class WhatsAppSendError(Exception):
+    """Falha temporária da Evolution API ao enviar (a fila tenta de novo com backoff)."""
+
 class WhatsAppService:
     """Serviço para envio de mensagens via WhatsApp (Integração real com Evolution API & Simulação Local)"""
 
@@ -37,41 +50,33 @@ class WhatsAppService:
             url = os.getenv("EVOLUTION_API_URL", "http://localhost:8080")
         return url
 
+    @staticmethod
+    def _instance_name(empresa: Empresa) -> str:
+        return getattr(empresa, 'whatsapp_api_instance', DEFAULT_INSTANCE) or DEFAULT_INSTANCE
+
     @staticmethod
     def send_message(empresa: Empresa, to_phone: str, message: str) -> bool:
         """
-        Coloca a mensagem na fila assíncrona do WhatsApp para evitar bloqueio por anti-spam.
-        Retorna True imediatamente.
+        Coloca a mensagem na fila de saída do WhatsApp (whatsapp_queue), que respeita
+        o rate limit da instância. Retorna True assim que a mensagem é gravada.
         """
-        from app.services.whatsapp_queue import wa_queue
+        from app.services.whatsapp_queue import enqueue
         
         cleaned_phone = WhatsAppService._clean_phone(to_phone)
         if not cleaned_phone:
             logger.error("Número de telefone inválido para envio de WhatsApp")
             return False
             
-        empresa_data = {
-            "id": getattr(empresa, "id", None),
-            "razao_social": getattr(empresa, "razao_social", "Desconhecida"),
-            "whatsapp_api_server": getattr(empresa, "whatsapp_api_server", None),
-            "whatsapp_api_instance": getattr(empresa, "whatsapp_api_instance", None),
-            "whatsapp_api_system": getattr(empresa, "whatsapp_api_system", None),
-        }
-        
-        wa_queue.put({
-            "empresa": empresa_data,
-            "to_phone": to_phone,
-            "message": message,
-            "is_media": False
-        })
-        
-        return True
+        return enqueue(empresa, to_phone, message)
 
     @staticmethod
-    def _send_message_sync_real(empresa: Empresa, to_phone: str, message: str) -> bool:
+    def _send_message_sync_real(empresa: Empresa, to_phone: str, message: str, raise_on_error: bool = False) -> bool:
         """
         Envia uma mensagem de WhatsApp real via Evolution API com fallback de simulação em log local.
         (Chamado pelo worker da fila)
+
+        Com raise_on_error, instância desconectada ou falha no envio levantam
+        WhatsAppSendError em vez de cair na simulação.
         """
         try:
             cleaned_phone = WhatsAppService._clean_phone(to_phone)
@@ -79,7 +84,7 @@ class WhatsAppService:
                 logger.error("Número de telefone inválido para envio de WhatsApp")
                 return False
 
-            instance_name = getattr(empresa, 'whatsapp_api_instance', 'mega-net-telecom') or 'mega-net-telecom'
+            instance_name = WhatsAppService._instance_name(empresa)
             system_name = getattr(empresa, 'whatsapp_api_system', 'MK Auth') or 'MK Auth'
             
             # 1. Tenta envio via Evolution API (Real)
@@ -88,8 +93,10 @@ class WhatsAppService:
             
             if api_url:
                 # 1.1 Verificar se a instância está conectada antes de tentar o envio real para evitar timeouts longos
-                conn = WhatsAppService.get_connection_state(empresa)
+                conn = WhatsAppService.get_connection_state(empresa, use_cache=True)
                 if not conn.get("connected", False):
+                    if raise_on_error:
+                        raise WhatsAppSendError(f"Instância '{instance_name}' desconectada (Status: {conn.get('state', 'desconhecido')})")
                     logger.warning(f"Instância WhatsApp '{instance_name}' não está ativa/conectada (Status: {conn.get('state', 'desconhecido')}). Ativando fallback de simulação local.")
                 else:
                     if api_url.endswith("/"):
@@ -113,8 +120,13 @@ class WhatsAppService:
                             return True
                         else:
                             logger.warning(f"Brazcom API retornou status {response.status_code}: {response.text}. Ativando fallback de simulação.")
+                            api_error = f"HTTP {response.status_code}"
                     except Exception as api_err:
                         logger.warning(f"Falha de conexão com a Brazcom API ({api_err}). Ativando fallback de simulação local.")
+                        api_error = str(api_err)
+                    if raise_on_error:
+                        WhatsAppService.invalidate_connection_state(empresa)
+                        raise WhatsAppSendError(api_error)
             
             # 2. Fallback de Simulação em arquivo local de logs (Garante que nunca quebra o fluxo local)
             logger.info("=========================================")
@@ -134,6 +146,8 @@ class WhatsAppService:
                 f.write(f"[{empresa.razao_social}] Para: {cleaned_phone} | Msg: {clean_msg}\n")
 
             return True
+        except WhatsAppSendError:
+            raise
         except Exception as e:
             logger.error(f"Erro ao disparar mensagem de WhatsApp: {e}", exc_info=True)
             return False
@@ -146,10 +160,10 @@ class WhatsAppService:
         file_path: str
     ) -> bool:
         """
-        Coloca o documento na fila assíncrona do WhatsApp.
-        Retorna True imediatamente.
+        Coloca o documento na fila de saída do WhatsApp.
+        Retorna True assim que a mensagem é gravada.
         """
-        from app.services.whatsapp_queue import wa_queue
+        from app.services.whatsapp_queue import enqueue
         
         cleaned_phone = WhatsAppService._clean_phone(to_phone)
         if not cleaned_phone:
@@ -166,23 +180,7 @@ class WhatsAppService:
             logger.error(f"Erro ao ler o documento PDF antes de enfileirar: {e}")
             return False
             
-        empresa_data = {
-            "id": getattr(empresa, "id", None),
-            "razao_social": getattr(empresa, "razao_social", "Desconhecida"),
-            "whatsapp_api_server": getattr(empresa, "whatsapp_api_server", None),
-            "whatsapp_api_instance": getattr(empresa, "whatsapp_api_instance", None),
-            "whatsapp_api_system": getattr(empresa, "whatsapp_api_system", None),
-        }
-        
-        wa_queue.put({
-            "empresa": empresa_data,
-            "to_phone": to_phone,
-            "is_media": True,
-            "file_data": file_data,
-            "file_name": file_name
-        })
-        
-        return True
+        return enqueue(empresa, to_phone, caption, is_media=True, file_data=file_data, file_name=file_name)
 
     @staticmethod
     def send_document_base64(
@@ -195,31 +193,14 @@ class WhatsAppService:
         """
         Enfileira um documento (PDF) que JÁ ESTÁ em base64.
         """
-        from app.services.whatsapp_queue import wa_queue
+        from app.services.whatsapp_queue import enqueue
         
         cleaned_phone = WhatsAppService._clean_phone(to_phone)
         if not cleaned_phone:
             logger.error("Número de telefone inválido para envio de documento WhatsApp")
             return False
             
-        empresa_data = {
-            "id": getattr(empresa, "id", None),
-            "razao_social": getattr(empresa, "razao_social", "Desconhecida"),
-            "whatsapp_api_server": getattr(empresa, "whatsapp_api_server", None),
-            "whatsapp_api_instance": getattr(empresa, "whatsapp_api_instance", None),
-            "whatsapp_api_system": getattr(empresa, "whatsapp_api_system", None),
-        }
-        
-        wa_queue.put({
-            "empresa": empresa_data,
-            "to_phone": to_phone,
-            "message": caption,
-            "is_media": True,
-            "file_data": file_data,
-            "file_name": file_name
-        })
-        
-        return True
+        return enqueue(empresa, to_phone, caption, is_media=True, file_data=file_data, file_name=file_name)
 
     @staticmethod
     def _send_document_sync_real(
@@ -227,11 +208,12 @@ class WhatsAppService:
         to_phone: str,
         caption: str,
         file_data: str,
-        file_name: str
+        file_name: str,
+        raise_on_error: bool = False
     ) -> bool:
         """
         Envia um documento via WhatsApp API usando message/sendMedia
-        (Chamado pelo worker da fila)
+        (Chamado pelo worker da fila; raise_on_error como em _send_message_sync_real)
         """
         if not to_phone:
             return False
@@ -246,10 +228,12 @@ class WhatsAppService:
             if system_name == "evolution_api":
                 api_url = WhatsAppService._get_api_url(empresa)
                 api_key = os.getenv("EVOLUTION_API_TOKEN", "brazcom_secure_token_12345")
-                instance_name = getattr(empresa, 'whatsapp_api_instance', 'mega-net-telecom') or 'mega-net-telecom'
+                instance_name = WhatsAppService._instance_name(empresa)
 
-                conn = WhatsAppService.get_connection_state(empresa)
+                conn = WhatsAppService.get_connection_state(empresa, use_cache=True)
                 if not conn.get("connected", False):
+                    if raise_on_error:
+                        raise WhatsAppSendError(f"Instância '{instance_name}' desconectada (Status: {conn.get('state', 'desconhecido')})")
                     logger.warning(f"Instância WhatsApp '{instance_name}' não está ativa/conectada. Ativando fallback local para arquivo.")
                 else:
                     if api_url.endswith("/"):
@@ -298,8 +282,13 @@ class WhatsAppService:
                             return True
                         else:
                             logger.warning(f"Brazcom API retornou status {response.status_code}: {response.text}.")
+                            api_error = f"HTTP {response.status_code}"
                     except Exception as api_err:
                         logger.warning(f"Falha de conexão com a API ({api_err}). Fallback de simulação local.")
+                        api_error = str(api_err)
+                    if raise_on_error:
+                        WhatsAppService.invalidate_connection_state(empresa)
+                        raise WhatsAppSendError(api_error)
             
             # Fallback
             logger.info("=========================================")
@@ -317,6 +306,8 @@ class WhatsAppService:
                 f.write(f"[{empresa.razao_social}] Para: {cleaned_phone} | Arquivo: {file_name} | Msg: {clean_msg}\n")
 
             return True
+        except WhatsAppSendError:
+            raise
         except Exception as e:
             logger.error(f"Erro ao disparar documento WhatsApp: {e}", exc_info=True)
             return False
@@ -407,15 +398,37 @@ class WhatsAppService:
         return WhatsAppService.send_message(empresa, cliente_phone, message)
 
     @staticmethod
-    def get_connection_state(empresa: Empresa) -> Dict[str, Any]:
+    def get_connection_state(empresa: Empresa, use_cache: bool = False) -> Dict[str, Any]:
         """
         Consulta o status de conexão da instância do WhatsApp na Evolution API.
         Retorna {"connected": True/False, "state": "open"/"close"/etc.}
+
+        Com use_cache, reaproveita a última consulta da instância por até
+        WHATSAPP_CONN_STATE_TTL segundos (usado nos envios da fila).
         """
+        key = (WhatsAppService._get_api_url(empresa), WhatsAppService._instance_name(empresa))
+        if use_cache:
+            cached = _conn_state_cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+        state = WhatsAppService._fetch_connection_state(empresa)
+        if WHATSAPP_CONN_STATE_TTL > 0:
+            with _conn_state_lock:
+                _conn_state_cache[key] = (time.monotonic() + WHATSAPP_CONN_STATE_TTL, state)
+        return state
+
+    @staticmethod
+    def invalidate_connection_state(empresa: Empresa) -> None:
+        key = (WhatsAppService._get_api_url(empresa), WhatsAppService._instance_name(empresa))
+        with _conn_state_lock:
+            _conn_state_cache.pop(key, None)
+
+    @staticmethod
+    def _fetch_connection_state(empresa: Empresa) -> Dict[str, Any]:
         try:
             api_url = WhatsAppService._get_api_url(empresa)
             api_key = os.getenv("EVOLUTION_API_TOKEN", "brazcom_secure_token_12345")
-            instance_name = getattr(empresa, 'whatsapp_api_instance', 'mega-net-telecom') or 'mega-net-telecom'
+            instance_name = WhatsAppService._instance_name(empresa)
 
             if not api_url:
                 return {"connected": False, "state": "offline", "message": "API URL não configurada"}
@@ -443,10 +456,12 @@ class WhatsAppService:
         """
         Cria/conecta a instância na Evolution API e retorna o QR Code em base64.
         """
+        # O estado da instância muda: a próxima consulta dos envios vai à API
+        WhatsAppService.invalidate_connection_state(empresa)
         try:
             api_url = WhatsAppService._get_api_url(empresa)
             api_key = os.getenv("EVOLUTION_API_TOKEN", "brazcom_secure_token_12345")
-            instance_name = getattr(empresa, 'whatsapp_api_instance', 'mega-net-telecom') or 'mega-net-telecom'
+            instance_name = WhatsAppService._instance_name(empresa)
 
             if not api_url:
                 return {"success": False, "message": "API URL não configurada"}
@@ -503,10 +518,12 @@ class WhatsAppService:
         """
         Desconecta, faz logout e exclui a instância do WhatsApp na Evolution API.
         """
+        # O estado da instância muda: a próxima consulta dos envios vai à API
+        WhatsAppService.invalidate_connection_state(empresa)
         try:
             api_url = WhatsAppService._get_api_url(empresa)
             api_key = os.getenv("EVOLUTION_API_TOKEN", "brazcom_secure_token_12345")
-            instance_name = getattr(empresa, 'whatsapp_api_instance', 'mega-net-telecom') or 'mega-net-telecom'
+            instance_name = WhatsAppService._instance_name(empresa)
 
             if not api_url:
                 return False
@@ -6,9 +6,10 @@ from datetime import datetime, timezone, timedelta
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app.core.database import SessionLocal
-from app.models.models import Empresa, Cliente, Receivable, ServicoContratado, StatusContrato, EmpresaCliente
-from app.services.isp_service import process_block_if_needed, process_unblock_if_needed, process_cancel_if_needed
-from sqlalchemy import or_
+from app.models.models import Empresa, Cliente, Receivable, ServicoContratado, StatusContrato, EmpresaCliente, Router
+from app.services.isp_service import run_router_actions, ACAO_BLOQUEIO, ACAO_DESBLOQUEIO, ACAO_CANCELAMENTO
+from collections import defaultdict
+from sqlalchemy import or_, func
 from sqlalchemy import select as sa_select
 
 def run_auto_blocking():
@@ -17,6 +18,7 @@ def run_auto_blocking():
     parser.add_argument("--company", type=int, help="ID da empresa para processar especificamente")
     parser.add_argument("--notifications-only", action="store_true", help="Executa apenas o envio de notificações pendentes")
     parser.add_argument("--test-emission", action="store_true", help="Testa apenas a geração (emissão) de cobranças, sem registrar em banco, sem notificar e sem bloquear")
+    parser.add_argument("--reconcile-address-lists", action="store_true", help="Após bloquear/desbloquear, reconcilia por completo a address-list pg_corte de cada roteador da empresa")
     args, unknown = parser.parse_known_args()
 
     print("=============================================================")
@@ -78,7 +80,6 @@ def run_auto_blocking():
                     if pending_receivables:
                         print(f"  [AUTO-NOTIFICATIONS] Found {len(pending_receivables)} pending receivables to notify.")
                         
-                        from collections import defaultdict
                         from app.services.receivable_service import send_carne_notification
 
                         # Agrupar por contrato
@@ -134,7 +135,6 @@ def run_auto_blocking():
                         # Exemplo: tolerância=1, hoje=05-21 → target=05-21 (bloqueia amanhã 05-22)
                         # Exemplo: tolerância=15, hoje=05-21 → target=05-07 (bloqueia amanhã 05-22)
                         target_due_date = today - timedelta(days=dias_limite - 1)
-                        from sqlalchemy import func
                         last_day_receivables = session.query(Receivable).filter(
                             Receivable.empresa_id == company.id,
                             Receivable.status.in_(['PENDING', 'REGISTERED', 'PENDING_REMITTANCE', 'REMITTED']),
@@ -187,20 +187,18 @@ def run_auto_blocking():
                     if not args.test_emission:
                         import asyncio
                         from app.services.billing_service import BillingService
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                        for r in created_recv:
-                            if r.bank_account_id and r.tipo != 'MERCADO_PAGO':
-                                try:
-                                    print(f"  [AUTO-BILLING] Attempting to register receivable {r.id} via bank API...")
-                                    success = loop.run_until_complete(BillingService.register_receivable_with_bank(session, r))
-                                    if success:
+                        to_register = [r for r in created_recv if r.bank_account_id and r.tipo != 'MERCADO_PAGO']
+                        if to_register:
+                            print(f"  [AUTO-BILLING] Registering {len(to_register)} receivable(s) via bank API...")
+                            try:
+                                registered = asyncio.run(BillingService.register_receivables_bulk(session, to_register))
+                                for r in to_register:
+                                    if registered.get(r.id):
                                         print(f"  [AUTO-BILLING] Registered receivable {r.id} successfully.")
                                     else:
                                         print(f"  [AUTO-BILLING] Failed to register receivable {r.id}.")
-                                except Exception as api_err:
-                                    print(f"  [AUTO-BILLING] API Error for receivable {r.id}: {api_err}")
-                        loop.close()
+                            except Exception as api_err:
+                                print(f"  [AUTO-BILLING] API Error while registering receivables: {api_err}")
                     else:
                         print(f"  [AUTO-BILLING] --test-emission active: Skipped bank API registration.")
                     
@@ -326,102 +324,117 @@ def run_auto_blocking():
                 .where(EmpresaCliente.empresa_id == company.id)
                 .scalar_subquery()
             )
-            clients = session.query(Cliente).filter(
+            active_clients = dict(session.query(Cliente.id, Cliente.nome_razao_social).filter(
                 Cliente.is_active == True,
                 or_(
                     Cliente.id.in_(subquery),            # novo modelo (EmpresaCliente)
                     Cliente.empresa_id == company.id     # legado (empresa_id direto)
                 )
-            ).all()
+            ).all())
             
             limit_date = now - timedelta(days=dias_limite)
             dias_cancelamento = getattr(company, "dias_cancelamento_inadimplentes", 90) or 90
+            limit_cancel_date = now - timedelta(days=dias_cancelamento)
+            
+            # Uma única consulta agregada: títulos em aberto vencidos há mais de dias_limite por cliente
+            # (quantidade + vencimento mais antigo, usado para decidir o cancelamento)
+            overdue_by_client = {
+                cliente_id: (count, oldest_due)
+                for cliente_id, count, oldest_due in session.query(
+                    Receivable.cliente_id,
+                    func.count(Receivable.id),
+                    func.min(Receivable.due_date)
+                ).filter(
+                    Receivable.empresa_id == company.id,
+                    Receivable.status.in_(['PENDING', 'REGISTERED', 'PENDING_REMITTANCE', 'REMITTED']),
+                    Receivable.due_date <= limit_date
+                ).group_by(Receivable.cliente_id).all()
+                if cliente_id in active_clients
+            }
+            
+            # Todos os contratos não cancelados da empresa carregados de uma vez, agrupados por cliente
+            contracts_by_client = defaultdict(list)
+            for contract_id, cliente_id, status in session.query(
+                ServicoContratado.id,
+                ServicoContratado.cliente_id,
+                ServicoContratado.status
+            ).filter(
+                ServicoContratado.empresa_id == company.id,
+                ServicoContratado.status != StatusContrato.CANCELADO
+            ).order_by(ServicoContratado.id).all():
+                if cliente_id in active_clients:
+                    contracts_by_client[cliente_id].append((contract_id, status))
+            
+            print(f"  [AUTO-BLOCK] {len(active_clients)} active clients, {len(overdue_by_client)} with overdue receivables.")
             
             company_blocked = 0
             company_unblocked = 0
             company_cancelled = 0
             
-            for client in clients:
-                # Find any unpaid/pending receivable overdue by more than dias_limite days
-                overdue_receivables = session.query(Receivable).filter(
-                    Receivable.cliente_id == client.id,
-                    Receivable.empresa_id == company.id,
-                    Receivable.status.in_(['PENDING', 'REGISTERED', 'PENDING_REMITTANCE', 'REMITTED']),
-                    Receivable.due_date <= limit_date
-                ).order_by(Receivable.due_date.asc()).all()
+            # Classifica cada cliente e monta a lista de ações; a execução nos roteadores
+            # é feita em lote (agrupada por router_id e em paralelo entre roteadores)
+            actions = []
+            for client_id, contracts in contracts_by_client.items():
+                client_name = active_clients[client_id]
+                overdue = overdue_by_client.get(client_id)
                 
-                should_be_blocked = len(overdue_receivables) > 0
-                should_be_cancelled = False
-                
-                if should_be_blocked and dias_cancelamento:
-                    limit_cancel_date = now - timedelta(days=dias_cancelamento)
-                    # Se a dívida MAIS ANTIGA for anterior à data limite de cancelamento, então cancela
-                    oldest_receivable = overdue_receivables[0]
-                    if oldest_receivable.due_date <= limit_cancel_date:
-                        should_be_cancelled = True
-                
-                if should_be_cancelled:
-                    # Find all contracts that are not cancelled
-                    contracts = session.query(ServicoContratado).filter(
-                        ServicoContratado.cliente_id == client.id,
-                        ServicoContratado.empresa_id == company.id,
-                        ServicoContratado.status != StatusContrato.CANCELADO
-                    ).all()
-                    
-                    if contracts:
-                        print(f"    -> Client '{client.nome_razao_social}' (ID: {client.id}) has unpaid bills older than {dias_cancelamento} days. Cancelling...")
-                        for contract in contracts:
-                            print(f"       Cancelling contract #{contract.id} (Current status: {contract.status})...")
-                            success = process_cancel_if_needed(session, contract.id)
-                            if success:
-                                print(f"       [SUCCESS] Contract #{contract.id} cancelled successfully.")
-                                company_cancelled += 1
-                                db_changed = True
-                            else:
-                                print(f"       [FAILED] Could not cancel contract #{contract.id}.")
+                # Se a dívida MAIS ANTIGA for anterior à data limite de cancelamento, então cancela
+                if overdue and overdue[1] <= limit_cancel_date:
+                    print(f"    -> Client '{client_name}' (ID: {client_id}) has unpaid bills older than {dias_cancelamento} days. Cancelling...")
+                    for contract_id, status in contracts:
+                        print(f"       Cancelling contract #{contract_id} (Current status: {status})...")
+                        actions.append((ACAO_CANCELAMENTO, contract_id))
                                 
-                elif should_be_blocked:
-                    # Find all active or non-suspended/non-cancelled contracts for the client
-                    contracts = session.query(ServicoContratado).filter(
-                        ServicoContratado.cliente_id == client.id,
-                        ServicoContratado.empresa_id == company.id,
-                        ServicoContratado.status != StatusContrato.SUSPENSO,
-                        ServicoContratado.status != StatusContrato.CANCELADO
-                    ).all()
-                    
-                    if contracts:
-                        print(f"    -> Client '{client.nome_razao_social}' (ID: {client.id}) has {len(overdue_receivables)} overdue receivables.")
-                        for contract in contracts:
-                            print(f"       Suspending contract #{contract.id} (Current status: {contract.status})...")
-                            success = process_block_if_needed(session, contract.id)
-                            if success:
-                                print(f"       [SUCCESS] Contract #{contract.id} suspended successfully.")
-                                company_blocked += 1
-                                total_blocked += 1
-                                db_changed = True
-                            else:
-                                print(f"       [FAILED] Could not suspend contract #{contract.id}.")
+                elif overdue:
+                    # Suspender os contratos ainda não suspensos
+                    to_block = [(cid, st) for cid, st in contracts if st != StatusContrato.SUSPENSO]
+                    if to_block:
+                        print(f"    -> Client '{client_name}' (ID: {client_id}) has {overdue[0]} overdue receivables.")
+                    for contract_id, status in to_block:
+                        print(f"       Suspending contract #{contract_id} (Current status: {status})...")
+                        actions.append((ACAO_BLOQUEIO, contract_id))
                                 
                 else:
-                    # Client is up-to-date. Check if they have any suspended contracts that need to be unblocked
-                    suspended_contracts = session.query(ServicoContratado).filter(
-                        ServicoContratado.cliente_id == client.id,
-                        ServicoContratado.empresa_id == company.id,
-                        ServicoContratado.status == StatusContrato.SUSPENSO
-                    ).all()
-                    
-                    if suspended_contracts:
-                        print(f"    -> Client '{client.nome_razao_social}' (ID: {client.id}) is up-to-date.")
-                        for contract in suspended_contracts:
-                            print(f"       Activating contract #{contract.id} (Current status: {contract.status})...")
-                            success = process_unblock_if_needed(session, contract.id)
-                            if success:
-                                print(f"       [SUCCESS] Contract #{contract.id} reactivated successfully.")
-                                company_unblocked += 1
-                                total_unblocked += 1
-                                db_changed = True
-                            else:
-                                print(f"       [FAILED] Could not reactivate contract #{contract.id}.")
+                    # Client is up-to-date. Reactivate any suspended contracts
+                    to_unblock = [(cid, st) for cid, st in contracts if st == StatusContrato.SUSPENSO]
+                    if to_unblock:
+                        print(f"    -> Client '{client_name}' (ID: {client_id}) is up-to-date.")
+                    for contract_id, status in to_unblock:
+                        print(f"       Activating contract #{contract_id} (Current status: {status})...")
+                        actions.append((ACAO_DESBLOQUEIO, contract_id))
+            
+            reconcile_router_ids = []
+            if args.reconcile_address_lists:
+                reconcile_router_ids = [r_id for (r_id,) in session.query(Router.id).filter(Router.empresa_id == company.id).all()]
+                print(f"  [AUTO-BLOCK] Full pg_corte reconcile enabled for {len(reconcile_router_ids)} router(s).")
+            
+            if actions or reconcile_router_ids:
+                print(f"  [AUTO-BLOCK] Executing {len(actions)} contract actions on routers...")
+                results = run_router_actions(session, actions, reconcile_router_ids=reconcile_router_ids)
+                for action, contract_id in actions:
+                    success = results.get(contract_id, False)
+                    if action == ACAO_CANCELAMENTO:
+                        if success:
+                            print(f"       [SUCCESS] Contract #{contract_id} cancelled successfully.")
+                            company_cancelled += 1
+                        else:
+                            print(f"       [FAILED] Could not cancel contract #{contract_id}.")
+                    elif action == ACAO_BLOQUEIO:
+                        if success:
+                            print(f"       [SUCCESS] Contract #{contract_id} suspended successfully.")
+                            company_blocked += 1
+                            total_blocked += 1
+                        else:
+                            print(f"       [FAILED] Could not suspend contract #{contract_id}.")
+                    else:
+                        if success:
+                            print(f"       [SUCCESS] Contract #{contract_id} reactivated successfully.")
+                            company_unblocked += 1
+                            total_unblocked += 1
+                        else:
+                            print(f"       [FAILED] Could not reactivate contract #{contract_id}.")
+                    if success:
+                        db_changed = True
             
             print(f"  [AUTO-BLOCK] Summary for {company.nome_fantasia or company.razao_social}: {company_cancelled} contracts cancelled, {company_blocked} contracts suspended, {company_unblocked} contracts reactivated.")
             company_summaries.append({
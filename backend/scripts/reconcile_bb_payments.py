@@ -37,12 +37,13 @@ logger = logging.getLogger(__name__)
 def run(company_id=None, days_back=60, dry_run=False):
     from app.core.database import SessionLocal
     from app.models.models import Receivable, BankAccount, Empresa
-    from app.services import bb_api_service, isp_service
+    from app.services import bb_api_service, unblock_dispatcher
 
     session = SessionLocal()
     total_checked = 0
     total_updated = 0
     total_errors = 0
+    contratos_pagos = set()
 
     try:
         cutoff_date = datetime.now() - timedelta(days=days_back)
@@ -159,11 +160,7 @@ def run(company_id=None, days_back=60, dry_run=False):
                                     except (ValueError, TypeError):
                                         pass
                                 if r.servico_contratado_id:
-                                    try:
-                                        isp_service.process_unblock_if_needed(session, r.servico_contratado_id)
-                                        logger.info(f"    Contrato #{r.servico_contratado_id} desbloqueado.")
-                                    except Exception as e:
-                                        logger.error(f"    Erro ao desbloquear contrato: {e}")
+                                    contratos_pagos.add(r.servico_contratado_id)
 
                             session.add(r)
                             total_updated += 1
@@ -178,6 +175,10 @@ def run(company_id=None, days_back=60, dry_run=False):
         if not dry_run and total_updated > 0:
             session.commit()
             logger.info(f"\nAlterações salvas com sucesso.")
+            # Desbloqueio aplicado pelo worker da API (fila unblock_outbox)
+            agendados = unblock_dispatcher.enqueue(contratos_pagos)
+            if agendados:
+                logger.info(f"Desbloqueio agendado para {agendados} contrato(s).")
 
     except Exception as e:
         session.rollback()
@@ -0,0 +1,59 @@
+import importlib
+import pkgutil
+from datetime import date, datetime
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+import app.models
+from app.core.database import Base
+
+# Registra todos os modelos no metadata antes do create_all
+for _mod in pkgutil.iter_modules(app.models.__path__):
+    importlib.import_module(f"app.models.{_mod.name}")
+
+
+@pytest.fixture
+def db():
+    """Session sobre um SQLite em memória com todas as tabelas."""
+    engine = sa.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine, autoflush=False)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def _placeholder(column):
+    if isinstance(column.type, sa.Enum):
+        return column.type.enums[0]
+    python_type = column.type.python_type
+    if python_type is bool:
+        return False
+    if python_type is int:
+        return 1
+    if python_type is float:
+        return 1.0
+    if python_type is datetime:
+        return datetime(2025, 1, 1)
+    if python_type is date:
+        return date(2025, 1, 1)
+    return "x"
+
+
+@pytest.fixture
+def insert_row(db):
+    """Insere uma linha preenchendo as colunas obrigatórias não informadas."""
+    def _insert(model, **values):
+        for column in model.__table__.columns:
+            if column.name in values or column.nullable or column.primary_key:
+                continue
+            if column.default is None and column.server_default is None:
+                values[column.name] = _placeholder(column)
+        db.execute(sa.insert(model.__table__).values(**values))
+        db.commit()
+        return db.get(model, values["id"]) if "id" in values else None
+    return _insert
@@ -0,0 +1,97 @@
+import io
+from datetime import date, datetime
+
+import pytest
+
+from app.services import cnab_retorno
+from app.services.cnab_retorno import BAIXADO, PAGO, REJEITADO, parse_retorno
+
+
+AGORA = datetime(2026, 1, 20, 10, 0)
+
+
+def _line(size, **fields):
+    """Linha de `size` posições com os campos {posição inicial (base 0): texto}."""
+    chars = [' '] * size
+    for pos, text in fields.items():
+        start = int(pos[1:])
+        chars[start:start + len(text)] = text
+    return ''.join(chars)
+
+
+def _retorno_240(*titulos):
+    lines = [_line(240, p0='0010000')]
+    for codigo, nosso_numero, valor, pago in titulos:
+        lines.append(_line(240, p7='3', p13='T', p15=codigo, p37=nosso_numero.ljust(20),
+                           p81=valor.zfill(15), p213='A1'))
+        lines.append(_line(240, p7='3', p13='U', p77=pago.zfill(15), p137='15012026', p145='16012026'))
+    lines.append(_line(240, p7='9'))
+    return io.BytesIO(('\r\n'.join(lines) + '\r\n').encode('latin-1'))
+
+
+def _retorno_400(*titulos):
+    lines = [_line(400, p0='02RETORNO')]
+    for codigo, nosso_numero, valor, pago in titulos:
+        lines.append(_line(400, p0='1', p47=nosso_numero.ljust(15), p108=codigo, p110='150126',
+                           p152=valor.zfill(13), p253=pago.zfill(13), p318='A1'))
+    lines.append(_line(400, p0='9'))
+    return io.StringIO('\n'.join(lines) + '\n')
+
+
+@pytest.mark.parametrize('retorno', [_retorno_240, _retorno_400])
+def test_parse_retorno_acoes(retorno):
+    ocorrencias = list(parse_retorno(retorno(
+        ('06', '0000000123', '10000', '10150'),
+        ('09', '0000000124', '5000', '0'),
+        ('03', '0000000125', '5000', '0'),
+        ('99', '0000000126', '5000', '0'),
+    )))
+
+    assert [oc['acao'] for oc in ocorrencias] == [PAGO, BAIXADO, REJEITADO, None]
+    pago = ocorrencias[0]
+    assert pago['nosso_numero'] == '0000000123'
+    assert pago['valor_titulo'] == 100.0
+    assert pago['valor_pago'] == 101.5
+    assert pago['data_ocorrencia'] == date(2026, 1, 15)
+    assert ocorrencias[2]['motivo'] == 'A1'
+
+
+@pytest.mark.parametrize('retorno', [_retorno_240, _retorno_400])
+def test_changes_por_acao(retorno):
+    pago, baixado, rejeitado = parse_retorno(retorno(
+        ('06', '1', '10000', '10150'),
+        ('09', '2', '5000', '0'),
+        ('03', '3', '5000', '0'),
+    ))
+
+    liquidacao = cnab_retorno._changes('REGISTERED', 100.0, pago, AGORA)
+    assert liquidacao == {'status': 'PAID', 'paid_at': datetime(2026, 1, 15), 'paid_amount': 101.5}
+    assert cnab_retorno._changes('REGISTERED', 50.0, baixado, AGORA)['status'] == 'CANCELLED'
+    falha = cnab_retorno._changes('REMITTED', 50.0, rejeitado, AGORA)
+    assert falha['status'] == 'REGISTRATION_FAILED'
+    assert 'motivo A1' in falha['registro_result']
+
+    # Reprocessar o arquivo não altera cobranças já no status final
+    assert cnab_retorno._changes('PAID', 100.0, pago, AGORA) is None
+    assert cnab_retorno._changes('PAID', 50.0, baixado, AGORA) is None
+    assert cnab_retorno._changes('CANCELLED', 50.0, rejeitado, AGORA) is None
+
+
+def test_parse_retorno_vazio():
+    with pytest.raises(ValueError, match='vazio'):
+        parse_retorno(io.BytesIO(b'\r\n   \r\n'))
+
+
+def test_parse_retorno_layout_invalido():
+    with pytest.raises(ValueError, match='inválido'):
+        parse_retorno(io.StringIO('HEADER CURTO\n'))
+
+
+def test_parse_retorno_ignora_linhas_truncadas():
+    retorno = _retorno_240(('06', '1', '10000', '10000'))
+    lines = retorno.getvalue().decode('latin-1').split('\r\n')
+    lines.insert(1, lines[1][:120])  # segmento T truncado
+    ocorrencias = list(parse_retorno(io.StringIO('\n'.join(lines))))
+
+    assert len(ocorrencias) == 1
+    assert ocorrencias[0]['acao'] == PAGO
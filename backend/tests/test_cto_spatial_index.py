@@ -0,0 +1,62 @@
+import random
+
+from app.services.cto_spatial_index import CTOSpatialIndex, _distance_m
+
+
+def _pontos(n=3000):
+    rnd = random.Random(7)
+    return [
+        (i, -23.5 + rnd.uniform(-0.3, 0.3), -46.6 + rnd.uniform(-0.3, 0.3), i % 4 or None)
+        for i in range(1, n + 1)
+    ]
+
+
+def test_nearest_matches_brute_force():
+    pontos = _pontos()
+    index = CTOSpatialIndex(pontos)
+    for lat, lng in [(-23.5, -46.6), (-23.79, -46.31), (-20.0, -40.0)]:
+        esperado = sorted(pontos, key=lambda p: _distance_m(lat, lng, p[1], p[2]))
+        assert [i for i, _ in index.nearest(lat, lng, 25)] == [p[0] for p in esperado[:25]]
+
+    so_olt_1 = index.nearest(-23.5, -46.6, 10, accept=lambda _id, olt_id: olt_id == 1)
+    assert len(so_olt_1) == 10 and all(i % 4 == 1 for i, _ in so_olt_1)
+
+
+def test_within_radius():
+    pontos = _pontos()
+    index = CTOSpatialIndex(pontos)
+    dentro = index.within(-23.5, -46.6, 2000)
+    esperado = {p[0] for p in pontos if _distance_m(-23.5, -46.6, p[1], p[2]) <= 2000}
+    assert {i for i, _ in dentro} == esperado
+    assert [d for _, d in dentro] == sorted(d for _, d in dentro)
+
+
+def test_list_ctos_por_proximidade_com_filtros(db, insert_row, monkeypatch):
+    from app.models.ftth import CTO, OLT
+    from app.models.models import Empresa
+    from app.services import cto_spatial_index, ftth_monitor_service
+    from app.services.ftth_monitor_service import FTTHMonitorService
+
+    insert_row(Empresa, id=1, cnpj='1')
+    insert_row(OLT, id=1, empresa_id=1, nome='OLT Norte')
+    insert_row(OLT, id=2, empresa_id=1, nome='OLT Sul')
+    for i in range(1, 61):
+        nome = f'CTO-{"A" if i % 3 == 0 else "B"}-{i:02d}'
+        insert_row(CTO, id=i, empresa_id=1, nome=nome, olt_id=1 if i % 2 else 2,
+                   latitude=-23.5 + i * 0.001, longitude=-46.6)
+    # Sem coordenadas: vem depois das georreferenciadas
+    insert_row(CTO, id=61, empresa_id=1, nome='CTO-A-sem-gps', olt_id=2)
+    cto_spatial_index.invalidate(1)
+    # Blocos pequenos para exercitar a conferência incremental da busca
+    monkeypatch.setattr(ftth_monitor_service, 'CTO_SEARCH_CHUNK', 4)
+
+    def _ids(**kwargs):
+        ctos, total = FTTHMonitorService.list_ctos(db, 1, proximidade_gps='-23.5,-46.6', **kwargs)
+        return [c.id for c in ctos], total
+
+    assert _ids(olt_id=1, limit=3) == ([1, 3, 5], 30)
+    assert _ids(search='A', skip=2, limit=3) == ([9, 12, 15], 21)
+    assert _ids(olt_id=2, search='A', skip=8, limit=5) == ([54, 60, 61], 11)
+    assert _ids(olt_id=2, search='A', raio_metros=2500) == ([6, 12, 18], 3)
+    assert _ids(olt_id=1, search='Norte', limit=2) == ([1, 3], 30)
+    cto_spatial_index.invalidate(1)
@@ -0,0 +1,63 @@
+import itertools
+from datetime import datetime
+
+import pytest
+from sqlalchemy import insert, update
+
+from app.models.models import Receivable
+from app.services import dashboard_service
+from app.services.dashboard_service import DashboardService
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    """compute_stats fake: cada execução retorna um número novo."""
+    dashboard_service._cache.clear()
+    contador = itertools.count(1)
+    monkeypatch.setattr(DashboardService, "compute_stats", staticmethod(lambda db, empresa_id: next(contador)))
+    yield
+    dashboard_service._cache.clear()
+
+
+def _cached():
+    return set(dashboard_service._cache)
+
+
+def test_nao_grava_estatistica_invalidada_durante_o_calculo(db, monkeypatch):
+    dashboard_service._cache.clear()
+
+    def _compute(db, empresa_id):
+        # Pagamento confirmado por outra requisição enquanto as consultas rodavam
+        DashboardService.invalidate(empresa_id)
+        return {"antigo": True}
+    monkeypatch.setattr(DashboardService, "compute_stats", staticmethod(_compute))
+
+    assert DashboardService.get_stats(db, 1) == {"antigo": True}
+    assert _cached() == set()
+
+
+@pytest.mark.parametrize("statement, params", [
+    (update(Receivable).where(Receivable.empresa_id == 1, Receivable.status == 'PENDING').values(status='PAID'), None),
+    (update(Receivable).where(Receivable.empresa_id.in_([1])).values(status='PAID'), None),
+    (insert(Receivable), [{"empresa_id": 1, "cliente_id": 1, "due_date": datetime(2025, 1, 1), "amount": 1.0}]),
+])
+def test_comando_em_massa_invalida_so_a_empresa_filtrada(db, stats, statement, params):
+    DashboardService.get_stats(db, 1)
+    DashboardService.get_stats(db, 2)
+
+    db.execute(statement, params)
+    assert _cached() == {1, 2}
+    db.commit()
+
+    assert _cached() == {2}
+    assert DashboardService.get_stats(db, 1) == 3
+
+
+def test_comando_em_massa_sem_empresa_invalida_todas(db, stats):
+    DashboardService.get_stats(db, 1)
+    DashboardService.get_stats(db, 2)
+
+    db.query(Receivable).filter(Receivable.status == 'PENDING').update({Receivable.status: 'CANCELLED'})
+    db.commit()
+
+    assert _cached() == set()
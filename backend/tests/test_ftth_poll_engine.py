@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+from app.services.ftth_poll_engine import FTTHPollEngine
+
+
+class FakePromise:
+    def __init__(self, ip, ready_at):
+        self.ip = ip
+        self.ready_at = ready_at
+
+    def get(self):
+        delay = self.ready_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if self.ip.endswith('.99'):
+            return [{'status': 'timeout'}]
+        return [{'received': '1', 'time': '2ms'}]
+
+
+class FakeRoot:
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def call_async(self, command, arguments):
+        assert command == 'ping'
+        with self.ctrl.lock:
+            self.ctrl.inflight += 1
+            self.ctrl.max_inflight = max(self.ctrl.max_inflight, self.ctrl.inflight)
+        return FakePromise(arguments['address'], time.monotonic() + 0.05)
+
+
+class FakeCtrl:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.max_inflight = 0
+        self._librouteros_api = None
+        self._api = SimpleNamespace(get_resource=lambda path: FakeRoot(self))
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_router_pings_are_pipelined(monkeypatch):
+    ctrls = []
+
+    def _open_session(router):
+        ctrl = FakeCtrl()
+        ctrls.append(ctrl)
+        return ctrl
+
+    async def _tcp_check(host, port, timeout=3.0):
+        return True
+
+    monkeypatch.setattr(FTTHPollEngine, '_open_session', staticmethod(_open_session))
+    monkeypatch.setattr(FTTHPollEngine, '_tcp_check', staticmethod(_tcp_check))
+
+    router = SimpleNamespace(id=1, nome='rb1', ip='10.0.0.1', porta=8728)
+    alvos = [{'contrato_id': i, 'empresa_id': 1, 'ip': f'100.64.0.{i}'} for i in range(1, 100)]
+    resumo = {'routers': []}
+
+    engine = FTTHPollEngine(sessions_per_router=2, max_inflight_per_router=40)
+    inicio = time.monotonic()
+    resultados = asyncio.run(engine._poll_async({1: router}, {1: alvos}, [], resumo))
+    elapsed = time.monotonic() - inicio
+
+    assert len(ctrls) == 2 and all(c.closed for c in ctrls)
+    assert max(c.max_inflight for c in ctrls) > 1
+    # 99 pings de 50ms em série levariam ~5s
+    assert elapsed < 2.0
+    por_contrato = {r['contrato_id']: r for r in resultados}
+    assert len(por_contrato) == 99
+    assert por_contrato[1]['status'] == 'ONLINE' and por_contrato[1]['latencia_ms'] == 2.0
+    assert por_contrato[99]['status'] == 'OFFLINE'
+    assert resumo['routers'][0]['onus'] == 99 and resumo['routers'][0]['erro'] is None
+
+
+def test_unreachable_router_marks_onus_offline(monkeypatch):
+    async def _tcp_check(host, port, timeout=3.0):
+        return False
+
+    monkeypatch.setattr(FTTHPollEngine, '_tcp_check', staticmethod(_tcp_check))
+
+    router = SimpleNamespace(id=2, nome='rb2', ip='10.0.0.2', porta=None)
+    alvos = [{'contrato_id': 1, 'empresa_id': 1, 'ip': '100.64.0.1'}]
+    resumo = {'routers': []}
+
+    resultados = asyncio.run(FTTHPollEngine()._poll_async({2: router}, {2: alvos}, [], resumo))
+
+    assert resultados[0]['status'] == 'OFFLINE'
+    assert 'inacessível' in resultados[0]['detalhe_erro']
+    assert 'inacessível' in resumo['routers'][0]['erro']
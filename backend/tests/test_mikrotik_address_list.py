@@ -0,0 +1,131 @@
+from types import SimpleNamespace
+
+from app.mikrotik.controller import MikrotikController
+
+
+class FakePromise:
+    def __init__(self, value=None):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class FakeAddressList:
+    def __init__(self, entries):
+        self.entries = entries
+        self.calls = []
+
+    def get(self, **kwargs):
+        self.calls.append(('print', kwargs))
+        return [e for e in self.entries if e['list'] == kwargs.get('list')]
+
+    def call_async(self, command, arguments=None):
+        self.calls.append((command, arguments))
+        return FakePromise([])
+
+
+def _controller(resource):
+    ctrl = MikrotikController('10.0.0.1', 'u', 'p', api_encoding='utf-8')
+    ctrl._api = SimpleNamespace(get_resource=lambda path: resource)
+    return ctrl
+
+
+def test_sync_address_list_applies_only_the_diff():
+    resource = FakeAddressList([
+        {'.id': '*1', 'list': 'pg_corte', 'address': '100.64.0.1', 'comment': '1-A'},
+        {'.id': '*2', 'list': 'pg_corte', 'address': '100.64.0.2/32', 'comment': '2-B'},
+        {'.id': '*3', 'list': 'pg_corte', 'address': '100.64.0.2', 'comment': '2-B'},
+        {'.id': '*4', 'list': 'pg_corte', 'address': '100.64.0.9', 'comment': 'old'},
+        {'.id': '*5', 'list': 'pg_corte', 'address': '100.64.0.8', 'dynamic': 'true'},
+        {'.id': '*6', 'list': 'outra', 'address': '100.64.0.7'},
+    ])
+    ctrl = _controller(resource)
+
+    result = ctrl.sync_address_list(
+        'pg_corte', {'100.64.0.1', '100.64.0.2', '100.64.0.3'},
+        comments={'100.64.0.1': '1-A-novo', '100.64.0.3': '3-C'}
+    )
+
+    assert [c for c in resource.calls if c[0] == 'print'] == [('print', {'list': 'pg_corte'})]
+    assert ('remove', {'.id': '*3,*4'}) in resource.calls
+    assert ('add', {'address': '100.64.0.3', 'list': 'pg_corte', 'comment': '3-C'}) in resource.calls
+    assert ('set', {'.id': '*1', 'comment': '1-A-novo'}) in resource.calls
+    assert result == {'added': 1, 'removed': 2, 'updated': 1, 'errors': 0, 'failed': []}
+
+
+def test_sync_address_list_incremental_keeps_other_entries():
+    resource = FakeAddressList([
+        {'.id': '*1', 'list': 'pg_corte', 'address': '100.64.0.1'},
+        {'.id': '*2', 'list': 'pg_corte', 'address': '100.64.0.2'},
+    ])
+    ctrl = _controller(resource)
+
+    result = ctrl.sync_address_list('pg_corte', {'100.64.0.3'}, remove_extra=False, absent_set={'100.64.0.2'})
+
+    assert ('remove', {'.id': '*2'}) in resource.calls
+    assert result['added'] == 1 and result['removed'] == 1
+
+
+def test_sync_address_list_full_reconcile_keeps_unmanaged_entries():
+    resource = FakeAddressList([
+        {'.id': '*1', 'list': 'pg_corte', 'address': '100.64.0.1', 'comment': '1-A'},
+        {'.id': '*2', 'list': 'pg_corte', 'address': '100.64.0.2', 'comment': 'manual'},
+    ])
+    ctrl = _controller(resource)
+
+    result = ctrl.sync_address_list(
+        'pg_corte', set(), removable=lambda e: e.get('comment', '').startswith('1-')
+    )
+
+    assert ('remove', {'.id': '*1'}) in resource.calls
+    assert result['removed'] == 1
+
+
+class FailingAddressList(FakeAddressList):
+    def call_async(self, command, arguments=None):
+        self.calls.append((command, arguments))
+        if command == 'add' and arguments['address'] == '100.64.0.4':
+            return SimpleNamespace(get=lambda: (_ for _ in ()).throw(RuntimeError('failure')))
+        return FakePromise([])
+
+
+def test_sync_address_list_reports_failed_addresses():
+    resource = FailingAddressList([{'.id': '*1', 'list': 'pg_corte', 'address': '100.64.0.1'}])
+    ctrl = _controller(resource)
+
+    result = ctrl.sync_address_list('pg_corte', {'100.64.0.3', '100.64.0.4'}, remove_extra=False)
+
+    assert result['added'] == 1 and result['errors'] == 1
+    assert result['failed'] == ['100.64.0.4']
+
+
+class FakeConnections:
+    def __init__(self, conns):
+        self.conns = conns
+        self.calls = []
+
+    def call(self, command, arguments=None):
+        self.calls.append((command, arguments))
+        return self.conns if command == 'print' else []
+
+
+class NoExecute:
+    def call(self, command, arguments=None):
+        raise RuntimeError('no such command')
+
+
+def test_kill_client_connections_fallback_matches_exact_host_in_batches():
+    conns = FakeConnections([
+        {'.id': '*1', 'src-address': '100.64.0.1:5000', 'dst-address': '8.8.8.8:53'},
+        {'.id': '*2', 'src-address': '100.64.0.10:5000', 'dst-address': '8.8.8.8:53'},
+        {'.id': '*3', 'src-address': '1.1.1.1', 'dst-address': '100.64.0.1'},
+    ])
+    ctrl = MikrotikController('10.0.0.1', 'u', 'p', api_encoding='utf-8')
+    ctrl._api = SimpleNamespace(get_resource=lambda path: NoExecute() if path == '/' else conns)
+
+    assert ctrl.kill_client_connections('100.64.0.1/32') is True
+    assert conns.calls == [
+        ('print', {'.proplist': '.id,src-address,dst-address'}),
+        ('remove', {'.id': '*1,*3'}),
+    ]
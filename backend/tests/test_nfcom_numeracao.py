@@ -0,0 +1,58 @@
+from app.crud import crud_nfcom
+from app.models.models import Cliente, Empresa, NFCom, NFComNumeracao, ServicoContratado
+
+
+def _ultimo(db):
+    return db.query(NFComNumeracao.ultimo_numero).filter_by(empresa_id=1, serie=1).scalar()
+
+
+def test_reserve_semeia_com_maior_numero_existente(db, insert_row):
+    insert_row(Empresa, id=1, cnpj='1')
+    insert_row(Cliente, id=1, empresa_id=1)
+    for numero in (3, 7):
+        insert_row(NFCom, empresa_id=1, cliente_id=1, numero_nf=numero, serie=1)
+
+    assert crud_nfcom.reserve_numeros_nf(db, empresa_id=1, serie=1, quantidade=5) == 8
+    db.commit()
+    assert _ultimo(db) == 12
+    assert crud_nfcom.reserve_numeros_nf(db, empresa_id=1, serie=1) == 13
+
+
+def test_release_devolve_final_nao_usado(db, insert_row):
+    insert_row(Empresa, id=1, cnpj='1')
+    primeiro = crud_nfcom.reserve_numeros_nf(db, empresa_id=1, serie=1, quantidade=10)
+    db.commit()
+
+    assert crud_nfcom.release_numeros_nf(db, 1, 1, reservado_ate=primeiro + 9, usado_ate=primeiro + 3)
+    db.commit()
+    assert _ultimo(db) == primeiro + 3
+    assert crud_nfcom.reserve_numeros_nf(db, empresa_id=1, serie=1) == primeiro + 4
+
+
+def test_release_nao_devolve_se_alguem_reservou_depois(db, insert_row):
+    insert_row(Empresa, id=1, cnpj='1')
+    primeiro = crud_nfcom.reserve_numeros_nf(db, empresa_id=1, serie=1, quantidade=10)
+    db.commit()
+    outro = crud_nfcom.reserve_numeros_nf(db, empresa_id=1, serie=1, quantidade=2)
+    db.commit()
+
+    assert not crud_nfcom.release_numeros_nf(db, 1, 1, reservado_ate=primeiro + 9, usado_ate=primeiro + 3)
+    db.commit()
+    assert _ultimo(db) == outro + 1
+
+
+def test_lote_reserva_so_contratos_emitiveis(db, insert_row):
+    insert_row(Empresa, id=1, cnpj='1')
+    insert_row(Cliente, id=1, empresa_id=1)
+    insert_row(ServicoContratado, id=1, empresa_id=1, cliente_id=1, servico_id=1, valor_unitario=100.0)
+    # Mesmo cliente e serviço do contrato 1: pulado no lote
+    insert_row(ServicoContratado, id=2, empresa_id=1, cliente_id=1, servico_id=1, valor_unitario=100.0)
+    # valor_unitario inválido
+    insert_row(ServicoContratado, id=3, empresa_id=1, cliente_id=1, servico_id=2, valor_unitario=0.0)
+    insert_row(ServicoContratado, id=4, empresa_id=1, cliente_id=1, servico_id=3, valor_unitario=50.0)
+
+    ctx = crud_nfcom._BulkEmitContext(db, 1, [1, 2, 3, 4, 99], execute=False)
+
+    assert ctx.count_emittable([1, 2, 3, 4, 99]) == 2
+    # A contagem não deixa registros de duplicidade para o laço de emissão
+    assert ctx.existing_nf(ctx.contratos[2]) is None
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from app.crud import crud_nfcom
+from app.models.models import Cliente, Empresa, NFCom
+
+
+def _ret_nfcom(cstat, motivo):
+    body = (
+        '<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope"><soap:Body>'
+        '<retNFCom xmlns="http://www.portalfiscal.inf.br/nfcom">'
+        f'<cStat>{cstat}</cStat><xMotivo>{motivo}</xMotivo></retNFCom>'
+        '</soap:Body></soap:Envelope>'
+    )
+    return SimpleNamespace(status_code=200, content=body.encode(), text=body, headers={})
+
+
+@pytest.fixture
+def nfcom(db, insert_row):
+    insert_row(Empresa, id=1, cnpj='1')
+    insert_row(Cliente, id=1, empresa_id=1, nome_razao_social='Cliente')
+
+    def _nfcom(**values):
+        return insert_row(NFCom, id=values.pop('id', 1), empresa_id=1, cliente_id=1, numero_nf=1, serie=1, **values)
+    return _nfcom
+
+
+@pytest.mark.parametrize('values', [
+    {'status': 'emitida', 'cstat': '100', 'protocolo_autorizacao': '123'},
+    {'status': 'cancelada', 'cstat': '135', 'protocolo_autorizacao': '123'},
+])
+def test_rejection_keeps_authorized_or_cancelled_status(db, nfcom, values):
+    db_nfcom = nfcom(**values)
+
+    resultado = crud_nfcom._process_sefaz_response(db, db_nfcom, _ret_nfcom('204', 'Duplicidade de NFCom'), '', '', None)
+
+    assert resultado['cStat'] == '204'
+    # Sem NFCOM_SIGN_DEBUG a resposta não é gravada em arquivo temporário
+    assert resultado['soap_response_file'] is None
+    db.refresh(db_nfcom)
+    assert (db_nfcom.status, db_nfcom.cstat) == (values['status'], values['cstat'])
+
+
+def test_rejection_records_cstat_on_pending_note(db, nfcom):
+    db_nfcom = nfcom(status='pendente')
+
+    crud_nfcom._process_sefaz_response(db, db_nfcom, _ret_nfcom('539', 'Rejeicao'), '', '', None)
+
+    db.refresh(db_nfcom)
+    assert (db_nfcom.status, db_nfcom.cstat) == ('pendente', '539')
+
+
+@pytest.mark.parametrize('values, message', [
+    ({'status': 'emitida', 'protocolo_autorizacao': '123'}, 'já autorizada'),
+    ({'status': 'cancelada', 'protocolo_autorizacao': '123'}, 'cancelada'),
+])
+def test_transmit_refuses_authorized_or_cancelled_note(db, nfcom, monkeypatch, values, message):
+    nfcom(**values)
+
+    def _fail(*args, **kwargs):
+        raise AssertionError('não deveria preparar a transmissão')
+    monkeypatch.setattr(crud_nfcom, '_prepare_transmission', _fail)
+
+    with pytest.raises(HTTPException) as exc:
+        crud_nfcom.transmit_nfcom(db, nfcom_id=1, empresa_id=1)
+    assert exc.value.status_code == 400
+    assert message in exc.value.detail
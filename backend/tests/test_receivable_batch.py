@@ -0,0 +1,63 @@
+from datetime import date, datetime
+
+import pytest
+
+from app.models.models import BankAccount, Cliente, Empresa, Receivable, ServicoContratado
+from app.services import receivable_service
+from app.services.receivable_service import _BillingBatch
+
+
+@pytest.fixture
+def empresa(db, insert_row):
+    insert_row(BankAccount, id=1, empresa_id=1, bank='SICOB', nosso_numero_sequence=10)
+    insert_row(Empresa, id=1, cnpj='1', default_bank_account_id=1)
+    for cliente_id in (1, 2):
+        insert_row(Cliente, id=cliente_id, empresa_id=1)
+    contrato = dict(empresa_id=1, servico_id=1, dia_emissao=5, dia_vencimento=10,
+                    d_contrato_ini=date(2025, 1, 1), valor_unitario=100.0, quantidade=1.0)
+    insert_row(ServicoContratado, id=1, cliente_id=1, periodicidade='SEMESTRAL', **contrato)
+    insert_row(ServicoContratado, id=2, cliente_id=2, periodicidade='MENSAL', **contrato)
+    # Março do contrato semestral já faturado em outra execução
+    insert_row(Receivable, id=100, empresa_id=1, cliente_id=1, servico_contratado_id=1,
+               issue_date=datetime(2024, 12, 1), due_date=datetime(2025, 3, 10), amount=100.0, nosso_numero='9')
+
+
+def _sequence(db):
+    db.expire_all()
+    return db.get(BankAccount, 1).nosso_numero_sequence
+
+
+def test_lote_semestral(db, empresa):
+    created = receivable_service.generate_receivables_for_company(db, 1, date(2025, 1, 5))
+    db.commit()
+
+    meses = [(r.servico_contratado_id, r.due_date.month) for r in created]
+    assert meses == [(1, 1), (1, 2), (1, 4), (1, 5), (1, 6), (2, 1)]
+    # Faixa contígua reservada em um único UPDATE, na ordem de geração
+    assert [r.nosso_numero for r in created] == [str(n) for n in range(10, 16)]
+    assert _sequence(db) == 16
+    # O recarregamento por issue_date traz exatamente as linhas inseridas
+    inseridas = {r.id for r in db.query(Receivable).filter(Receivable.id != 100)}
+    assert {r.id for r in created} == inseridas
+
+
+def test_mes_ja_faturado_nao_se_repete(db, empresa):
+    contrato = db.get(ServicoContratado, 1)
+    batch = _BillingBatch(db, 1, [contrato])
+    for _ in range(2):
+        # Duas passadas do carnê (ex.: execuções sobrepostas) no mesmo lote
+        for mes in range(1, 7):
+            batch.add(batch.build(contrato, date(2025, mes, 5)), contrato)
+
+    created = batch.persist()
+    db.commit()
+
+    assert [r.due_date.month for r in created] == [1, 2, 4, 5, 6]
+    assert _sequence(db) == 15
+
+    # Nova execução: todos os meses já têm cobrança
+    batch = _BillingBatch(db, 1, [contrato])
+    for mes in range(1, 7):
+        batch.add(batch.build(contrato, date(2025, mes, 5)), contrato)
+    assert batch.persist() == []
+    assert _sequence(db) == 15